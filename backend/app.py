@@ -1,39 +1,408 @@
-from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, make_response, g, send_file
 from flask_cors import CORS
 import requests
 import os
 from dotenv import load_dotenv
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 import mimetypes
 import time
 import tempfile
+import shutil
 import json
-from datetime import datetime, timedelta
+import re
+import hashlib
+import math
+import random
+import sys
+import functools
+import threading
+import queue
+import atexit
+import contextvars
+import sqlite3
+import uuid
+import zlib
+import heapq
+import itertools
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from json.decoder import scanstring as json_scanstring
 from typing import Dict, Optional
 
 # ➤ Google Gemini / File Search importieren
-from google import genai
-from google.genai import types
 
 # Carica variabili d'ambiente
 load_dotenv()
 
-# Configurazione logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# ==================== LOGGING ====================
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')           # text | json
+LOG_ASYNC = os.getenv('LOG_ASYNC', 'true').lower() == 'true'
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_MAX_FIELD_CHARS = int(os.getenv('LOG_MAX_FIELD_CHARS', '2000'))
+# Campionamento dei log INFO/DEBUG per route, es. "/api/chat/generate-stream=0.1,/api/documents=0.5";
+# WARNING ed ERROR vengono sempre scritti
+LOG_SAMPLE_RATES = {
+    route.strip(): float(rate)
+    for route, _, rate in (item.partition('=') for item in os.getenv('LOG_SAMPLE_RATES', '').split(','))
+    if route.strip() and rate.strip()
+}
+
+# (request_id, route, campionata) della richiesta corrente; i thread in background
+# la ereditano tramite contextvars.copy_context()
+LOG_CONTEXT_DEFAULT = ('-', '-', True)
+log_context = contextvars.ContextVar('log_context', default=LOG_CONTEXT_DEFAULT)
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+def truncate_for_log(value: str, limit: int = LOG_MAX_FIELD_CHARS) -> str:
+    if len(value) <= limit:
+        return value
+    return f"{value[:limit]}... [+{len(value) - limit} caratteri]"
+
+class LazyJson:
+    """Payload serializzato (e troncato) solo se il record viene davvero scritto"""
+    __slots__ = ('obj', 'limit')
+
+    def __init__(self, obj, limit: int = LOG_MAX_FIELD_CHARS):
+        self.obj = obj
+        self.limit = limit
+
+    def __str__(self):
+        return truncate_for_log(json.dumps(self.obj, ensure_ascii=False, default=str), self.limit)
+
+class RequestContextFilter(logging.Filter):
+    """Aggiunge request_id e route ai record e scarta INFO/DEBUG delle richieste non campionate"""
+    def filter(self, record):
+        request_id, route, sampled = log_context.get()
+        record.request_id = request_id
+        record.route = route
+        return sampled or record.levelno >= logging.WARNING
+
+class StructuredFormatter(logging.Formatter):
+    """Formato testo (come prima, con request id) o JSON su una riga; campi troncati a max_chars"""
+    STANDARD_ATTRS = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'request_id', 'route'}
+
+    def __init__(self, fmt_type: str = 'text', max_chars: int = LOG_MAX_FIELD_CHARS):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s')
+        self.fmt_type = fmt_type
+        self.max_chars = max_chars
+
+    def extra_fields(self, record) -> dict:
+        return {
+            key: value if isinstance(value, (int, float, bool)) or value is None else truncate_for_log(str(value), self.max_chars)
+            for key, value in record.__dict__.items() if key not in self.STANDARD_ATTRS
+        }
+
+    def format(self, record):
+        record.request_id = getattr(record, 'request_id', '-')
+        message = truncate_for_log(record.getMessage(), self.max_chars)
+        if self.fmt_type == 'json':
+            entry = {
+                'ts': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'request_id': record.request_id,
+                'route': getattr(record, 'route', '-'),
+                'msg': message,
+                **self.extra_fields(record),
+            }
+            if record.exc_info and not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            if record.exc_text:
+                entry['exc'] = truncate_for_log(record.exc_text, self.max_chars * 4)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        record.message = message
+        record.asctime = self.formatTime(record, self.datefmt)
+        line = self.formatMessage(record)
+        fields = self.extra_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Accoda i record senza formattarli: messaggio e I/O avvengono nel thread del QueueListener.
+    Con coda piena il record viene scartato (e contato) invece di bloccare la richiesta.
+    """
+    IMMUTABLE_ARGS = (str, int, float, bool, type(None), LazyJson)
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Argomenti mutabili (dict, list, ...) vanno congelati qui: il record viene letto più tardi
+        if record.args and not all(isinstance(arg, self.IMMUTABLE_ARGS) for arg in (
+                record.args.values() if isinstance(record.args, dict) else record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+log_listener: Optional[QueueListener] = None
+
+def stop_logging():
+    """Svuota la coda dei log e ferma il thread del listener (alla chiusura o riconfigurazione)"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+def configure_logging(level: str = LOG_LEVEL, fmt_type: str = LOG_FORMAT, async_mode: bool = LOG_ASYNC, stream=None):
+    """(Ri)configura il root logger: handler su stderr, sincrono o tramite coda e thread dedicato"""
+    global log_listener
+    stop_logging()
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(StructuredFormatter(fmt_type))
+    context_filter = RequestContextFilter()
+    if async_mode:
+        handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        log_listener = QueueListener(handler.queue, output, respect_handler_level=False)
+        log_listener.start()
+    else:
+        handler = output
+    handler.addFilter(context_filter)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+
+def restart_logging_after_fork():
+    """
+    Nel processo figlio (worker gunicorn con --preload) il thread del QueueListener del master non esiste:
+    nuova coda (quella ereditata può avere il lock preso al momento del fork) e nuovo listener
+    """
+    global log_listener
+    if log_listener is None:
+        return
+    outputs = log_listener.handlers
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, NonBlockingQueueHandler):
+            handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+            log_listener = QueueListener(handler.queue, *outputs, respect_handler_level=False)
+            log_listener.start()
+            return
+
+configure_logging()
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=restart_logging_after_fork)
 logger = logging.getLogger(__name__)
 
+# ==================== TRACING PER RICHIESTA ====================
+
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'true').lower() == 'true'
+# Trace dettagliato (albero degli span) solo con header X-Debug-Trace: 1 e se abilitato qui
+DEBUG_TRACE_ENABLED = os.getenv('DEBUG_TRACE_ENABLED', 'false').lower() == 'true'
+DEBUG_TRACE_BUFFER_SIZE = int(os.getenv('DEBUG_TRACE_BUFFER_SIZE', '200'))
+DEBUG_TRACE_TTL = int(os.getenv('DEBUG_TRACE_TTL', '3600'))
+
+class RequestTrace:
+    """
+    Span con nome di una richiesta: (nome, indice del padre, inizio, fine, attributi).
+    Gli attributi vengono conservati solo in modalità trace (detailed=True).
+    """
+    __slots__ = ('request_id', 'route', 'detailed', 'started', 'spans', 'stack')
+
+    def __init__(self, request_id: str, route: str, detailed: bool = False):
+        self.request_id = request_id
+        self.route = route
+        self.detailed = detailed
+        self.started = time.perf_counter()
+        self.spans = []
+        self.stack = []
+
+    def durations(self, top_level_only: bool = True) -> Dict[str, float]:
+        """Millisecondi per nome di span (sommati se ripetuti, es. più tentativi)"""
+        result = {}
+        for name, parent, start, end, _ in self.spans:
+            if end is None or (top_level_only and parent is not None):
+                continue
+            result[name] = result.get(name, 0.0) + (end - start) * 1000
+        return result
+
+    def server_timing(self) -> str:
+        # Anche gli span annidati (attesa in coda, chiamata upstream, backoff): le durate si sovrappongono
+        entries = [f'{name};dur={ms:.1f}' for name, ms in self.durations(top_level_only=False).items()]
+        entries.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(entries)
+
+    def to_tree(self) -> dict:
+        nodes = []
+        for name, parent, start, end, attrs in self.spans:
+            node = {
+                'name': name,
+                'start_ms': round((start - self.started) * 1000, 3),
+                'duration_ms': round((end - start) * 1000, 3) if end is not None else None,
+                'children': [],
+            }
+            if attrs:
+                node['attrs'] = attrs
+            nodes.append(node)
+            (nodes[parent]['children'] if parent is not None else []).append(node)
+        return {
+            'request_id': self.request_id,
+            'route': self.route,
+            'pid': os.getpid(),
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'spans': [node for node, (_, parent, _, _, _) in zip(nodes, self.spans) if parent is None],
+        }
+
+request_trace = contextvars.ContextVar('request_trace', default=None)
+
+class span:
+    """
+    Context manager per uno span nominato della richiesta corrente.
+    Senza trace attivo (fuori richiesta o Server-Timing disattivato) costa un solo get del contextvar.
+    """
+    __slots__ = ('name', 'attrs', 'trace', 'index')
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.trace = None
+
+    def __enter__(self):
+        trace = request_trace.get()
+        if trace is not None:
+            self.trace = trace
+            self.index = len(trace.spans)
+            parent = trace.stack[-1] if trace.stack else None
+            trace.spans.append([self.name, parent, time.perf_counter(), None, self.attrs if trace.detailed else None])
+            trace.stack.append(self.index)
+        return self
+
+    def set(self, **attrs):
+        """Attributi aggiuntivi (solo in modalità trace)"""
+        if self.trace is not None and self.trace.detailed:
+            self.trace.spans[self.index][4] = {**(self.trace.spans[self.index][4] or {}), **attrs}
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        if trace is not None:
+            trace.spans[self.index][3] = time.perf_counter()
+            if exc_type is not None and trace.detailed:
+                self.set(error=exc_type.__name__)
+            if trace.stack and trace.stack[-1] == self.index:
+                trace.stack.pop()
+        return False
+
 app = Flask(__name__, 
             template_folder='../frontend/templates',
             static_folder='../frontend/static')
 CORS(app)
 
+# Reverse proxy fidati davanti al backend (es. 1 = nginx del frontend):
+# servono per ricavare l'IP reale del client da X-Forwarded-For (rate limit)
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', '0'))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
+
+@app.before_request
+def bind_log_context():
+    """Request id (dal client o generato) e decisione di campionamento dei log per la richiesta"""
+    request_id = request.headers.get('X-Request-ID', '')
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex[:16]
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    rate = LOG_SAMPLE_RATES.get(route, 1.0)
+    log_context.set((request_id, route, rate >= 1.0 or random.random() < rate))
+    detailed = DEBUG_TRACE_ENABLED and request.headers.get('X-Debug-Trace') == '1'
+    if SERVER_TIMING_ENABLED or detailed:
+        request_trace.set(RequestTrace(request_id, route, detailed))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers['X-Request-ID'] = log_context.get()[0]
+    return response
+
+@app.after_request
+def add_server_timing(response):
+    """
+    Server-Timing con gli span di primo livello chiusi finora (per gli stream: solo la fase
+    prima dello streaming, il resto arriva nell'evento SSE 'timing'). In modalità trace
+    l'albero completo viene salvato alla chiusura della risposta.
+    """
+    trace = request_trace.get()
+    if trace is None:
+        return response
+    response.headers['Server-Timing'] = trace.server_timing()
+    if trace.detailed:
+        response.headers['X-Debug-Trace-Id'] = trace.request_id
+        response.call_on_close(lambda: store_debug_trace(trace))
+    return response
+
+@app.after_request
+def observe_request_duration(response):
+    """Istogramma per route; per gli stream la durata arriva fino alla chiusura della risposta"""
+    started = g.get('request_started')
+    if started is not None:
+        route = log_context.get()[1] if request.url_rule is not None else 'unmatched'
+        labels = {'route': route, 'method': request.method, 'status': str(response.status_code)}
+        response.call_on_close(lambda: metrics.observe('http_request_duration_seconds', time.perf_counter() - started, **labels))
+    return response
+
+@app.teardown_request
+def reset_log_context(exc):
+    log_context.set(LOG_CONTEXT_DEFAULT)
+    request_trace.set(None)
+
+def current_request_id() -> str:
+    return log_context.get()[0]
+
+def stream_with_log_context(generator):
+    """
+    Come stream_with_context, ma i log e gli span emessi durante lo streaming (dopo la fine
+    della view) mantengono request id, campionamento e trace della richiesta
+    """
+    bound = log_context.get()
+    trace = request_trace.get()
+
+    def wrapped():
+        log_context.set(bound)
+        request_trace.set(trace)
+        try:
+            yield from generator
+        finally:
+            log_context.set(LOG_CONTEXT_DEFAULT)
+            request_trace.set(None)
+
+    return stream_with_context(wrapped())
+
 # Configurazione
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 FILE_SEARCH_STORE_NAME = os.getenv('FILE_SEARCH_STORE_NAME')
+# Store aggiuntivi per la ricerca federata (lista separata da virgole): lo store principale
+# (FILE_SEARCH_STORE_NAME, o il primo della lista) resta il default per upload, lista documenti e sonda
+FILE_SEARCH_STORES = [s.strip() for s in os.getenv('FILE_SEARCH_STORE_NAMES', '').split(',') if s.strip()]
+if FILE_SEARCH_STORE_NAME and FILE_SEARCH_STORE_NAME not in FILE_SEARCH_STORES:
+    FILE_SEARCH_STORES.insert(0, FILE_SEARCH_STORE_NAME)
+FILE_SEARCH_STORE_NAME = FILE_SEARCH_STORE_NAME or (FILE_SEARCH_STORES[0] if FILE_SEARCH_STORES else None)
 DEFAULT_MODEL = os.getenv('DEFAULT_MODEL', 'gemini-2.5-pro')
 DEFAULT_CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', '512'))
 CHUNK_OVERLAP_PERCENT = int(os.getenv('CHUNK_OVERLAP_PERCENT', '10'))
@@ -47,15 +416,19 @@ MAX_CHAT_HISTORY = int(os.getenv('MAX_CHAT_HISTORY', '2'))
 GENERATION_PROVIDER = os.getenv('GENERATION_PROVIDER', 'gemini').lower()
 GENERATION_MODEL = os.getenv('GENERATION_MODEL', DEFAULT_MODEL)
 GENERATION_API_KEY = os.getenv('GENERATION_API_KEY', GEMINI_API_KEY)
-BASE_URL = 'https://generativelanguage.googleapis.com/v1beta'
-UPLOAD_BASE_URL = 'https://generativelanguage.googleapis.com/upload/v1beta'
+# Radice delle API Gemini (sovrascrivibile per puntare a un server finto nei benchmark)
+GEMINI_API_ROOT = os.getenv('GEMINI_API_ROOT', 'https://generativelanguage.googleapis.com').rstrip('/')
+BASE_URL = f'{GEMINI_API_ROOT}/v1beta'
+UPLOAD_BASE_URL = f'{GEMINI_API_ROOT}/upload/v1beta'
+# Anche il client google-genai (query con FileSearch tool) segue GEMINI_API_ROOT
+GENAI_BASE_URL = GEMINI_API_ROOT if 'GEMINI_API_ROOT' in os.environ else None
 
 # Dimensione massima file: 100MB
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
 # Upload folder temporaneo
 app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
-# Cartella per archiviare i documenti caricati (per download futuro)
-app.config['DOCUMENTS_STORAGE'] = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'documents_storage')
+# Cartella per archiviare gli originali dei documenti caricati (download da /api/documents/<name>/download)
+app.config['DOCUMENTS_STORAGE'] = os.getenv('DOCUMENTS_STORAGE') or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'documents_storage')
 # Crea la cartella se non esiste
 os.makedirs(app.config['DOCUMENTS_STORAGE'], exist_ok=True)
 
@@ -69,28 +442,45 @@ ALLOWED_MIME_TYPES = {
 
 # Cache in-memory per query con TTL
 class QueryCache:
-    """Cache semplice in-memory per risultati query con Time-To-Live"""
-    def __init__(self, ttl_seconds=300):  # Default: 5 minuti
-        self.cache = {}
+    """
+    Cache semplice in-memory per risultati query con Time-To-Live (oltre max_entries esce la voce più vecchia).
+    Il contenuto dipende dai documenti: sync_generation() la svuota quando un worker
+    qualsiasi aggiunge o elimina documenti (generation counter nello store condiviso).
+    """
+    def __init__(self, ttl_seconds=300, max_entries=500):  # Default: 5 minuti
+        self.cache = OrderedDict()
         self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.generation = None
     
     def get(self, key):
         """Recupera valore dalla cache se non scaduto"""
-        if key in self.cache:
-            value, timestamp = self.cache[key]
+        entry = self.cache.get(key)
+        if entry is not None:
+            value, timestamp = entry
             if time.time() - timestamp < self.ttl:
-                logger.debug(f"Cache HIT per query: {key[:50]}...")
+                logger.debug("Cache HIT per query: %s...", key[:50])
                 return value
             else:
                 # Scaduto, rimuovi
-                del self.cache[key]
-                logger.debug(f"Cache EXPIRED per query: {key[:50]}...")
+                self.cache.pop(key, None)
+                logger.debug("Cache EXPIRED per query: %s...", key[:50])
         return None
     
     def set(self, key, value):
         """Memorizza valore in cache con timestamp"""
+        if self.ttl <= 0:
+            return
         self.cache[key] = (value, time.time())
-        logger.debug(f"Cache SET per query: {key[:50]}...")
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        logger.debug("Cache SET per query: %s...", key[:50])
+    
+    def sync_generation(self, generation):
+        """Svuota la cache se i documenti sono cambiati dall'ultima lettura"""
+        if generation != self.generation:
+            self.cache.clear()
+            self.generation = generation
     
     def clear(self):
         """Svuota cache"""
@@ -102,51 +492,561 @@ class QueryCache:
         return len(self.cache)
 
 # Inizializza cache globale
-query_cache = QueryCache(ttl_seconds=int(os.getenv('QUERY_CACHE_TTL', '300')))
+query_cache = QueryCache(ttl_seconds=int(os.getenv('QUERY_CACHE_TTL', '300')),
+                         max_entries=int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '500')))
+# Pagine della lista documenti (invalidata dagli eventi documento, il TTL copre le modifiche esterne all'app)
+documents_cache = QueryCache(ttl_seconds=int(os.getenv('DOCUMENTS_CACHE_TTL', '30')), max_entries=100)
+
+# Cache delle risposte generate (fase di generazione)
+class ResponseCache:
+    """
+    Cache LRU in-memory delle risposte del modello.
+    La chiave è un hash deterministico di modello + prompt finale + generationConfig,
+    quindi la stessa domanda con gli stessi chunk non richiama generateContent.
+    Con stale_ttl > 0 le voci scadute restano servibili (stale-while-revalidate)
+    mentre vengono aggiornate in background.
+    """
+    def __init__(self, ttl_seconds=300, stale_ttl_seconds=0, max_entries=500):
+        self.cache = OrderedDict()  # {key: (value, timestamp)}
+        self.ttl = ttl_seconds
+        self.stale_ttl = stale_ttl_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    @staticmethod
+    def make_key(model: str, payload: dict) -> str:
+        """Hash deterministico di modello, contenuti e configurazione di generazione"""
+        canonical = json.dumps(
+            {'model': model, 'contents': payload.get('contents'), 'generationConfig': payload.get('generationConfig')},
+            sort_keys=True, ensure_ascii=False, separators=(',', ':')
+        )
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        """
+        Cerca una risposta in cache
+        Returns: (value, status) con status in 'fresh', 'stale', 'miss'
+        """
+        if not self.enabled:
+            return None, 'miss'
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, 'miss'
+            value, timestamp = entry
+            age = time.time() - timestamp
+            if age < self.ttl:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return value, 'fresh'
+            if age < self.ttl + self.stale_ttl:
+                self.cache.move_to_end(key)
+                self.stale_hits += 1
+                return value, 'stale'
+            # Scaduta anche la finestra stale, rimuovi
+            del self.cache[key]
+            self.misses += 1
+            return None, 'miss'
+
+    def set(self, key, value):
+        """Memorizza una risposta, eliminando le meno recenti oltre max_entries"""
+        if not self.enabled or not value:
+            return
+        with self.lock:
+            self.cache[key] = (value, time.time())
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+    def begin_refresh(self, key) -> bool:
+        """Segna una chiave come in aggiornamento; False se un refresh è già in corso"""
+        with self.lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self.lock:
+            self.refreshing.discard(key)
+
+    def clear(self):
+        """Svuota cache"""
+        with self.lock:
+            self.cache.clear()
+        logger.info("Cache risposte svuotata")
+
+    def size(self):
+        """Ritorna numero elementi in cache"""
+        return len(self.cache)
+
+response_cache = ResponseCache(
+    ttl_seconds=int(os.getenv('RESPONSE_CACHE_TTL', '300')),
+    stale_ttl_seconds=int(os.getenv('RESPONSE_CACHE_STALE_TTL', '0')),
+    max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '500'))
+)
+# Replay SSE delle risposte in cache: dimensione dei frame (0 = un solo frame) e pausa tra frame
+RESPONSE_CACHE_REPLAY_CHUNK_CHARS = int(os.getenv('RESPONSE_CACHE_REPLAY_CHUNK_CHARS', '0'))
+RESPONSE_CACHE_REPLAY_DELAY_MS = int(os.getenv('RESPONSE_CACHE_REPLAY_DELAY_MS', '0'))
+
+# ==================== STATO CONDIVISO TRA WORKER ====================
+
+class MemorySharedStore:
+    """
+    Store chiave/valore con TTL, locale al processo.
+    Usato quando SHARED_STATE_PATH non è configurato (sviluppo, test, singolo worker).
+    """
+    backend = 'memory'
+
+    def __init__(self, sweep_interval=60):
+        self.data = {}  # {key: (value, expires_at | None)}
+        self.lock = threading.Lock()
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.time()
+
+    def _get(self, key, now):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= now:
+            del self.data[key]
+            return None
+        return value
+
+    def get(self, key) -> Optional[str]:
+        with self.lock:
+            return self._get(key, time.time())
+
+    def set(self, key, value: str, ttl: Optional[float] = None):
+        with self.lock:
+            now = time.time()
+            self.data[key] = (value, now + ttl if ttl else None)
+            self._maybe_sweep(now)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def incr(self, key, amount: int = 1, ttl: Optional[float] = None) -> int:
+        def apply(current):
+            value = int(current or 0) + amount
+            return str(value), value
+        return self.update(key, apply, ttl)
+
+    def update(self, key, fn, ttl: Optional[float] = None):
+        """
+        Read-modify-write atomico.
+        fn(valore_corrente) -> (nuovo_valore | None per eliminare, risultato)
+        """
+        with self.lock:
+            now = time.time()
+            new_value, result = fn(self._get(key, now))
+            if new_value is None:
+                self.data.pop(key, None)
+            else:
+                self.data[key] = (new_value, now + ttl if ttl else None)
+            self._maybe_sweep(now)
+            return result
+
+    def keys(self, prefix: str) -> list:
+        with self.lock:
+            now = time.time()
+            return [k for k in list(self.data) if k.startswith(prefix) and self._get(k, now) is not None]
+
+    def sweep(self) -> int:
+        """Elimina le chiavi scadute. Returns: numero di chiavi eliminate"""
+        with self.lock:
+            return self._sweep(time.time())
+
+    def _sweep(self, now):
+        expired = [k for k, (_, exp) in self.data.items() if exp is not None and exp <= now]
+        for k in expired:
+            del self.data[k]
+        self.last_sweep = now
+        return len(expired)
+
+    def _maybe_sweep(self, now):
+        # Chiamato con il lock già acquisito
+        if now - self.last_sweep >= self.sweep_interval:
+            self._sweep(now)
+
+class SqliteSharedStore:
+    """
+    Store chiave/valore con TTL su file SQLite (WAL), condiviso da tutti i worker
+    gunicorn dello stesso nodo. Una connessione per thread e per processo (fork-safe).
+    """
+    backend = 'sqlite'
+
+    def __init__(self, path: str, sweep_interval=60):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.time()
+        self.local = threading.local()
+        self._connect()
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, key) -> Optional[str]:
+        row = self._connect().execute(
+            'SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)', (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value: str, ttl: Optional[float] = None):
+        now = time.time()
+        self._connect().execute(
+            'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)', (key, value, now + ttl if ttl else None)
+        )
+        self._maybe_sweep(now)
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def incr(self, key, amount: int = 1, ttl: Optional[float] = None) -> int:
+        def apply(current):
+            value = int(current or 0) + amount
+            return str(value), value
+        return self.update(key, apply, ttl)
+
+    def update(self, key, fn, ttl: Optional[float] = None):
+        """
+        Read-modify-write atomico (BEGIN IMMEDIATE serializza i writer tra processi).
+        fn(valore_corrente) -> (nuovo_valore | None per eliminare, risultato)
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)', (key, now)
+            ).fetchone()
+            new_value, result = fn(row[0] if row else None)
+            if new_value is None:
+                conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+            else:
+                conn.execute(
+                    'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, new_value, now + ttl if ttl else None)
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._maybe_sweep(now)
+        return result
+
+    def keys(self, prefix: str) -> list:
+        rows = self._connect().execute(
+            'SELECT key FROM kv WHERE substr(key, 1, ?) = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (len(prefix), prefix, time.time())
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def sweep(self) -> int:
+        """Elimina le chiavi scadute. Returns: numero di chiavi eliminate"""
+        now = time.time()
+        self.last_sweep = now
+        cursor = self._connect().execute('DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+        return cursor.rowcount
+
+    def _maybe_sweep(self, now):
+        if now - self.last_sweep >= self.sweep_interval:
+            self.sweep()
+
+def create_shared_store():
+    """SQLite condiviso se SHARED_STATE_PATH è configurato, altrimenti in-memory"""
+    path = os.getenv('SHARED_STATE_PATH', '')
+    if path:
+        logger.info("Stato condiviso tra worker su SQLite: %s", path)
+        return SqliteSharedStore(path)
+    return MemorySharedStore()
 
-# Rate limiter in-memory
+shared_store = create_shared_store()
+
+# ==================== METRICHE ====================
+
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800)
+
+METRIC_HELP = {
+    'http_request_duration_seconds': ('histogram', 'Durata delle richieste per route Flask (fino alla chiusura della risposta)'),
+    'upstream_request_duration_seconds': ('histogram', 'Latenza delle chiamate a Gemini per operazione (fino agli header per lo streaming)'),
+    'stream_time_to_first_token_seconds': ('histogram', "Tempo dall'arrivo della richiesta al primo testo inviato"),
+    'stream_tokens_per_second': ('histogram', 'Velocità di generazione degli stream (token stimati ~4 caratteri)'),
+    'stream_output_tokens_total': ('counter', 'Token inviati negli stream (stima ~4 caratteri per token)'),
+    'streams_in_flight': ('gauge', 'Stream SSE attualmente aperti'),
+    'response_cache_requests_total': ('counter', 'Lookup nella cache risposte per esito'),
+    'response_cache_hit_ratio': ('gauge', 'Quota di lookup serviti dalla cache risposte (fresh + stale)'),
+    'response_cache_entries': ('gauge', 'Voci nella cache risposte'),
+    'upstream_retries_total': ('counter', 'Retry eseguiti verso Gemini per operazione'),
+    'upstream_retry_giveups_total': ('counter', 'Richieste abbandonate dopo retry o budget esauriti'),
+    'scheduler_granted_total': ('counter', 'Slot concessi dallo scheduler per priorità'),
+    'scheduler_timeouts_total': ('counter', 'Attese in coda scadute per priorità'),
+    'log_records_dropped_total': ('counter', 'Record di log scartati per coda piena'),
+    'circuit_breaker_state': ('gauge', 'Stato del circuit breaker (0=CLOSED, 1=HALF_OPEN, 2=OPEN)'),
+    'circuit_breaker_transitions_total': ('counter', 'Transizioni di stato dei circuit breaker'),
+    'scheduler_queue_depth': ('gauge', 'Richieste in coda nello scheduler per priorità'),
+    'scheduler_in_flight': ('gauge', 'Chiamate upstream in corso'),
+    'admission_decisions_total': ('counter', 'Decisioni del controllo di ammissione per priorità (admitted, overload, in_flight)'),
+    'admission_queue_delay_seconds': ('histogram', 'Attesa in coda nello scheduler osservata dal controllo di ammissione'),
+    'admission_overloaded': ('gauge', 'Worker in sovraccarico secondo il controllo di ammissione (CoDel)'),
+    'admission_in_flight': ('gauge', 'Richieste ammesse in corso per priorità'),
+    'health_check_ok': ('gauge', 'Worker che vedono superato il controllo di salute (store, upstream)'),
+    'http_compression_bytes_total': ('counter', 'Byte delle risposte compresse prima (stage=in) e dopo (stage=out) la compressione'),
+    'http_compression_cpu_seconds_total': ('counter', 'Tempo CPU speso a comprimere le risposte'),
+    'events_published_total': ('counter', 'Eventi pubblicati su /api/events per tipo'),
+    'event_subscribers': ('gauge', 'Client collegati a /api/events'),
+    'event_subscribers_rejected_total': ('counter', 'Connessioni a /api/events rifiutate (503) per limite di subscriber del worker'),
+    'bulk_delete_items_total': ('counter', 'Documenti delle eliminazioni in blocco per esito (deleted, missing, failed, skipped)'),
+    'operation_polls_total': ('counter', 'Poll delle operazioni di upload eseguiti dal watcher per esito'),
+    'federated_store_latency_seconds': ('histogram', 'Latenza del retrieval per store nella ricerca federata per esito'),
+    'document_query_latency_seconds': ('histogram', 'Latenza di {document}:query nella ricerca su più documenti per esito'),
+    'stream_upstream_hold_seconds': ('histogram', 'Tempo di occupazione della connessione a Gemini per stream (dalla richiesta alla chiusura)'),
+    'stream_generation_seconds': ('histogram', 'Durata della generazione negli stream (dagli header all\'ultimo evento di Gemini)'),
+    'stream_client_lag_seconds': ('histogram', 'Ritardo del client rispetto alla fine della generazione (buffer svuotato dopo la chiusura upstream)'),
+    'stream_resumes_total': ('counter', 'Riprese degli stream con Last-Event-ID per esito (replayed, attached, not_found)'),
+    'stream_buffer_overflow_total': ('counter', 'Eventi oltre i limiti del buffer degli stream per policy'),
+    'stream_clients_dropped_total': ('counter', 'Client degli stream chiusi perché troppo lenti per policy'),
+    'document_downloads_total': ('counter', 'Download degli originali per esito (full, partial, not_modified, missing)'),
+    'document_download_bytes_total': ('counter', 'Byte degli originali inviati ai client (full, partial)'),
+    'chunk_store_lookups_total': ('counter', 'Risoluzione degli id dei chunk per esito (local, shared, missing)'),
+    'generation_context_tokens_total': ('counter', 'Token stimati del contesto di generazione per selezione (rerank/threshold e baseline a soglia fissa)'),
+    'metrics_workers': ('gauge', 'Worker che hanno pubblicato metriche di recente'),
+}
+
+def _format_metric_value(value) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+def _metric_key(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{labels[k]}"' for k in sorted(labels)) + '}'
+
+class MetricsRegistry:
+    """
+    Contatori, gauge e istogrammi del processo. Ogni worker pubblica periodicamente
+    un'istantanea nello store condiviso (metrics:<pid>, con TTL); /metrics somma le
+    istantanee di tutti i worker vivi e le espone in formato testo Prometheus.
+    """
+    KEY_PREFIX = 'metrics:'
+
+    def __init__(self, store, flush_interval: float = 5.0):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counters = {}     # chiave serie -> valore
+        self.gauges = {}
+        self.histograms = {}   # chiave serie -> [conteggi per bucket..., somma, conteggio]
+        self.buckets = {}      # nome -> bucket
+        self.collectors = []   # funzioni che aggiornano le metriche cumulative del processo
+        self.flusher_pid = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._ensure_flusher()
+
+    def set_counter(self, name: str, value: float, **labels):
+        """Per contatori già cumulativi mantenuti altrove (cache, retry, scheduler)"""
+        with self.lock:
+            self.counters[_metric_key(name, labels)] = value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[_metric_key(name, labels)] = value
+
+    def gauge_add(self, name: str, delta: float, **labels):
+        key = _metric_key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+        self._ensure_flusher()
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS, **labels):
+        key = _metric_key(name, labels)
+        with self.lock:
+            self.buckets.setdefault(name, list(buckets))
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+        self._ensure_flusher()
+
+    def snapshot(self) -> dict:
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                logger.debug("Collector metriche fallito: %s", e)
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {k: list(v) for k, v in self.histograms.items()},
+                'buckets': dict(self.buckets),
+            }
+
+    def flush(self):
+        self.store.set(f'{self.KEY_PREFIX}{os.getpid()}', json.dumps(self.snapshot(), separators=(',', ':')),
+                       ttl=max(self.flush_interval * 6, 30))
+
+    def _ensure_flusher(self):
+        # Un thread per processo, avviato al primo uso (anche dopo un fork del master gunicorn)
+        if self.flusher_pid == os.getpid() or self.flush_interval <= 0:
+            return
+        self.flusher_pid = os.getpid()
+
+        def loop():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.warning("Pubblicazione metriche fallita: %s", e)
+
+        threading.Thread(target=loop, name='metrics-flush', daemon=True).start()
+
+    def aggregate(self) -> dict:
+        """Somma le istantanee di tutti i worker (il processo corrente pubblica la propria prima)"""
+        self.flush()
+        total = {'counters': {}, 'gauges': {}, 'histograms': {}, 'buckets': {}, 'workers': 0}
+        for key in self.store.keys(self.KEY_PREFIX):
+            raw = self.store.get(key)
+            if not raw:
+                continue
+            snapshot = json.loads(raw)
+            total['workers'] += 1
+            total['buckets'].update(snapshot.get('buckets', {}))
+            for kind in ('counters', 'gauges'):
+                for series, value in snapshot.get(kind, {}).items():
+                    total[kind][series] = total[kind].get(series, 0) + value
+            for series, values in snapshot.get('histograms', {}).items():
+                current = total['histograms'].get(series)
+                total['histograms'][series] = values if current is None else [a + b for a, b in zip(current, values)]
+        return total
+
+    @staticmethod
+    def render(data: dict) -> str:
+        """Formato di esposizione testo Prometheus 0.0.4 dei dati restituiti da aggregate()"""
+        families = {}
+        for kind in ('counters', 'gauges', 'histograms'):
+            for series, value in data[kind].items():
+                name = series.split('{', 1)[0]
+                families.setdefault(name, []).append((series, value))
+
+        lines = []
+        for name in sorted(families):
+            metric_type, help_text = METRIC_HELP.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for series, value in sorted(families[name]):
+                if metric_type != 'histogram':
+                    lines.append(f'{series} {_format_metric_value(value)}')
+                    continue
+                labels = series[len(name):].strip('{}')
+                prefix = labels + ',' if labels else ''
+                cumulative = 0
+                for bound, count in zip(data['buckets'].get(name, LATENCY_BUCKETS), value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {value[-1]}')
+                suffix = '{' + labels + '}' if labels else ''
+                lines.append(f'{name}_sum{suffix} {value[-2]:.6f}')
+                lines.append(f'{name}_count{suffix} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry(shared_store, METRICS_FLUSH_INTERVAL)
+
+
+# Rate limiter GCRA (Generic Cell Rate Algorithm)
 class RateLimiter:
-    """Rate limiter semplice basato su token bucket"""
-    def __init__(self, max_requests=10, time_window=60):
+    """
+    Rate limiter GCRA: per ogni identificatore si memorizza solo il
+    "theoretical arrival time" (TAT), quindi tempo e memoria O(1) per chiave.
+    Consente burst fino a max_requests e poi una richiesta ogni time_window/max_requests.
+    Le chiavi inattive scadono dopo time_window e vengono eliminate periodicamente dallo store;
+    con uno store condiviso il limite vale per tutti i worker.
+    """
+    def __init__(self, max_requests=10, time_window=60, store=None, prefix='rl'):
         self.max_requests = max_requests
         self.time_window = time_window  # secondi
-        self.requests = {}  # {ip: [(timestamp, ...), ...]}
-    
+        self.emission_interval = time_window / max_requests
+        self.store = store if store is not None else MemorySharedStore()
+        self.prefix = prefix  # limiter diversi sullo stesso store hanno contatori separati
+
+    def check(self, identifier) -> tuple[bool, int, float, float]:
+        """
+        Verifica e registra una richiesta
+        Returns: (allowed, remaining, retry_after, reset_after) in secondi;
+        retry_after è 0 se la richiesta è permessa, reset_after è il tempo per tornare al limite pieno
+        """
+        def apply(raw):
+            now = time.time()
+            tat = max(float(raw), now) if raw else now
+            new_tat = tat + self.emission_interval
+            allow_at = new_tat - self.time_window
+            if now < allow_at:
+                return raw, (False, 0, allow_at - now, tat - now)
+            remaining = int((self.time_window - (new_tat - now)) / self.emission_interval + 1e-9)
+            return repr(new_tat), (True, remaining, 0.0, new_tat - now)
+
+        result = self.store.update(f'{self.prefix}:{identifier}', apply, ttl=self.time_window)
+        if not result[0]:
+            logger.debug("Rate limit exceeded per %s", identifier)
+        return result
+
     def is_allowed(self, identifier):
         """Verifica se la richiesta è permessa"""
-        now = time.time()
-        
-        # Pulisci richieste vecchie
-        if identifier in self.requests:
-            self.requests[identifier] = [
-                ts for ts in self.requests[identifier]
-                if now - ts < self.time_window
-            ]
-        else:
-            self.requests[identifier] = []
-        
-        # Controlla limite
-        if len(self.requests[identifier]) >= self.max_requests:
-            logger.warning(f"Rate limit exceeded per {identifier}")
-            return False
-        
-        # Aggiungi nuova richiesta
-        self.requests[identifier].append(now)
-        return True
-    
+        return self.check(identifier)[0]
+
     def get_remaining(self, identifier):
         """Ritorna richieste rimanenti"""
-        now = time.time()
-        if identifier not in self.requests:
+        raw = self.store.get(f'{self.prefix}:{identifier}')
+        if not raw:
             return self.max_requests
-        
-        recent = [ts for ts in self.requests[identifier] if now - ts < self.time_window]
-        return max(0, self.max_requests - len(recent))
+        backlog = max(float(raw) - time.time(), 0)
+        return max(0, int((self.time_window - backlog) / self.emission_interval + 1e-9))
 
 # Inizializza rate limiter
 rate_limiter = RateLimiter(
     max_requests=int(os.getenv('RATE_LIMIT_MAX', '30')),
-    time_window=int(os.getenv('RATE_LIMIT_WINDOW', '60'))
+    time_window=int(os.getenv('RATE_LIMIT_WINDOW', '60')),
+    store=shared_store
+)
+# Download degli originali: limite proprio (i visualizzatori PDF e i download ripresi mandano
+# molte richieste Range) che non consuma quello della chat
+download_rate_limiter = RateLimiter(
+    max_requests=int(os.getenv('DOWNLOAD_RATE_LIMIT_MAX', '300')),
+    time_window=int(os.getenv('DOWNLOAD_RATE_LIMIT_WINDOW', '60')),
+    store=shared_store,
+    prefix='rl:download'
 )
 
 # Session requests per connection pooling
@@ -154,113 +1054,900 @@ http_session = requests.Session()
 adapter = requests.adapters.HTTPAdapter(
     pool_connections=10,
     pool_maxsize=20,
-    max_retries=3
+    max_retries=0  # I retry li gestisce RetryPolicy, altrimenti i tentativi si moltiplicano
 )
 http_session.mount('https://', adapter)
 http_session.mount('http://', adapter)
+# Socket del pool eventualmente aperti nel master (gunicorn --preload) non vanno condivisi con i worker
+os.register_at_fork(after_in_child=adapter.close)
+
+# ==================== SDK (CARICAMENTO RITARDATO) ====================
+# google-genai (~0.4s di import, quasi tutto google.genai.types) e openai servono solo ad alcune route:
+# si importano al primo uso, oppure una volta sola nel master con gunicorn --preload (gunicorn.conf.py).
+# I client hanno un proprio pool httpx: uno per processo, creato al primo uso (dopo il fork).
+
+sdk_clients = {}  # (sdk, pid, api key, base url) -> client
+
+def load_genai():
+    """Moduli (genai, types) di google-genai"""
+    from google import genai
+    from google.genai import types
+    return genai, types
+
+def get_genai_client():
+    """Client google-genai del processo (segue GEMINI_API_ROOT se impostato)"""
+    key = ('genai', os.getpid(), GENERATION_API_KEY, GENAI_BASE_URL)
+    client = sdk_clients.get(key)
+    if client is None:
+        genai, types = load_genai()
+        http_options = types.HttpOptions(base_url=GENAI_BASE_URL) if GENAI_BASE_URL else None
+        client = sdk_clients[key] = genai.Client(api_key=GENERATION_API_KEY, http_options=http_options)
+    return client
+
+@functools.lru_cache(maxsize=1)
+def load_numpy():
+    """numpy per il reranking dei chunk, o None se non installato (resta la soglia fissa)"""
+    try:
+        import numpy
+    except ImportError:
+        logger.warning("numpy non installato: selezione dei chunk con MIN_RELEVANCE_SCORE senza reranking")
+        return None
+    return numpy
+
+def get_openai_client(base_url: Optional[str] = None):
+    """Client OpenAI (o compatibile, es. DeepSeek) del processo"""
+    key = ('openai', os.getpid(), GENERATION_API_KEY, base_url)
+    client = sdk_clients.get(key)
+    if client is None:
+        import openai
+        client = sdk_clients[key] = openai.OpenAI(api_key=GENERATION_API_KEY, base_url=base_url)
+    return client
+
+class UpstreamUnavailableError(Exception):
+    """Base per gli errori che rifiutano una chiamata a Gemini senza eseguirla"""
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
 
-# Circuit Breaker per gestione rate limit
+class CircuitOpenError(UpstreamUnavailableError):
+    """Circuit breaker aperto per l'operazione upstream richiesta"""
+    def __init__(self, operation, retry_after=1):
+        super().__init__('Servizio temporaneamente non disponibile. Riprova tra qualche minuto.', retry_after)
+        self.operation = operation
+
+# Circuit Breaker per operazione upstream
 class CircuitBreaker:
-    """Circuit breaker per gestire rate limit 429"""
-    def __init__(self, failure_threshold=5, timeout=60):
+    """
+    Circuit breaker per una singola operazione upstream (generate, stream, upload, ...).
+    Conta come fallimenti 429, 5xx, timeout ed errori di connessione.
+    Lo stato vive nello shared store (condiviso tra i worker); le transizioni sono atomiche.
+    In HALF_OPEN passa una sola chiamata di prova alla volta, le altre falliscono subito.
+    """
+    def __init__(self, name, store, failure_threshold=5, timeout=60, probe_timeout=120):
+        self.name = name
+        self.store = store
         self.failure_threshold = failure_threshold
-        self.timeout = timeout  # secondi
-        self.failure_count = 0
-        self.last_failure_time: Optional[datetime] = None
-        self.state = 'CLOSED'  # CLOSED, OPEN, HALF_OPEN
-    
+        self.timeout = timeout  # secondi in OPEN prima della prova
+        self.probe_timeout = probe_timeout  # dopo questo tempo una prova senza esito viene riassegnata
+        self.key = f'cb:{name}'
+        self.lock = threading.Lock()
+        self.open_until = 0.0  # cache locale: fallisci subito senza leggere lo store
+        self.transitions = {}  # {(da, a): conteggio} in questo worker
+
+    def _load(self, raw):
+        return json.loads(raw) if raw else {'state': 'CLOSED', 'failures': 0, 'opened_at': 0, 'probe_until': 0}
+
+    def _transition(self, old, new):
+        if old == new:
+            return
+        with self.lock:
+            self.transitions[(old, new)] = self.transitions.get((old, new), 0) + 1
+        self.store.incr(f'cb:transitions:{self.name}:{new}')
+        log = logger.warning if new == 'OPEN' else logger.info
+        log("Circuit breaker %s: %s -> %s", self.name, old, new)
+
+    @property
+    def state(self) -> str:
+        return self._load(self.store.get(self.key))['state']
+
+    def peek(self) -> tuple[bool, float]:
+        """
+        Verifica senza effetti collaterali se una chiamata verrebbe rifiutata
+        Returns: (open, retry_after)
+        """
+        now = time.time()
+        if now < self.open_until:
+            return True, self.open_until - now
+        data = self._load(self.store.get(self.key))
+        if data['state'] == 'OPEN' and now - data['opened_at'] < self.timeout:
+            self.open_until = data['opened_at'] + self.timeout
+            return True, self.open_until - now
+        if data['state'] == 'HALF_OPEN' and data['probe_until'] > now:
+            return True, 1.0
+        return False, 0.0
+
     def call_allowed(self) -> bool:
-        """Verifica se la chiamata è permessa"""
-        if self.state == 'CLOSED':
-            return True
-        
-        if self.state == 'OPEN':
-            # Verifica se è passato il timeout
-            if self.last_failure_time and datetime.now() - self.last_failure_time > timedelta(seconds=self.timeout):
-                self.state = 'HALF_OPEN'
-                logger.info("Circuit breaker: OPEN -> HALF_OPEN (timeout scaduto)")
-                return True
+        """Verifica se la chiamata è permessa (in HALF_OPEN assegna l'unica prova)"""
+        if time.time() < self.open_until:
             return False
-        
-        # HALF_OPEN: permette una chiamata di test
-        return True
-    
+        raw = self.store.get(self.key)
+        if raw is None or self._load(raw)['state'] == 'CLOSED':
+            return True
+
+        def apply(raw):
+            now = time.time()
+            data = self._load(raw)
+            if data['state'] == 'CLOSED':
+                return raw, (True, 'CLOSED', 'CLOSED')
+            if data['state'] == 'OPEN':
+                if now - data['opened_at'] < self.timeout:
+                    return raw, (False, 'OPEN', 'OPEN')
+                # Timeout scaduto: questa chiamata diventa la prova
+                data.update(state='HALF_OPEN', probe_until=now + self.probe_timeout)
+                return json.dumps(data), (True, 'OPEN', 'HALF_OPEN')
+            if data['probe_until'] > now:
+                return raw, (False, 'HALF_OPEN', 'HALF_OPEN')
+            # Prova precedente persa (worker morto, timeout): riassegnala
+            data['probe_until'] = now + self.probe_timeout
+            return json.dumps(data), (True, 'HALF_OPEN', 'HALF_OPEN')
+
+        allowed, old, new = self.store.update(self.key, apply)
+        self._transition(old, new)
+        if not allowed and new == 'OPEN':
+            data = self._load(self.store.get(self.key))
+            self.open_until = data['opened_at'] + self.timeout
+        return allowed
+
     def record_success(self):
         """Registra una chiamata riuscita"""
-        self.failure_count = 0
-        if self.state == 'HALF_OPEN':
-            self.state = 'CLOSED'
-            logger.info("Circuit breaker: HALF_OPEN -> CLOSED (successo)")
-    
+        raw = self.store.get(self.key)
+        if raw is None:
+            return
+        data = self._load(raw)
+        if data['state'] == 'CLOSED' and data['failures'] == 0:
+            return
+
+        def apply(raw):
+            data = self._load(raw)
+            old = data['state']
+            return None, old  # CLOSED e contatore azzerato = chiave assente
+
+        old = self.store.update(self.key, apply)
+        self.open_until = 0.0
+        self._transition(old, 'CLOSED')
+
     def record_failure(self):
         """Registra una chiamata fallita"""
-        self.failure_count += 1
-        self.last_failure_time = datetime.now()
-        
-        if self.failure_count >= self.failure_threshold:
-            self.state = 'OPEN'
-            logger.warning(f"Circuit breaker: OPEN (troppi errori: {self.failure_count})")
+        def apply(raw):
+            now = time.time()
+            data = self._load(raw)
+            old = data['state']
+            data['failures'] += 1
+            if old == 'HALF_OPEN' or (old == 'CLOSED' and data['failures'] >= self.failure_threshold):
+                data.update(state='OPEN', opened_at=now, probe_until=0)
+            return json.dumps(data), (old, data['state'], data['opened_at'])
 
-# Istanza globale del circuit breaker
-gemini_circuit_breaker = CircuitBreaker(failure_threshold=5, timeout=60)
+        old, new, opened_at = self.store.update(self.key, apply)
+        if new == 'OPEN':
+            self.open_until = opened_at + self.timeout
+        self._transition(old, new)
 
-def get_headers():
-    """Restituisce gli headers per le richieste API"""
-    return {
-        'x-goog-api-key': GEMINI_API_KEY
-    }
+    def cancel_probe(self):
+        """La prova in HALF_OPEN non è partita (es. coda satura): libera subito lo slot di prova"""
+        def apply(raw):
+            data = self._load(raw)
+            if data['state'] != 'HALF_OPEN':
+                return raw, None
+            data['probe_until'] = 0
+            return json.dumps(data), None
+        if self.store.get(self.key) is not None:
+            self.store.update(self.key, apply)
 
-def fix_encoding_issues(text: str) -> str:
-    """
-    Corregge problemi comuni di encoding UTF-8 mal interpretato come Latin-1
-    """
-    if not text:
-        return text
-    
-    # Mappa dei caratteri comuni mal codificati
-    replacements = {
-        'â¬': '€',     # Euro
-        'Ã ': 'à',     # a con accento grave
-        'Ã¨': 'è',     # e con accento grave
-        'Ã©': 'é',     # e con accento acuto
-        'Ã¬': 'ì',     # i con accento grave
-        'Ã²': 'ò',     # o con accento grave
-        'Ã¹': 'ù',     # u con accento grave
-        'Ã': 'À',      # A con accento grave
-        'Ã': 'È',      # E con accento grave
-        'Ã': 'É',      # E con accento acuto
-        'Ã': 'Ì',      # I con accento grave
-        'Ã': 'Ò',      # O con accento grave
-        'Ã': 'Ù',      # U con accento grave
-        'â': '"',      # Virgolette
-        'â': '"',      # Virgolette
-        'â': "'",      # Apostrofo
-        'â¦': '...',   # Ellipsis
-        'â': '–',      # En dash
-        'â': '—',      # Em dash
-    }
-    
-    for wrong, correct in replacements.items():
-        text = text.replace(wrong, correct)
-    
-    return text
+    def stats(self) -> dict:
+        data = self._load(self.store.get(self.key))
+        return {
+            'state': data['state'],
+            'failures': data['failures'],
+            'transitions': {
+                state: int(self.store.get(f'cb:transitions:{self.name}:{state}') or 0)
+                for state in ('OPEN', 'HALF_OPEN', 'CLOSED')
+            }
+        }
 
-def validate_query_text(query: str) -> tuple[bool, Optional[str]]:
+class CircuitBreakerRegistry:
+    """Un circuit breaker per ciascuna operazione upstream, creato al primo uso"""
+    OPERATIONS = ('generate', 'stream', 'upload', 'query', 'list', 'operations', 'delete')
+
+    def __init__(self, store, failure_threshold=5, timeout=60):
+        self.store = store
+        self.failure_threshold = failure_threshold
+        self.timeout = timeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, operation: str) -> CircuitBreaker:
+        breaker = self.breakers.get(operation)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(
+                    operation, CircuitBreaker(operation, self.store, self.failure_threshold, self.timeout)
+                )
+        return breaker
+
+    def stats(self) -> dict:
+        return {operation: self.get(operation).stats() for operation in self.OPERATIONS}
+
+circuit_breakers = CircuitBreakerRegistry(
+    shared_store,
+    failure_threshold=int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', '5')),
+    timeout=int(os.getenv('CIRCUIT_BREAKER_TIMEOUT', '60'))
+)
+
+def is_upstream_failure(status_code: Optional[int] = None, error: Optional[Exception] = None) -> bool:
+    """429, 5xx, timeout ed errori di connessione contano come guasto dell'upstream"""
+    if status_code == 429 or (isinstance(status_code, int) and status_code >= 500):
+        return True
+    if error is None:
+        return False
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError, TimeoutError, ConnectionError)):
+        return True
+    # Eccezioni httpx dell'SDK genai (ReadTimeout, ConnectError, ...)
+    return type(error).__name__.endswith(('Timeout', 'TimeoutException', 'ConnectError'))
+
+# ==================== SCHEDULER CHIAMATE UPSTREAM ====================
+
+class UpstreamBusyError(UpstreamUnavailableError):
+    """Nessuno slot upstream disponibile entro il tempo massimo di attesa in coda"""
+
+# Priorità delle chiamate (numero più basso = servita prima)
+PRIORITY_INTERACTIVE = 0  # chat: query e generazione
+PRIORITY_DEFAULT = 1      # lista documenti, stato operazioni, eliminazioni
+PRIORITY_BULK = 2         # upload ed export dei chunks
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_DEFAULT: 'default', PRIORITY_BULK: 'bulk'}
+
+class UpstreamScheduler:
     """
-    Valida il testo della query
-    Returns: (is_valid, error_message)
+    Scheduler delle chiamate a generativelanguage.googleapis.com condiviso tra i worker.
+    Token bucket su richieste/minuto (RPM) e token/minuto (TPM) più un limite di chiamate
+    concorrenti: chi non può partire attende in una coda a priorità (poi FIFO) invece di
+    prendersi un 429. Bucket, coda e lease vivono nello shared store, quindi valgono per il nodo.
     """
-    if not query or not query.strip():
-        return False, "Query vuota"
-    
-    if len(query) > 2000:
-        return False, "Query troppo lunga (max 2000 caratteri)"
-    
-    # Controllo caratteri pericolosi per injection
-    dangerous_chars = ['<script', 'javascript:', 'onerror=', 'onclick=']
-    query_lower = query.lower()
-    for char in dangerous_chars:
-        if char in query_lower:
+    STATE_KEY = 'sched:state'
+    WAITER_PREFIX = 'sched:w:'
+
+    def __init__(self, store, rpm=150, tpm=2000000, max_concurrency=16, burst_seconds=10,
+                 max_wait=30, est_output_tokens=1024, lease_ttl=300, poll_interval=0.05):
+        self.store = store
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.burst_seconds = burst_seconds
+        self.max_wait = max_wait
+        self.est_output_tokens = est_output_tokens
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.cond = threading.Condition()
+        # Metriche locali al worker
+        self.granted = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.timeouts = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.wait_total = {name: 0.0 for name in PRIORITY_NAMES.values()}
+        self.recent_waits = deque(maxlen=1000)
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm > 0 or self.tpm > 0 or self.max_concurrency > 0
+
+    def estimate_tokens(self, prompt_chars: int = 0, output_tokens: Optional[int] = None) -> int:
+        """Stima grossolana del costo: ~4 caratteri per token in input più l'output atteso"""
+        if output_tokens is None:
+            output_tokens = self.est_output_tokens
+        return prompt_chars // 4 + output_tokens
+
+    def _capacity(self, per_minute):
+        return max(per_minute / 60 * self.burst_seconds, 1)
+
+    def _refill(self, state, now):
+        """Ricarica i bucket in base al tempo trascorso"""
+        elapsed = max(now - state.get('ts', now), 0)
+        requests_level = state.get('r', self._capacity(self.rpm))
+        tokens_level = state.get('t', self._capacity(self.tpm))
+        if self.rpm > 0:
+            requests_level = min(self._capacity(self.rpm), requests_level + elapsed * self.rpm / 60)
+        if self.tpm > 0:
+            tokens_level = min(self._capacity(self.tpm), tokens_level + elapsed * self.tpm / 60)
+        return requests_level, tokens_level
+
+    def _waiter_key(self, waiter_id, priority, enqueued_at):
+        # L'ordine lessicografico della chiave è l'ordine della coda: priorità, poi FIFO
+        return f"{self.WAITER_PREFIX}{priority:03d}:{enqueued_at:017.6f}:{waiter_id}"
+
+    def _try_acquire(self, waiter_id, cost):
+        """
+        Tentativo atomico sui bucket e sui lease, eseguito solo dal waiter in testa alla coda
+        Returns: (granted, retry_in)
+        """
+        def apply(raw):
+            now = time.time()
+            state = json.loads(raw) if raw else {}
+            requests_level, tokens_level = self._refill(state, now)
+            leases = {k: exp for k, exp in state.get('l', {}).items() if exp > now}
+
+            cost_tokens = min(cost, self._capacity(self.tpm))
+            waits = []
+            if self.rpm > 0 and requests_level < 1:
+                waits.append((1 - requests_level) / (self.rpm / 60))
+            if self.tpm > 0 and tokens_level < cost_tokens:
+                waits.append((cost_tokens - tokens_level) / (self.tpm / 60))
+            if self.max_concurrency > 0 and len(leases) >= self.max_concurrency:
+                waits.append(self.poll_interval)
+            if waits:
+                # Nulla da scrivere: lo stato resta com'è
+                return raw, (False, min(max(max(waits), self.poll_interval), 1.0))
+
+            if self.rpm > 0:
+                requests_level -= 1
+            if self.tpm > 0:
+                tokens_level -= cost_tokens
+            leases[waiter_id] = now + self.lease_ttl
+            new_state = {'r': requests_level, 't': tokens_level, 'ts': now, 'l': leases}
+            return json.dumps(new_state, separators=(',', ':')), (True, self.poll_interval)
+
+        return self.store.update(self.STATE_KEY, apply)
+
+    def _release_lease(self, lease_id):
+        def apply(raw):
+            if not raw:
+                return None, None
+            state = json.loads(raw)
+            state.get('l', {}).pop(lease_id, None)
+            return json.dumps(state, separators=(',', ':')), None
+        self.store.update(self.STATE_KEY, apply)
+        with self.cond:
+            self.cond.notify_all()
+
+    def acquire(self, priority=PRIORITY_DEFAULT, cost_tokens=0, timeout=None) -> str:
+        """
+        Attende uno slot upstream
+        Returns: id del lease da passare a release()
+        Raises: UpstreamBusyError se lo slot non arriva entro timeout
+        """
+        if not self.enabled:
+            return ''
+        name = PRIORITY_NAMES.get(priority, 'default')
+        timeout = self.max_wait if timeout is None else timeout
+        waiter_id = uuid.uuid4().hex
+        waiter_key = self._waiter_key(waiter_id, priority, time.time())
+        started = time.monotonic()
+        deadline = started + timeout
+        # Ogni waiter è una chiave a sé, scritta una volta sola: chi non è in testa legge soltanto
+        self.store.set(waiter_key, '1', ttl=timeout + 5)
+
+        try:
+            while True:
+                retry_in = self.poll_interval
+                queue = self.store.keys(self.WAITER_PREFIX)
+                if waiter_key not in queue:
+                    # Chiave scaduta o spazzata via: ci si rimette in coda con l'anzianità originale
+                    self.store.set(waiter_key, '1', ttl=max(deadline - time.monotonic(), 0) + 5)
+                elif min(queue) == waiter_key:
+                    granted, retry_in = self._try_acquire(waiter_id, cost_tokens)
+                    if granted:
+                        waited = time.monotonic() - started
+                        with self.cond:
+                            self.granted[name] += 1
+                            self.wait_total[name] += waited
+                            self.recent_waits.append(waited)
+                        if waited > 1:
+                            logger.info("Scheduler upstream: slot %s ottenuto dopo %.2fs in coda", name, waited)
+                        return waiter_id
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self.cond:
+                        self.timeouts[name] += 1
+                    logger.warning("Scheduler upstream: timeout in coda (%s) dopo %ss", name, timeout)
+                    raise UpstreamBusyError('Servizio Gemini saturo, riprova tra poco', retry_after=max(int(retry_in) + 1, 1))
+
+                # Un rilascio locale risveglia subito i waiter; quelli degli altri worker li vediamo al prossimo poll
+                with self.cond:
+                    self.cond.wait(min(retry_in, remaining))
+        finally:
+            # Ottenuto lo slot o scaduto il timeout, si esce dalla coda e il prossimo passa in testa
+            self.store.delete(waiter_key)
+            with self.cond:
+                self.cond.notify_all()
+
+    def release(self, lease_id: str):
+        """Rilascia lo slot di concorrenza ottenuto con acquire()"""
+        if lease_id:
+            self._release_lease(lease_id)
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_DEFAULT, cost_tokens=0, timeout=None):
+        """Context manager: acquire() all'ingresso, release() all'uscita (anche su errore)"""
+        lease_id = self.acquire(priority, cost_tokens, timeout)
+        try:
+            yield
+        finally:
+            self.release(lease_id)
+
+    def stats(self) -> dict:
+        """Profondità della coda, slot in uso, livelli dei bucket e tempi di attesa"""
+        raw = self.store.get(self.STATE_KEY)
+        state = json.loads(raw) if raw else {}
+        now = time.time()
+        requests_level, tokens_level = self._refill(state, now)
+        queue_depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for key in self.store.keys(self.WAITER_PREFIX):
+            priority = int(key[len(self.WAITER_PREFIX):].split(':', 1)[0])
+            queue_depth[PRIORITY_NAMES.get(priority, 'default')] += 1
+        with self.cond:
+            waits = sorted(self.recent_waits)
+            granted = dict(self.granted)
+            timeouts = dict(self.timeouts)
+            wait_total = dict(self.wait_total)
+
+        def percentile(p):
+            return round(waits[min(int(len(waits) * p), len(waits) - 1)], 4) if waits else 0.0
+
+        return {
+            'enabled': self.enabled,
+            'backend': self.store.backend,
+            'limits': {'rpm': self.rpm, 'tpm': self.tpm, 'max_concurrency': self.max_concurrency},
+            'queue_depth': queue_depth,
+            'in_flight': sum(1 for exp in state.get('l', {}).values() if exp > now),
+            'bucket': {'requests': round(requests_level, 2), 'tokens': int(tokens_level)},
+            'granted': granted,
+            'timeouts': timeouts,
+            'wait_seconds': {
+                'total': {k: round(v, 4) for k, v in wait_total.items()},
+                'p50': percentile(0.5),
+                'p95': percentile(0.95),
+                'max': round(waits[-1], 4) if waits else 0.0
+            }
+        }
+
+upstream_scheduler = UpstreamScheduler(
+    shared_store,
+    rpm=int(os.getenv('GEMINI_RPM_LIMIT', '150')),
+    tpm=int(os.getenv('GEMINI_TPM_LIMIT', '2000000')),
+    max_concurrency=int(os.getenv('UPSTREAM_MAX_CONCURRENCY', '16')),
+    burst_seconds=int(os.getenv('SCHEDULER_BURST_SECONDS', '10')),
+    max_wait=int(os.getenv('SCHEDULER_MAX_WAIT', '30')),
+    est_output_tokens=int(os.getenv('SCHEDULER_EST_OUTPUT_TOKENS', '1024'))
+)
+
+# ==================== CONTROLLO DI AMMISSIONE ====================
+
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+
+class AdmissionRejectedError(UpstreamUnavailableError):
+    """Richiesta rifiutata all'ingresso: worker in sovraccarico o troppe richieste in corso"""
+    def __init__(self, message, retry_after=1, reason='overload'):
+        super().__init__(message, retry_after)
+        self.reason = reason
+
+class AdmissionController:
+    """
+    Controllo di ammissione del worker in stile CoDel applicato all'attesa nella coda dello scheduler.
+    Si osserva l'attesa (sojourn) di ogni acquisizione di slot: se anche la minima di un intervallo
+    supera il target, la coda non è un burst ma una coda stabile e il worker entra in sovraccarico.
+    In sovraccarico le richieste bulk (export chunks, upload) vengono rifiutate subito e le chat
+    attendono in coda al massimo overload_timeout: chi non parte riceve un 503 rapido con Retry-After
+    invece di accumulare latenza. Fuori dal sovraccarico la chat attende al massimo lo SLO.
+    Un tetto di richieste in corso per worker (più basso per il bulk) limita i burst.
+    """
+    def __init__(self, target: float = 0.2, interval: float = 1.0, slo: float = 5.0, overload_timeout: float = 0.5,
+                 max_in_flight: int = 64, bulk_share: float = 0.25, enabled: bool = True, clock=time.monotonic):
+        self.target = target
+        self.interval = interval
+        self.slo = slo
+        self.overload_timeout = overload_timeout
+        self.max_in_flight = max_in_flight
+        self.bulk_limit = max(int(max_in_flight * bulk_share), 1) if max_in_flight > 0 else 0
+        self.enabled = enabled
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.interval_min = math.inf
+        self.interval_end = clock() + interval
+        self.last_min = 0.0
+        self.overloaded = False
+        self.in_flight = {name: 0 for name in PRIORITY_NAMES.values()}
+
+    def _roll(self, now):
+        # Fine intervallo: sovraccarico se la minima attesa osservata è rimasta sopra il target
+        if now < self.interval_end:
+            return
+        observed = self.interval_min != math.inf
+        overloaded = observed and self.interval_min > self.target
+        if overloaded != self.overloaded:
+            logger.warning("Controllo di ammissione: %s (attesa minima in coda %.0f ms)",
+                           'SOVRACCARICO' if overloaded else 'carico normale', (self.interval_min if observed else 0) * 1000)
+        self.overloaded = overloaded
+        self.last_min = self.interval_min if observed else 0.0
+        self.interval_min = math.inf
+        self.interval_end = now + self.interval
+
+    def observe(self, sojourn: float, priority=PRIORITY_DEFAULT):
+        """Attesa in coda di un'acquisizione di slot (ottenuto o scaduto)"""
+        metrics.observe('admission_queue_delay_seconds', sojourn, priority=PRIORITY_NAMES.get(priority, 'default'))
+        if not self.enabled:
+            return
+        with self.lock:
+            now = self.clock()
+            self._roll(now)
+            self.interval_min = min(self.interval_min, sojourn)
+
+    def shedding(self) -> bool:
+        """True se il worker è in sovraccarico (usato anche per non ritentare)"""
+        if not self.enabled:
+            return False
+        with self.lock:
+            self._roll(self.clock())
+            return self.overloaded
+
+    def retry_after(self) -> int:
+        return min(max(math.ceil(max(self.last_min, self.interval)), 1), 30)
+
+    def admit(self, priority):
+        """
+        Decisione all'ingresso della richiesta
+        Raises: AdmissionRejectedError; se ammessa, va chiamato release(priority) a fine richiesta
+        """
+        name = PRIORITY_NAMES.get(priority, 'default')
+        with self.lock:
+            if self.enabled:
+                self._roll(self.clock())
+            in_flight = sum(self.in_flight.values())
+            reason = None
+            if self.enabled and self.overloaded and priority == PRIORITY_BULK:
+                reason = 'overload'
+            elif self.enabled and self.max_in_flight > 0 and (
+                    in_flight >= self.max_in_flight
+                    or (priority == PRIORITY_BULK and self.in_flight[name] >= self.bulk_limit)):
+                reason = 'in_flight'
+            if reason is None:
+                self.in_flight[name] += 1
+        metrics.inc('admission_decisions_total', priority=name, decision='admitted' if reason is None else reason)
+        if reason is not None:
+            logger.warning("Richiesta %s rifiutata dal controllo di ammissione (%s)", name, reason)
+            raise AdmissionRejectedError('Servizio sovraccarico, riprova tra poco', self.retry_after(), reason)
+
+    def release(self, priority):
+        with self.lock:
+            self.in_flight[PRIORITY_NAMES.get(priority, 'default')] -= 1
+
+    def queue_timeout(self, priority) -> Optional[float]:
+        """Attesa massima nello scheduler: breve in sovraccarico, SLO per la chat, default altrimenti"""
+        if self.shedding():
+            return self.overload_timeout
+        return self.slo if priority == PRIORITY_INTERACTIVE else None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'overloaded': self.overloaded,
+                'last_interval_min_delay_ms': round(self.last_min * 1000, 2),
+                'target_ms': round(self.target * 1000, 2),
+                'slo_seconds': self.slo,
+                'in_flight': dict(self.in_flight),
+                'limits': {'total': self.max_in_flight, 'bulk': self.bulk_limit},
+            }
+
+admission = AdmissionController(
+    target=float(os.getenv('ADMISSION_TARGET_DELAY_MS', '200')) / 1000,
+    interval=float(os.getenv('ADMISSION_INTERVAL_MS', '1000')) / 1000,
+    slo=float(os.getenv('ADMISSION_SLO_SECONDS', '5')),
+    overload_timeout=float(os.getenv('ADMISSION_OVERLOAD_TIMEOUT_MS', '500')) / 1000,
+    max_in_flight=int(os.getenv('ADMISSION_MAX_IN_FLIGHT', '64')),
+    bulk_share=float(os.getenv('ADMISSION_BULK_SHARE', '0.25')),
+    enabled=ADMISSION_ENABLED
+)
+
+def acquire_upstream_slot(priority=PRIORITY_DEFAULT, cost_tokens=0) -> str:
+    """Slot dello scheduler con l'attesa massima decisa dal controllo di ammissione; l'attesa alimenta CoDel"""
+    started = time.perf_counter()
+    try:
+        with span('scheduler_wait'):
+            return upstream_scheduler.acquire(priority, cost_tokens, timeout=admission.queue_timeout(priority))
+    finally:
+        admission.observe(time.perf_counter() - started, priority)
+
+# ==================== CHIAMATE UPSTREAM ====================
+
+# Timeout delle chiamate HTTP a Gemini in secondi: (connessione, lettura)
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '5'))
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', '60'))
+UPLOAD_READ_TIMEOUT = float(os.getenv('UPLOAD_READ_TIMEOUT', '300'))
+
+def upstream_sleep(seconds: float):
+    """
+    Attesa tra i retry. Con worker asincroni (gunicorn -k gevent) cede il controllo
+    all'event loop invece di bloccare il thread del worker.
+    """
+    gevent = sys.modules.get('gevent')
+    if gevent is not None:
+        gevent.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+class RetryPolicy:
+    """
+    Politica di retry unica per tutte le chiamate a Gemini.
+    Backoff "decorrelated jitter" (attesa = min(cap, random(base, attesa_precedente * 3)))
+    per non sincronizzare i client, rispetto dell'header Retry-After e un budget complessivo
+    per richiesta: se la prossima attesa sforerebbe la deadline si rinuncia subito.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8, deadline=45):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.retries = {}   # {operazione: retry eseguiti}
+        self.gave_up = {}   # {operazione: rinunce per tentativi o budget esauriti}
+
+    def next_delay(self, previous: float) -> float:
+        return min(self.max_delay, random.uniform(self.base_delay, max(previous, self.base_delay) * 3))
+
+    @staticmethod
+    def retry_after(response) -> Optional[float]:
+        """Secondi indicati dall'header Retry-After (numero o data HTTP)"""
+        headers = getattr(response, 'headers', None) or {}
+        value = headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                return None
+
+    def _count(self, counter, operation):
+        with self.lock:
+            counter[operation] = counter.get(operation, 0) + 1
+
+    def run(self, attempt, operation: str = 'upstream', deadline: Optional[float] = None, retry_on_timeout: bool = True):
+        """
+        Esegue attempt(secondi_rimanenti) ritentando su 429/5xx, timeout ed errori di connessione.
+        attempt restituisce una risposta (con status_code) o solleva un'eccezione.
+        Returns: l'ultima risposta ottenuta; Raises: l'ultima eccezione se non ci sono altri tentativi
+        """
+        budget_end = time.monotonic() + (self.deadline if deadline is None else deadline)
+        delay = self.base_delay
+        attempt_no = 0
+        while True:
+            attempt_no += 1
+            remaining = budget_end - time.monotonic()
+            error = None
+            result = None
+            try:
+                result = attempt(remaining)
+            except UpstreamUnavailableError:
+                # Breaker aperto o coda satura: ritentare subito non serve
+                raise
+            except Exception as e:
+                retryable = is_upstream_failure(getattr(e, 'code', None), e)
+                if isinstance(e, requests.exceptions.Timeout) and not retry_on_timeout:
+                    retryable = False
+                if not retryable or attempt_no >= self.max_attempts:
+                    if retryable:
+                        self._count(self.gave_up, operation)
+                    raise
+                error = e
+                delay = self.next_delay(delay)
+                wait = delay
+            else:
+                status = getattr(result, 'status_code', None)
+                if status not in self.RETRY_STATUSES:
+                    return result
+                if attempt_no >= self.max_attempts:
+                    self._count(self.gave_up, operation)
+                    return result
+                delay = self.next_delay(delay)
+                hinted = self.retry_after(result)
+                wait = hinted if hinted is not None else delay
+
+            if admission.shedding():
+                # In sovraccarico un backoff terrebbe occupato il worker: meglio fallire subito
+                logger.warning("Retry %s: worker in sovraccarico, nessun nuovo tentativo", operation)
+                self._count(self.gave_up, operation)
+                if error is not None:
+                    raise error
+                return result
+
+            if time.monotonic() + wait >= budget_end:
+                logger.warning("Retry %s: budget esaurito, attesa di %.1fs oltre la deadline", operation, wait)
+                self._count(self.gave_up, operation)
+                if error is not None:
+                    raise error
+                return result
+
+            if result is not None and hasattr(result, 'close'):
+                result.close()
+            reason = f"status {result.status_code}" if result is not None else type(error).__name__
+            logger.warning("Retry %s %s/%s dopo %.2fs (%s)", operation, attempt_no, self.max_attempts - 1, wait, reason)
+            self._count(self.retries, operation)
+            with span('retry_backoff', operation=operation, attempt=attempt_no, reason=reason):
+                upstream_sleep(wait)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'retries': dict(self.retries), 'gave_up': dict(self.gave_up)}
+
+retry_policy = RetryPolicy(
+    max_attempts=int(os.getenv('RETRY_MAX_ATTEMPTS', '3')),
+    base_delay=float(os.getenv('RETRY_BASE_DELAY', '0.5')),
+    max_delay=float(os.getenv('RETRY_MAX_DELAY', '8')),
+    deadline=float(os.getenv('RETRY_DEADLINE', '45'))
+)
+
+def call_upstream(operation: str, fn, priority=PRIORITY_DEFAULT, cost_tokens=0, schedule=True):
+    """
+    Esegue fn() (richiesta HTTP o chiamata SDK genai) attraverso il circuit breaker
+    dell'operazione e, se schedule=True, uno slot dello scheduler.
+    Raises: CircuitOpenError senza toccare la rete se il breaker è aperto
+    """
+    breaker = circuit_breakers.get(operation)
+    if not breaker.call_allowed():
+        raise CircuitOpenError(operation, max(math.ceil(breaker.peek()[1]), 1))
+    started = []
+
+    def timed_call():
+        # La latenza misurata esclude l'attesa in coda nello scheduler
+        started.append(time.perf_counter())
+        with span(f'upstream_{operation}'):
+            return fn()
+
+    try:
+        if schedule:
+            lease_id = acquire_upstream_slot(priority, cost_tokens)
+            try:
+                result = timed_call()
+            finally:
+                upstream_scheduler.release(lease_id)
+        else:
+            result = timed_call()
+    except UpstreamUnavailableError:
+        breaker.cancel_probe()
+        raise
+    except Exception as e:
+        if started:
+            metrics.observe('upstream_request_duration_seconds', time.perf_counter() - started[0],
+                            operation=operation, outcome='error')
+        if is_upstream_failure(getattr(e, 'code', None), e):
+            breaker.record_failure()
+        else:
+            breaker.cancel_probe()
+        raise
+
+    status_code = getattr(result, 'status_code', None)
+    metrics.observe('upstream_request_duration_seconds', time.perf_counter() - started[0],
+                    operation=operation, outcome=f'{status_code // 100}xx' if isinstance(status_code, int) else 'ok')
+    if is_upstream_failure(status_code):
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return result
+
+def upstream_request(operation: str, method: str, url: str, priority=PRIORITY_DEFAULT, cost_tokens=0,
+                     schedule=True, retry=True, **kwargs) -> requests.Response:
+    """
+    Richiesta HTTP a Gemini via http_session, con breaker, scheduler e timeout di default.
+    Con retry=True ogni tentativo passa da RetryPolicy (il timeout di lettura non supera il budget rimanente).
+    """
+    connect_timeout, read_timeout = kwargs.pop('timeout', (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+    send = getattr(http_session, method.lower())
+
+    def attempt(remaining):
+        timeout = (connect_timeout, max(min(read_timeout, remaining), 1)) if retry else (connect_timeout, read_timeout)
+        return call_upstream(operation, lambda: send(url, timeout=timeout, **kwargs), priority, cost_tokens, schedule)
+
+    if not retry:
+        return attempt(None)
+    return retry_policy.run(attempt, operation)
+
+def get_headers():
+    """Restituisce gli headers per le richieste API"""
+    return {
+        'x-goog-api-key': GEMINI_API_KEY
+    }
+
+# Caratteri riparati: testo UTF-8 decodificato per errore come cp1252/Latin-1 ('Ã¨' -> 'è').
+# Il valore è la forma in uscita (virgolette tipografiche ed ellissi restano normalizzate in ASCII)
+MOJIBAKE_TARGETS = {
+    **{c: c for c in 'àèéìòùáíóúâêîôûäöüçñÀÈÉÌÒÙÁÍÓÚÂÊÎÔÛÄÖÜÇÑß€°±«»§–—'},
+    '“': '"', '”': '"', '„': '"', '‘': "'", '’': "'", '…': '...',
+}
+
+def _mojibake_forms(char: str):
+    """Forme mal decodificate di un carattere: cp1252 (byte non definiti come Latin-1) e Latin-1"""
+    raw = char.encode('utf-8')
+    cp1252 = []
+    for byte in raw:
+        try:
+            cp1252.append(bytes([byte]).decode('cp1252'))
+        except UnicodeDecodeError:
+            cp1252.append(chr(byte))
+    return {''.join(cp1252), raw.decode('latin-1')}
+
+def _build_mojibake_table() -> Dict[str, str]:
+    table = {}
+    for char, output in MOJIBAKE_TARGETS.items():
+        for wrong in _mojibake_forms(char):
+            table[wrong] = output
+    # NBSP di 'à' (C3 A0) spesso normalizzato in spazio lungo il percorso
+    table['Ã '] = 'à'
+    return table
+
+MOJIBAKE_TABLE = _build_mojibake_table()
+# Alternanza unica, chiavi più lunghe prima: una sola passata sul testo
+MOJIBAKE_PATTERN = re.compile('|'.join(re.escape(k) for k in sorted(MOJIBAKE_TABLE, key=len, reverse=True)))
+# Primo carattere di ogni sequenza: se nessuno compare il testo è pulito
+MOJIBAKE_LEADS = frozenset(k[0] for k in MOJIBAKE_TABLE)
+# Prefissi propri delle sequenze: in streaming vanno trattenuti finché non arriva il chunk successivo
+MOJIBAKE_PREFIXES = frozenset(k[:i] for k in MOJIBAKE_TABLE for i in range(1, len(k)))
+MOJIBAKE_MAX_PREFIX = max(len(p) for p in MOJIBAKE_PREFIXES)
+
+def _has_mojibake_leads(text: str) -> bool:
+    return not text.isascii() and any(lead in text for lead in MOJIBAKE_LEADS)
+
+def fix_encoding_issues(text: str) -> str:
+    """
+    Corregge problemi comuni di encoding UTF-8 mal interpretato come Latin-1/cp1252,
+    in una sola passata (regex compilata, sequenza più lunga per prima)
+    """
+    if not text or not _has_mojibake_leads(text):
+        return text
+    return MOJIBAKE_PATTERN.sub(lambda m: MOJIBAKE_TABLE[m.group(0)], text)
+
+class EncodingRepairer:
+    """
+    Variante in streaming di fix_encoding_issues: una sequenza spezzata tra due chunk
+    ('â€' + '™') viene trattenuta a fine chunk e riparata quando arriva il resto.
+    """
+    def __init__(self):
+        self.held = ''
+
+    def feed(self, text: str) -> str:
+        if self.held:
+            text = self.held + text
+            self.held = ''
+        if not text or not _has_mojibake_leads(text):
+            return text
+        for size in range(min(MOJIBAKE_MAX_PREFIX, len(text)), 0, -1):
+            if text[-size:] in MOJIBAKE_PREFIXES:
+                self.held = text[-size:]
+                text = text[:-size]
+                break
+        return fix_encoding_issues(text)
+
+    def flush(self) -> str:
+        """Restituisce l'eventuale coda trattenuta a fine stream"""
+        held, self.held = self.held, ''
+        return fix_encoding_issues(held)
+
+def validate_query_text(query: str) -> tuple[bool, Optional[str]]:
+    """
+    Valida il testo della query
+    Returns: (is_valid, error_message)
+    """
+    if not query or not query.strip():
+        return False, "Query vuota"
+    
+    if len(query) > 2000:
+        return False, "Query troppo lunga (max 2000 caratteri)"
+    
+    # Controllo caratteri pericolosi per injection
+    dangerous_chars = ['<script', 'javascript:', 'onerror=', 'onclick=']
+    query_lower = query.lower()
+    for char in dangerous_chars:
+        if char in query_lower:
             return False, f"Query contiene contenuto non permesso: {char}"
     
     return True, None
@@ -325,7 +2012,7 @@ def validate_config():
         raise ValueError("GEMINI_API_KEY non configurata")
     if not FILE_SEARCH_STORE_NAME:
         raise ValueError("FILE_SEARCH_STORE_NAME non configurato")
-    logger.info(f"Configurazione valida. Store: {FILE_SEARCH_STORE_NAME}")
+    logger.info("Configurazione valida. Store: %s", FILE_SEARCH_STORE_NAME)
 
 def call_generation_provider(messages: list, max_tokens: int = None, temperature: float = 0.7) -> str:
     """
@@ -343,11 +2030,7 @@ def call_generation_provider(messages: list, max_tokens: int = None, temperature
     
     if GENERATION_PROVIDER == 'deepseek':
         # DeepSeek API (compatibile OpenAI)
-        import openai
-        client = openai.OpenAI(
-            api_key=GENERATION_API_KEY,
-            base_url="https://api.deepseek.com"
-        )
+        client = get_openai_client("https://api.deepseek.com")
         
         # Converti formato messaggi
         deepseek_messages = []
@@ -368,8 +2051,7 @@ def call_generation_provider(messages: list, max_tokens: int = None, temperature
     
     elif GENERATION_PROVIDER == 'openai':
         # OpenAI API
-        import openai
-        client = openai.OpenAI(api_key=GENERATION_API_KEY)
+        client = get_openai_client()
         
         openai_messages = []
         for msg in messages:
@@ -407,15 +2089,1749 @@ def call_generation_provider(messages: list, max_tokens: int = None, temperature
             }
         }
         
-        response = http_session.post(generate_url, headers=get_headers(), json=payload, timeout=60)
+        prompt_chars = sum(len(msg.get('content', '')) for msg in messages)
+        response = upstream_request('generate', 'POST', generate_url, PRIORITY_INTERACTIVE,
+                                    upstream_scheduler.estimate_tokens(prompt_chars),
+                                    headers=get_headers(), json=payload)
+        response.raise_for_status()
+        
+        result = response.json()
+        candidates = result.get('candidates', [])
+        if not candidates:
+            raise ValueError('Nessuna risposta generata dal modello')
+        
+        return candidates[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+
+def upstream_unavailable_response(error: UpstreamUnavailableError):
+    """Risposta 503 con Retry-After quando la coda verso Gemini è satura o il circuit breaker è aperto"""
+    body = {
+        'success': False,
+        'error': str(error),
+        'retry_after': error.retry_after
+    }
+    if isinstance(error, CircuitOpenError):
+        body['circuit_breaker_status'] = 'OPEN'
+        body['operation'] = error.operation
+    elif isinstance(error, AdmissionRejectedError):
+        body['reason'] = error.reason
+    response = jsonify(body)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def rate_limited(view=None, *, limiter=None):
+    """
+    Decorator: applica il rate limit per IP del client e aggiunge gli header
+    X-RateLimit-Limit / X-RateLimit-Remaining / X-RateLimit-Reset (e Retry-After su 429).
+    limiter: funzione che restituisce un RateLimiter diverso da quello generale (letto a ogni richiesta)
+    """
+    if view is None:
+        return functools.partial(rate_limited, limiter=limiter)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        active = limiter() if limiter is not None else rate_limiter
+        identifier = request.remote_addr or 'unknown'
+        allowed, remaining, retry_after, reset_after = active.check(identifier)
+        if allowed:
+            response = make_response(view(*args, **kwargs))
+        else:
+            response = jsonify({
+                'success': False,
+                'error': 'Troppe richieste, riprova più tardi',
+                'retry_after': math.ceil(retry_after)
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(retry_after))
+        response.headers['X-RateLimit-Limit'] = str(active.max_requests)
+        response.headers['X-RateLimit-Remaining'] = str(remaining)
+        response.headers['X-RateLimit-Reset'] = str(math.ceil(reset_after))
+        return response
+    return wrapper
+
+def admission_controlled(priority):
+    """
+    Decorator: controllo di ammissione per priorità (chat interattiva prima di export e upload).
+    Rifiuto = 503 rapido con Retry-After; la richiesta resta "in corso" fino alla chiusura
+    della risposta, quindi per gli stream fino alla fine dello streaming.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                admission.admit(priority)
+            except AdmissionRejectedError as e:
+                return upstream_unavailable_response(e)
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                admission.release(priority)
+                raise
+            response.call_on_close(lambda: admission.release(priority))
+            return response
+        return wrapper
+    return decorator
+
+# ==================== RELAY STREAMING SSE ====================
+
+# Codec JSON veloce opzionale (pip install orjson); altrimenti json della libreria standard
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+
+    JSON_CODEC = 'orjson'
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    JSON_CODEC = 'json'
+
+# Batching dei delta: i token che arrivano entro l'intervallo vengono uniti in un solo frame
+STREAM_FLUSH_INTERVAL_MS = int(os.getenv('STREAM_FLUSH_INTERVAL_MS', '50'))
+STREAM_FLUSH_MAX_CHARS = int(os.getenv('STREAM_FLUSH_MAX_CHARS', '512'))
+
+# Header degli stream SSE: niente cache e niente buffering nei proxy (nginx), ogni frame arriva subito
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def sse_frame(obj) -> str:
+    """Serializza un evento SSE 'data:'"""
+    return f"data: {json_dumps(obj)}\n\n"
+
+def sse_event(event: str, obj) -> str:
+    """Evento SSE con nome (i client che leggono solo 'data:' lo ignorano: niente text/done/error)"""
+    return f"event: {event}\ndata: {json_dumps(obj)}\n\n"
+
+def iter_sse_data(chunks):
+    """
+    Parser SSE incrementale sui byte grezzi dello stream (response.iter_content).
+    Restituisce il payload di ogni evento 'data:' senza decodificare le righe una a una;
+    gestisce delimitatori \\n e \\r\\n e righe spezzate tra un chunk di rete e l'altro.
+    """
+    buffer = b''
+    data_lines = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer = buffer + chunk if buffer else chunk
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start)
+            if end < 0:
+                break
+            line = buffer[start:end]
+            start = end + 1
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if not line:
+                # Riga vuota: fine evento
+                if data_lines:
+                    yield data_lines[0] if len(data_lines) == 1 else b'\n'.join(data_lines)
+                    data_lines = []
+            elif line.startswith(b'data:'):
+                data_lines.append(line[6:] if line.startswith(b'data: ') else line[5:])
+            # Campi event:/id:/retry: e commenti non servono al relay
+        buffer = buffer[start:]
+    # Ultimo evento senza riga vuota finale
+    tail = buffer.rstrip(b'\r')
+    if tail.startswith(b'data:'):
+        data_lines.append(tail[6:] if tail.startswith(b'data: ') else tail[5:])
+    if data_lines:
+        yield data_lines[0] if len(data_lines) == 1 else b'\n'.join(data_lines)
+
+def parse_stream_event(data: bytes):
+    """
+    Estrae (testo, finishReason) da un evento di streamGenerateContent.
+    Percorso veloce: per i delta intermedi (un solo part testuale, nessun finishReason)
+    decodifica solo la stringa "text" senza costruire i dizionari dell'evento.
+    """
+    event = data.decode('utf-8')
+    if 'finishReason' not in event and '"thought"' not in event and event.count('"text"') == 1:
+        pos = event.index('"text"') + 6
+        length = len(event)
+        while pos < length and event[pos] in ' \t\r\n:':
+            pos += 1
+        if pos < length and event[pos] == '"':
+            return json_scanstring(event, pos + 1)[0], None
+
+    parsed = json_loads(event)
+    candidates = parsed.get('candidates') or []
+    if not candidates:
+        return None, None
+    candidate = candidates[0]
+    parts = (candidate.get('content') or {}).get('parts') or []
+    text = parts[0].get('text') if parts else None
+    return text, candidate.get('finishReason')
+
+class StreamRelay:
+    """
+    Inoltra al client lo stream SSE di Gemini: parsing incrementale dei byte,
+    correzione encoding dei delta e invio a frame raggruppati ogni flush_interval
+    (o quando il testo in attesa supera max_chars). Accumula il testo completo per la cache.
+    """
+    def __init__(self, flush_interval: float = STREAM_FLUSH_INTERVAL_MS / 1000, max_chars: int = STREAM_FLUSH_MAX_CHARS):
+        self.flush_interval = flush_interval
+        self.max_chars = max_chars
+        self.parts = []
+        self.repairer = EncodingRepairer()
+        self.finish_reason = None
+        self.events = 0
+        self.frames = 0
+        self.parse_errors = 0
+        self.first_text_at = None  # perf_counter del primo frame di testo (time-to-first-token)
+        self.last_text_at = None
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.parts)
+
+    def relay(self, chunks):
+        """Generatore di frame SSE 'data: {"text": ...}' (e avvisi di finishReason anomalo)"""
+        for event in self.deltas(chunks):
+            yield sse_frame(event)
+
+    def deltas(self, chunks):
+        """Come relay(), ma restituisce gli eventi {'text': ...} / {'warning': ...} da serializzare"""
+        pending = []
+        pending_chars = 0
+        last_flush = 0.0  # il primo delta parte subito (time-to-first-token)
+        for data in iter_sse_data(chunks):
+            self.events += 1
+            try:
+                text, finish_reason = parse_stream_event(data)
+            except (ValueError, AttributeError, TypeError, IndexError) as e:
+                self.parse_errors += 1
+                logger.warning("Errore parsing chunk streaming: %s, evento: %r", e, data[:100])
+                continue
+
+            if finish_reason:
+                self.finish_reason = finish_reason
+                if finish_reason != 'STOP':
+                    logger.warning("Streaming terminato con finishReason: %s", finish_reason)
+                    if pending:
+                        self.frames += 1
+                        yield {'text': ''.join(pending)}
+                        pending = []
+                        pending_chars = 0
+                    yield {'warning': f'Risposta incompleta: {finish_reason}'}
+
+            if text:
+                text = self.repairer.feed(text)
+            if text:
+                self.parts.append(text)
+                pending.append(text)
+                pending_chars += len(text)
+                now = time.monotonic()
+                if pending_chars >= self.max_chars or now - last_flush >= self.flush_interval:
+                    self.frames += 1
+                    self.last_text_at = time.perf_counter()
+                    if self.first_text_at is None:
+                        self.first_text_at = self.last_text_at
+                    yield {'text': pending[0] if len(pending) == 1 else ''.join(pending)}
+                    pending = []
+                    pending_chars = 0
+                    last_flush = now
+
+        tail = self.repairer.flush()
+        if tail:
+            self.parts.append(tail)
+            pending.append(tail)
+        if pending:
+            self.frames += 1
+            self.last_text_at = time.perf_counter()
+            if self.first_text_at is None:
+                self.first_text_at = self.last_text_at
+            yield {'text': ''.join(pending)}
+
+    def observe_metrics(self, request_started: Optional[float]):
+        """Registra time-to-first-token, token inviati e token/secondo dello stream"""
+        if self.first_text_at is None:
+            return
+        tokens = len(self.text) / 4
+        metrics.inc('stream_output_tokens_total', tokens)
+        if request_started is not None:
+            metrics.observe('stream_time_to_first_token_seconds', self.first_text_at - request_started)
+        duration = self.last_text_at - self.first_text_at
+        if duration > 0:
+            metrics.observe('stream_tokens_per_second', tokens / duration, buckets=TOKENS_PER_SECOND_BUCKETS)
+
+def stream_timing(relay: StreamRelay, request_started: Optional[float]) -> Optional[dict]:
+    """Tempi dello stream in ms per l'evento SSE finale 'timing' (None se il trace è disattivato)"""
+    trace = request_trace.get()
+    if trace is None:
+        return None
+    timing = {name: round(ms, 1) for name, ms in trace.durations(top_level_only=False).items()}
+    if relay.first_text_at is not None and request_started is not None:
+        timing['first_token'] = round((relay.first_text_at - request_started) * 1000, 1)
+    timing['total'] = round((time.perf_counter() - trace.started) * 1000, 1)
+    return timing
+
+# ==================== BUFFER TRA UPSTREAM E CLIENT ====================
+# Il lettore dello stream di Gemini (producer, thread dedicato) scarica la risposta a piena velocità
+# in un buffer limitato per stream; il generatore della risposta Flask (consumer) lo svuota al ritmo
+# del client. Connessione del pool e slot dello scheduler si liberano quando finisce la generazione,
+# non quando il client più lento ha letto l'ultimo frame. Oltre i limiti si applica la policy:
+# coalesce (i delta di testo in attesa confluiscono nell'ultimo frame), spill (eventi successivi su
+# file temporaneo) o drop (il client viene chiuso con un errore; la generazione arriva comunque in fondo
+# e finisce nella cache risposte, così un nuovo tentativo del client è immediato).
+
+STREAM_BUFFER_POLICY = os.getenv('STREAM_BUFFER_POLICY', 'coalesce').lower()
+STREAM_BUFFER_MAX_FRAMES = int(os.getenv('STREAM_BUFFER_MAX_FRAMES', '64'))
+STREAM_BUFFER_MAX_BYTES = int(os.getenv('STREAM_BUFFER_MAX_BYTES', str(256 * 1024)))
+STREAM_SPILL_MAX_BYTES = int(os.getenv('STREAM_SPILL_MAX_BYTES', str(16 * 1024 * 1024)))
+STREAM_SPILL_DIR = os.getenv('STREAM_SPILL_DIR') or None
+STREAM_BUFFER_POLICIES = ('coalesce', 'spill', 'drop')
+if STREAM_BUFFER_POLICY not in STREAM_BUFFER_POLICIES:
+    logger.warning("STREAM_BUFFER_POLICY non valida (%s), uso coalesce", STREAM_BUFFER_POLICY)
+    STREAM_BUFFER_POLICY = 'coalesce'
+# Byte stimati per frame oltre al testo (prefisso "data: ", JSON, righe vuote)
+STREAM_FRAME_OVERHEAD = 32
+
+
+class StreamBuffer:
+    """
+    Coda limitata di eventi dello stream (dizionari da serializzare con sse_frame) tra un producer
+    e un consumer. put() non blocca mai il producer; drain() blocca il consumer finché arriva un evento
+    e alla fine rilancia l'eventuale errore del producer
+    """
+    def __init__(self, policy: str = STREAM_BUFFER_POLICY, max_frames: int = STREAM_BUFFER_MAX_FRAMES,
+                 max_bytes: int = STREAM_BUFFER_MAX_BYTES, spill_max_bytes: int = STREAM_SPILL_MAX_BYTES):
+        self.policy = policy
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.spill_max_bytes = spill_max_bytes
+        self.queue = deque()
+        self.bytes = 0
+        self.cond = threading.Condition()
+        self.finished = False  # il producer ha terminato
+        self.error = None
+        self.cancelled = False  # il consumer non legge più (client disconnesso)
+        self.dropped = False
+        self.spill = None
+        self.spill_read = 0
+        self.spill_write = 0
+        self.spill_pending = 0
+        self.overflows = 0
+        self.max_depth = 0
+        self.finished_at = None
+
+    @staticmethod
+    def size(event: dict) -> int:
+        return len(event.get('text') or '') + STREAM_FRAME_OVERHEAD
+
+    def put(self, event: dict) -> bool:
+        """Accoda un evento. Returns: False se il consumer non legge più e il producer può fermarsi"""
+        with self.cond:
+            if self.cancelled:
+                return False
+            if self.dropped:
+                return True
+            # Con eventi già su disco i successivi seguono lo stesso percorso per restare in ordine
+            if not self.spill_pending and len(self.queue) < self.max_frames and self.bytes + self.size(event) <= self.max_bytes:
+                self._append(event)
+            else:
+                self._overflow(event)
+            self.cond.notify()
+            return True
+
+    def _append(self, event: dict):
+        self.queue.append(event)
+        self.bytes += self.size(event)
+        self.max_depth = max(self.max_depth, len(self.queue))
+
+    def _overflow(self, event: dict):
+        # Chiamato con il lock già acquisito
+        self.overflows += 1
+        metrics.inc('stream_buffer_overflow_total', policy=self.policy)
+        if self.policy == 'coalesce' and self.bytes + self.size(event) <= self.max_bytes:
+            last = self.queue[-1] if self.queue else None
+            if 'text' in event and last is not None and 'text' in last:
+                last['text'] += event['text']
+                self.bytes += len(event['text'])
+                if 'id' in event:
+                    last['id'] = event['id']
+            else:
+                self._append(event)
+        elif self.policy == 'spill' and self.spill_write + self.size(event) <= self.spill_max_bytes:
+            self._spill(event)
+        else:
+            # Oltre ogni limite (o policy drop): il client resta indietro troppo, lo si chiude
+            logger.warning("Client dello stream troppo lento: %s eventi in attesa, chiuso (policy %s)",
+                           len(self.queue) + self.spill_pending, self.policy)
+            metrics.inc('stream_clients_dropped_total', policy=self.policy)
+            self.dropped = True
+            self.queue.clear()
+            self.bytes = 0
+
+    def _spill(self, event: dict):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(dir=STREAM_SPILL_DIR)
+        self.spill.seek(self.spill_write)
+        self.spill.write(json_dumps(event).encode('utf-8') + b'\n')
+        self.spill_write = self.spill.tell()
+        self.spill_pending += 1
+
+    def _unspill(self) -> dict:
+        self.spill.seek(self.spill_read)
+        event = json_loads(self.spill.readline())
+        self.spill_read = self.spill.tell()
+        self.spill_pending -= 1
+        if not self.spill_pending:
+            # Recuperato tutto: il file ricomincia da capo e si torna alla coda in memoria
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.spill_read = self.spill_write = 0
+        return event
+
+    def finish(self, error: Optional[BaseException] = None):
+        """Chiamato dal producer alla fine (con l'errore che il consumer deve rilanciare)"""
+        with self.cond:
+            self.finished = True
+            self.finished_at = time.perf_counter()
+            self.error = error
+            self.cond.notify()
+
+    def drain(self):
+        """Eventi nell'ordine di arrivo; si ferma presto se il client è stato chiuso (dropped)"""
+        while True:
+            with self.cond:
+                while not (self.queue or self.spill_pending or self.finished or self.dropped):
+                    self.cond.wait()
+                if self.dropped:
+                    return
+                if self.queue:
+                    event = self.queue.popleft()
+                    self.bytes -= self.size(event)
+                elif self.spill_pending:
+                    event = self._unspill()
+                else:
+                    if self.error is not None:
+                        raise self.error
+                    return
+            yield event
+
+    def cancel(self):
+        """
+        Chiamato dal consumer quando smette di leggere: il producer si ferma al prossimo evento,
+        salvo che il client sia stato chiuso per lentezza (la generazione prosegue per la cache)
+        """
+        with self.cond:
+            self.cancelled = not self.dropped
+            self.queue.clear()
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+                self.spill_pending = 0
+
+# ==================== RIPRESA DEGLI STREAM (LAST-EVENT-ID) ====================
+# Ogni stream di generazione ha un id e ogni frame l'id "<stream>:<n>". Il producer registra gli eventi
+# nello stato condiviso (TTL, al più STREAM_REPLAY_MAX_FRAMES per stream): un client che perde la
+# connessione ripete la POST con Last-Event-ID e riceve da qualunque worker i frame mancanti, poi segue
+# la generazione ancora in corso senza una nuova chiamata a Gemini. Con il replay attivo la generazione
+# prosegue anche se il client si disconnette (finisce comunque in cache).
+
+STREAM_REPLAY_ENABLED = os.getenv('STREAM_REPLAY_ENABLED', 'true').lower() == 'true'
+STREAM_REPLAY_TTL = int(os.getenv('STREAM_REPLAY_TTL', '300'))
+STREAM_REPLAY_MAX_FRAMES = int(os.getenv('STREAM_REPLAY_MAX_FRAMES', '2000'))
+STREAM_REPLAY_POLL_INTERVAL = float(os.getenv('STREAM_REPLAY_POLL_INTERVAL', '0.1'))
+STREAM_EVENT_ID_PATTERN = re.compile(r'^([0-9a-f]{16}):(\d{1,9})$')
+
+
+class StreamReplayLog:
+    """
+    Registro dei frame degli stream nello store condiviso: 'stream:<id>' con stato, ultimo id e frame
+    finale (done o errore) e 'stream:<id>:<n>' per ogni evento. follow() rilegge i frame dopo un id e,
+    se lo stream è ancora in corso, attende i successivi fino al frame finale
+    """
+    def __init__(self, store, ttl: float = 300, max_frames: int = 2000, poll_interval: float = 0.1):
+        self.store = store
+        self.ttl = ttl
+        self.max_frames = max_frames
+        self.poll_interval = poll_interval
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex[:16]
+
+    def start(self, stream_id: str):
+        self.store.set(f'stream:{stream_id}', json_dumps({'status': 'running', 'pid': os.getpid()}), ttl=self.ttl)
+
+    def append(self, stream_id: str, seq: int, event: dict):
+        if seq <= self.max_frames:
+            self.store.set(f'stream:{stream_id}:{seq}', json_dumps(event), ttl=self.ttl)
+
+    def finish(self, stream_id: str, seq: int, final: dict):
+        """Frame finale (id seq): {'done': True} o l'evento di errore"""
+        status = 'error' if 'error' in final else 'done'
+        self.store.set(f'stream:{stream_id}', json_dumps({'status': status, 'last': seq, 'final': final}), ttl=self.ttl)
+
+    def meta(self, stream_id: str) -> Optional[dict]:
+        raw = self.store.get(f'stream:{stream_id}')
+        return json_loads(raw) if raw else None
+
+    def frame(self, stream_id: str, seq: int) -> Optional[dict]:
+        raw = self.store.get(f'stream:{stream_id}:{seq}')
+        return json_loads(raw) if raw else None
+
+    def follow(self, stream_id: str, after: int, idle_timeout: float = UPSTREAM_READ_TIMEOUT):
+        """(id, evento) successivi ad after fino al frame finale; errore 'replay_unavailable' se mancano frame"""
+        seq = after
+        idle_since = time.monotonic()
+        while True:
+            event = self.frame(stream_id, seq + 1)
+            if event is not None:
+                seq += 1
+                idle_since = time.monotonic()
+                yield seq, event
+                continue
+            meta = self.meta(stream_id)
+            if meta is not None and meta['status'] != 'running':
+                # Il producer scrive l'ultimo evento prima dello stato finale: ricontrolla prima di concludere
+                if self.frame(stream_id, seq + 1) is not None:
+                    continue
+                if seq + 1 >= meta['last']:
+                    yield meta['last'], meta['final']
+                    return
+            if meta is None or meta['status'] != 'running' or time.monotonic() - idle_since > idle_timeout:
+                yield seq + 1, {'error': 'Stream non più disponibile: ripetere la domanda',
+                                'code': 'replay_unavailable', 'request_id': current_request_id()}
+                return
+            time.sleep(self.poll_interval)
+
+stream_replay = StreamReplayLog(shared_store, STREAM_REPLAY_TTL, STREAM_REPLAY_MAX_FRAMES, STREAM_REPLAY_POLL_INTERVAL)
+
+
+def stream_event_id(stream_id: Optional[str], seq: Optional[int]) -> str:
+    """Riga 'id:' di un frame (vuota senza replay)"""
+    return f"id: {stream_id}:{seq}\n" if stream_id and seq is not None else ''
+
+
+def recorded_stream(stream_id: str, events):
+    """Frame SSE con id di eventi già pronti (es. risposta in cache), registrati per la ripresa"""
+    stream_replay.start(stream_id)
+    yield stream_event_id(stream_id, 0) + sse_event('stream', {'stream_id': stream_id})
+    seq = 0
+    for event in events:
+        seq += 1
+        if 'done' in event or 'error' in event:
+            stream_replay.finish(stream_id, seq, event)
+        else:
+            stream_replay.append(stream_id, seq, event)
+        yield stream_event_id(stream_id, seq) + sse_frame(event)
+
+
+def stream_error_event(error: BaseException) -> dict:
+    """Evento di errore di uno stream (uguale per il client collegato e per chi riprende dal registro)"""
+    if isinstance(error, UpstreamUnavailableError):
+        return {'error': str(error), 'retry_after': error.retry_after, 'request_id': current_request_id()}
+    if isinstance(error, requests.exceptions.HTTPError):
+        return {'error': 'Errore durante la generazione', 'request_id': current_request_id()}
+    return {'error': str(error), 'request_id': current_request_id()}
+
+# ==================== RERANKING LOCALE DEI CHUNK ====================
+# Prima della generazione i chunk ricevuti vengono riordinati in locale: lo score del File Search
+# viene combinato con la copertura lessicale della domanda, la lista viene tagliata al "ginocchio"
+# della curva degli score (invece della soglia fissa MIN_RELEVANCE_SCORE) e la selezione MMR
+# scarta i quasi duplicati (chunk sovrapposti della stessa pagina) che sprecherebbero token del prompt.
+# I vettori dei termini (hashing in RERANK_DIMENSIONS dimensioni, tf logaritmico, norma L2) restano
+# in una cache LRU per processo: i chunk si ripetono tra i turni e la tokenizzazione è la parte costosa.
+
+RERANK_ENABLED = os.getenv('RERANK_ENABLED', 'true').lower() == 'true'
+RERANK_LEXICAL_WEIGHT = float(os.getenv('RERANK_LEXICAL_WEIGHT', '0.3'))
+RERANK_MMR_LAMBDA = float(os.getenv('RERANK_MMR_LAMBDA', '0.7'))
+RERANK_DUPLICATE_SIMILARITY = float(os.getenv('RERANK_DUPLICATE_SIMILARITY', '0.9'))
+RERANK_MIN_CHUNKS = int(os.getenv('RERANK_MIN_CHUNKS', '3'))
+RERANK_VECTOR_CACHE_SIZE = int(os.getenv('RERANK_VECTOR_CACHE_SIZE', '2048'))
+RERANK_DIMENSIONS = 1024
+# Sotto questa distanza dalla corda la curva degli score è quasi lineare: nessun ginocchio, si tiene tutto
+RERANK_KNEE_MIN_DISTANCE = 0.1
+TERM_PATTERN = re.compile(r'\w{3,}')
+
+
+def chunk_text(chunk: dict) -> str:
+    """Testo di un chunk in uno dei formati ricevuti: export nidificato, piatto o da /api/chat/query"""
+    return (chunk.get('chunk', {}).get('data', {}).get('stringValue', '')
+            or chunk.get('stringValue', '') or chunk.get('chunkText', ''))
+
+
+def term_hashes(np, text: str, return_counts: bool = False):
+    """Hash (a 32 bit, nel processo) dei termini distinti di almeno 3 caratteri, con le occorrenze se richieste"""
+    return np.unique(np.fromiter((hash(term) & 0xFFFFFFFF for term in TERM_PATTERN.findall(text.lower())), dtype=np.uint32),
+                     return_counts=return_counts)
+
+
+class TermVectorCache:
+    """
+    LRU dei vettori dei termini per testo: (vettore denso normalizzato, hash dei termini distinti).
+    Il vettore (hash modulo RERANK_DIMENSIONS, ~4KB) serve alla similarità tra chunk, gli hash completi
+    alla copertura esatta dei termini della domanda. La chiave è l'hash del testo nel processo
+    """
+    def __init__(self, max_entries: int = 2048):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def vectorize(self, np, text: str) -> tuple:
+        terms, counts = term_hashes(np, text, return_counts=True)
+        vector = np.bincount(terms % RERANK_DIMENSIONS, weights=np.log1p(counts), minlength=RERANK_DIMENSIONS)
+        norm = float(np.linalg.norm(vector))
+        return (vector / norm if norm else vector).astype(np.float32), terms
+
+    def get_many(self, np, texts: list) -> list:
+        """Vettori dei testi: un solo passaggio sotto lock per le hit, tokenizzazione solo per le miss"""
+        keys = [hash(text) for text in texts]
+        with self.lock:
+            vectors = [self.entries.get(key) for key in keys]
+            for key, vector in zip(keys, vectors):
+                if vector is not None:
+                    self.entries.move_to_end(key)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        for i in missing:
+            vectors[i] = self.vectorize(np, texts[i])
+        with self.lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+            for i in missing:
+                self.entries[keys[i]] = vectors[i]
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return vectors
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+term_vectors = TermVectorCache(RERANK_VECTOR_CACHE_SIZE)
+
+
+def knee_cutoff(np, sorted_scores, minimum: int) -> int:
+    """
+    Numero di chunk da tenere: quelli prima del ginocchio della curva degli score decrescenti,
+    cioè del punto più lontano sotto la corda tra il primo e l'ultimo (Kneedle)
+    """
+    count = len(sorted_scores)
+    spread = float(sorted_scores[0] - sorted_scores[-1]) if count else 0.0
+    if count <= minimum or spread <= 1e-9:
+        return count
+    x = np.linspace(0.0, 1.0, count)
+    y = (sorted_scores - sorted_scores[-1]) / spread
+    distance = (1.0 - x) - y
+    knee = int(np.argmax(distance))
+    if distance[knee] < RERANK_KNEE_MIN_DISTANCE:
+        return count
+    return max(knee, minimum)
+
+
+def rerank_chunks(query_text: str, chunks: list, limit: int) -> Optional[tuple]:
+    """
+    Riordina e seleziona i chunk per la generazione.
+    Returns: (chunk scelti in ordine MMR, chunk sopra il ginocchio, duplicati scartati) o None senza numpy
+    """
+    np = load_numpy()
+    if np is None:
+        return None
+    count = len(chunks)
+    vectors = term_vectors.get_many(np, [chunk_text(chunk) for chunk in chunks])
+
+    # Copertura lessicale: quota dei termini distinti della domanda presenti nel chunk
+    query_terms = term_hashes(np, query_text)
+    lexical = np.zeros(count, dtype=np.float32)
+    if len(query_terms):
+        term_rows = np.repeat(np.arange(count), [len(terms) for _, terms in vectors])
+        found = np.isin(np.concatenate([terms for _, terms in vectors]), query_terms)
+        lexical = np.bincount(term_rows[found], minlength=count) / len(query_terms)
+    upstream = np.clip(np.array([float(c.get('chunkRelevanceScore') or 0) for c in chunks], dtype=np.float32), 0, 1)
+    fused = (1 - RERANK_LEXICAL_WEIGHT) * upstream + RERANK_LEXICAL_WEIGHT * lexical
+
+    order = np.argsort(-fused, kind='stable')
+    candidates = order[:knee_cutoff(np, fused[order], RERANK_MIN_CHUNKS)]
+
+    matrix = np.stack([vectors[i][0] for i in candidates])
+
+    # MMR: a ogni passo il candidato con il miglior compromesso tra score e novità rispetto ai già scelti;
+    # le similarità si calcolano solo rispetto ai chunk scelti (k prodotti matrice-vettore)
+    relevance = RERANK_MMR_LAMBDA * fused[candidates]
+    max_similarity = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    selected, duplicates = [], 0
+    while len(selected) < limit and available.any():
+        mmr = np.where(available, relevance - (1 - RERANK_MMR_LAMBDA) * max_similarity, -np.inf)
+        best = int(np.argmax(mmr))
+        available[best] = False
+        if max_similarity[best] >= RERANK_DUPLICATE_SIMILARITY:
+            duplicates += 1
+            continue
+        selected.append(best)
+        np.maximum(max_similarity, matrix @ matrix[best], out=max_similarity)
+
+    return ([chunks[candidates[i]] for i in selected],
+            [chunks[i] for i in candidates], duplicates)
+
+
+def context_tokens(chunks: list) -> int:
+    """Stima dei token del contesto (~4 caratteri per token, come lo scheduler)"""
+    return sum(len(chunk_text(chunk)) for chunk in chunks) // 4
+
+# ==================== ARCHIVIO DEI CHUNK (CONTENT-ADDRESSED) ====================
+# /api/chat/query restituisce per ogni chunk un id (hash del testo) e un'anteprima; la generazione
+# riceve gli id e recupera i testi qui invece di farseli rinviare dal browser a ogni turno.
+# LRU per processo davanti allo stato condiviso (TTL): un id emesso da un worker si risolve in tutti.
+# Se un id non è più disponibile la generazione risponde 409 con gli id mancanti e il client
+# ripete il retrieval con il testo completo.
+
+CHUNK_STORE_MAX_ENTRIES = int(os.getenv('CHUNK_STORE_MAX_ENTRIES', '5000'))
+CHUNK_STORE_TTL = int(os.getenv('CHUNK_STORE_TTL', '3600'))
+CHUNK_PREVIEW_CHARS = int(os.getenv('CHUNK_PREVIEW_CHARS', '200'))
+CHUNK_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class ChunkStore:
+    """
+    Testi dei chunk per hash del contenuto (blake2b a 128 bit). Le voci locali ricordano quando sono
+    state scritte nello stato condiviso e vengono riscritte a metà TTL, così un chunk usato di frequente
+    non scade per gli altri worker. I testi letti dallo stato condiviso vengono verificati con l'hash
+    """
+    def __init__(self, store, max_entries: int = 5000, ttl: float = 3600):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # {chunk_id: (text, scritto nello store condiviso alle)}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_id(text: str) -> str:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _remember(self, chunk_id: str, text: str, shared_at: float):
+        # Chiamato con il lock già acquisito
+        self.entries[chunk_id] = (text, shared_at)
+        self.entries.move_to_end(chunk_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(self, text: str) -> str:
+        """Memorizza un testo e ne restituisce l'id"""
+        chunk_id = self.make_id(text)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(chunk_id)
+            share = entry is None or now - entry[1] > self.ttl / 2
+            self._remember(chunk_id, text, now if share else entry[1])
+        if share:
+            self.store.set(f'chunk:{chunk_id}', text, ttl=self.ttl)
+        return chunk_id
+
+    def get_many(self, chunk_ids: list) -> dict:
+        """Testi degli id noti: prima la LRU locale, poi lo stato condiviso. Returns: {chunk_id: testo}"""
+        found = {}
+        with self.lock:
+            for chunk_id in chunk_ids:
+                entry = self.entries.get(chunk_id)
+                if entry is not None:
+                    self.entries.move_to_end(chunk_id)
+                    found[chunk_id] = entry[0]
+        if found:
+            metrics.inc('chunk_store_lookups_total', len(found), result='local')
+        for chunk_id in chunk_ids:
+            if chunk_id in found:
+                continue
+            text = self.store.get(f'chunk:{chunk_id}')
+            if text is None or self.make_id(text) != chunk_id:
+                metrics.inc('chunk_store_lookups_total', result='missing')
+                continue
+            metrics.inc('chunk_store_lookups_total', result='shared')
+            found[chunk_id] = text
+            with self.lock:
+                self._remember(chunk_id, text, time.time())
+        return found
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+chunk_store = ChunkStore(shared_store, CHUNK_STORE_MAX_ENTRIES, CHUNK_STORE_TTL)
+
+
+def chunk_reference(chunk: dict, chunk_id: str, text: str) -> dict:
+    """Chunk senza testo: id, anteprima e gli altri campi (score, documento, store)"""
+    reference = {k: v for k, v in chunk.items() if k not in ('chunk', 'stringValue', 'chunkText')}
+    reference['chunkId'] = chunk_id
+    reference['chunkPreview'] = text[:CHUNK_PREVIEW_CHARS]
+    return reference
+
+
+def publish_chunks(chunks: list, include_text: bool = True) -> list:
+    """Registra i testi nell'archivio e aggiunge chunkId; senza include_text solo riferimento e anteprima"""
+    published = []
+    for chunk in chunks:
+        text = chunk_text(chunk)
+        if not text:
+            published.append(chunk)
+            continue
+        chunk_id = chunk_store.put(text)
+        published.append(dict(chunk, chunkId=chunk_id) if include_text else chunk_reference(chunk, chunk_id, text))
+    return published
+
+
+class ChunkReferenceError(ValueError):
+    """relevant_chunks non valido (formato o id malformato)"""
+
+
+def resolve_chunks(relevant_chunks) -> tuple[list, list, bool]:
+    """
+    Testi dei chunk ricevuti per la generazione: quelli con il testo vengono usati così come sono
+    (e registrati nell'archivio), quelli con solo chunkId vengono cercati nell'archivio.
+    Returns: (chunk con il testo, id non più disponibili, True se almeno un chunk era un riferimento)
+    """
+    if not isinstance(relevant_chunks, list) or not all(isinstance(c, dict) for c in relevant_chunks):
+        raise ChunkReferenceError('relevant_chunks deve essere una lista di chunk')
+    references = [c['chunkId'] for c in relevant_chunks if not chunk_text(c) and c.get('chunkId')]
+    for chunk_id in references:
+        if not isinstance(chunk_id, str) or not CHUNK_ID_PATTERN.match(chunk_id):
+            raise ChunkReferenceError(f'chunkId non valido: {str(chunk_id)[:40]}')
+    texts = chunk_store.get_many(list(dict.fromkeys(references))) if references else {}
+    resolved, missing = [], []
+    for chunk in relevant_chunks:
+        if chunk_text(chunk):
+            chunk_store.put(chunk_text(chunk))
+            resolved.append(chunk)
+        elif chunk.get('chunkId') in texts:
+            fields = {k: v for k, v in chunk.items() if k != 'chunkPreview'}
+            resolved.append(dict(fields, chunkText=texts[chunk['chunkId']]))
+        elif chunk.get('chunkId'):
+            missing.append(chunk['chunkId'])
+    return resolved, list(dict.fromkeys(missing)), bool(references)
+
+
+def chunks_evicted_response(missing: list):
+    """409 con gli id non più disponibili: il client ripete il retrieval con il testo completo"""
+    logger.info("Chunk non più in archivio: %s id, richiesto il testo completo", len(missing))
+    return jsonify({
+        'success': False,
+        'error': 'Testo dei chunk non più disponibile sul server: reinviare i chunk con il testo',
+        'code': 'chunks_evicted',
+        'missing_chunk_ids': missing,
+    }), 409
+
+# ==================== GENERAZIONE (helpers) ====================
+
+# System instruction compatto
+GENERATION_SYSTEM_INSTRUCTION = """Du bist ein KI-Assistent, der AUSSCHLIESSLICH auf Grundlage der bereitgestellten Dokumente antwortet.
+Antworte klar und präzise und extrahiere nur die relevanten Informationen."""
+
+def select_chunks_by_threshold(relevant_chunks: list) -> tuple[list, list]:
+    """
+    Filtra chunk per generazione basandoci sulla rilevanza
+    Returns: (chunks_to_use, high_score_chunks)
+    """
+    high_score_chunks = [
+        chunk for chunk in relevant_chunks
+        if chunk.get('chunkRelevanceScore', 0) >= MIN_RELEVANCE_SCORE
+    ]
+
+    # Se non ci sono chunk con score alto, usa comunque i migliori disponibili
+    if not high_score_chunks and relevant_chunks:
+        logger.warning("Nessun chunk supera MIN_RELEVANCE_SCORE=%s, uso i migliori %s disponibili", MIN_RELEVANCE_SCORE, MAX_CHUNKS_FOR_GENERATION)
+        return relevant_chunks[:MAX_CHUNKS_FOR_GENERATION], high_score_chunks
+
+    # Se abbiamo troppi chunk anche dopo il filtro, prendi i top N
+    return high_score_chunks[:MAX_CHUNKS_FOR_GENERATION], high_score_chunks
+
+def select_chunks_for_generation(relevant_chunks: list, query_text: str = '') -> tuple[list, list, dict]:
+    """
+    Chunk per la generazione: reranking locale se abilitato e numpy è disponibile, altrimenti soglia fissa.
+    Returns: (chunks_to_use, chunk sopra soglia/ginocchio, report con i token di contesto risparmiati
+    rispetto alla soglia fissa)
+    """
+    started = time.perf_counter()
+    baseline, high_score_chunks = select_chunks_by_threshold(relevant_chunks)
+    reranked = None
+    if RERANK_ENABLED and query_text and len(relevant_chunks) > 1:
+        reranked = rerank_chunks(query_text, relevant_chunks, MAX_CHUNKS_FOR_GENERATION)
+    if reranked is None:
+        chunks_to_use, duplicates, selection = baseline, 0, 'threshold'
+    else:
+        chunks_to_use, high_score_chunks, duplicates = reranked
+        selection = 'rerank'
+
+    report = {
+        'selection': selection,
+        'chunks_received': len(relevant_chunks),
+        'chunks_used': len(chunks_to_use),
+        'duplicates_dropped': duplicates,
+        'context_tokens': context_tokens(chunks_to_use),
+        'context_tokens_threshold': context_tokens(baseline),
+        'ms': round((time.perf_counter() - started) * 1000, 3),
+    }
+    report['context_tokens_saved'] = report['context_tokens_threshold'] - report['context_tokens']
+    metrics.inc('generation_context_tokens_total', report['context_tokens'], selection=selection)
+    metrics.inc('generation_context_tokens_total', report['context_tokens_threshold'], selection='threshold_baseline')
+    return chunks_to_use, high_score_chunks, report
+
+def build_generation_prompt(query_text: str, chunks_to_use: list, chat_history: list) -> str:
+    """
+    Costruisce un singolo prompt con: system instruction + contesto + domande precedenti + domanda corrente
+    """
+    # Costruisci il contesto dai chunk rilevanti
+    context_parts = []
+    if chunks_to_use:
+        context_parts.append("CONTESTO DOCUMENTI:\n\n")
+        for i, chunk in enumerate(chunks_to_use, 1):
+            # Supporta tutti i formati: nidificato, piatto e quello di /api/chat/query
+            text = chunk_text(chunk)
+            source = chunk.get('source_document') or chunk.get('sourceDocument') or 'documento'
+            if text:
+                context_parts.append(f"[Frammento {i} da {source}]:\n{text}\n\n")
+
+    # STRATEGIA OTTIMIZZATA: Invia solo le DOMANDE dell'utente (non le risposte)
+    # Questo riduce drasticamente i token usati mantenendo il contesto della conversazione
+    user_questions = [msg.get('text', '') for msg in chat_history if msg.get('role') == 'user']
+
+    # Limita al numero massimo configurato
+    max_history_messages = MAX_CHAT_HISTORY * 2  # Moltiplica per 2 perché contiamo solo user
+    recent_questions = user_questions[-max_history_messages:] if len(user_questions) > max_history_messages else user_questions
+
+    # Rimuovi duplicati (a volte il frontend invia la stessa domanda 2 volte)
+    unique_questions = []
+    seen = set()
+    for q in recent_questions:
+        if q and q not in seen:
+            unique_questions.append(q)
+            seen.add(q)
+
+    user_prompt = GENERATION_SYSTEM_INSTRUCTION + "\n\n"
+
+    # Aggiungi il contesto dei documenti
+    user_prompt += ''.join(context_parts)
+
+    # Aggiungi cronologia domande precedenti (se ci sono)
+    if unique_questions:
+        user_prompt += "\n\nCONTESTO CONVERSAZIONE - Domande precedenti dell'utente:\n"
+        for i, q in enumerate(unique_questions, 1):
+            user_prompt += f"{i}. {q}\n"
+        user_prompt += "\n"
+
+    # Aggiungi la domanda corrente
+    user_prompt += f"DOMANDA CORRENTE: {query_text}\n\nRISPOSTA:"
+
+    return user_prompt
+
+def build_generation_payload(user_prompt: str) -> dict:
+    """Payload generateContent/streamGenerateContent con un singolo messaggio user"""
+    return {
+        'contents': [{
+            'role': 'user',
+            'parts': [{'text': user_prompt}]
+        }],
+        'generationConfig': {
+            'temperature': 0.7,
+            'topK': 40,
+            'topP': 0.95,
+            'maxOutputTokens': 8192,  # Aumentato per risposte più lunghe (era 2048)
+        }
+    }
+
+def estimate_payload_tokens(payload: dict) -> int:
+    """Costo stimato in token di un payload generateContent, per lo scheduler"""
+    prompt_chars = sum(len(part.get('text', '')) for content in payload.get('contents', []) for part in content.get('parts', []))
+    return upstream_scheduler.estimate_tokens(prompt_chars)
+
+def request_generate_content(model: str, payload: dict, priority: int = PRIORITY_INTERACTIVE) -> dict:
+    """
+    Esegue generateContent con retries su 429/5xx e timeout
+    Returns: il JSON della risposta del modello
+    """
+    generate_url = f"{BASE_URL}/models/{model}:generateContent"
+    cost_tokens = estimate_payload_tokens(payload)
+
+    # Retry con jitter e Retry-After gestiti da RetryPolicy; il breaker 'generate' registra gli esiti
+    response = upstream_request('generate', 'POST', generate_url, priority, cost_tokens,
+                                headers=get_headers(), json=payload)
+    response.raise_for_status()
+
+    return response.json()
+
+def extract_response_text(result: dict) -> Optional[str]:
+    """Estrae il testo dal primo candidato; None se il modello non ha prodotto candidati"""
+    candidates = result.get('candidates', [])
+    if not candidates:
+        return None
+    return candidates[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+
+def refresh_cached_response(cache_key: str, model: str, payload: dict):
+    """Rigenera in background una risposta stale (stale-while-revalidate)"""
+    if not response_cache.begin_refresh(cache_key):
+        return
+
+    def worker():
+        try:
+            response_text = extract_response_text(request_generate_content(model, payload, PRIORITY_DEFAULT))
+            if response_text:
+                response_cache.set(cache_key, fix_encoding_issues(response_text))
+                logger.info("Cache risposte aggiornata in background (%s)", cache_key[:12])
+        except Exception as e:
+            logger.warning("Refresh in background della risposta fallito: %s", e)
+        finally:
+            response_cache.end_refresh(cache_key)
+
+    # Il refresh eredita il contesto di log (request id) della richiesta che lo ha avviato
+    threading.Thread(target=contextvars.copy_context().run, args=(worker,), name='response-cache-refresh', daemon=True).start()
+
+def replay_cached_response(response_text: str):
+    """Riproduce una risposta in cache come stream SSE, con pacing opzionale"""
+    for event in cached_response_events(response_text):
+        yield sse_frame(event)
+
+def cached_response_events(response_text: str):
+    """Eventi della riproduzione di una risposta in cache (testo a pezzi, poi done)"""
+    size = RESPONSE_CACHE_REPLAY_CHUNK_CHARS
+    if size <= 0:
+        pieces = [response_text]
+    else:
+        pieces = [response_text[i:i + size] for i in range(0, len(response_text), size)]
+
+    for i, piece in enumerate(pieces):
+        if i and RESPONSE_CACHE_REPLAY_DELAY_MS > 0:
+            time.sleep(RESPONSE_CACHE_REPLAY_DELAY_MS / 1000)
+        yield {'text': piece}
+
+    yield {'done': True, 'cached': True}
+
+# ==================== COMPRESSIONE E CACHE HTTP ====================
+# Compressione delle risposte negoziata con Accept-Encoding: brotli se installato (pip install brotli),
+# altrimenti gzip. Le risposte JSON sotto la soglia restano in chiaro; gli stream (SSE) sono compressi
+# frame per frame con un flush dopo ogni frame, così il client riceve ogni token senza attendere il buffer.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'true').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))  # byte
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4'))
+COMPRESSION_STREAMS = os.getenv('COMPRESSION_STREAMS', 'true').lower() == 'true'
+COMPRESSIBLE_MIMETYPES = frozenset({
+    'application/json', 'application/x-ndjson', 'text/event-stream', 'text/plain', 'text/html',
+    'text/css', 'application/javascript',
+})
+
+class GzipEncoder:
+    """Compressore gzip incrementale (flush con Z_SYNC_FLUSH: il client decodifica tutto quanto ricevuto)"""
+    name = 'gzip'
+
+    def __init__(self, level: int = COMPRESSION_GZIP_LEVEL):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+class BrotliEncoder:
+    """Compressore brotli incrementale (modalità testo)"""
+    name = 'br'
+
+    def __init__(self, quality: int = COMPRESSION_BROTLI_QUALITY):
+        self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+    def finish(self) -> bytes:
+        return self.compressor.finish()
+
+# In ordine di preferenza del server a parità di qualità richiesta dal client
+RESPONSE_ENCODERS = {'gzip': GzipEncoder}
+if brotli is not None:
+    RESPONSE_ENCODERS = {'br': BrotliEncoder, **RESPONSE_ENCODERS}
+
+def negotiate_encoding() -> Optional[str]:
+    """Codifica migliore tra quelle accettate dal client (None = nessuna compressione)"""
+    return request.accept_encodings.best_match(list(RESPONSE_ENCODERS))
+
+def compress_stream(chunks, encoder):
+    """Comprime uno stream frame per frame; chiude lo stream originale anche se il client si disconnette"""
+    raw = compressed = 0
+    cpu = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+            started = time.thread_time()
+            data = encoder.compress(chunk) + encoder.flush()
+            cpu += time.thread_time() - started
+            raw += len(chunk)
+            compressed += len(data)
+            yield data
+        tail = encoder.finish()
+        compressed += len(tail)
+        yield tail
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+        record_compression(encoder.name, raw, compressed, cpu)
+
+def record_compression(encoding: str, raw: int, compressed: int, cpu: float):
+    metrics.inc('http_compression_bytes_total', raw, encoding=encoding, stage='in')
+    metrics.inc('http_compression_bytes_total', compressed, encoding=encoding, stage='out')
+    metrics.inc('http_compression_cpu_seconds_total', cpu, encoding=encoding)
+
+@app.after_request
+def compress_response(response):
+    """Content-Encoding secondo Accept-Encoding per JSON oltre la soglia e per gli stream"""
+    if (not COMPRESSION_ENABLED or request.method == 'HEAD' or response.status_code < 200
+            or response.status_code in (204, 206, 304) or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough):
+        return response
+    if response.is_streamed and not COMPRESSION_STREAMS:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+    encoder = RESPONSE_ENCODERS[encoding]()
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoder)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        started = time.thread_time()
+        body = encoder.compress(data) + encoder.finish()
+        record_compression(encoding, len(data), len(body), time.thread_time() - started)
+        response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    # Byte diversi per codifica: un ETag forte diventerebbe falso, quindi diventa debole
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def conditional_response(response):
+    """
+    ETag debole calcolato sul corpo JSON: con If-None-Match uguale (GET/HEAD) la risposta diventa
+    un 304 senza corpo. Cache-Control no-cache: il browser riusa la sua copia solo dopo la rivalidazione.
+    """
+    if response.status_code != 200:
+        return response
+    response.set_etag(hashlib.blake2b(response.get_data(), digest_size=16).hexdigest(), weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+# ==================== HEALTH / READINESS ====================
+
+HEALTH_PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL', '15'))
+HEALTH_PROBE_TIMEOUT = float(os.getenv('HEALTH_PROBE_TIMEOUT', '5'))
+HEALTH_PROBE_STALE_AFTER = float(os.getenv('HEALTH_PROBE_STALE_AFTER', str(max(HEALTH_PROBE_INTERVAL * 4, 30))))
+# Load shedding: /readyz fallisce oltre questi stream aperti nel worker / richieste in coda nello scheduler (0 = disattivato)
+READY_MAX_STREAMS_IN_FLIGHT = int(os.getenv('READY_MAX_STREAMS_IN_FLIGHT', '0'))
+READY_MAX_QUEUE_DEPTH = int(os.getenv('READY_MAX_QUEUE_DEPTH', '0'))
+
+class HealthProbe:
+    """
+    Stato di salute aggiornato in background da un thread per worker (avviato al primo /readyz):
+    ogni secondo store condiviso, breaker e scheduler; ogni `interval` secondi una GET del
+    File Search Store su Gemini (chiave, raggiungibilità e store in una sola chiamata).
+    La sonda upstream è coordinata tramite lo store condiviso: al più una chiamata per
+    intervallo sull'intero nodo, gli altri worker riusano il risultato pubblicato.
+    /readyz legge solo l'ultimo risultato in memoria, senza mai chiamare Gemini.
+    """
+    RESULT_KEY = 'health:upstream'
+    LEASE_KEY = 'health:upstream:lease'
+    # Quota o sovraccarico di Gemini: l'API risponde, e il limite è comune a tutti i nodi.
+    # Togliere il nodo dalla rotazione non serve (lo farebbero tutti insieme): ci pensano scheduler e breaker
+    THROTTLED_STATUSES = (429, 503)
+    TICK = 1.0
+
+    def __init__(self, interval: float = 15.0, timeout: float = 5.0, stale_after: float = 60.0, autostart: bool = True):
+        self.interval = interval
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.autostart = autostart
+        self.state = None      # ultimo risultato completo (dict), sostituito in blocco dal thread
+        self.upstream = None
+        self.started_pid = None
+        self.booted_at = time.time()
+
+    def ensure_started(self):
+        # Un thread per processo, anche dopo il fork dei worker gunicorn
+        if not self.autostart or self.started_pid == os.getpid():
+            return
+        self.started_pid = os.getpid()
+        if self.state is None:
+            # Primo stato subito: controlli locali e sonda già pubblicata da un altro worker, mai Gemini inline
+            try:
+                self.refresh(allow_probe=False)
+            except Exception as e:
+                logger.warning("Sonda di salute fallita: %s", e)
+        threading.Thread(target=self._loop, name='health-probe', daemon=True).start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning("Sonda di salute fallita: %s", e)
+            time.sleep(self.TICK)
+
+    def refresh(self, allow_probe: bool = True):
+        """Un giro di controlli; la chiamata a Gemini solo se il risultato condiviso è scaduto"""
+        now = time.time()
+        started = time.perf_counter()
+        try:
+            shared_store.set('health:ping', repr(now), ttl=60)
+            store = {'ok': shared_store.get('health:ping') == repr(now), 'backend': shared_store.backend}
+        except Exception as e:
+            store = {'ok': False, 'backend': shared_store.backend, 'error': str(e)}
+        store['latency_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+        if self.interval > 0 and store['ok']:
+            self.upstream = self._upstream(now, allow_probe)
+        elif self.interval <= 0:
+            self.upstream = {'ok': True, 'skipped': True, 'checked_at': now}
+
+        scheduler = upstream_scheduler.stats()
+        self.state = {
+            'checked_at': now,
+            'store': store,
+            'upstream': self.upstream,
+            'breakers': {operation: stats['state'] for operation, stats in circuit_breakers.stats().items()},
+            'scheduler': {
+                'queue_depth': sum(scheduler['queue_depth'].values()),
+                'in_flight': scheduler['in_flight'],
+                'max_concurrency': scheduler['limits']['max_concurrency'],
+            },
+        }
+
+    def _upstream(self, now: float, allow_probe: bool = True) -> Optional[dict]:
+        raw = shared_store.get(self.RESULT_KEY)
+        published = json.loads(raw) if raw else None
+        if published and now - published['checked_at'] < self.interval:
+            return published
+        if not allow_probe:
+            return published or self.upstream
+
+        def claim(current):
+            if current:
+                return current, False
+            return str(os.getpid()), True
+
+        # Un solo worker per intervallo esegue la sonda; gli altri tengono l'ultimo valore noto
+        if not shared_store.update(self.LEASE_KEY, claim, ttl=max(self.interval, self.timeout)):
+            return published or self.upstream
+        result = self.probe_upstream()
+        shared_store.set(self.RESULT_KEY, json.dumps(result), ttl=max(self.stale_after, self.interval) * 2)
+        return result
+
+    def probe_upstream(self) -> dict:
+        """GET del File Search Store, fuori da scheduler e breaker (non consuma la coda utente)"""
+        checked_at = time.time()
+        if not (GEMINI_API_KEY and FILE_SEARCH_STORE_NAME):
+            return {'ok': False, 'checked_at': checked_at, 'error': 'GEMINI_API_KEY o FILE_SEARCH_STORE_NAME non impostati'}
+        started = time.perf_counter()
+        try:
+            response = http_session.get(f'{BASE_URL}/{FILE_SEARCH_STORE_NAME}', headers=get_headers(),
+                                        timeout=self.timeout)
+            result = {'ok': response.status_code == 200, 'status': response.status_code}
+            if response.status_code in self.THROTTLED_STATUSES:
+                result.update(ok=True, degraded='throttled')
+        except requests.exceptions.RequestException as e:
+            result = {'ok': False, 'error': type(e).__name__}
+        result['checked_at'] = checked_at
+        result['latency_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        if not result['ok']:
+            logger.warning("Sonda Gemini fallita: %s", result)
+        elif result.get('degraded'):
+            logger.warning("Sonda Gemini: raggiungibile ma limitata (%s)", result['status'])
+        return result
+
+    def readiness(self) -> tuple[bool, dict]:
+        """(pronto, dettaglio) dal solo stato in memoria"""
+        self.ensure_started()
+        state = self.state
+        streams = metrics.gauges.get('streams_in_flight', 0)
+        reasons = []
+        degraded = []
+        if state is None:
+            reasons.append('probe_pending')
+        else:
+            if time.time() - state['checked_at'] > self.stale_after:
+                reasons.append('probe_stale')
+            if not state['store']['ok']:
+                reasons.append('store')
+            if state['upstream'] is None:
+                reasons.append('probe_pending')
+            elif not state['upstream']['ok']:
+                reasons.append('upstream')
+            elif state['upstream'].get('degraded'):
+                degraded.append(f"upstream_{state['upstream']['degraded']}")
+            if READY_MAX_QUEUE_DEPTH > 0 and state['scheduler']['queue_depth'] >= READY_MAX_QUEUE_DEPTH:
+                reasons.append('queue_saturated')
+        if READY_MAX_STREAMS_IN_FLIGHT > 0 and streams > READY_MAX_STREAMS_IN_FLIGHT:
+            reasons.append('load_shedding')
+        detail = {
+            'ready': not reasons,
+            'reasons': reasons,
+            'degraded': degraded,
+            'pid': os.getpid(),
+            'streams_in_flight': streams,
+            'checks': state,
+        }
+        return not reasons, detail
+
+health_probe = HealthProbe(HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT, HEALTH_PROBE_STALE_AFTER)
+
+# ==================== ARCHIVIO DEGLI ORIGINALI (DOWNLOAD) ====================
+
+# Copia locale del file originale a ogni upload, servita da /api/documents/<name>/download
+DOCUMENTS_STORAGE_ENABLED = os.getenv('DOCUMENTS_STORAGE_ENABLED', 'true').lower() == 'true'
+DOCUMENT_HASH_BLOCK = 1024 * 1024
+# Blocchi del file_wrapper del server (con gunicorn il corpo parte con sendfile, senza passare da Python)
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+
+
+class DocumentStorage:
+    """
+    Originali dei documenti caricati, sul filesystem condiviso dai worker (DOCUMENTS_STORAGE).
+    All'upload il file va in pending/ sotto il nome dell'operazione; quando l'operazione termina
+    (watcher o polling, in qualunque worker) passa con un rename atomico in files/ sotto il nome del
+    documento Gemini. Accanto a ogni file un .json con nome originale, MIME type, dimensione, hash
+    del contenuto (ETag forte, valido per If-Range) e operazione di origine.
+    """
+    def __init__(self, root: str, enabled: bool = True):
+        self.root = root
+        self.enabled = enabled
+
+    def _path(self, kind: str, name: str) -> str:
+        # Nomi hashati: nessun problema di caratteri o di path traversal dai nomi delle risorse
+        return os.path.join(self.root, kind, hashlib.blake2b(name.encode('utf-8'), digest_size=16).hexdigest())
+
+    @staticmethod
+    def _write_meta(path: str, meta: dict):
+        temp_path = f"{path}.json.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(temp_path, f"{path}.json")
+
+    @staticmethod
+    def _read_meta(path: str) -> Optional[dict]:
+        try:
+            with open(f"{path}.json", encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def stage(self, operation: str, source_path: str, filename: str, mime_type: str, display_name: str):
+        """Sposta il file caricato in pending/ in attesa del nome del documento"""
+        if not self.enabled or not operation:
+            return
+        digest = hashlib.blake2b(digest_size=16)
+        with open(source_path, 'rb') as f:
+            for block in iter(lambda: f.read(DOCUMENT_HASH_BLOCK), b''):
+                digest.update(block)
+        path = self._path('pending', operation)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(source_path, path)
+        self._write_meta(path, {'operation': operation, 'filename': filename, 'mimeType': mime_type,
+                                'displayName': display_name, 'sizeBytes': os.path.getsize(path),
+                                'etag': digest.hexdigest(), 'storedAt': time.time()})
+
+    def attach(self, operation: str, document_name: Optional[str]) -> bool:
+        """Operazione conclusa: l'originale diventa scaricabile col nome del documento"""
+        if not self.enabled or not document_name:
+            return False
+        source, target = self._path('pending', operation), self._path('files', document_name)
+        meta = self._read_meta(source)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(source, target)
+        except FileNotFoundError:
+            # Mai salvato (upload di un altro nodo) o già spostato da un altro worker
+            return False
+        self._write_meta(target, dict(meta or {}, document=document_name))
+        self._remove(f"{source}.json")
+        logger.info("Originale di %s archiviato per il download", document_name)
+        return True
+
+    def discard(self, operation: str):
+        """Operazione fallita o scaduta: l'originale in attesa non serve più"""
+        path = self._path('pending', operation)
+        self._remove(path)
+        self._remove(f"{path}.json")
+
+    def get(self, document_name: str) -> Optional[tuple]:
+        """(path, metadati) dell'originale, None se non archiviato"""
+        path = self._path('files', document_name)
+        meta = self._read_meta(path)
+        if meta is None or not os.path.isfile(path):
+            return None
+        return path, meta
+
+    def remove(self, document_name: str):
+        path = self._path('files', document_name)
+        self._remove(path)
+        self._remove(f"{path}.json")
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Impossibile eliminare %s: %s", path, e)
+
+document_storage = DocumentStorage(app.config['DOCUMENTS_STORAGE'], DOCUMENTS_STORAGE_ENABLED)
+
+
+def sendfile_range(response, path: str):
+    """
+    Risposta 206: werkzeug serve l'intervallo leggendo il file in Python. Con gunicorn il file,
+    posizionato all'inizio dell'intervallo, torna al suo file_wrapper: il server invia
+    Content-Length byte da lì con sendfile (e comunque non oltre Content-Length)
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if (response.status_code != 206 or file_wrapper is None or response.content_range is None
+            or not request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')):
+        return response
+    f = open(path, 'rb')
+    f.seek(response.content_range.start)
+    previous = response.response
+    response.response = file_wrapper(f, DOWNLOAD_BLOCK_SIZE)
+    close = getattr(previous, 'close', None)
+    if close is not None:
+        close()
+    return response
+
+# ==================== EVENTI (OPERAZIONI E DOCUMENTI) ====================
+
+EVENTS_BUFFER_SIZE = int(os.getenv('EVENTS_BUFFER_SIZE', '200'))
+EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', '0.5'))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv('EVENTS_HEARTBEAT_SECONDS', '15'))
+# Gli stream /api/events si chiudono dopo questo tempo: EventSource si riconnette da solo con Last-Event-ID
+EVENTS_STREAM_MAX_SECONDS = float(os.getenv('EVENTS_STREAM_MAX_SECONDS', '300'))
+EVENTS_RETRY_MS = int(os.getenv('EVENTS_RETRY_MS', '2000'))
+# Stream /api/events aperti al più per worker: ognuno occupa un thread gthread per tutta la durata,
+# oltre il limite 503 con Retry-After (il frontend intanto fa polling)
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv('EVENTS_MAX_SUBSCRIBERS', '4'))
+EVENTS_RETRY_AFTER = int(os.getenv('EVENTS_RETRY_AFTER', '30'))
+OPERATION_POLL_INITIAL = float(os.getenv('OPERATION_POLL_INITIAL', '1'))
+OPERATION_POLL_MAX = float(os.getenv('OPERATION_POLL_MAX', '15'))
+OPERATION_POLL_BACKOFF = float(os.getenv('OPERATION_POLL_BACKOFF', '1.5'))
+OPERATION_WATCH_MAX_AGE = float(os.getenv('OPERATION_WATCH_MAX_AGE', '3600'))
+
+class EventBus:
+    """
+    Eventi dell'applicazione condivisi tra i worker tramite lo store: un registro circolare degli
+    ultimi `size` eventi con id crescente più un contatore dell'ultimo id, così un sottoscrittore
+    legge un solo intero per giro finché non arriva qualcosa di nuovo.
+    Gli eventi sui documenti incrementano anche il generation counter che invalida le cache locali.
+    """
+    LOG_KEY = 'events:log'
+    SEQ_KEY = 'events:seq'
+    GENERATION_KEY = 'documents:generation'
+
+    def __init__(self, store, size: int = 200):
+        self.store = store
+        self.size = size
+
+    def publish(self, event: str, data: dict) -> int:
+        now = time.time()
+
+        def append(current):
+            log = json.loads(current) if current else {'last_id': 0, 'events': []}
+            log['last_id'] += 1
+            log['events'] = log['events'][-(self.size - 1):] + [{'id': log['last_id'], 'event': event, 'data': data, 'ts': now}]
+            return json.dumps(log), log['last_id']
+
+        # L'id viene assegnato nello stesso aggiornamento atomico che scrive l'evento:
+        # chi vede il contatore trova sempre l'evento già nel registro
+        event_id = self.store.update(self.LOG_KEY, append)
+        self.store.update(self.SEQ_KEY, lambda current: (str(max(int(current or 0), event_id)), None))
+        metrics.inc('events_published_total', event=event)
+        return event_id
+
+    def document_changed(self, event: str, data: dict) -> int:
+        """Evento documento: nuova generation (cache da invalidare in tutti i worker) e notifica"""
+        generation = self.store.incr(self.GENERATION_KEY)
+        return self.publish(event, dict(data, generation=generation))
+
+    def generation(self) -> int:
+        return int(self.store.get(self.GENERATION_KEY) or 0)
+
+    def last_id(self) -> int:
+        return int(self.store.get(self.SEQ_KEY) or 0)
+
+    def read_since(self, last_id: int) -> tuple[list, int, bool]:
+        """
+        Eventi successivi a last_id: (eventi, nuovo cursore, lacuna).
+        lacuna=True se alcuni eventi sono usciti dal registro (o lo store è stato azzerato):
+        il client deve ricaricare lo stato invece di applicare gli eventi.
+        """
+        seq = self.last_id()
+        if seq == last_id:
+            return [], last_id, False
+        if seq < last_id:
+            return [], seq, True
+        raw = self.store.get(self.LOG_KEY)
+        events = json.loads(raw)['events'] if raw else []
+        fresh = [event for event in events if event['id'] > last_id]
+        gap = not fresh or fresh[0]['id'] > last_id + 1
+        return fresh, (fresh[-1]['id'] if fresh else seq), gap
+
+event_bus = EventBus(shared_store, EVENTS_BUFFER_SIZE)
+
+
+class EventHub:
+    """
+    Subscriber di /api/events di questo worker: un solo thread legge il registro condiviso ogni
+    poll_interval e inoltra i frame alle code dei subscriber, che attendono senza leggere lo store.
+    Il thread esiste solo finché c'è almeno un subscriber. Ogni stream aperto occupa comunque un
+    thread gthread: oltre max_subscribers la sottoscrizione viene rifiutata
+    """
+    def __init__(self, max_subscribers: int = 4, poll_interval: float = 0.5):
+        self.max_subscribers = max_subscribers
+        self.poll_interval = poll_interval
+        self.subscribers = {}   # {coda: ultimo id consegnato}
+        self.cursor = 0
+        self.reader_pid = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def frames(events: list, cursor: int, gap: bool) -> str:
+        head = f"id: {cursor}\n" + sse_event('resync', {'id': cursor}) if gap else ''
+        return head + ''.join(f"id: {event['id']}\n" + sse_event(event['event'], event['data']) for event in events)
+
+    def subscribe(self, last_id: int) -> Optional[tuple]:
+        """(coda, frame arretrati da Last-Event-ID) o None se il worker ha già max_subscribers stream"""
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            # Lettura arretrati e registrazione sotto lo stesso lock della consegna: nessun evento perso o doppio
+            if last_id < 0:
+                events, cursor, gap = [], event_bus.last_id(), False
+            else:
+                events, cursor, gap = event_bus.read_since(last_id)
+            if not self.subscribers:
+                self.cursor = cursor
+            inbox = queue.SimpleQueue()
+            self.subscribers[inbox] = cursor
+            if self.reader_pid != os.getpid():
+                self.reader_pid = os.getpid()
+                threading.Thread(target=self._loop, name='event-hub', daemon=True).start()
+        return inbox, self.frames(events, cursor, gap)
+
+    def unsubscribe(self, inbox):
+        with self.lock:
+            self.subscribers.pop(inbox, None)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                if not self.subscribers:
+                    self.reader_pid = None
+                    return
+                cursor = self.cursor
+            try:
+                events, cursor, gap = event_bus.read_since(cursor)
+            except Exception as e:
+                logger.warning("Lettura degli eventi fallita: %s", e)
+                continue
+            if not events and not gap:
+                continue
+            with self.lock:
+                for inbox, delivered in self.subscribers.items():
+                    frames = self.frames([event for event in events if event['id'] > delivered], cursor, gap)
+                    if frames:
+                        inbox.put(frames)
+                    self.subscribers[inbox] = cursor if gap else max(delivered, cursor)
+                self.cursor = cursor
+
+event_hub = EventHub(EVENTS_MAX_SUBSCRIBERS, EVENTS_POLL_INTERVAL)
+
+def sync_document_caches():
+    """Allinea le cache locali al generation counter condiviso (una lettura dello store)"""
+    generation = event_bus.generation()
+    documents_cache.sync_generation(generation)
+    query_cache.sync_generation(generation)
+
+class OperationWatcher:
+    """
+    Sorveglianza lato server delle operazioni di upload: ogni operazione in corso viene interrogata
+    su Gemini da un solo worker alla volta (assegnazione atomica nello store), con intervallo
+    crescente (backoff adattivo), qualunque sia il numero di client interessati.
+    L'ultimo stato resta nello store: GET /api/operations/<name> lo legge senza chiamare Gemini
+    e ogni cambio di stato diventa un evento su /api/events.
+    """
+    WATCH_KEY = 'operations:watch'
+    STATUS_PREFIX = 'operations:status:'
+    TICK = 0.5
+    BATCH = 8        # operazioni assegnate a un worker per giro: le altre restano agli altri worker
+    LEASE = 60.0     # un poll senza esito entro questo tempo torna assegnabile
+
+    def __init__(self, store, bus: EventBus, initial_interval: float = 1.0, max_interval: float = 15.0,
+                 backoff: float = 1.5, max_age: float = 3600.0, autostart: bool = True, clock=time.time):
+        self.store = store
+        self.bus = bus
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_age = max_age
+        self.autostart = autostart
+        self.clock = clock
+        self.started_pid = None
+
+    def ensure_started(self):
+        # Un thread per processo, anche dopo il fork dei worker gunicorn
+        if not self.autostart or self.started_pid == os.getpid():
+            return
+        self.started_pid = os.getpid()
+        threading.Thread(target=self._loop, name='operation-watcher', daemon=True).start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                logger.warning("Sorveglianza operazioni fallita: %s", e)
+            time.sleep(self.TICK)
+
+    def _watched(self) -> dict:
+        raw = self.store.get(self.WATCH_KEY)
+        return json.loads(raw) if raw else {}
+
+    def watch(self, name: str, display_name: Optional[str] = None):
+        """Aggiunge un'operazione in corso (idempotente)"""
+        now = self.clock()
+
+        def add(current):
+            watched = json.loads(current) if current else {}
+            watched.setdefault(name, {'display_name': display_name, 'since': now,
+                                      'interval': self.initial_interval, 'next_poll': now + self.initial_interval})
+            return json.dumps(watched), None
+        self.store.update(self.WATCH_KEY, add)
+        self.ensure_started()
+
+    def watching(self, name: str) -> bool:
+        return name in self._watched()
+
+    def status(self, name: str) -> Optional[dict]:
+        raw = self.store.get(self.STATUS_PREFIX + name)
+        return json.loads(raw) if raw else None
+
+    def record(self, name: str, operation: dict, display_name: Optional[str] = None) -> dict:
+        """Salva l'ultimo stato noto; se è cambiato pubblica 'operation' (e 'document_added' a fine upload)"""
+        status = {'operation': operation, 'done': bool(operation.get('done')), 'checked_at': self.clock()}
+
+        def apply(current):
+            # Confronto e scrittura atomici: se route e watcher registrano lo stesso cambio, uno solo lo pubblica
+            previous = json.loads(current) if current else None
+            changed = previous is None or self._state(previous['operation']) != self._state(operation)
+            return json.dumps(status), changed
+        if not self.store.update(self.STATUS_PREFIX + name, apply, ttl=max(self.max_age, 3600)):
+            return status
+        event = {'name': name, 'done': status['done'], 'displayName': display_name}
+        document_name = (operation.get('response') or {}).get('documentName')
+        if 'error' in operation:
+            event['error'] = operation['error']
+        elif document_name:
+            event['document'] = document_name
+        self.bus.publish('operation', event)
+        if status['done'] and 'error' in operation:
+            document_storage.discard(name)
+        if status['done'] and 'error' not in operation:
+            document_storage.attach(name, document_name)
+            self.bus.document_changed('document_added', {'name': document_name, 'displayName': display_name,
+                                                         'operation': name})
+        return status
+
+    @staticmethod
+    def _state(operation: dict) -> tuple:
+        # Campi che cambiano lo stato visibile ai client (l'upload risponde senza 'done', il primo poll con done=false)
+        return (bool(operation.get('done')), json.dumps([operation.get(k) for k in ('error', 'response', 'metadata')], sort_keys=True))
+
+    def claim_due(self) -> list:
+        """Assegna a questo worker le operazioni da interrogare ora (al più BATCH)"""
+        now = self.clock()
+        watched = self._watched()
+        if not any(entry['next_poll'] <= now for entry in watched.values()):
+            return []
+
+        def claim(current):
+            watched = json.loads(current) if current else {}
+            due = []
+            for name, entry in sorted(watched.items(), key=lambda item: item[1]['next_poll']):
+                if entry['next_poll'] > now or len(due) >= self.BATCH:
+                    break
+                entry['next_poll'] = now + self.LEASE
+                due.append((name, dict(entry)))
+            return (json.dumps(watched) if watched else None), due
+        return self.store.update(self.WATCH_KEY, claim)
+
+    def reschedule(self, name: str, done: bool):
+        """Operazione conclusa o scaduta: via dalla lista; altrimenti prossimo poll con backoff"""
+        now = self.clock()
+
+        def apply(current):
+            watched = json.loads(current) if current else {}
+            entry = watched.get(name)
+            expired = False
+            if entry is not None:
+                expired = not done and now - entry['since'] > self.max_age
+                if done or expired:
+                    del watched[name]
+                else:
+                    entry['interval'] = min(entry['interval'] * self.backoff, self.max_interval)
+                    entry['next_poll'] = now + entry['interval']
+            return (json.dumps(watched) if watched else None), expired
+        if self.store.update(self.WATCH_KEY, apply):
+            logger.warning("Operazione %s ancora in corso dopo %ss: sorveglianza interrotta", name, self.max_age)
+            document_storage.discard(name)
+            self.bus.publish('operation', {'name': name, 'done': False, 'expired': True})
+
+    def fetch(self, name: str) -> dict:
+        response = upstream_request('operations', 'GET', f"{BASE_URL}/{name}", PRIORITY_BULK, headers=get_headers())
         response.raise_for_status()
-        
-        result = response.json()
-        candidates = result.get('candidates', [])
-        if not candidates:
-            raise ValueError('Nessuna risposta generata dal modello')
-        
-        return candidates[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+        return response.json()
+
+    def poll(self, name: str, entry: dict):
+        try:
+            operation = self.fetch(name)
+        except (UpstreamUnavailableError, requests.exceptions.RequestException) as e:
+            logger.warning("Poll operazione %s fallito: %s", name, e)
+            metrics.inc('operation_polls_total', outcome='error')
+            self.reschedule(name, False)
+            return
+        status = self.record(name, operation, entry.get('display_name'))
+        metrics.inc('operation_polls_total', outcome='done' if status['done'] else 'pending')
+        self.reschedule(name, status['done'])
+
+    def tick(self):
+        for name, entry in self.claim_due():
+            self.poll(name, entry)
+
+    def stats(self) -> dict:
+        return {'watched': len(self._watched())}
+
+operation_watcher = OperationWatcher(shared_store, event_bus, OPERATION_POLL_INITIAL, OPERATION_POLL_MAX,
+                                     OPERATION_POLL_BACKOFF, OPERATION_WATCH_MAX_AGE)
 
 @app.route('/')
 def index():
@@ -427,52 +3843,210 @@ def index():
 def get_config():
     """Restituisce la configurazione corrente (senza API key)"""
     try:
-        return jsonify({
+        return conditional_response(jsonify({
             'success': True,
             'store_name': FILE_SEARCH_STORE_NAME,
+            'stores': FILE_SEARCH_STORES,
             'api_configured': bool(GEMINI_API_KEY),
             'chunk_size': DEFAULT_CHUNK_SIZE,
             'chunk_overlap_percent': CHUNK_OVERLAP_PERCENT,
             'results_count': RESULTS_COUNT,
             'min_relevance_score': MIN_RELEVANCE_SCORE,
             'max_chunks_for_generation': MAX_CHUNKS_FOR_GENERATION
-        })
+        }))
     except Exception as e:
-        logger.error(f"Errore nel recupero configurazione: {str(e)}")
+        logger.error("Errore nel recupero configurazione: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: il processo risponde (nessun controllo esterno)"""
+    return jsonify({'status': 'ok', 'pid': os.getpid(), 'uptime_s': round(time.time() - health_probe.booted_at, 1)})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: ultimo esito delle sonde in background, stato dei breaker, coda e stream del worker"""
+    ready, detail = health_probe.readiness()
+    response = jsonify(detail)
+    response.status_code = 200 if ready else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/upstream/breakers', methods=['GET'])
+def get_breaker_stats():
+    """Stato dei circuit breaker per operazione upstream e conteggio transizioni"""
+    return jsonify({'success': True, 'breakers': circuit_breakers.stats()})
+
+@app.route('/api/upstream/retries', methods=['GET'])
+def get_retry_stats():
+    """Retry eseguiti e rinunce per operazione upstream"""
+    return jsonify({'success': True, 'retries': retry_policy.stats()})
+
+@app.route('/api/upstream/scheduler', methods=['GET'])
+def get_scheduler_stats():
+    """Stato dello scheduler upstream (coda per priorità, slot in uso, tempi di attesa) e del controllo di ammissione"""
+    return jsonify({'success': True, 'scheduler': upstream_scheduler.stats(), 'admission': admission.stats()})
+
+def collect_process_metrics(registry: MetricsRegistry):
+    """Contatori cumulativi tenuti dai componenti del singolo worker, copiati nell'istantanea"""
+    for result, value in (('hit', response_cache.hits), ('stale', response_cache.stale_hits), ('miss', response_cache.misses)):
+        registry.set_counter('response_cache_requests_total', value, result=result)
+    registry.set_gauge('response_cache_entries', response_cache.size())
+    retry_stats = retry_policy.stats()
+    for operation, value in retry_stats['retries'].items():
+        registry.set_counter('upstream_retries_total', value, operation=operation)
+    for operation, value in retry_stats['gave_up'].items():
+        registry.set_counter('upstream_retry_giveups_total', value, operation=operation)
+    for priority, value in upstream_scheduler.granted.items():
+        registry.set_counter('scheduler_granted_total', value, priority=priority)
+    for priority, value in upstream_scheduler.timeouts.items():
+        registry.set_counter('scheduler_timeouts_total', value, priority=priority)
+    dropped = sum(getattr(handler, 'dropped', 0) for handler in logging.getLogger().handlers)
+    registry.set_counter('log_records_dropped_total', dropped)
+    admission_stats = admission.stats()
+    registry.set_gauge('admission_overloaded', int(admission_stats['overloaded']))
+    for priority, value in admission_stats['in_flight'].items():
+        registry.set_gauge('admission_in_flight', value, priority=priority)
+    health = health_probe.state
+    if health is not None:
+        registry.set_gauge('health_check_ok', int(health['store']['ok']), check='store')
+        if health['upstream'] is not None:
+            registry.set_gauge('health_check_ok', int(health['upstream']['ok']), check='upstream')
+
+metrics.collectors.append(collect_process_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Metriche in formato Prometheus, sommate su tutti i worker gunicorn.
+    Stato dei breaker e dello scheduler viene letto direttamente dallo store condiviso.
+    """
+    data = metrics.aggregate()
+    counters, gauges = data['counters'], data['gauges']
+
+    lookups = {k: v for k, v in counters.items() if k.startswith('response_cache_requests_total')}
+    total_lookups = sum(lookups.values())
+    served = total_lookups - sum(v for k, v in lookups.items() if 'result="miss"' in k)
+    gauges['response_cache_hit_ratio'] = round(served / total_lookups, 4) if total_lookups else 0
+
+    state_values = {'CLOSED': 0, 'HALF_OPEN': 1, 'OPEN': 2}
+    for operation, breaker in circuit_breakers.stats().items():
+        gauges[_metric_key('circuit_breaker_state', {'operation': operation})] = state_values.get(breaker['state'], 0)
+        for state, count in breaker['transitions'].items():
+            counters[_metric_key('circuit_breaker_transitions_total', {'operation': operation, 'state': state})] = count
+
+    scheduler = upstream_scheduler.stats()
+    for priority, depth in scheduler['queue_depth'].items():
+        gauges[_metric_key('scheduler_queue_depth', {'priority': priority})] = depth
+    gauges['scheduler_in_flight'] = scheduler['in_flight']
+    gauges['metrics_workers'] = data['workers']
+
+    return Response(MetricsRegistry.render(data), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+def store_debug_trace(trace: RequestTrace):
+    """Salva l'albero degli span nello store condiviso: ring buffer degli ultimi N trace di tutti i worker"""
+    shared_store.set(f'trace:{trace.request_id}', json.dumps(trace.to_tree()), ttl=DEBUG_TRACE_TTL)
+
+    def push(raw):
+        index = json.loads(raw) if raw else []
+        index.append(trace.request_id)
+        evicted = index[:-DEBUG_TRACE_BUFFER_SIZE]
+        return json.dumps(index[-DEBUG_TRACE_BUFFER_SIZE:]), evicted
+
+    for request_id in shared_store.update('trace:index', push, ttl=DEBUG_TRACE_TTL):
+        shared_store.delete(f'trace:{request_id}')
+
+@app.route('/api/debug/traces', methods=['GET'])
+def list_debug_traces():
+    """Ultimi trace registrati con header X-Debug-Trace: 1 (richiede DEBUG_TRACE_ENABLED=true)"""
+    if not DEBUG_TRACE_ENABLED:
+        return jsonify({'success': False, 'error': 'Trace disabilitati (DEBUG_TRACE_ENABLED=false)'}), 404
+    raw_index = shared_store.get('trace:index')
+    traces = []
+    for request_id in reversed(json.loads(raw_index) if raw_index else []):
+        raw = shared_store.get(f'trace:{request_id}')
+        if raw:
+            tree = json.loads(raw)
+            traces.append({'request_id': request_id, 'route': tree['route'], 'total_ms': tree['total_ms']})
+    return jsonify({'success': True, 'traces': traces})
+
+@app.route('/api/debug/traces/<request_id>', methods=['GET'])
+def get_debug_trace(request_id):
+    """Albero degli span di una richiesta"""
+    if not DEBUG_TRACE_ENABLED:
+        return jsonify({'success': False, 'error': 'Trace disabilitati (DEBUG_TRACE_ENABLED=false)'}), 404
+    raw = shared_store.get(f'trace:{request_id}')
+    if not raw:
+        return jsonify({'success': False, 'error': 'Trace non trovato o scaduto'}), 404
+    return jsonify({'success': True, 'trace': json.loads(raw)})
+
 @app.route('/api/documents', methods=['GET'])
 def list_documents():
-    """Elenca tutti i documenti nel File Search Store"""
+    """
+    Elenca tutti i documenti nel File Search Store (?store= per uno store diverso dal principale).
+    ?filters={json} filtra sui metadati e ?facets=true aggiunge i conteggi per chiave/valore:
+    entrambi sono serviti dal mirror locale (pageToken è allora un offset)
+    """
     try:
-        url = f"{BASE_URL}/{FILE_SEARCH_STORE_NAME}/documents"
+        try:
+            store = resolve_stores(request.args.get('store'), [FILE_SEARCH_STORE_NAME])[0]
+            filters = parse_metadata_filters(json.loads(request.args['filters'])) if request.args.get('filters') else {}
+            # Parametri opzionali per paginazione (max 20 per Google API); con filters pageToken è un offset
+            page_size = min(int(request.args.get('pageSize', 20)), 20)
+            page_token = request.args.get('pageToken', '')
+            offset = int(page_token or 0) if filters else 0
+            if page_size < 1 or offset < 0:
+                raise ValueError('pageSize e pageToken devono essere positivi')
+        except (StoreSelectionError, MetadataFilterError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        url = f"{BASE_URL}/{store}/documents"
         headers = get_headers()
         
-        # Parametri opzionali per paginazione (max 20 per Google API)
-        page_size = min(int(request.args.get('pageSize', 20)), 20)
-        page_token = request.args.get('pageToken', '')
+        facets = None
+        if filters or request.args.get('facets') == 'true':
+            index = document_mirror.get(store)
+            selection = index.match(filters) if filters else index.all
+            facets = {'facets': index.counts(selection), 'totalCount': selection.bit_count()}
+            if filters:
+                matching = index.select(selection)
+                return conditional_response(jsonify({
+                    'success': True,
+                    'store': store,
+                    'documents': matching[offset:offset + page_size],
+                    'nextPageToken': str(offset + page_size) if offset + page_size < len(matching) else '',
+                    'filter': compile_metadata_filter(filters),
+                    **facets
+                }))
         
         params = {'pageSize': page_size}
         if page_token:
             params['pageToken'] = page_token
         
-        logger.info(f"Recupero documenti da: {url}")
-        response = http_session.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        
-        data = response.json()
+        cache_key = f"{store}:{page_size}:{page_token}"
+        sync_document_caches()
+        data = documents_cache.get(cache_key)
+        if data is None:
+            logger.info("Recupero documenti da: %s", url)
+            response = upstream_request('list', 'GET', url, headers=headers, params=params)
+            response.raise_for_status()
+            data = response.json()
+            documents_cache.set(cache_key, data)
         documents = data.get('documents', [])
         
-        logger.info(f"Recuperati {len(documents)} documenti")
+        logger.info("Recuperati %s documenti", len(documents))
         
-        return jsonify({
+        return conditional_response(jsonify({
             'success': True,
+            'store': store,
             'documents': documents,
-            'nextPageToken': data.get('nextPageToken', '')
-        })
+            'nextPageToken': data.get('nextPageToken', ''),
+            **(facets or {})
+        }))
         
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
     except requests.exceptions.RequestException as e:
-        logger.error(f"Errore nella lista documenti: {str(e)}")
+        logger.error("Errore nella lista documenti: %s", e)
         error_detail = e.response.json() if hasattr(e, 'response') and e.response.content else str(e)
         return jsonify({
             'success': False,
@@ -480,10 +4054,12 @@ def list_documents():
             'details': error_detail
         }), 500
     except Exception as e:
-        logger.error(f"Errore imprevisto: {str(e)}")
+        logger.error("Errore imprevisto: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/documents/upload', methods=['POST'])
+@rate_limited
+@admission_controlled(PRIORITY_BULK)
 def upload_document():
     """Carica un documento nel File Search Store (Long-Running Operation)"""
     temp_file_path = None
@@ -501,6 +4077,12 @@ def upload_document():
         mime_type = request.form.get('mimeType', '')
         chunk_size = int(request.form.get('chunkSize', DEFAULT_CHUNK_SIZE))  # Default dal .env
         
+        # Store di destinazione (default: lo store principale)
+        try:
+            store = resolve_stores(request.form.get('store'), [FILE_SEARCH_STORE_NAME])[0]
+        except StoreSelectionError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
         # VALIDAZIONE CHUNK SIZE (limite API Google: 1-512)
         if chunk_size < 1 or chunk_size > 512:
             return jsonify({'success': False, 'error': f'Chunk size deve essere tra 1 e 512 (ricevuto: {chunk_size})'}), 400
@@ -519,13 +4101,13 @@ def upload_document():
         metadata_keys = request.form.getlist('metadataKeys[]')
         metadata_values = request.form.getlist('metadataValues[]')
         
-        logger.info(f"Metadati ricevuti - Keys: {metadata_keys}, Values: {metadata_values}")
+        logger.info("Metadati ricevuti - Keys: %s, Values: %s", metadata_keys, metadata_values)
         
         # VALIDAZIONE METADATI
         if metadata_keys or metadata_values:
             is_valid, error = validate_metadata(metadata_keys, metadata_values)
             if not is_valid:
-                logger.error(f"Validazione metadati fallita: {error}")
+                logger.error("Validazione metadati fallita: %s", error)
                 return jsonify({'success': False, 'error': error}), 400
         
         # Filtra e aggiungi solo metadati non vuoti
@@ -533,15 +4115,15 @@ def upload_document():
             if key and key.strip() and value and value.strip():
                 custom_metadata[key.strip()] = value.strip()
         
-        logger.info(f"Metadati custom validati: {custom_metadata}")
+        logger.info("Metadati custom validati: %s", custom_metadata)
         
         # SALVA FILE TEMPORANEAMENTE SU DISCO (non in memoria)
         temp_file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"upload_{int(time.time())}_{secure_filename(file.filename)}")
         file.save(temp_file_path)
-        logger.info(f"File salvato temporaneamente: {temp_file_path}")
+        logger.info("File salvato temporaneamente: %s", temp_file_path)
         
         # URL per upload
-        url = f"{UPLOAD_BASE_URL}/{FILE_SEARCH_STORE_NAME}:uploadToFileSearchStore"
+        url = f"{UPLOAD_BASE_URL}/{store}:uploadToFileSearchStore"
         
         headers = get_headers()
         
@@ -567,7 +4149,7 @@ def upload_document():
             }
         }
         
-        logger.info(f"Chunking config: max_tokens={chunk_size}, overlap={chunk_overlap}")
+        logger.info("Chunking config: max_tokens=%s, overlap=%s", chunk_size, chunk_overlap)
         
         # Apri il file salvato e invialo (non usare stream che carica in memoria)
         with open(temp_file_path, 'rb') as f:
@@ -576,151 +4158,921 @@ def upload_document():
                 'file': (secure_filename(file.filename), f, mime_type)
             }
             
-            logger.info(f"Caricamento file: {file.filename} ({mime_type})")
-            logger.info(f"Display name: {display_name}")
-            logger.info(f"Metadata: {json.dumps(metadata)}")
+            logger.info("Caricamento file: %s (%s)", file.filename, mime_type)
+            logger.info("Display name: %s", display_name)
+            logger.debug("Metadata: %s", LazyJson(metadata))
             
             # Effettua l'upload - restituisce un'operazione
-            response = http_session.post(url, headers=headers, files=files)
+            # Nessun retry: il file è già stato letto e un upload ripetuto duplicherebbe il documento
+            response = upstream_request('upload', 'POST', url, PRIORITY_BULK, retry=False, headers=headers, files=files,
+                                        timeout=(UPSTREAM_CONNECT_TIMEOUT, UPLOAD_READ_TIMEOUT))
             response.raise_for_status()
         
         operation_data = response.json()
         operation_name = operation_data.get('name', '')
         
-        logger.info(f"Upload avviato. Operation: {operation_name}")
+        logger.info("Upload avviato. Operation: %s", operation_name)
+        
+        # Originale conservato per il download: diventa scaricabile a fine operazione (nome del documento)
+        if operation_name:
+            try:
+                document_storage.stage(operation_name, temp_file_path, file.filename, mime_type, display_name)
+            except OSError as e:
+                logger.warning("Originale di %s non archiviato: %s", file.filename, e)
+        
+        # Da qui lo stato lo segue il watcher del server e arriva ai client come evento su /api/events
+        if operation_name:
+            status = operation_watcher.record(operation_name, operation_data, display_name)
+            if not status['done']:
+                operation_watcher.watch(operation_name, display_name)
         
         return jsonify({
             'success': True,
             'operation': operation_data,
             'operationName': operation_name,
+            'store': store,
             'message': 'Upload avviato con successo. L\'elaborazione è in corso.'
         })
         
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
     except requests.exceptions.RequestException as e:
-        logger.error(f"Errore durante upload: {str(e)}")
+        logger.error("Errore durante upload: %s", e)
         error_detail = str(e)
         if hasattr(e, 'response') and e.response is not None:
             try:
                 error_detail = e.response.json()
-                logger.error(f"Dettagli errore API: {error_detail}")
+                logger.error("Dettagli errore API: %s", error_detail)
             except:
                 error_detail = e.response.text
-                logger.error(f"Risposta errore API (testo): {error_detail}")
+                logger.error("Risposta errore API (testo): %s", error_detail)
         return jsonify({
             'success': False,
             'error': 'Errore durante il caricamento',
             'details': error_detail
         }), 500
     except Exception as e:
-        logger.error(f"Errore imprevisto durante upload: {str(e)}")
+        logger.error("Errore imprevisto durante upload: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
     finally:
         # PULIZIA FILE TEMPORANEO (anche se ci sono stati errori)
         if temp_file_path and os.path.exists(temp_file_path):
             try:
                 os.remove(temp_file_path)
-                logger.info(f"File temporaneo eliminato: {temp_file_path}")
+                logger.info("File temporaneo eliminato: %s", temp_file_path)
             except Exception as cleanup_error:
-                logger.warning(f"Errore nella pulizia del file temporaneo: {cleanup_error}")
+                logger.warning("Errore nella pulizia del file temporaneo: %s", cleanup_error)
+
+@app.route('/api/operations/<path:operation_name>', methods=['GET'])
+def get_operation_status(operation_name):
+    """Recupera lo stato di un'operazione di upload"""
+    try:
+        # Validazione
+        if not operation_name or operation_name == 'undefined':
+            logger.error("Operation name mancante o undefined")
+            return jsonify({
+                'success': False,
+                'error': 'Operation name mancante'
+            }), 400
+        
+        # Stato già noto e aggiornato dal watcher (nessuna chiamata a Gemini per i client che fanno polling)
+        cached = operation_watcher.status(operation_name)
+        if cached is not None and (cached['done'] or operation_watcher.watching(operation_name)):
+            operation_watcher.ensure_started()
+            operation_data = cached['operation']
+        else:
+            # L'operation name è già completo (es: fileSearchStores/.../upload/operations/...)
+            url = f"{BASE_URL}/{operation_name}"
+            headers = get_headers()
+            
+            logger.info("Controllo stato operazione: %s", operation_name)
+            
+            response = upstream_request('operations', 'GET', url, headers=headers)
+            response.raise_for_status()
+            
+            operation_data = response.json()
+            if not operation_watcher.record(operation_name, operation_data)['done']:
+                operation_watcher.watch(operation_name)
+        done = operation_data.get('done', False)
+        
+        result = {
+            'success': True,
+            'operation': operation_data,
+            'done': done
+        }
+        
+        if done:
+            if 'error' in operation_data:
+                result['error'] = operation_data['error']
+                logger.warning("Operazione completata con errore: %s", operation_data['error'])
+            else:
+                result['document'] = operation_data.get('response', {})
+                logger.info("Operazione completata con successo")
+        
+        return jsonify(result)
+        
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
+    except requests.exceptions.RequestException as e:
+        logger.error("Errore nel controllo operazione: %s", e)
+        error_detail = e.response.json() if hasattr(e, 'response') and e.response.content else str(e)
+        return jsonify({
+            'success': False,
+            'error': 'Errore nel controllo dello stato',
+            'details': error_detail
+        }), 500
+    except Exception as e:
+        logger.error("Errore imprevisto: %s", e)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """
+    Canale SSE unico per le notifiche: 'operation' (stato degli upload), 'document_added',
+    'document_deleted' e 'resync' (eventi persi: ricaricare liste e operazioni).
+    Ogni evento ha un id: EventSource si riconnette con Last-Event-ID e riprende da lì.
+    """
+    operation_watcher.ensure_started()
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('lastEventId') or -1)
+    except ValueError:
+        last_id = -1
+    subscription = event_hub.subscribe(last_id)
+    if subscription is None:
+        metrics.inc('event_subscribers_rejected_total')
+        response = jsonify({'success': False, 'error': 'Troppi client collegati agli eventi, riprovare più tardi',
+                            'retry_after': EVENTS_RETRY_AFTER})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(EVENTS_RETRY_AFTER)
+        return response
+    inbox, backlog = subscription
+
+    def generate():
+        metrics.gauge_add('event_subscribers', 1)
+        try:
+            yield f"retry: {EVENTS_RETRY_MS}\n: connesso\n\n" + backlog
+            deadline = time.monotonic() + EVENTS_STREAM_MAX_SECONDS
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    yield inbox.get(timeout=min(EVENTS_HEARTBEAT_SECONDS, remaining))
+                except queue.Empty:
+                    if remaining > EVENTS_HEARTBEAT_SECONDS:
+                        yield ": ping\n\n"
+        finally:
+            metrics.gauge_add('event_subscribers', -1)
+
+    response = Response(stream_with_log_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+    # Anche se lo stream non viene mai letto, il posto si libera alla chiusura della risposta
+    response.call_on_close(lambda: event_hub.unsubscribe(inbox))
+    return response
+
+@app.route('/api/documents/<path:document_name>/download', methods=['GET'])
+@rate_limited(limiter=lambda: download_rate_limiter)
+def download_document(document_name):
+    """
+    Scarica l'originale di un documento caricato da questa applicazione.
+    Range / If-Range (download riprendibili) ed ETag / If-None-Match tramite send_file;
+    il corpo è inviato dal server con sendfile quando possibile.
+    """
+    stored = document_storage.get(document_name)
+    if stored is None:
+        metrics.inc('document_downloads_total', outcome='missing')
+        return jsonify({'success': False, 'code': 'original_not_available',
+                        'error': 'Originale non disponibile (documento caricato altrove o prima dell\'archiviazione)'}), 404
+    path, meta = stored
+    response = send_file(path, mimetype=meta.get('mimeType') or 'application/octet-stream', as_attachment=True,
+                         download_name=meta.get('filename') or meta.get('displayName') or 'document',
+                         conditional=True, etag=meta.get('etag') or True)
+    response.cache_control.private = True
+    outcome = {200: 'full', 206: 'partial', 304: 'not_modified'}.get(response.status_code, str(response.status_code))
+    metrics.inc('document_downloads_total', outcome=outcome)
+    if request.method == 'GET' and response.status_code in (200, 206):
+        metrics.inc('document_download_bytes_total', response.content_length or 0, outcome=outcome)
+    return sendfile_range(response, path)
+
+@app.route('/api/documents/<path:document_name>', methods=['DELETE'])
+def delete_document(document_name):
+    """Elimina un documento dal File Search Store"""
+    try:
+        # Il document_name include già il path completo (fileSearchStores/.../documents/...)
+        url = f"{BASE_URL}/{document_name}"
+        headers = get_headers()
+        
+        # IMPORTANTE: force=true elimina anche tutti i Chunk associati
+        params = {'force': 'true'}
+        
+        logger.info("Eliminazione documento: %s", document_name)
+        
+        response = upstream_request('delete', 'DELETE', url, headers=headers, params=params)
+        response.raise_for_status()
+        
+        logger.info("Documento eliminato con successo")
+        document_storage.remove(document_name)
+        event_bus.document_changed('document_deleted', {'name': document_name})
+        
+        return jsonify({
+            'success': True,
+            'message': 'Documento eliminato con successo'
+        })
+        
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
+    except requests.exceptions.RequestException as e:
+        logger.error("Errore durante eliminazione: %s", e)
+        error_detail = e.response.json() if hasattr(e, 'response') and e.response.content else str(e)
+        return jsonify({
+            'success': False,
+            'error': 'Errore durante l\'eliminazione',
+            'details': error_detail
+        }), 500
+    except Exception as e:
+        logger.error("Errore imprevisto: %s", e)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ==================== RICERCA FEDERATA (PIÙ STORE O DOCUMENTI) ====================
+
+# Ogni store ha la propria scadenza: chi non risponde in tempo viene escluso e il risultato è parziale
+FEDERATED_STORE_TIMEOUT = float(os.getenv('FEDERATED_STORE_TIMEOUT', '10'))
+FEDERATED_MAX_WORKERS = int(os.getenv('FEDERATED_MAX_WORKERS', '8'))
+# none: score grezzi limitati a [0, 1]; max: score divisi per il migliore dello store
+# (confrontabili anche se gli store hanno distribuzioni diverse)
+FEDERATED_SCORE_NORMALIZATION = os.getenv('FEDERATED_SCORE_NORMALIZATION', 'none').lower()
+# Ricerca limitata a più documenti (documentNames): un {document}:query per documento
+MULTI_DOCUMENT_MAX = int(os.getenv('MULTI_DOCUMENT_MAX', '20'))
+MULTI_DOCUMENT_CONCURRENCY = int(os.getenv('MULTI_DOCUMENT_CONCURRENCY', '5'))
+MULTI_DOCUMENT_TIMEOUT = float(os.getenv('MULTI_DOCUMENT_TIMEOUT', '10'))
+
+fanout_executors = {}
+fanout_lock = threading.Lock()
+
+
+class StoreSelectionError(ValueError):
+    """Store richiesto non presente tra quelli configurati"""
+
+
+def resolve_stores(requested, default: list) -> list:
+    """
+    Store richiesti (lista, o stringa separata da virgole) tra quelli configurati.
+    Accetta il nome completo (fileSearchStores/x) o solo l'id; senza selezione restituisce default
+    """
+    if isinstance(requested, str):
+        requested = [s.strip() for s in requested.split(',') if s.strip()]
+    if not requested:
+        return list(default)
+    if not isinstance(requested, list):
+        raise StoreSelectionError('stores deve essere una lista di nomi di store')
+    stores = []
+    for name in requested:
+        store = name if str(name).startswith('fileSearchStores/') else f'fileSearchStores/{name}'
+        if store not in FILE_SEARCH_STORES:
+            raise StoreSelectionError(f'Store non configurato: {name}')
+        if store not in stores:
+            stores.append(store)
+    return stores
+
+
+def store_operation(operation: str, store: str) -> str:
+    """Nome dell'operazione upstream per lo store: gli store aggiuntivi hanno breaker propri"""
+    return operation if store == FILE_SEARCH_STORE_NAME else f"{operation}:{store.rsplit('/', 1)[-1]}"
+
+
+def get_fanout_executor(pool: str = 'fanout') -> ThreadPoolExecutor:
+    """
+    Pool di thread creato al primo uso in ciascun processo (i thread non sopravvivono al fork):
+    'fanout' per il retrieval interattivo, 'maintenance' per le eliminazioni in blocco, che così
+    non occupano i thread del fan-out della chat
+    """
+    key = (pool, os.getpid())
+    executor = fanout_executors.get(key)
+    if executor is None:
+        with fanout_lock:
+            executor = fanout_executors.get(key)
+            if executor is None:
+                workers = BULK_DELETE_WORKERS if pool == 'maintenance' else FEDERATED_MAX_WORKERS
+                executor = fanout_executors[key] = ThreadPoolExecutor(workers, thread_name_prefix=pool)
+    return executor
+
+
+def submit_in_context(fn, *args, pool: str = 'fanout'):
+    """
+    Esegue fn nel pool con il contesto dei log della richiesta (request id) ma senza trace:
+    RequestTrace non è thread-safe, gli span restano al thread della richiesta
+    """
+    context = contextvars.copy_context()
+    context.run(request_trace.set, None)
+    return get_fanout_executor(pool).submit(context.run, fn, *args)
+
+
+def retrieve_from_store(store: str, query_text: str, document_name: Optional[str] = None,
+                        metadata_filter: Optional[str] = None) -> dict:
+    """
+    Retrieval su un singolo store: risposta del modello e chunk di grounding con lo store di origine.
+    metadata_filter (sintassi del File Search) limita la ricerca ai documenti con quei metadati
+    """
+    genai_client = get_genai_client()
+    _, types = load_genai()
+
+    # Con un documento indicato il File Search filtra su quel documento
+    if document_name:
+        fs_tool = types.Tool(
+            file_search=types.FileSearch(
+                file_search_store_names=[store],
+                filters={"document": document_name}
+            )
+        )
+    elif metadata_filter:
+        fs_tool = types.Tool(
+            file_search=types.FileSearch(
+                file_search_store_names=[store],
+                metadata_filter=metadata_filter
+            )
+        )
+    else:
+        fs_tool = types.Tool(
+            file_search=types.FileSearch(
+                file_search_store_names=[store]
+            )
+        )
+
+    operation = store_operation('query', store)
+    response = retry_policy.run(lambda remaining: call_upstream(
+        operation,
+        lambda: genai_client.models.generate_content(
+            model="gemini-2.5-flash",
+            contents=query_text,
+            config=types.GenerateContentConfig(
+                tools=[fs_tool],
+                max_output_tokens=512
+            )
+        ),
+        PRIORITY_INTERACTIVE,
+        upstream_scheduler.estimate_tokens(len(query_text), 512)
+    ), operation)
+
+    chunks = []
+    candidate = response.candidates[0] if response.candidates else None
+    if candidate and candidate.grounding_metadata:
+        for ch in candidate.grounding_metadata.grounding_chunks or []:
+            chunks.append({
+                "chunkText": getattr(ch, "text", ""),
+                "chunkRelevanceScore": getattr(ch, "relevance_score", 0),
+                "sourceDocument": getattr(ch, "document_name", "unknown"),
+                "sourceStore": store
+            })
+    return {'answer': response.text, 'chunks': chunks}
+
+
+def query_document_chunks(document_name: str, query_text: str, results_count: int, priority=PRIORITY_INTERACTIVE) -> list:
+    """Chunk più rilevanti di un solo documento tramite {document}:query (solo retrieval, senza generazione)"""
+    headers = get_headers()
+    headers['Content-Type'] = 'application/json'
+    response = upstream_request('query', 'POST', f"{BASE_URL}/{document_name}:query", priority,
+                                headers=headers, json={'query': query_text, 'resultsCount': results_count})
+    response.raise_for_status()
+    chunks = []
+    for wrapper in response.json().get('relevantChunks', []):
+        chunk = wrapper.get('chunk', {})
+        chunks.append({
+            "chunkText": chunk.get('data', {}).get('stringValue', ''),
+            "chunkRelevanceScore": wrapper.get('chunkRelevanceScore', 0),
+            "sourceDocument": document_name,
+            "chunkName": chunk.get('name')
+        })
+    return chunks
+
+
+def fan_out(fn, keys: list, timeout: float, concurrency: Optional[int] = None) -> dict:
+    """
+    Esegue fn(key) per ogni chiave nel pool, con al più `concurrency` chiamate in volo per questa
+    richiesta e una scadenza comune. Restituisce {key: (risultato, errore, secondi)}: le chiavi non
+    completate entro la scadenza hanno TimeoutError (quelle non ancora partite vengono annullate).
+    Una sola chiave viene eseguita nel thread della richiesta, senza scadenza
+    """
+    def timed(key):
+        started = time.perf_counter()
+        try:
+            return fn(key), None, time.perf_counter() - started
+        except Exception as e:
+            return None, e, time.perf_counter() - started
+
+    if len(keys) == 1:
+        return {keys[0]: timed(keys[0])}
+
+    deadline = time.monotonic() + timeout
+    waiting = deque(keys)
+    running, outcomes = {}, {}
+    while waiting or running:
+        while waiting and len(running) < (concurrency or len(keys)):
+            key = waiting.popleft()
+            running[submit_in_context(timed, key)] = (key, time.monotonic())
+        remaining = deadline - time.monotonic()
+        done = wait_futures(running, timeout=remaining, return_when=FIRST_COMPLETED)[0] if remaining > 0 else ()
+        if not done:
+            break
+        for future in done:
+            outcomes[running.pop(future)[0]] = future.result()
+
+    expired = TimeoutError(f'Nessuna risposta entro {timeout}s')
+    now = time.monotonic()
+    for future, (key, started) in running.items():
+        future.cancel()
+        outcomes[key] = (None, expired, now - started)
+    for key in waiting:
+        outcomes[key] = (None, expired, 0.0)
+    return {key: outcomes[key] for key in keys}
+
+
+def summarize_outcomes(outcomes: dict, field: str, metric: str, label_keys: bool = False):
+    """
+    Esiti del fan-out per la risposta: (risultati riusciti, report con esito e latenza per chiave, errori).
+    label_keys aggiunge la chiave (id finale) come label della metrica: solo per insiemi piccoli come gli store.
+    Se nessuna chiave è riuscita solleva l'errore del primo (503 se breaker/coda, altrimenti 500 o 504)
+    """
+    results, report, errors = {}, [], []
+    for key, (result, error, seconds) in outcomes.items():
+        if error is None:
+            status = 'ok'
+            results[key] = result
+        else:
+            status = 'timeout' if isinstance(error, TimeoutError) else 'error'
+            errors.append(error)
+            logger.warning("%s %s escluso dalla ricerca (%s): %s", field, key, status, error)
+        labels = {field: key.rsplit('/', 1)[-1]} if label_keys else {}
+        metrics.observe(metric, seconds, outcome=status, **labels)
+        entry = {field: key, 'status': status, 'latency_ms': round(seconds * 1000, 1)}
+        if error is not None:
+            entry['error'] = str(error)
+        report.append(entry)
+    if not results:
+        unavailable = [e for e in errors if isinstance(e, UpstreamUnavailableError)]
+        raise (unavailable or errors)[0]
+    return results, report, errors
+
+
+def chunk_identity(chunk: dict) -> str:
+    """Chiave di deduplicazione: nome del chunk se noto, altrimenti hash del testo a spazi normalizzati"""
+    if chunk.get('chunkName'):
+        return chunk['chunkName']
+    text = ' '.join(str(chunk.get('chunkText', '')).split()).lower()
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=12).hexdigest()
+
+
+def normalized_scores(chunks: list, mode: str = None) -> list:
+    """Score dei chunk di uno store riportati in [0, 1] secondo FEDERATED_SCORE_NORMALIZATION"""
+    raw = [max(0.0, min(1.0, float(c.get('chunkRelevanceScore') or 0))) for c in chunks]
+    if (mode or FEDERATED_SCORE_NORMALIZATION) == 'max' and raw and max(raw) > 0:
+        best = max(raw)
+        return [score / best for score in raw]
+    return raw
+
+
+def merge_top_chunks(groups: Dict[str, list], limit: int, mode: str = None) -> list:
+    """
+    I migliori `limit` chunk di tutti i gruppi (store o documenti) per score normalizzato: heap di
+    dimensione limit, O(n log k) senza ordinare l'intero insieme. I duplicati (stesso chunk da più
+    gruppi o testo identico) tengono lo score migliore; a parità di score vince l'ordine di arrivo
+    """
+    best = {}
+    order = itertools.count()
+    for chunks in groups.values():
+        for chunk, score in zip(chunks, normalized_scores(chunks, mode)):
+            key = chunk_identity(chunk)
+            if key not in best or score > best[key][0]:
+                best[key] = (score, -next(order), chunk)
+    return [dict(chunk, normalizedScore=round(score, 4)) for score, _, chunk in heapq.nlargest(limit, best.values())]
+
+
+def federated_retrieve(stores: list, query_text: str, document_name: Optional[str], limit: int,
+                       metadata_filter: Optional[str] = None) -> dict:
+    """
+    Retrieval in parallelo sugli store con scadenza per store e merge dei chunk.
+    Gli store lenti o in errore sono riportati in `stores` e il risultato è marcato parziale.
+    Le chiamate oltre la scadenza non vengono interrotte: finiscono nel pool e il risultato si scarta
+    """
+    outcomes = fan_out(lambda store: retrieve_from_store(store, query_text, document_name, metadata_filter),
+                       stores, FEDERATED_STORE_TIMEOUT)
+    results, report, errors = summarize_outcomes(outcomes, 'store', 'federated_store_latency_seconds', label_keys=True)
+    for entry in report:
+        entry['chunks'] = len(results[entry['store']]['chunks']) if entry['store'] in results else 0
+
+    chunks = merge_top_chunks({store: result['chunks'] for store, result in results.items()}, limit)
+    # La risposta viene dallo store del chunk migliore (o dal primo che ha risposto)
+    answer_store = chunks[0]['sourceStore'] if chunks else next(iter(results))
+    return {'answer': results[answer_store]['answer'], 'chunks': chunks, 'stores': report, 'partial': bool(errors)}
+
+
+def multi_document_retrieve(document_names: list, query_text: str, limit: int) -> dict:
+    """
+    Retrieval limitato a un insieme di documenti: {document}:query in parallelo (al più
+    MULTI_DOCUMENT_CONCURRENCY alla volta, scadenza comune MULTI_DOCUMENT_TIMEOUT) e merge top-k.
+    Gli score di :query sono già confrontabili tra documenti: nessuna normalizzazione
+    """
+    outcomes = fan_out(lambda name: query_document_chunks(name, query_text, limit), document_names,
+                       MULTI_DOCUMENT_TIMEOUT, MULTI_DOCUMENT_CONCURRENCY)
+    results, report, errors = summarize_outcomes(outcomes, 'document', 'document_query_latency_seconds')
+    for entry in report:
+        entry['chunks'] = len(results.get(entry['document'], []))
+    return {'chunks': merge_top_chunks(results, limit, mode='none'), 'documents': report, 'partial': bool(errors)}
+
+# ==================== FILTRI METADATI E FACCETTE ====================
+
+# Copia locale dei documenti (per worker) da cui si costruisce l'indice delle faccette
+DOCUMENT_MIRROR_TTL = float(os.getenv('DOCUMENT_MIRROR_TTL', '300'))
+DOCUMENT_MIRROR_MAX_DOCUMENTS = int(os.getenv('DOCUMENT_MIRROR_MAX_DOCUMENTS', '10000'))
+METADATA_FILTER_MAX_KEYS = 20
+METADATA_FILTER_KEY = re.compile(r'^[A-Za-z_][A-Za-z0-9_.-]{0,99}$')
+RANGE_OPERATORS = {'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+
+class MetadataFilterError(ValueError):
+    """Filtro sui metadati non valido"""
+
+
+def parse_metadata_filters(raw) -> dict:
+    """
+    Normalizza il campo `filters`: {chiave: valore | [valori] | {"gte": n, "lte": n, ...}}.
+    Valori alternativi della stessa chiave sono in OR, chiavi diverse in AND.
+    Returns: {chiave: {'in': [valori]} | {operatore: numero}}
+    """
+    if not raw:
+        return {}
+    if not isinstance(raw, dict):
+        raise MetadataFilterError('filters deve essere un oggetto {chiave: valore}')
+    if len(raw) > METADATA_FILTER_MAX_KEYS:
+        raise MetadataFilterError(f'Troppi filtri (max {METADATA_FILTER_MAX_KEYS})')
+    filters = {}
+    for key, condition in raw.items():
+        if not METADATA_FILTER_KEY.match(key):
+            raise MetadataFilterError(f'Chiave di filtro non valida: {key[:20]}')
+        if isinstance(condition, dict):
+            unknown = set(condition) - set(RANGE_OPERATORS)
+            if unknown or not condition:
+                raise MetadataFilterError(f"Operatori ammessi per {key}: {', '.join(RANGE_OPERATORS)}")
+            if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in condition.values()):
+                raise MetadataFilterError(f'Gli intervalli su {key} richiedono valori numerici')
+            filters[key] = dict(condition)
+            continue
+        values = condition if isinstance(condition, list) else [condition]
+        if not values or not all(isinstance(v, (str, int, float)) and not isinstance(v, bool) for v in values):
+            raise MetadataFilterError(f'Valori non validi per il filtro {key}')
+        if any(isinstance(v, str) and len(v) > 500 for v in values):
+            raise MetadataFilterError('Valore di filtro troppo lungo (max 500 caratteri)')
+        filters[key] = {'in': list(dict.fromkeys(values))}
+    return filters
 
-@app.route('/api/operations/<path:operation_name>', methods=['GET'])
-def get_operation_status(operation_name):
-    """Recupera lo stato di un'operazione di upload"""
+
+def filter_literal(value) -> str:
+    if isinstance(value, str):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return repr(value)
+
+
+def compile_metadata_filter(filters: dict) -> Optional[str]:
+    """Filtri normalizzati nella sintassi di metadata_filter del File Search (stile AIP-160)"""
+    clauses = []
+    for key, condition in filters.items():
+        if 'in' in condition:
+            terms = [f'{key} = {filter_literal(v)}' for v in condition['in']]
+            clauses.append(terms[0] if len(terms) == 1 else '(' + ' OR '.join(terms) + ')')
+        else:
+            clauses.extend(f'{key} {RANGE_OPERATORS[op]} {filter_literal(v)}' for op, v in condition.items())
+    return ' AND '.join(clauses) or None
+
+
+def metadata_value(item: dict):
+    """Valore di una voce customMetadata: stringa, numero o None (liste di stringhe non indicizzate)"""
+    if 'stringValue' in item:
+        return item['stringValue']
+    if 'numericValue' in item:
+        return float(item['numericValue'])
+    return None
+
+
+def condition_matches(condition: dict, value) -> bool:
+    """Come il File Search: le stringhe confrontano solo stringhe, i numeri solo valori numerici"""
+    if 'in' in condition:
+        if isinstance(value, float):
+            return any(not isinstance(v, str) and float(v) == value for v in condition['in'])
+        return value in condition['in']
+    if not isinstance(value, float):
+        return False
+    return all({'gt': value > v, 'gte': value >= v, 'lt': value < v, 'lte': value <= v}[op]
+               for op, v in condition.items())
+
+
+class FacetIndex:
+    """
+    Indice invertito dei customMetadata: per ogni chiave/valore una bitmap (int Python, bit i = documento i).
+    Un filtro è l'AND (tra chiavi) di OR (tra valori) di bitmap: risponde senza scorrere i documenti,
+    e i conteggi delle faccette sono popcount di bitmap & selezione
+    """
+    def __init__(self, documents: list, generation: int = 0):
+        self.documents = documents
+        self.generation = generation
+        self.built_at = time.monotonic()
+        self.all = (1 << len(documents)) - 1
+        positions = {}
+        for i, document in enumerate(documents):
+            for item in document.get('customMetadata') or []:
+                value = metadata_value(item)
+                if value is not None and item.get('key'):
+                    positions.setdefault(item['key'], {}).setdefault(value, []).append(i)
+        self.bitmaps = {key: {value: sum(1 << i for i in idx) for value, idx in values.items()}
+                        for key, values in positions.items()}
+
+    def match(self, filters: dict) -> int:
+        selection = self.all
+        for key, condition in filters.items():
+            bits = 0
+            for value, bitmap in self.bitmaps.get(key, {}).items():
+                if condition_matches(condition, value):
+                    bits |= bitmap
+            selection &= bits
+            if not selection:
+                break
+        return selection
+
+    def select(self, selection: int) -> list:
+        """Documenti dei bit impostati, nell'ordine del mirror"""
+        documents = []
+        while selection:
+            low = selection & -selection
+            documents.append(self.documents[low.bit_length() - 1])
+            selection ^= low
+        return documents
+
+    def counts(self, selection: Optional[int] = None) -> dict:
+        """{chiave: {valore: documenti}} limitati alla selezione (default: tutti), senza valori a zero"""
+        selection = self.all if selection is None else selection
+        facets = {}
+        for key, values in self.bitmaps.items():
+            counts = {}
+            for value, bitmap in values.items():
+                count = (bitmap & selection).bit_count()
+                if count:
+                    counts[format(value, 'g') if isinstance(value, float) else value] = count
+            if counts:
+                facets[key] = dict(sorted(counts.items(), key=lambda item: -item[1]))
+        return facets
+
+
+class DocumentMirror:
+    """
+    Elenco completo dei documenti di ciascuno store con FacetIndex, per worker.
+    Si ricostruisce (tutte le pagine di documents.list) quando cambia la generation dei documenti
+    condivisa dagli eventi, o dopo DOCUMENT_MIRROR_TTL per le modifiche fatte fuori dall'app.
+    La ricostruzione avviene in background (una per store) mentre le richieste continuano a usare
+    l'indice precedente: si attende solo la prima costruzione, o con wait=True
+    """
+    RETRY_AFTER_FAILURE = 10.0
+
+    def __init__(self, ttl: float = 300, max_documents: int = 10000):
+        self.ttl = ttl
+        self.max_documents = max_documents
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.retry_at = {}
+        self.refresh_lock = threading.Lock()
+
+    def fresh(self, index: Optional[FacetIndex], generation: int) -> bool:
+        return (index is not None and index.generation == generation
+                and time.monotonic() - index.built_at < self.ttl)
+
+    def get(self, store: str, wait: bool = False) -> FacetIndex:
+        generation = event_bus.generation()
+        index = self.indexes.get(store)
+        if self.fresh(index, generation):
+            return index
+        if index is not None and not wait:
+            self.refresh_in_background(store, generation)
+            return index
+        # Una costruzione alla volta: le richieste concorrenti attendono e riusano il risultato
+        with self.lock:
+            index = self.indexes.get(store)
+            if index is None or (wait and not self.fresh(index, generation)):
+                with span('document_mirror'):
+                    index = self.build(store, generation)
+        return index
+
+    def build(self, store: str, generation: int) -> FacetIndex:
+        index = self.indexes[store] = FacetIndex(self.fetch(store), generation)
+        logger.info("Mirror documenti di %s: %s documenti, %s chiavi di metadati",
+                    store, len(index.documents), len(index.bitmaps))
+        return index
+
+    def refresh_in_background(self, store: str, generation: int):
+        with self.refresh_lock:
+            if store in self.refreshing or time.monotonic() < self.retry_at.get(store, 0):
+                return
+            self.refreshing.add(store)
+        threading.Thread(target=contextvars.copy_context().run, args=(self._refresh, store, generation),
+                         name='document-mirror', daemon=True).start()
+
+    def _refresh(self, store: str, generation: int):
+        # Contesto dei log della richiesta che ha avviato l'aggiornamento, senza il suo trace
+        request_trace.set(None)
+        try:
+            self.build(store, generation)
+        except Exception as e:
+            logger.warning("Aggiornamento del mirror di %s fallito, resta l'indice precedente: %s", store, e)
+            with self.refresh_lock:
+                self.retry_at[store] = time.monotonic() + self.RETRY_AFTER_FAILURE
+        finally:
+            with self.refresh_lock:
+                self.refreshing.discard(store)
+
+    def fetch(self, store: str) -> list:
+        url = f"{BASE_URL}/{store}/documents"
+        documents, page_token = [], ''
+        while len(documents) < self.max_documents:
+            params = {'pageSize': 20}
+            if page_token:
+                params['pageToken'] = page_token
+            response = upstream_request('list', 'GET', url, PRIORITY_BULK, headers=get_headers(), params=params)
+            response.raise_for_status()
+            data = response.json()
+            documents.extend(data.get('documents', []))
+            page_token = data.get('nextPageToken')
+            if not page_token:
+                break
+        return documents[:self.max_documents]
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
+        with self.refresh_lock:
+            self.retry_at.clear()
+
+document_mirror = DocumentMirror(DOCUMENT_MIRROR_TTL, DOCUMENT_MIRROR_MAX_DOCUMENTS)
+
+
+def matching_documents(stores: list, filters: dict) -> Optional[set]:
+    """Nomi dei documenti degli store che soddisfano i filtri; None se il mirror non è disponibile"""
     try:
-        # Validazione
-        if not operation_name or operation_name == 'undefined':
-            logger.error("Operation name mancante o undefined")
-            return jsonify({
-                'success': False,
-                'error': 'Operation name mancante'
-            }), 400
-        
-        # L'operation name è già completo (es: fileSearchStores/.../upload/operations/...)
-        url = f"{BASE_URL}/{operation_name}"
-        headers = get_headers()
-        
-        logger.info(f"Controllo stato operazione: {operation_name}")
-        
-        response = http_session.get(url, headers=headers)
-        response.raise_for_status()
-        
-        operation_data = response.json()
-        done = operation_data.get('done', False)
-        
-        result = {
-            'success': True,
-            'operation': operation_data,
-            'done': done
-        }
-        
-        if done:
-            if 'error' in operation_data:
-                result['error'] = operation_data['error']
-                logger.warning(f"Operazione completata con errore: {operation_data['error']}")
-            else:
-                result['document'] = operation_data.get('response', {})
-                logger.info(f"Operazione completata con successo")
-        
-        return jsonify(result)
-        
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Errore nel controllo operazione: {str(e)}")
-        error_detail = e.response.json() if hasattr(e, 'response') and e.response.content else str(e)
-        return jsonify({
-            'success': False,
-            'error': 'Errore nel controllo dello stato',
-            'details': error_detail
-        }), 500
+        names = set()
+        for store in stores:
+            index = document_mirror.get(store)
+            names.update(document['name'] for document in index.select(index.match(filters)))
+        return names
     except Exception as e:
-        logger.error(f"Errore imprevisto: {str(e)}")
-        return jsonify({'success': False, 'error': str(e)}), 500
+        logger.warning("Indice delle faccette non disponibile, filtro solo lato File Search: %s", e)
+        return None
+
+# ==================== ELIMINAZIONE IN BLOCCO ====================
+
+# Documenti al più per richiesta (elenco esplicito o risultato del filtro)
+BULK_DELETE_MAX = int(os.getenv('BULK_DELETE_MAX', '1000'))
+# Eliminazioni in volo per richiesta, in un pool proprio di BULK_DELETE_WORKERS thread per processo
+# (condiviso dalle eliminazioni concorrenti, separato dal fan-out del retrieval interattivo)
+BULK_DELETE_CONCURRENCY = int(os.getenv('BULK_DELETE_CONCURRENCY', '4'))
+BULK_DELETE_WORKERS = int(os.getenv('BULK_DELETE_WORKERS', '4'))
+DOCUMENT_NAME_PATTERN = re.compile(r'^(fileSearchStores/[^/]+)/documents/[^/]+$')
+
+
+def delete_stored_document(name: str) -> str:
+    """
+    Elimina un documento con i suoi chunk (force=true). Retry su 429/5xx e circuit breaker come
+    per ogni chiamata a Gemini; un documento già assente conta come 'missing', non come errore
+    """
+    response = upstream_request('delete', 'DELETE', f"{BASE_URL}/{name}", PRIORITY_BULK,
+                                headers=get_headers(), params={'force': 'true'})
+    if response.status_code == 404:
+        return 'missing'
+    response.raise_for_status()
+    document_storage.remove(name)
+    return 'deleted'
+
+
+def bulk_delete_targets(data: dict) -> list:
+    """
+    Documenti da eliminare: `names` (nomi completi negli store configurati) oppure i documenti che
+    soddisfano `filters` negli store selezionati (`stores`), letti dal mirror locale
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Il corpo della richiesta deve essere un oggetto JSON')
+    names = data.get('names')
+    filters = parse_metadata_filters(data.get('filters'))
+    if (names is None) == (not filters):
+        raise ValueError('Indicare names (lista di documenti) oppure filters (non vuoto), non entrambi')
+    if names is not None:
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            raise ValueError('names deve essere una lista di nomi di documenti')
+        for name in names:
+            match = DOCUMENT_NAME_PATTERN.match(name)
+            if match is None or match.group(1) not in FILE_SEARCH_STORES:
+                raise ValueError(f'Documento non valido o di uno store non configurato: {name[:100]}')
+        targets = list(dict.fromkeys(names))
+    else:
+        targets = []
+        for store in resolve_stores(data.get('stores'), [FILE_SEARCH_STORE_NAME]):
+            # Eliminazione: indice aggiornato, non quello precedente servito durante la ricostruzione
+            index = document_mirror.get(store, wait=True)
+            targets.extend(document['name'] for document in index.select(index.match(filters)))
+    if len(targets) > BULK_DELETE_MAX:
+        raise ValueError(f'Troppi documenti ({len(targets)}, max {BULK_DELETE_MAX}): restringere la selezione')
+    return targets
+
+
+def run_bulk_delete(names: list):
+    """
+    Generatore NDJSON: una riga 'start', una riga 'item' per documento appena concluso e una 'done'.
+    Al più BULK_DELETE_CONCURRENCY eliminazioni in volo; con breaker aperto o coda satura le
+    eliminazioni non ancora partite vengono saltate ('skipped', con retry_after).
+    Un solo evento document_deleted alla fine (una sola invalidazione delle cache), anche se il
+    client si disconnette a metà: le eliminazioni già partite vengono attese e contate
+    """
+    def timed(name):
+        started = time.perf_counter()
+        try:
+            return delete_stored_document(name), None, time.perf_counter() - started
+        except Exception as e:
+            return 'failed', e, time.perf_counter() - started
+
+    counts = dict.fromkeys(('deleted', 'missing', 'failed', 'skipped'), 0)
+    deleted = []
+    waiting, running = deque(names), {}
+    blocked = None
+    started = time.perf_counter()
+
+    def record(name, status, error, seconds) -> dict:
+        counts[status] += 1
+        metrics.inc('bulk_delete_items_total', outcome=status)
+        if status == 'deleted':
+            deleted.append(name)
+        item = {'type': 'item', 'name': name, 'status': status, 'latency_ms': round(seconds * 1000, 1),
+                'completed': sum(counts.values()), 'total': len(names)}
+        if error is not None:
+            logger.warning("Eliminazione di %s fallita: %s", name, error)
+            item['error'] = str(error)
+        return item
 
-@app.route('/api/documents/<path:document_name>', methods=['DELETE'])
-def delete_document(document_name):
-    """Elimina un documento dal File Search Store"""
     try:
-        # Il document_name include già il path completo (fileSearchStores/.../documents/...)
-        url = f"{BASE_URL}/{document_name}"
-        headers = get_headers()
-        
-        # IMPORTANTE: force=true elimina anche tutti i Chunk associati
-        params = {'force': 'true'}
-        
-        logger.info(f"Eliminazione documento: {document_name}")
-        
-        response = http_session.delete(url, headers=headers, params=params)
-        response.raise_for_status()
-        
-        logger.info(f"Documento eliminato con successo")
-        
-        return jsonify({
-            'success': True,
-            'message': 'Documento eliminato con successo'
-        })
-        
+        yield json_dumps({'type': 'start', 'total': len(names), 'concurrency': BULK_DELETE_CONCURRENCY}) + '\n'
+        while running or (waiting and blocked is None):
+            while waiting and blocked is None and len(running) < BULK_DELETE_CONCURRENCY:
+                name = waiting.popleft()
+                running[submit_in_context(timed, name, pool='maintenance')] = name
+            for future in wait_futures(running, return_when=FIRST_COMPLETED)[0]:
+                status, error, seconds = future.result()
+                if isinstance(error, UpstreamUnavailableError) and blocked is None:
+                    blocked = error
+                    logger.warning("Eliminazione in blocco sospesa: %s", error)
+                yield json_dumps(record(running.pop(future), status, error, seconds)) + '\n'
+        while waiting:
+            item = record(waiting.popleft(), 'skipped', None, 0.0)
+            item.update(error=str(blocked), retry_after=blocked.retry_after)
+            yield json_dumps(item) + '\n'
+        logger.info("Eliminazione in blocco: %s in %.1fs", counts, time.perf_counter() - started)
+        yield json_dumps({'type': 'done', **counts, 'total': len(names),
+                          'duration_ms': round((time.perf_counter() - started) * 1000, 1)}) + '\n'
+    finally:
+        for future, name in running.items():
+            record(name, *future.result())
+        if deleted:
+            event_bus.document_changed('document_deleted', {'name': None, 'names': deleted, 'count': len(deleted)})
+
+
+@app.route('/api/documents/bulk-delete', methods=['POST'])
+@rate_limited
+@admission_controlled(PRIORITY_BULK)
+def bulk_delete_documents():
+    """
+    Elimina più documenti: {"names": [...]} oppure {"filters": {...}, "stores": [...]}.
+    Con "dryRun": true restituisce solo l'elenco dei documenti selezionati; altrimenti l'avanzamento
+    arriva come NDJSON (application/x-ndjson), una riga per documento
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        names = bulk_delete_targets(data)
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
+    except (StoreSelectionError, MetadataFilterError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except requests.exceptions.RequestException as e:
-        logger.error(f"Errore durante eliminazione: {str(e)}")
-        error_detail = e.response.json() if hasattr(e, 'response') and e.response.content else str(e)
-        return jsonify({
-            'success': False,
-            'error': 'Errore durante l\'eliminazione',
-            'details': error_detail
-        }), 500
-    except Exception as e:
-        logger.error(f"Errore imprevisto: {str(e)}")
-        return jsonify({'success': False, 'error': str(e)}), 500
+        logger.error("Selezione dei documenti da eliminare fallita: %s", e)
+        return jsonify({'success': False, 'error': 'Errore nel recupero dei documenti'}), 500
+    if data.get('dryRun'):
+        return jsonify({'success': True, 'names': names, 'total': len(names)})
+    logger.info("Eliminazione in blocco di %s documenti", len(names))
+    return Response(stream_with_log_context(run_bulk_delete(names)), mimetype='application/x-ndjson',
+                    headers=SSE_HEADERS)
 
 # ==================== CHATBOT ENDPOINTS ====================
 
 @app.route('/api/chat/query', methods=['POST'])
+@rate_limited
+@admission_controlled(PRIORITY_INTERACTIVE)
 def query_documents():
     try:
         data = request.get_json()
         query_text = data.get("query", "").strip()
         document_name = data.get("documentName")
         results_count = int(data.get("resultsCount", RESULTS_COUNT))
+        # includeText: false -> Chunks nur als chunkId + chunkPreview (Text bleibt im Chunk-Archiv)
+        include_text = data.get("includeText", True) is not False
 
-        logger.info(f"Query erhalten: {query_text}")
+        logger.info("Query erhalten: %s", query_text)
 
         if not query_text:
             return jsonify({"success": False, "error": "Keine Query angegeben"}), 400
@@ -731,230 +5083,186 @@ def query_documents():
                 "error": "FILE_SEARCH_STORE_NAME ist nicht gesetzt."
             }), 500
 
-        logger.info(f"Verwende File Search Store: {FILE_SEARCH_STORE_NAME}")
+        # Föderierte Suche: standardmäßig alle konfigurierten Stores, "stores" wählt pro Anfrage aus
+        try:
+            stores = resolve_stores(data.get("stores"), FILE_SEARCH_STORES)
+        except StoreSelectionError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
 
-        # Google GenAI Client
-        genai_client = genai.Client(api_key=GENERATION_API_KEY)
+        # Mehrere Dokumente: {document}:query pro Dokument statt Suche im ganzen Store
+        document_names = data.get("documentNames") or []
+        if not isinstance(document_names, list) or not all(isinstance(n, str) and n for n in document_names):
+            return jsonify({"success": False, "error": "documentNames muss eine Liste von Dokumentnamen sein"}), 400
+        document_names = list(dict.fromkeys(document_names))
+        if len(document_names) > MULTI_DOCUMENT_MAX:
+            return jsonify({"success": False, "error": f"Maximal {MULTI_DOCUMENT_MAX} Dokumente pro Anfrage"}), 400
+        foreign = [n for n in document_names if not any(n.startswith(f"{store}/documents/") for store in stores)]
+        if foreign:
+            return jsonify({"success": False, "error": f"Dokument in keinem ausgewählten Store: {foreign[0]}"}), 400
 
-        # 📌 FileSearch-Tool definieren
-        # Wenn ein Dokument angegeben wurde → filtere auf dieses Dokument
         if document_name:
-            fs_tool = types.Tool(
-                file_search=types.FileSearch(
-                    file_search_store_names=[FILE_SEARCH_STORE_NAME],
-                    filters={"document": document_name}
-                )
-            )
-            logger.info(f"Filter aktiv: Dokument = {document_name}")
-        else:
-            fs_tool = types.Tool(
-                file_search=types.FileSearch(
-                    file_search_store_names=[FILE_SEARCH_STORE_NAME]
-                )
-            )
+            # Ein Dokument gehört zu genau einem Store
+            stores = [store for store in stores if document_name.startswith(f"{store}/")] or stores
+            logger.info("Filter aktiv: Dokument = %s", document_name)
 
-        # 📌 Generate Content + FileSearch Tool
-        response = genai_client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=query_text,
-            config=types.GenerateContentConfig(
-                tools=[fs_tool],
-                max_output_tokens=512
-            )
-        )
+        # Metadaten-Filter: File Search bekommt den kompilierten metadata_filter
+        try:
+            filters = parse_metadata_filters(data.get("filters"))
+        except MetadataFilterError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        metadata_filter = compile_metadata_filter(filters)
 
-        # 📌 Grounding extrahieren → relevante Chunks
-        relevant_chunks = []
+        logger.info("Verwende File Search Stores: %s", ", ".join(stores))
 
-        candidate = response.candidates[0] if response.candidates else None
-        if candidate and candidate.grounding_metadata:
-            gm = candidate.grounding_metadata
-            chunks = gm.grounding_chunks or []
+        # Retrieval-Cache: wird geleert, sobald ein Worker Dokumente hinzufügt oder löscht
+        cache_key = json.dumps([query_text, document_name, results_count, stores, document_names, filters],
+                               ensure_ascii=False, sort_keys=True)
+        with span('cache_lookup'):
+            sync_document_caches()
+            cached = query_cache.get(cache_key)
+        if cached is not None:
+            return jsonify(dict(cached, relevant_chunks=publish_chunks(cached["relevant_chunks"], include_text), cached=True))
 
-            for ch in chunks:
-                relevant_chunks.append({
-                    "chunkText": getattr(ch, "text", ""),
-                    "chunkRelevanceScore": getattr(ch, "relevance_score", 0),
-                    "sourceDocument": getattr(ch, "document_name", "unknown")
-                })
+        # Der lokale Facettenindex kennt die passenden Dokumente: Stores und Dokumente ohne Treffer
+        # werden nicht abgefragt, ohne Treffer gibt es sofort ein leeres Ergebnis
+        matched = None
+        if filters:
+            with span('facet_filter'):
+                matched = matching_documents(stores, filters)
+            if matched is not None:
+                requested_documents = bool(document_names)
+                document_names = [n for n in document_names if n in matched]
+                stores = [store for store in stores if any(n.startswith(f"{store}/") for n in matched)]
+                no_match = (not stores or (requested_documents and not document_names)
+                            or (document_name and document_name not in matched))
+                logger.info("Metadaten-Filter %s: %s Dokumente", metadata_filter, len(matched))
 
-        result = {
-            "success": True,
-            "answer": response.text,
-            "query": query_text,
-            "relevant_chunks": relevant_chunks,
-            "documents_searched": "1" if document_name else "ALL"
-        }
+        with span('retrieval'):
+            if matched is not None and no_match:
+                retrieved = {"answer": None, "chunks": [], "stores": [], "documents": [], "partial": False}
+            elif document_names:
+                retrieved = multi_document_retrieve(document_names, query_text, results_count)
+            else:
+                retrieved = federated_retrieve(stores, query_text, document_name, results_count, metadata_filter)
 
-        return jsonify(result)
+        with span('postprocess'):
+            result = {
+                "success": True,
+                # Nur Retrieval bei mehreren Dokumenten: die Antwort erzeugt /api/chat/generate
+                "answer": retrieved.get("answer"),
+                "query": query_text,
+                "relevant_chunks": retrieved["chunks"],
+                "documents_searched": str(len(document_names)) if document_names else "1" if document_name else "ALL",
+            }
+            if document_names:
+                result["documents"] = retrieved["documents"]
+            else:
+                result["stores"] = retrieved["stores"]
+            if filters:
+                result["filter"] = metadata_filter
+                if matched is not None:
+                    result["documents_matched"] = len(matched)
+            # Teilergebnisse (Store/Dokument ausgefallen oder zu langsam) werden nicht gecacht
+            if retrieved["partial"]:
+                result["partial"] = True
+            else:
+                query_cache.set(cache_key, result)
+            # Im Cache bleibt der volle Text; die Antwort referenziert das Chunk-Archiv
+            relevant_chunks = publish_chunks(result["relevant_chunks"], include_text)
 
+        return jsonify(dict(result, relevant_chunks=relevant_chunks))
+
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
+    except TimeoutError as e:
+        logger.error("Query-Timeout: %s", e)
+        return jsonify({"success": False, "error": str(e)}), 504
     except Exception as e:
-        logger.error(f"Query-Fehler: {e}", exc_info=True)
+        logger.error("Query-Fehler: %s", e, exc_info=True)
         return jsonify({
             "success": False,
             "error": str(e),
         }), 500
 
 @app.route('/api/chat/generate', methods=['POST'])
+@rate_limited
+@admission_controlled(PRIORITY_INTERACTIVE)
 def generate_response():
     """
     Endpoint per generare una risposta usando Gemini (Generation Phase)
     Prende i chunk rilevanti e genera una risposta coerente
     """
     try:
-        data = request.json
-        query_text = data.get('query')
-        relevant_chunks = data.get('relevant_chunks', [])
-        chat_history = data.get('chat_history', [])  # Per conversazioni multi-turn
-        model = data.get('model', DEFAULT_MODEL)  # Default dal .env
-        
-        if not query_text:
-            return jsonify({
-                'success': False,
-                'error': 'Query text è obbligatorio'
-            }), 400
-        
-        # VALIDAZIONE INPUT
-        is_valid, error = validate_query_text(query_text)
-        if not is_valid:
-            return jsonify({'success': False, 'error': error}), 400
-        
-        # CONTROLLO CIRCUIT BREAKER
-        if not gemini_circuit_breaker.call_allowed():
-            logger.warning("Circuit breaker APERTO - troppe richieste fallite a Gemini API")
-            return jsonify({
-                'success': False,
-                'error': 'Servizio temporaneamente non disponibile. Riprova tra qualche minuto.',
-                'circuit_breaker_status': 'OPEN'
-            }), 503
-        
-        logger.info(f"Generazione risposta per: {query_text}")
-        
-        # Filtra chunk per generazione basandoci sulla rilevanza
-        # Usa solo chunk con score alto o limita il numero
-        high_score_chunks = [
-            chunk for chunk in relevant_chunks 
-            if chunk.get('chunkRelevanceScore', 0) >= MIN_RELEVANCE_SCORE
-        ]
-        
-        # Se non ci sono chunk con score alto, usa comunque i migliori disponibili
-        if not high_score_chunks and relevant_chunks:
-            logger.warning(f"Nessun chunk supera MIN_RELEVANCE_SCORE={MIN_RELEVANCE_SCORE}, uso i migliori {MAX_CHUNKS_FOR_GENERATION} disponibili")
-            chunks_to_use = relevant_chunks[:MAX_CHUNKS_FOR_GENERATION]
-        else:
-            # Se abbiamo troppi chunk anche dopo il filtro, prendi i top N
-            chunks_to_use = high_score_chunks[:MAX_CHUNKS_FOR_GENERATION]
-        
-        logger.info(f"Chunk recuperati: {len(relevant_chunks)}, Score >= {MIN_RELEVANCE_SCORE}: {len(high_score_chunks)}, Usati per generazione: {len(chunks_to_use)}")
-        
-        # Costruisci il contesto dai chunk rilevanti
-        context_parts = []
-        if chunks_to_use:
-            context_parts.append("CONTESTO DOCUMENTI:\n\n")
-            for i, chunk in enumerate(chunks_to_use, 1):
-                chunk_text = chunk.get('chunk', {}).get('data', {}).get('stringValue', '')
-                source = chunk.get('source_document', 'documento')
-                context_parts.append(f"[Frammento {i} da {source}]:\n{chunk_text}\n\n")
-        
-        # System instruction compatto
-        system_instruction = """Du bist ein KI-Assistent, der AUSSCHLIESSLICH auf Grundlage der bereitgestellten Dokumente antwortet.
-Antworte klar und präzise und extrahiere nur die relevanten Informationen."""
+        with span('validate'):
+            data = request.json
+            query_text = data.get('query')
+            chat_history = data.get('chat_history', [])  # Per conversazioni multi-turn
+            model = data.get('model', DEFAULT_MODEL)  # Default dal .env
         
-        # STRATEGIA OTTIMIZZATA: Invia solo le DOMANDE dell'utente (non le risposte)
-        # Estrai solo le domande dell'utente dalla cronologia
-        user_questions = [msg.get('text', '') for msg in chat_history if msg.get('role') == 'user']
+            if not query_text:
+                return jsonify({
+                    'success': False,
+                    'error': 'Query text è obbligatorio'
+                }), 400
         
-        # Limita al numero massimo configurato
-        max_history_messages = MAX_CHAT_HISTORY * 2
-        recent_questions = user_questions[-max_history_messages:] if len(user_questions) > max_history_messages else user_questions
-        
-        # Rimuovi duplicati
-        unique_questions = []
-        seen = set()
-        for q in recent_questions:
-            if q and q not in seen:
-                unique_questions.append(q)
-                seen.add(q)
-        
-        # Costruisci un singolo prompt
-        user_prompt = system_instruction + "\n\n"
-        
-        # Aggiungi il contesto dei documenti
-        user_prompt += ''.join(context_parts)
+            # VALIDAZIONE INPUT
+            is_valid, error = validate_query_text(query_text)
+            if not is_valid:
+                return jsonify({'success': False, 'error': error}), 400
         
-        # Aggiungi cronologia domande precedenti (se ci sono)
-        if unique_questions:
-            user_prompt += "\n\nCONTESTO CONVERSAZIONE - Domande precedenti dell'utente:\n"
-            for i, q in enumerate(unique_questions, 1):
-                user_prompt += f"{i}. {q}\n"
-            user_prompt += "\n"
+            # Chunk per riferimento (chunkId): testi dall'archivio, 409 se qualcuno non c'è più
+            try:
+                relevant_chunks, missing, by_reference = resolve_chunks(data.get('relevant_chunks', []))
+            except ChunkReferenceError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+            if missing:
+                return chunks_evicted_response(missing)
         
-        # Aggiungi la domanda corrente
-        user_prompt += f"DOMANDA CORRENTE: {query_text}\n\nRISPOSTA:"
+        logger.info("Generazione risposta per: %s", query_text)
         
-        # Costruisci contents con un singolo messaggio user
-        contents = [{
-            'role': 'user',
-            'parts': [{'text': user_prompt}]
-        }]
+        with span('prompt'):
+            chunks_to_use, high_score_chunks, selection = select_chunks_for_generation(relevant_chunks, query_text)
         
-        # Chiamata all'API Gemini
-        generate_url = f"{BASE_URL}/models/{model}:generateContent"
+            logger.info("Chunk recuperati: %s, selezionati (%s): %s, Usati per generazione: %s, token di contesto risparmiati: %s", len(relevant_chunks), selection['selection'], len(high_score_chunks), len(chunks_to_use), selection['context_tokens_saved'])
         
-        payload = {
-            'contents': contents,
-            'generationConfig': {
-                'temperature': 0.7,
-                'topK': 40,
-                'topP': 0.95,
-                'maxOutputTokens': 8192,  # Aumentato per risposte più lunghe (era 2048)
-            }
-        }
+            user_prompt = build_generation_prompt(query_text, chunks_to_use, chat_history)
+            payload = build_generation_payload(user_prompt)
         
-        # Esegui la chiamata al modello con retries su 429 (rate limit)
-        max_retries = 3
-        delay = 1
-        response = None
-        for attempt in range(max_retries):
-            try:
-                response = http_session.post(generate_url, headers=get_headers(), json=payload, timeout=60)
-                response.raise_for_status()
-                
-                # REGISTRA SUCCESSO NEL CIRCUIT BREAKER
-                gemini_circuit_breaker.record_success()
-                break
-            except requests.exceptions.HTTPError as he:
-                status = he.response.status_code if he.response is not None else None
-                # Se riceviamo 429 (Too Many Requests), ritentiamo con backoff
-                if status == 429:
-                    # REGISTRA FALLIMENTO NEL CIRCUIT BREAKER
-                    gemini_circuit_breaker.record_failure()
-                    
-                    if attempt < max_retries - 1:
-                        logger.warning(f"429 from Gemini API, retry {attempt+1}/{max_retries} after {delay}s")
-                        time.sleep(delay)
-                        delay *= 2
-                        continue
-                # Non gestito qui: rilancia per essere catturato più in basso
-                raise
+        # CACHE RISPOSTE: stessa domanda + stessi chunk + stesso modello
+        with span('cache_lookup'):
+            cache_key = response_cache.make_key(model, payload)
+            cached_text, cache_status = response_cache.lookup(cache_key)
+        if cached_text is not None:
+            logger.info("Cache risposte %s (%s)", cache_status.upper(), cache_key[:12])
+            if cache_status == 'stale':
+                refresh_cached_response(cache_key, model, payload)
+            return jsonify({
+                'success': True,
+                'response': cached_text,
+                'query': query_text,
+                'model': model,
+                'chunks_used': len(chunks_to_use),
+                'chunks_filtered': publish_chunks(chunks_to_use, include_text=False) if by_reference else chunks_to_use,
+                'context_selection': selection,
+                'cached': True
+            })
         
-        if response is None:
-            raise RuntimeError('Nessuna risposta dal servizio di generazione')
-
-        result = response.json()
+        # Chiamata all'API Gemini (coda dello scheduler, tentativi e backoff inclusi)
+        with span('upstream'):
+            result = request_generate_content(model, payload)
         
         # Estrai il testo della risposta
-        candidates = result.get('candidates', [])
-        if not candidates:
+        with span('parse'):
+            response_text = extract_response_text(result)
+        if response_text is None:
             return jsonify({
                 'success': False,
                 'error': 'Nessuna risposta generata dal modello'
             }), 500
         
-        response_text = candidates[0].get('content', {}).get('parts', [{}])[0].get('text', '')
-        
         # Correggi problemi di encoding
         response_text = fix_encoding_issues(response_text)
+        response_cache.set(cache_key, response_text)
         
         return jsonify({
             'success': True,
@@ -962,11 +5270,15 @@ Antworte klar und präzise und extrahiere nur die relevanten Informationen."""
             'query': query_text,
             'model': model,
             'chunks_used': len(chunks_to_use),
-            'chunks_filtered': chunks_to_use  # Restituisce solo i chunks effettivamente usati
+            # Restituisce solo i chunks effettivamente usati (come riferimenti se così sono arrivati)
+            'chunks_filtered': publish_chunks(chunks_to_use, include_text=False) if by_reference else chunks_to_use,
+            'context_selection': selection
         })
         
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
     except requests.exceptions.RequestException as e:
-        logger.error(f"Errore durante generazione: {str(e)}")
+        logger.error("Errore durante generazione: %s", e)
         # Se l'errore proviene dall'API esterna, proviamo ad estrarre lo status code
         status_code = None
         try:
@@ -994,237 +5306,221 @@ Antworte klar und präzise und extrahiere nur die relevanten Informationen."""
             'details': error_detail
         }), 500
     except Exception as e:
-        logger.error(f"Errore imprevisto: {str(e)}")
+        logger.error("Errore imprevisto: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def resume_stream(last_event_id: str):
+    """Ripresa di uno stream dal registro condiviso: frame dopo Last-Event-ID, poi quelli ancora in arrivo"""
+    match = STREAM_EVENT_ID_PATTERN.match(last_event_id.strip())
+    meta = stream_replay.meta(match[1]) if match else None
+    if meta is None:
+        metrics.inc('stream_resumes_total', outcome='not_found')
+        return jsonify({'success': False, 'error': 'Stream non trovato o scaduto: ripetere la domanda',
+                        'code': 'stream_not_found'}), 404
+    stream_id, after = match[1], int(match[2])
+    metrics.inc('stream_resumes_total', outcome='attached' if meta['status'] == 'running' else 'replayed')
+    logger.info("Ripresa dello stream %s dal frame %s (%s)", stream_id, after + 1, meta['status'])
+
+    def generate():
+        for seq, event in stream_replay.follow(stream_id, after):
+            yield stream_event_id(stream_id, seq) + sse_frame(event)
+
+    return Response(stream_with_log_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 @app.route('/api/chat/generate-stream', methods=['POST'])
+@rate_limited
+@admission_controlled(PRIORITY_INTERACTIVE)
 def generate_response_stream():
     """
     Endpoint per generare una risposta in streaming usando Gemini
-    Invia i chunk di testo man mano che vengono generati (SSE)
+    Invia i chunk di testo man mano che vengono generati (SSE).
+    Con Last-Event-ID (header o ?lastEventId=) riprende uno stream precedente dal frame successivo
     """
-    data = request.json
-    query_text = data.get('query')
-    relevant_chunks = data.get('relevant_chunks', [])
-    chat_history = data.get('chat_history', [])
-    model = data.get('model', DEFAULT_MODEL)  # Default dal .env
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    if last_event_id and STREAM_REPLAY_ENABLED:
+        return resume_stream(last_event_id)
     
-    # Validazione input
-    if not query_text:
-        return jsonify({'success': False, 'error': 'Query text è obbligatorio'}), 400
+    with span('validate'):
+        data = request.json
+        query_text = data.get('query')
+        chat_history = data.get('chat_history', [])
+        model = data.get('model', DEFAULT_MODEL)  # Default dal .env
     
-    is_valid, error = validate_query_text(query_text)
-    if not is_valid:
-        return jsonify({'success': False, 'error': error}), 400
+        # Validazione input
+        if not query_text:
+            return jsonify({'success': False, 'error': 'Query text è obbligatorio'}), 400
     
-    # Controllo circuit breaker
-    if not gemini_circuit_breaker.call_allowed():
-        return jsonify({
-            'success': False,
-            'error': 'Servizio temporaneamente non disponibile. Riprova tra qualche minuto.',
-            'circuit_breaker_status': 'OPEN'
-        }), 503
+        is_valid, error = validate_query_text(query_text)
+        if not is_valid:
+            return jsonify({'success': False, 'error': error}), 400
     
-    def generate():
-        """Generatore per lo streaming SSE"""
         try:
-            # Filtra chunk per generazione basandoci sulla rilevanza
-            high_score_chunks = [
-                chunk for chunk in relevant_chunks 
-                if chunk.get('chunkRelevanceScore', 0) >= MIN_RELEVANCE_SCORE
-            ]
-            
-            # Se non ci sono chunk con score alto, usa comunque i migliori disponibili
-            if not high_score_chunks and relevant_chunks:
-                logger.warning(f"Streaming - Nessun chunk supera MIN_RELEVANCE_SCORE={MIN_RELEVANCE_SCORE}, uso i migliori {MAX_CHUNKS_FOR_GENERATION} disponibili")
-                chunks_to_use = relevant_chunks[:MAX_CHUNKS_FOR_GENERATION]
-            else:
-                chunks_to_use = high_score_chunks[:MAX_CHUNKS_FOR_GENERATION]
-            
-            logger.info(f"Streaming - Chunk recuperati: {len(relevant_chunks)}, Score >= {MIN_RELEVANCE_SCORE}: {len(high_score_chunks)}, Usati: {len(chunks_to_use)}")
-            
-            # Debug: mostra la struttura del primo chunk
-            if chunks_to_use:
-                logger.info(f"Esempio chunk per streaming: {json.dumps(chunks_to_use[0], indent=2)[:500]}")
-            
-            # Costruisci il contesto
-            context_parts = []
-            if chunks_to_use:
-                context_parts.append("CONTESTO DOCUMENTI:\n\n")
-                for i, chunk in enumerate(chunks_to_use, 1):
-                    # Supporta entrambi i formati: nidificato e piatto
-                    chunk_text = chunk.get('chunk', {}).get('data', {}).get('stringValue', '') or chunk.get('stringValue', '')
-                    source = chunk.get('source_document', 'documento')
-                    if chunk_text:
-                        context_parts.append(f"[Frammento {i} da {source}]:\n{chunk_text}\n\n")
-                        logger.debug(f"Chunk {i}: {len(chunk_text)} caratteri")
-            
-            logger.info(f"Contesto costruito: {len(context_parts)} parti, totale {sum(len(p) for p in context_parts)} caratteri")
-            
-            # System instruction compatto
-            system_instruction = """Du bist ein KI-Assistent, der AUSSCHLIESSLICH auf Grundlage der bereitgestellten Dokumente antwortet.
-Antworte klar und präzise und extrahiere nur die relevanten Informationen."""
-            
-            # STRATEGIA OTTIMIZZATA: Invia solo le DOMANDE dell'utente (non le risposte)
-            # Questo riduce drasticamente i token usati mantenendo il contesto della conversazione
-            
-            # Estrai solo le domande dell'utente dalla cronologia (ignora le risposte dell'assistant)
-            user_questions = [msg.get('text', '') for msg in chat_history if msg.get('role') == 'user']
-            
-            # Limita al numero massimo configurato
-            max_history_messages = MAX_CHAT_HISTORY * 2  # Moltiplica per 2 perché contiamo solo user
-            recent_questions = user_questions[-max_history_messages:] if len(user_questions) > max_history_messages else user_questions
-            
-            # Rimuovi duplicati (a volte il frontend invia la stessa domanda 2 volte)
-            unique_questions = []
-            seen = set()
-            for q in recent_questions:
-                if q and q not in seen:
-                    unique_questions.append(q)
-                    seen.add(q)
-            
-            logger.info(f"Chat history: {len(user_questions)} domande utente totali, usando le ultime {len(unique_questions)} uniche")
-            
-            # Costruisci un singolo prompt con: system instruction + contesto + domande precedenti + domanda corrente
-            user_prompt = system_instruction + "\n\n"
-            
-            # Aggiungi il contesto dei documenti
-            user_prompt += ''.join(context_parts)
-            
-            # Aggiungi cronologia domande precedenti (se ci sono)
-            if unique_questions:
-                user_prompt += "\n\nCONTESTO CONVERSAZIONE - Domande precedenti dell'utente:\n"
-                for i, q in enumerate(unique_questions, 1):
-                    user_prompt += f"{i}. {q}\n"
-                user_prompt += "\n"
-            
-            # Aggiungi la domanda corrente
-            user_prompt += f"DOMANDA CORRENTE: {query_text}\n\nRISPOSTA:"
-            
-            logger.info(f"User prompt totale: {len(user_prompt)} caratteri (contesto: {sum(len(p) for p in context_parts)}, domande: {len(unique_questions)})")
-            
-            # Costruisci contents con un singolo messaggio user
-            contents = [{
-                'role': 'user',
-                'parts': [{'text': user_prompt}]
-            }]
+            relevant_chunks, missing, _ = resolve_chunks(data.get('relevant_chunks', []))
+        except ChunkReferenceError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        if missing:
+            return chunks_evicted_response(missing)
+    
+    with span('prompt'):
+        chunks_to_use, high_score_chunks, selection = select_chunks_for_generation(relevant_chunks, query_text)
+        logger.info("Streaming - Chunk recuperati: %s, selezionati (%s): %s, Usati: %s, token di contesto risparmiati: %s", len(relevant_chunks), selection['selection'], len(high_score_chunks), len(chunks_to_use), selection['context_tokens_saved'])
+    
+        user_prompt = build_generation_prompt(query_text, chunks_to_use, chat_history)
+        payload = build_generation_payload(user_prompt)
+    
+    # Cache risposte: le hit vengono riprodotte come SSE senza chiamare il modello
+    with span('cache_lookup'):
+        cache_key = response_cache.make_key(model, payload)
+        cached_text, cache_status = response_cache.lookup(cache_key)
+    if cached_text is not None:
+        logger.info("Streaming - Cache risposte %s (%s)", cache_status.upper(), cache_key[:12])
+        if cache_status == 'stale':
+            refresh_cached_response(cache_key, model, payload)
+        if STREAM_REPLAY_ENABLED:
+            return Response(stream_with_log_context(recorded_stream(stream_replay.new_id(), cached_response_events(cached_text))),
+                            mimetype='text/event-stream', headers=SSE_HEADERS)
+        return Response(stream_with_log_context(replay_cached_response(cached_text)), mimetype='text/event-stream', headers=SSE_HEADERS)
+    
+    # Controllo circuit breaker (senza consumare la chiamata di prova in HALF_OPEN)
+    is_open, retry_after = circuit_breakers.get('stream').peek()
+    if is_open:
+        logger.warning("Circuit breaker stream APERTO - troppe richieste fallite a Gemini API")
+        return upstream_unavailable_response(CircuitOpenError('stream', max(math.ceil(retry_after), 1)))
+    
+    request_started = g.get('request_started')
+    
+    relay = StreamRelay()
+    buffer = StreamBuffer()
+    upstream = {}  # tempi del producer per le metriche e l'evento 'timing'
+    stream_id = stream_replay.new_id() if STREAM_REPLAY_ENABLED else None
+    
+    def produce():
+        """Producer (thread dedicato): chiamata a Gemini e lettura dello stream a piena velocità nel buffer"""
+        # Lo slot dello scheduler resta occupato fino alla fine della generazione (non della lettura del client)
+        lease_id = ''
+        response = None
+        error = None
+        try:
+            logger.info("User prompt totale: %s caratteri", len(user_prompt))
             
             # Chiamata streaming all'API Gemini
             # IMPORTANTE: Aggiungi alt=sse per ricevere Server-Sent Events
             stream_url = f"{BASE_URL}/models/{model}:streamGenerateContent?alt=sse"
-            payload = {
-                'contents': contents,
-                'generationConfig': {
-                    'temperature': 0.7,
-                    'topK': 40,
-                    'topP': 0.95,
-                    'maxOutputTokens': 8192,  # Aumentato per risposte più lunghe (era 2048)
-                }
-            }
             
-            # Stream con requests - con retry su 503
-            logger.info(f"Chiamata API streaming a {stream_url}")
-            logger.info(f"Payload prompt length: {len(user_prompt)} caratteri")
+            # Stream con requests - retry (429/5xx, timeout) gestiti da RetryPolicy
+            logger.info("Chiamata API streaming a %s", stream_url)
             
-            max_retries = 3
-            delay = 2
-            response = None
+            cost_tokens = estimate_payload_tokens(payload)
             
-            for attempt in range(max_retries):
+            def attempt(remaining):
+                # Uno slot nuovo per ogni tentativo: durante il backoff non occupiamo la concorrenza
+                nonlocal lease_id
+                upstream_scheduler.release(lease_id)
+                lease_id = ''
+                lease_id = acquire_upstream_slot(PRIORITY_INTERACTIVE, cost_tokens)
+                upstream['connected_at'] = time.perf_counter()
                 try:
-                    response = http_session.post(stream_url, headers=get_headers(), json=payload, stream=True, timeout=60)
-                    logger.info(f"Risposta API status: {response.status_code} (attempt {attempt+1})")
-                    
-                    # Se riceviamo 503 o 429, ritentiamo
-                    if response.status_code in [503, 429]:
-                        if attempt < max_retries - 1:
-                            logger.warning(f"{response.status_code} from Gemini API, retry {attempt+1}/{max_retries} after {delay}s")
-                            response.close()
-                            time.sleep(delay)
-                            delay *= 2
-                            continue
-                    
-                    response.raise_for_status()
-                    gemini_circuit_breaker.record_success()
-                    break
-                except requests.exceptions.RequestException as e:
-                    if attempt < max_retries - 1:
-                        logger.warning(f"Request error, retry {attempt+1}/{max_retries} after {delay}s: {str(e)}")
-                        time.sleep(delay)
-                        delay *= 2
-                        continue
+                    result = upstream_request('stream', 'POST', stream_url, schedule=False, retry=False,
+                                              headers=get_headers(), json=payload, stream=True,
+                                              timeout=(UPSTREAM_CONNECT_TIMEOUT, max(min(UPSTREAM_READ_TIMEOUT, remaining), 1)))
+                except BaseException:
+                    upstream_scheduler.release(lease_id)
+                    lease_id = ''
                     raise
+                if result.status_code in RetryPolicy.RETRY_STATUSES:
+                    # 429/5xx: lo slot si libera prima che RetryPolicy.run dorma il backoff
+                    upstream_scheduler.release(lease_id)
+                    lease_id = ''
+                # Altrimenti lo slot resta occupato per tutto lo stream
+                return result
             
-            if response is None:
-                raise RuntimeError('Nessuna risposta dal servizio dopo tutti i retry')
-            
-            chunk_count = 0
-            raw_chunk_count = 0
-            
-            # DEBUG: Leggi il contenuto grezzo per vedere il formato
-            logger.info("Inizio lettura streaming...")
+            # Fino agli header della risposta (include coda, tentativi e backoff)
+            with span('upstream_wait'):
+                response = retry_policy.run(attempt, 'stream')
+            logger.info("Risposta API status: %s", response.status_code)
+            response.raise_for_status()
             
-            # Gemini restituisce SSE format: "data: {...json...}\n"
-            for line in response.iter_lines(decode_unicode=True):
-                raw_chunk_count += 1
-                logger.debug(f"Raw line #{raw_chunk_count}: {line[:200] if line else 'EMPTY'}")
-                
-                if line and line.startswith('data: '):
-                    try:
-                        # Rimuovi il prefisso "data: " e parsa il JSON
-                        json_str = line[6:]  # Salta "data: "
-                        chunk_data = json.loads(json_str)
-                        logger.debug(f"Parsed JSON keys: {list(chunk_data.keys())}")
-                        
-                        # Estrai il testo dal chunk
-                        candidates = chunk_data.get('candidates', [])
-                        if candidates:
-                            candidate = candidates[0]
-                            logger.info(f"Candidates trovati: {len(candidates)}, keys: {list(candidate.keys())}")
-                            
-                            # Controlla se c'è un finishReason
-                            if 'finishReason' in candidate:
-                                finish_reason = candidate.get('finishReason')
-                                logger.warning(f"⚠️ Streaming terminato con finishReason: {finish_reason}")
-                                # Invia un messaggio di avviso al frontend se non è STOP normale
-                                if finish_reason != 'STOP':
-                                    yield f"data: {json.dumps({'warning': f'Risposta incompleta: {finish_reason}'})}\n\n"
-                            
-                            if 'content' in candidate:
-                                parts = candidate.get('content', {}).get('parts', [])
-                                logger.info(f"Parts trovati: {len(parts)}")
-                                if parts and 'text' in parts[0]:
-                                    text_chunk = parts[0]['text']
-                                    logger.info(f"Text chunk estratto: {repr(text_chunk[:100])}")
-                                    # Invia anche chunk vuoti/whitespace - il frontend li gestirà
-                                    if text_chunk:
-                                        # Correggi problemi di encoding
-                                        text_chunk = fix_encoding_issues(text_chunk)
-                                        chunk_count += 1
-                                        logger.info(f"✓ Inviato chunk {chunk_count}: {text_chunk[:50]}...")
-                                        # Invia il chunk come SSE
-                                        yield f"data: {json.dumps({'text': text_chunk})}\n\n"
-                                else:
-                                    logger.info(f"No text in parts: {parts}")
-                            else:
-                                logger.info(f"No content in candidate, keys: {list(candidate.keys())}")
-                    except (json.JSONDecodeError, IndexError, KeyError) as e:
-                        logger.warning(f"Errore parsing chunk streaming: {str(e)}, line: {line[:100]}")
-                        continue
+            # Gemini restituisce SSE: "data: {...json...}" separati da righe vuote
+            upstream['headers_at'] = time.perf_counter()
+            with span('relay'):
+                for event in relay.deltas(response.iter_content(chunk_size=None)):
+                    upstream['seq'] += 1
+                    if stream_id:
+                        stream_replay.append(stream_id, upstream['seq'], event)
+                    if not buffer.put(dict(event, id=upstream['seq'])) and not stream_id:
+                        logger.info("Client disconnesso: lettura dello stream interrotta")
+                        return
+            upstream['generated_at'] = time.perf_counter()
+            # Memorizza solo risposte complete (anche se il client è stato chiuso perché troppo lento)
+            if relay.finish_reason in (None, 'STOP') and relay.parts:
+                response_cache.set(cache_key, relay.text)
+        except BaseException as e:
+            error = e
+        finally:
+            if response is not None:
+                response.close()
+            upstream_scheduler.release(lease_id)
+            if 'connected_at' in upstream:
+                upstream['hold'] = time.perf_counter() - upstream['connected_at']
+                metrics.observe('stream_upstream_hold_seconds', upstream['hold'])
+            if 'generated_at' in upstream:
+                metrics.observe('stream_generation_seconds', upstream['generated_at'] - upstream['headers_at'])
+            # Frame finale (done o errore) con l'id successivo all'ultimo evento
+            upstream['final_seq'] = upstream['seq'] + 1
+            if stream_id:
+                stream_replay.finish(stream_id, upstream['final_seq'], stream_error_event(error) if error else {'done': True})
+            buffer.finish(error)
+    
+    def generate():
+        """Generatore per lo streaming SSE (consumer: svuota il buffer al ritmo del client)"""
+        metrics.gauge_add('streams_in_flight', 1)
+        upstream['seq'] = 0
+        try:
+            if stream_id:
+                stream_replay.start(stream_id)
+            # Il producer eredita il contesto (request id dei log, trace degli span): finché lavora,
+            # il consumer non apre span propri
+            threading.Thread(target=contextvars.copy_context().run, args=(produce,),
+                             name='stream-producer', daemon=True).start()
+            if stream_id:
+                # Primo frame con id: da qui il client può già riprendere
+                yield stream_event_id(stream_id, 0) + sse_event('stream', {'stream_id': stream_id})
+            for event in buffer.drain():
+                seq = event.pop('id', None)
+                yield stream_event_id(stream_id, seq) + sse_frame(event)
+            if buffer.dropped:
+                yield sse_frame({'error': 'Connessione troppo lenta: stream interrotto, riprovare',
+                                 'code': 'slow_client', 'request_id': current_request_id()})
+                return
             
-            logger.info(f"Streaming completato: {raw_chunk_count} raw chunks ricevuti, {chunk_count} chunks testo inviati")
-            # Segnala fine dello streaming
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            lag = time.perf_counter() - buffer.finished_at
+            metrics.observe('stream_client_lag_seconds', lag)
+            logger.info("Streaming completato: %s eventi ricevuti, %s delta inviati in %s frame, connessione upstream "
+                        "occupata %.0f ms, client in ritardo di %.0f ms (buffer: %s frame al massimo, %s overflow)",
+                        relay.events, len(relay.parts), relay.frames, upstream.get('hold', 0) * 1000, lag * 1000,
+                        buffer.max_depth, buffer.overflows)
+            relay.observe_metrics(request_started)
+            # Ripartizione dei tempi (equivalente di Server-Timing per lo stream), poi fine dello streaming
+            timing = stream_timing(relay, request_started)
+            if timing is not None:
+                timing['upstream_hold'] = round(upstream.get('hold', 0) * 1000, 1)
+                timing['client_lag'] = round(lag * 1000, 1)
+                yield sse_event('timing', timing)
+            yield stream_event_id(stream_id, upstream['final_seq']) + sse_frame({'done': True})
                 
+        except UpstreamUnavailableError as e:
+            yield stream_event_id(stream_id, upstream.get('final_seq')) + sse_frame(stream_error_event(e))
         except requests.exceptions.HTTPError as he:
-            if he.response and he.response.status_code == 429:
-                gemini_circuit_breaker.record_failure()
-            yield f"data: {json.dumps({'error': 'Errore durante la generazione'})}\n\n"
+            logger.error("Errore HTTP streaming: %s", he)
+            yield stream_event_id(stream_id, upstream.get('final_seq')) + sse_frame(stream_error_event(he))
         except Exception as e:
-            logger.error(f"Errore streaming: {str(e)}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            logger.error("Errore streaming: %s", e)
+            yield stream_event_id(stream_id, upstream.get('final_seq')) + sse_frame(stream_error_event(e))
+        finally:
+            buffer.cancel()
+            metrics.gauge_add('streams_in_flight', -1)
     
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    return Response(stream_with_log_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 @app.route('/chat')
 def chat_page():
@@ -1236,19 +5532,20 @@ def chunks_page():
     """Pagina per visualizzare i chunks dei documenti"""
     return render_template('chunks.html')
 
-@app.route('/api/documents/<path:document_name>/chunks', methods=['POST'])
+@app.route('/api/documents/<path:document_name>/chunks', methods=['GET', 'POST'])
+@admission_controlled(PRIORITY_BULK)
 def get_document_chunks(document_name):
     """
     Recupera tutti i chunks di un documento specifico tramite query.
     L'API Google non ha un endpoint diretto per listare chunks,
     quindi usiamo il metodo query con una stringa generica.
     
-    Body params:
+    Body params (o query string con GET, che supporta ETag/If-None-Match -> 304):
     - query: stringa di ricerca (opzionale, default: "*" per tutti i chunks)
     - resultsCount: numero di chunks da recuperare (max 100)
     """
     try:
-        data = request.get_json() or {}
+        data = request.args if request.method == 'GET' else (request.get_json() or {})
         query_string = data.get('query', '*')  # Query generica per ottenere tutti i chunks
         results_count = min(int(data.get('resultsCount', 100)), 100)  # Max 100 per API
         
@@ -1264,75 +5561,79 @@ def get_document_chunks(document_name):
             'resultsCount': results_count
         }
         
-        logger.info(f"Query chunks su documento: {document_name}")
-        logger.info(f"Query: '{query_string}', Max results: {results_count}")
+        logger.info("Query chunks su documento: %s", document_name)
+        logger.info("Query: '%s', Max results: %s", query_string, results_count)
         
-        response = http_session.post(url, headers=headers, json=payload)
+        response = upstream_request('query', 'POST', url, PRIORITY_BULK, headers=headers, json=payload)
         response.raise_for_status()
         
         response_data = response.json()
         relevant_chunks = response_data.get('relevantChunks', [])
         
-        logger.info(f"Recuperati {len(relevant_chunks)} chunks")
+        logger.info("Recuperati %s chunks", len(relevant_chunks))
         
         # Debug: log della struttura del primo chunk
         if relevant_chunks:
-            logger.info(f"Esempio chunk: {json.dumps(relevant_chunks[0], indent=2)}")
+            logger.debug("Esempio chunk: %s", LazyJson(relevant_chunks[0]))
         
-        # Recupera informazioni del documento per includere i metadati
-        document_info = None
-        try:
-            doc_url = f"{BASE_URL}/{document_name}"
-            doc_response = http_session.get(doc_url, headers=headers)
-            doc_response.raise_for_status()
-            document_info = doc_response.json()
-            logger.info(f"Metadati documento recuperati: {document_info.get('displayName', 'N/A')}")
-        except Exception as doc_error:
-            logger.warning(f"Impossibile recuperare metadati documento: {doc_error}")
-        
-        # Formatta i chunks mantenendo la struttura originale per il frontend
-        formatted_chunks = []
-        for chunk_wrapper in relevant_chunks:
-            chunk_data = {
-                'chunk': chunk_wrapper.get('chunk', {}),
-                'chunkRelevanceScore': chunk_wrapper.get('chunkRelevanceScore', 0),
-                'source_document': document_name
-            }
-            
-            # Aggiungi informazioni del documento se disponibili
-            if document_info:
-                chunk_data['document'] = {
-                    'name': document_info.get('name'),
-                    'displayName': document_info.get('displayName'),
-                    'customMetadata': document_info.get('customMetadata', [])
+        with span('doc_info'):
+            # Recupera informazioni del documento per includere i metadati
+            document_info = None
+            try:
+                doc_url = f"{BASE_URL}/{document_name}"
+                doc_response = upstream_request('list', 'GET', doc_url, PRIORITY_BULK, headers=headers)
+                doc_response.raise_for_status()
+                document_info = doc_response.json()
+                logger.info("Metadati documento recuperati: %s", document_info.get('displayName', 'N/A'))
+            except Exception as doc_error:
+                logger.warning("Impossibile recuperare metadati documento: %s", doc_error)
+        
+        with span('transform'):
+            # Formatta i chunks mantenendo la struttura originale per il frontend
+            formatted_chunks = []
+            for chunk_wrapper in relevant_chunks:
+                chunk_data = {
+                    'chunk': chunk_wrapper.get('chunk', {}),
+                    'chunkRelevanceScore': chunk_wrapper.get('chunkRelevanceScore', 0),
+                    'source_document': document_name
                 }
             
-            formatted_chunks.append(chunk_data)
+                # Aggiungi informazioni del documento se disponibili
+                if document_info:
+                    chunk_data['document'] = {
+                        'name': document_info.get('name'),
+                        'displayName': document_info.get('displayName'),
+                        'customMetadata': document_info.get('customMetadata', [])
+                    }
+            
+                formatted_chunks.append(chunk_data)
         
-        return jsonify({
+        return conditional_response(jsonify({
             'success': True,
             'chunks': formatted_chunks,
             'totalCount': len(formatted_chunks),
             'document': document_info,
             'note': 'I chunks sono ordinati per rilevanza. Per vedere tutti i chunks, usa query generiche come "*" o "document".'
-        })
+        }))
         
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
     except requests.exceptions.RequestException as e:
-        logger.error(f"Errore durante recupero chunks: {e}")
+        logger.error("Errore durante recupero chunks: %s", e)
         error_detail = {}
         if hasattr(e, 'response') and e.response is not None:
             try:
                 error_detail = e.response.json()
             except:
                 error_detail = {'error': str(e)}
-        logger.error(f"Dettagli errore API: {error_detail}")
+        logger.error("Dettagli errore API: %s", error_detail)
         return jsonify({
             'success': False,
             'error': f'Errore nel recupero dei chunks: {str(e)}',
             'details': error_detail
         }), 500
     except Exception as e:
-        logger.error(f"Errore imprevisto: {e}")
+        logger.error("Errore imprevisto: %s", e)
         import traceback
         logger.error(traceback.format_exc())
         return jsonify({
@@ -1351,7 +5652,7 @@ def request_entity_too_large(error):
 @app.errorhandler(500)
 def internal_error(error):
     """Gestisce errori interni del server"""
-    logger.error(f"Errore interno del server: {str(error)}")
+    logger.error("Errore interno del server: %s", error)
     return jsonify({
         'success': False,
         'error': 'Errore interno del server'
@@ -1364,7 +5665,7 @@ if __name__ == '__main__':
         # Disabilito use_reloader per evitare problemi con watchdog su Windows
         app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=False)
     except ValueError as e:
-        logger.error(f"Errore di configurazione: {str(e)}")
+        logger.error("Errore di configurazione: %s", e)
         print(f"\n❌ ERRORE: {str(e)}")
         print("Assicurati di aver configurato correttamente il file .env")
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Byte trasmessi e CPU di codifica per i payload tipici dell'API: export di 100 chunk con i
+metadati del documento, risposta di /api/chat/query, lista di 20 documenti e uno stream SSE
+di ~300 frame (compressione con flush per frame contro compressione del corpo intero).
+
+Per ogni payload: identity, gzip (livelli 1 e COMPRESSION_GZIP_LEVEL) e brotli (se installato),
+più il costo di serializzazione JSON ed ETag (blake2b) del percorso 200 contro un 304.
+
+Uso:
+    python benchmarks/bench_compression.py --repeat 50
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+WORDS = ('progetto budget fase sviluppo durata mesi euro contratto fornitore consegna verifica '
+         'documento requisiti analisi rischio cliente servizio manutenzione sistema dati utente '
+         'il la di che per con una non sono dal nella degli previsto stimato complessivo tre').split()
+
+
+def text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def document(rng, i):
+    return {
+        'name': f'fileSearchStores/bench-store/documents/doc-{i:04d}-{rng.randrange(16 ** 8):08x}',
+        'displayName': f'Contratto_{i:04d}.pdf',
+        'customMetadata': [{'key': 'categoria', 'stringValue': rng.choice(['contratti', 'tecnico', 'hr'])},
+                           {'key': 'anno', 'numericValue': rng.choice([2023, 2024, 2025])}],
+        'createTime': '2025-03-14T10:21:33.123456Z', 'updateTime': '2025-03-14T10:22:01.654321Z',
+        'state': 'STATE_ACTIVE', 'sizeBytes': str(rng.randrange(10 ** 4, 10 ** 7)), 'mimeType': 'application/pdf',
+    }
+
+
+def payloads(seed):
+    rng = random.Random(seed)
+    doc = document(rng, 1)
+    chunk_export = {
+        'success': True,
+        'chunks': [{'chunk': {'data': {'stringValue': text(rng, 180)}, 'customMetadata': doc['customMetadata']},
+                    'chunkRelevanceScore': round(rng.random(), 4), 'source_document': doc['name'],
+                    'document': {k: doc[k] for k in ('name', 'displayName', 'customMetadata')}}
+                   for _ in range(100)],
+        'totalCount': 100, 'document': doc, 'note': 'I chunks sono ordinati per rilevanza.',
+    }
+    query = {
+        'success': True, 'answer': text(rng, 150), 'query': 'Qual è il budget del progetto?',
+        'relevant_chunks': [{'chunkText': text(rng, 180), 'chunkRelevanceScore': round(rng.random(), 4),
+                             'sourceDocument': document(rng, i)['name']} for i in range(25)],
+        'documents_searched': 'ALL',
+    }
+    listing = {'success': True, 'documents': [document(rng, i) for i in range(20)], 'nextPageToken': 'abc'}
+    with app_module.app.app_context():
+        encode = app_module.app.json.response
+        bodies = {name: encode(obj).get_data() for name, obj in
+                  (('chunk_export_100', chunk_export), ('chat_query_25', query), ('documents_20', listing))}
+    frames = [app_module.sse_frame({'text': rng.choice(WORDS) + ' '}).encode() for _ in range(300)]
+    frames.append(app_module.sse_event('timing', {'first_token': 412.3, 'total': 5120.8}).encode())
+    frames.append(app_module.sse_frame({'done': True}).encode())
+    return bodies, frames, {'chunk_export_100': chunk_export, 'chat_query_25': query, 'documents_20': listing}
+
+
+def encoders():
+    options = {'gzip-1': lambda: app_module.GzipEncoder(1),
+               f'gzip-{app_module.COMPRESSION_GZIP_LEVEL}': lambda: app_module.GzipEncoder()}
+    if app_module.brotli is not None:
+        options[f'br-{app_module.COMPRESSION_BROTLI_QUALITY}'] = lambda: app_module.BrotliEncoder()
+        options['br-11'] = lambda: app_module.BrotliEncoder(11)
+    return options
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.thread_time()
+        result = fn()
+        samples.append(time.thread_time() - started)
+    return result, round(statistics.median(samples) * 1e6, 1)
+
+
+def bench_body(body, factory, repeat):
+    def run():
+        encoder = factory()
+        return encoder.compress(body) + encoder.finish()
+    data, cpu_us = timed(run, repeat)
+    return {'bytes': len(data), 'ratio': round(len(body) / len(data), 2), 'cpu_us': cpu_us}
+
+
+def bench_stream(frames, factory, repeat):
+    def flushed():
+        encoder = factory()
+        return sum(len(encoder.compress(frame) + encoder.flush()) for frame in frames) + len(encoder.finish())
+    wire, cpu_us = timed(flushed, repeat)
+    whole = factory()
+    buffered = len(whole.compress(b''.join(frames)) + whole.finish())
+    return {'bytes_flushed_per_frame': wire, 'bytes_buffered': buffered,
+            'ratio': round(sum(map(len, frames)) / wire, 2), 'cpu_us_per_frame': round(cpu_us / len(frames), 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    bodies, frames, objects = payloads(args.seed)
+    report = {'brotli_available': app_module.brotli is not None, 'payloads': {}}
+    for name, body in bodies.items():
+        with app_module.app.app_context():
+            _, json_us = timed(lambda: app_module.app.json.response(objects[name]).get_data(), args.repeat)
+        _, etag_us = timed(lambda: hashlib.blake2b(body, digest_size=16).hexdigest(), args.repeat)
+        report['payloads'][name] = {
+            'identity_bytes': len(body),
+            'json_encode_us': json_us,
+            'etag_us': etag_us,
+            'not_modified_bytes': 0,  # 304: solo header
+            **{label: bench_body(body, factory, args.repeat) for label, factory in encoders().items()},
+        }
+    report['sse_stream'] = {'frames': len(frames), 'identity_bytes': sum(map(len, frames)),
+                            **{label: bench_stream(frames, factory, args.repeat) for label, factory in encoders().items()}}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
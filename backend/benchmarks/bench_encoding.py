@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark di fix_encoding_issues: vecchia versione (19 str.replace in sequenza)
+contro la riparazione in una passata, su testo pulito e su testo con mojibake,
+per chunk di streaming brevi e per risposte complete.
+
+Uso:
+    python benchmarks/bench_encoding.py --repeat 20000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import fix_encoding_issues, EncodingRepairer, MOJIBAKE_TABLE  # noqa: E402
+
+# Dizionario del codice precedente: i byte C1/cp1252 erano andati persi, le 19 regole
+# collassavano in 10 chiavi e 'Ã'/'â' isolati diventavano 'Ù'/'—' (output errato)
+LEGACY_REPLACEMENTS = {
+    '\xe2\xac': '€', '\xc3 ': 'à', '\xc3\xa8': 'è', '\xc3\xa9': 'é', '\xc3\xac': 'ì', '\xc3\xb2': 'ò',
+    '\xc3\xb9': 'ù', '\xc3': 'Ù', '\xe2': '—', '\xe2\xa6': '...',
+}
+
+
+def legacy_fix_encoding_issues(text):
+    if not text:
+        return text
+    for wrong, correct in LEGACY_REPLACEMENTS.items():
+        text = text.replace(wrong, correct)
+    return text
+
+
+def sequential_full_table(text):
+    """Riferimento corretto ma ingenuo: una str.replace per ogni voce della tabella completa"""
+    for wrong in sorted(MOJIBAKE_TABLE, key=len, reverse=True):
+        text = text.replace(wrong, MOJIBAKE_TABLE[wrong])
+    return text
+
+
+CLEAN_IT = ('Il computo metrico estimativo è il documento che quantifica le lavorazioni. '
+            'Perché la città è più bella? Così dice l’architetto. ') * 8
+CLEAN_DE = 'Die Größe der Fläche beträgt 120 m², über „schöne“ Räume für Müller. ' * 8
+BROKEN_IT = CLEAN_IT.encode('utf-8').decode('cp1252', errors='replace')
+ASCII_CHUNK = 'The answer is '
+IT_CHUNK = 'più '
+
+
+def bench(fn, text, repeat):
+    seconds = min(timeit.repeat(lambda: fn(text), number=repeat, repeat=3))
+    return round(seconds / repeat * 1e6, 3)
+
+
+def bench_stream(text, chunk_size, repeat):
+    chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+    def run(_):
+        repairer = EncodingRepairer()
+        for chunk in chunks:
+            repairer.feed(chunk)
+        repairer.flush()
+
+    return bench(run, None, max(repeat // 50, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20000)
+    args = parser.parse_args()
+
+    cases = {
+        'chunk_ascii': ASCII_CHUNK,
+        'chunk_italian_clean': IT_CHUNK,
+        'answer_italian_clean': CLEAN_IT,
+        'answer_german_clean': CLEAN_DE,
+        'answer_italian_mojibake': BROKEN_IT,
+    }
+    report = {'us_per_call': {
+        name: {'legacy': bench(legacy_fix_encoding_issues, text, args.repeat),
+               'sequential_full_table': bench(sequential_full_table, text, args.repeat),
+               'single_pass': bench(fix_encoding_issues, text, args.repeat)}
+        for name, text in cases.items()
+    }}
+    report['us_per_stream_of_answer_italian_mojibake'] = {
+        f'chunk_{size}_chars': bench_stream(BROKEN_IT, size, args.repeat) for size in (4, 16, 64)
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Load test del logging: latenza p50/p99 di /api/chat/generate e /api/chat/generate-stream
+con logging spento (WARNING), sincrono a INFO, asincrono (QueueHandler/QueueListener) e
+asincrono con campionamento, contro il server Gemini finto. I log vanno su file.
+
+Uso:
+    python benchmarks/bench_logging.py --requests 400 --concurrency 8
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_gemini import FakeGeminiServer  # noqa: E402
+
+MODES = {
+    'off': {'level': 'WARNING', 'fmt_type': 'text', 'async_mode': False},
+    'sync_info': {'level': 'INFO', 'fmt_type': 'text', 'async_mode': False},
+    'async_info_json': {'level': 'INFO', 'fmt_type': 'json', 'async_mode': True},
+    'async_info_sampled_10pct': {'level': 'INFO', 'fmt_type': 'json', 'async_mode': True, 'sample': 0.1},
+}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_mode(app_module, name, options, args, log_path):
+    with open(log_path, 'w') as log_file:
+        app_module.configure_logging(options['level'], options['fmt_type'], options['async_mode'], stream=log_file)
+        app_module.LOG_SAMPLE_RATES.clear()
+        if 'sample' in options:
+            for route in ('/api/chat/generate', '/api/chat/generate-stream'):
+                app_module.LOG_SAMPLE_RATES[route] = options['sample']
+
+        latencies = {'/api/chat/generate': [], '/api/chat/generate-stream': []}
+        lock = threading.Lock()
+        counter = iter(range(args.requests))
+
+        def worker():
+            client = app_module.app.test_client()
+            for i in counter:
+                endpoint = '/api/chat/generate-stream' if i % 2 else '/api/chat/generate'
+                body = {'query': f'domanda {name} {i}', 'relevant_chunks': [
+                    {'chunk': {'data': {'stringValue': 'Il computo metrico è un documento tecnico. ' * 20}}, 'chunkRelevanceScore': 0.9}]}
+                started = time.perf_counter()
+                client.post(endpoint, json=body).get_data()
+                with lock:
+                    latencies[endpoint].append(time.perf_counter() - started)
+
+        cpu_started = time.process_time()
+        wall_started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - wall_started
+        cpu = time.process_time() - cpu_started
+        # Svuota la coda sul file prima di chiuderlo
+        app_module.configure_logging('WARNING')
+
+    result = {
+        'throughput_rps': round(args.requests / wall, 1),
+        'cpu_ms_per_request': round(cpu / args.requests * 1000, 3),
+        'log_bytes': os.path.getsize(log_path),
+    }
+    for endpoint, values in latencies.items():
+        result[endpoint] = {'p50_ms': round(percentile(values, 50) * 1000, 2), 'p99_ms': round(percentile(values, 99) * 1000, 2)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--answer-words', type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ.setdefault('GEMINI_API_KEY', 'fake-key')
+    os.environ['RESPONSE_CACHE_TTL'] = '0'
+    import app as app_module
+
+    answer = ' '.join(f'parola{i}' for i in range(args.answer_words))
+    report = {}
+    with FakeGeminiServer(answer=answer) as server, tempfile.TemporaryDirectory() as tmp:
+        app_module.BASE_URL = f'{server.url}/v1beta'
+        for name, options in MODES.items():
+            app_module.rate_limiter = app_module.RateLimiter(10 ** 6, 60, app_module.MemorySharedStore())
+            app_module.upstream_scheduler = app_module.UpstreamScheduler(app_module.MemorySharedStore(), rpm=10 ** 6, tpm=10 ** 9)
+            app_module.response_cache.clear()
+            report[name] = run_mode(app_module, name, options, args, os.path.join(tmp, f'{name}.log'))
+    app_module.configure_logging()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark del rate limiter: costo per check con molte chiavi distinte.
+
+Confronta il RateLimiter GCRA (O(1) per chiave) con la vecchia implementazione
+a lista di timestamp, su store in-memory o SQLite condiviso.
+
+Uso:
+    python benchmarks/bench_rate_limiter.py --keys 100000 --checks 200000
+    python benchmarks/bench_rate_limiter.py --backend sqlite --checks 20000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import RateLimiter, MemorySharedStore, SqliteSharedStore  # noqa: E402
+
+
+class LegacyRateLimiter:
+    """Implementazione precedente: lista di timestamp per identificatore, mai ripulita"""
+    def __init__(self, max_requests=30, time_window=60):
+        self.max_requests = max_requests
+        self.time_window = time_window
+        self.requests = {}
+
+    def is_allowed(self, identifier):
+        now = time.time()
+        if identifier in self.requests:
+            self.requests[identifier] = [ts for ts in self.requests[identifier] if now - ts < self.time_window]
+        else:
+            self.requests[identifier] = []
+        if len(self.requests[identifier]) >= self.max_requests:
+            return False
+        self.requests[identifier].append(now)
+        return True
+
+
+def run(limiter_check, keys, checks, hot_keys=0):
+    identifiers = [f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}' for i in range(keys)]
+    # Popola tutte le chiavi, poi misura i check su chiavi casuali
+    for identifier in identifiers:
+        limiter_check(identifier)
+    # hot_keys > 0: traffico concentrato su pochi client che restano al limite
+    population = identifiers[:hot_keys] if hot_keys else identifiers
+    sample = [random.choice(population) for _ in range(checks)]
+    started = time.perf_counter()
+    for identifier in sample:
+        limiter_check(identifier)
+    elapsed = time.perf_counter() - started
+    return elapsed / checks * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--checks', type=int, default=200000)
+    parser.add_argument('--hot-keys', type=int, default=1000, help='client attivi nello scenario "hot"')
+    parser.add_argument('--backend', choices=['memory', 'sqlite'], default='memory')
+    args = parser.parse_args()
+
+    results = {'keys': args.keys, 'checks': args.checks, 'backend': args.backend}
+
+    if args.backend == 'sqlite':
+        store = SqliteSharedStore(os.path.join(tempfile.mkdtemp(), 'bench-state.db'))
+    else:
+        store = MemorySharedStore()
+    limiter = RateLimiter(max_requests=30, time_window=60, store=store)
+    results['gcra_ns_per_check'] = round(run(limiter.check, args.keys, args.checks))
+    results['legacy_ns_per_check'] = round(run(LegacyRateLimiter().is_allowed, args.keys, args.checks))
+    limiter = RateLimiter(max_requests=30, time_window=60, store=MemorySharedStore() if args.backend == 'memory' else store)
+    results['gcra_hot_ns_per_check'] = round(run(limiter.check, args.keys, args.checks, args.hot_keys))
+    results['legacy_hot_ns_per_check'] = round(run(LegacyRateLimiter().is_allowed, args.keys, args.checks, args.hot_keys))
+
+    # Memoria misurata a parte: tracemalloc falsa i tempi
+    if args.backend == 'memory':
+        for name, factory in (('gcra', lambda: RateLimiter(30, 60, MemorySharedStore()).check),
+                              ('legacy', lambda: LegacyRateLimiter().is_allowed)):
+            tracemalloc.start()
+            check = factory()
+            for i in range(args.keys):
+                check(f'key-{i}')
+            results[f'{name}_mb_for_keys'] = round(tracemalloc.get_traced_memory()[0] / 1e6, 1)
+            tracemalloc.stop()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Costo e resa del reranking locale dei chunk (select_chunks_for_generation):
+tempo per 100 chunk con vettori dei termini già in cache (caso tipico: i chunk si ripetono tra i turni)
+e a freddo (tokenizzazione inclusa), solo fase numerica (fusione, ginocchio, MMR) e token di contesto
+inviati al modello rispetto alla soglia fissa MIN_RELEVANCE_SCORE.
+
+I chunk sintetici imitano il retrieval reale: poche pagine pertinenti e una coda di pagine marginali,
+finestre sovrapposte della stessa pagina (CHUNK_OVERLAP_PERCENT) e lo stesso passaggio da documenti
+caricati due volte. Senza numpy riporta solo il ripiego sulla soglia.
+
+Uso:
+    python benchmarks/bench_rerank.py --chunks 100 --repeat 200
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+COMMON = ('il la di che per con una non sono dal nella degli previsto stimato complessivo tre '
+          'progetto budget fase sviluppo durata mesi euro contratto fornitore consegna').split()
+SYLLABLES = 'ba ce di fo gu la me ni po ru sa te vi zo tra pre con ser mar ten dol'.split()
+
+
+def vocabulary(rng, size=4000):
+    """Parole inventate con frequenza di Zipf, più le parole funzionali comuni"""
+    words = list(COMMON)
+    while len(words) < size:
+        words.append(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    return words, weights
+
+
+def make_chunks(rng, count, words_per_chunk=380, overlap=0.25, relevant_pages=3):
+    """
+    Poche pagine pertinenti con score alto e molte pagine marginali con score sopra la soglia:
+    da ogni pagina più finestre sovrapposte e qualche copia esatta (documento caricato due volte)
+    """
+    words, weights = vocabulary(rng)
+    chunks = []
+    pages = 0
+    while len(chunks) < count:
+        page = rng.choices(words, weights, k=words_per_chunk * 3)
+        step = int(words_per_chunk * (1 - overlap))
+        score = rng.uniform(0.75, 0.9) if pages < relevant_pages else rng.uniform(0.3, 0.5)
+        pages += 1
+        for start in range(0, words_per_chunk * 2, step):
+            text = ' '.join(page[start:start + words_per_chunk])
+            for copy in range(2 if rng.random() < 0.3 else 1):
+                chunks.append({'chunkText': text, 'chunkRelevanceScore': round(max(0.0, score - rng.uniform(0, 0.05)), 3),
+                               'sourceDocument': f'fileSearchStores/s/documents/p{pages}-{copy}'})
+    chunks = chunks[:count]
+    rng.shuffle(chunks)
+    return chunks
+
+
+def median_us(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return round(statistics.median(samples) * 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    rng = random.Random(args.seed)
+    chunks = make_chunks(rng, args.chunks)
+    query = 'budget previsto per la manutenzione del sistema'
+    limit = app_module.MAX_CHUNKS_FOR_GENERATION
+    report = {'numpy': app_module.load_numpy() is not None, 'chunks': args.chunks}
+    if not report['numpy']:
+        _, _, report['selection'] = app_module.select_chunks_for_generation(chunks, query)
+        print(json.dumps(report, indent=2))
+        return
+
+    def cold():
+        app_module.term_vectors.clear()
+        app_module.rerank_chunks(query, chunks, limit)
+
+    report['rerank_cold_us'] = median_us(cold, max(args.repeat // 10, 5))
+    app_module.rerank_chunks(query, chunks, limit)
+    report['rerank_cached_us'] = median_us(lambda: app_module.rerank_chunks(query, chunks, limit), args.repeat)
+    report['threshold_us'] = median_us(lambda: app_module.select_chunks_by_threshold(chunks), args.repeat)
+    report['select_for_generation_us'] = median_us(lambda: app_module.select_chunks_for_generation(chunks, query), args.repeat)
+
+    _, _, selection = app_module.select_chunks_for_generation(chunks, query)
+    report['selection'] = selection
+    report['context_tokens_saved_percent'] = round(
+        selection['context_tokens_saved'] / max(selection['context_tokens_threshold'], 1) * 100, 1)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
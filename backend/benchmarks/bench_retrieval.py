@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Latenza di /api/chat/query limitata a un insieme di documenti (documentNames: un {document}:query
+per documento in parallelo, merge top-k) contro la ricerca sull'intero store (generateContent con
+FileSearch), al variare del numero di documenti e del limite di concorrenza.
+
+Le richieste vanno al server Gemini finto (fake_gemini.py) con latenza e jitter configurabili:
+la latenza della ricerca su più documenti è dominata dal documento più lento del gruppo.
+
+Uso:
+    python benchmarks/bench_retrieval.py --latency 0.2 --jitter 0.1 --documents 5,10,20
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_gemini import STORE_NAME, FakeGeminiServer  # noqa: E402
+
+
+def measure(client, server, body, requests):
+    client.post('/api/chat/query', json=dict(body, query=f"{body['query']} warmup")).close()  # import SDK e connessioni
+    latencies = []
+    calls_before = server.state.total_calls()
+    for i in range(requests):
+        started = time.perf_counter()
+        # close() rilascia lo slot del controllo di ammissione
+        with client.post('/api/chat/query', json=dict(body, query=f"{body['query']} {i}")) as response:
+            data = response.get_json()
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, data
+    latencies.sort()
+    return {
+        'median_ms': round(statistics.median(latencies) * 1000, 1),
+        'p90_ms': round(latencies[int(len(latencies) * 0.9) - 1] * 1000, 1) if len(latencies) >= 10 else None,
+        'max_ms': round(latencies[-1] * 1000, 1),
+        'upstream_calls_per_request': round((server.state.total_calls() - calls_before) / requests, 1),
+        'chunks': len(data['relevant_chunks']),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.2, help='latenza di base per chiamata upstream (s)')
+    parser.add_argument('--jitter', type=float, default=0.1, help='latenza casuale aggiuntiva massima (s)')
+    parser.add_argument('--documents', default='1,5,10,20', help='dimensioni degli insiemi di documenti')
+    parser.add_argument('--concurrency', default='1,5,20', help='limiti di concorrenza per richiesta')
+    parser.add_argument('--requests', type=int, default=10)
+    parser.add_argument('--results', type=int, default=10)
+    args = parser.parse_args()
+    sizes = [int(n) for n in args.documents.split(',')]
+
+    with FakeGeminiServer(latency=args.latency, latency_jitter=args.jitter, documents=max(sizes)) as server:
+        # Import ritardato: GEMINI_API_ROOT deve puntare al server finto prima di importare app
+        os.environ.update({'GEMINI_API_ROOT': server.url, 'GEMINI_API_KEY': 'fake-key',
+                           'FILE_SEARCH_STORE_NAME': STORE_NAME, 'QUERY_CACHE_TTL': '0',
+                           'MULTI_DOCUMENT_MAX': str(max(sizes)),
+                           # Il pool del processo limita comunque le chiamate in volo
+                           'FEDERATED_MAX_WORKERS': str(max(int(c) for c in args.concurrency.split(',')))})
+        logging.disable(logging.WARNING)
+        import app as app_module
+        app_module.rate_limiter = app_module.RateLimiter(10 ** 6, 60, app_module.MemorySharedStore())
+        app_module.upstream_scheduler = app_module.UpstreamScheduler(app_module.MemorySharedStore(), rpm=10 ** 6, tpm=10 ** 9)
+        client = app_module.app.test_client()
+        documents = sorted(server.state.documents)
+        base = {'query': 'Qual è il budget del progetto?', 'resultsCount': args.results}
+
+        report = {'latency_s': args.latency, 'jitter_s': args.jitter,
+                  'whole_store': measure(client, server, base, args.requests), 'documents': {}}
+        for concurrency in (int(c) for c in args.concurrency.split(',')):
+            app_module.MULTI_DOCUMENT_CONCURRENCY = concurrency
+            for size in sizes:
+                report['documents'][f'{size}_docs_concurrency_{concurrency}'] = measure(
+                    client, server, dict(base, documentNames=documents[:size]), args.requests)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
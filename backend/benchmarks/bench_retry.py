@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Harness dei retry: avvia il server Gemini finto con pattern di 429/503 e misura,
+per ogni scenario, la latenza totale di /api/chat/generate e /api/chat/generate-stream
+e il numero di chiamate arrivate all'upstream.
+
+Uso:
+    python benchmarks/bench_retry.py
+    python benchmarks/bench_retry.py --requests 20 --base-delay 0.2
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_gemini import FakeGeminiServer  # noqa: E402
+
+SCENARIOS = {
+    'ok': {'errors': 'ok'},
+    '429-then-ok': {'errors': '429,ok'},
+    '503x2-then-ok': {'errors': '503,503,ok'},
+    '429-retry-after-1s': {'errors': '429,ok', 'retry_after': 1},
+    '429-retry-after-over-budget': {'errors': '429', 'retry_after': 120},
+    'always-503': {'errors': '503'},
+}
+
+
+def run_scenario(name, options, args):
+    # Import ritardato: GEMINI_API_ROOT deve puntare al server finto prima di importare app
+    import app as app_module
+
+    with FakeGeminiServer(**options) as server:
+        app_module.BASE_URL = f'{server.url}/v1beta'
+        app_module.response_cache.clear()
+        app_module.circuit_breakers = app_module.CircuitBreakerRegistry(app_module.MemorySharedStore(), failure_threshold=10 ** 6)
+        app_module.rate_limiter = app_module.RateLimiter(10 ** 6, 60, app_module.MemorySharedStore())
+        # Scheduler senza limiti pratici: misuriamo solo il costo dei retry
+        app_module.upstream_scheduler = app_module.UpstreamScheduler(app_module.MemorySharedStore(), rpm=10 ** 6, tpm=10 ** 9)
+        client = app_module.app.test_client()
+        results = {}
+        for endpoint in ('/api/chat/generate', '/api/chat/generate-stream'):
+            latencies = []
+            statuses = {}
+            calls_before = server.state.total_calls()
+            for i in range(args.requests):
+                body = {'query': f'domanda {name} {i}', 'relevant_chunks': []}
+                started = time.perf_counter()
+                response = client.post(endpoint, json=body)
+                response.get_data()
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            latencies.sort()
+            results[endpoint] = {
+                'upstream_calls_per_request': round((server.state.total_calls() - calls_before) / args.requests, 2),
+                'latency_avg_s': round(sum(latencies) / len(latencies), 3),
+                'latency_max_s': round(latencies[-1], 3),
+                'statuses': statuses,
+            }
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=10)
+    parser.add_argument('--base-delay', type=float, default=0.1)
+    parser.add_argument('--deadline', type=float, default=10)
+    args = parser.parse_args()
+
+    os.environ.setdefault('GEMINI_API_KEY', 'fake-key')
+    os.environ['RETRY_BASE_DELAY'] = str(args.base_delay)
+    os.environ['RETRY_DEADLINE'] = str(args.deadline)
+    os.environ['RESPONSE_CACHE_TTL'] = '0'
+    logging.disable(logging.WARNING)
+
+    report = {name: run_scenario(name, options, args) for name, options in SCENARIOS.items()}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Benchmark di contesa sullo scheduler upstream con lo store SQLite condiviso.
+
+N thread si contendono max_concurrency slot tenendoli per --hold-ms ciascuno.
+Confronta lo scheduler attuale (un waiter per chiave, scrive solo chi è in testa)
+con la vecchia coda dentro sched:state, dove ogni waiter rifaceva un BEGIN IMMEDIATE
+sull'intero stato a ogni poll. Conta le transazioni di scrittura e il tempo totale.
+
+Uso:
+    python benchmarks/bench_scheduler_contention.py --waiters 64
+    python benchmarks/bench_scheduler_contention.py --waiters 200 --concurrency 4 --hold-ms 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import UpstreamScheduler, SqliteSharedStore, PRIORITY_DEFAULT, PRIORITY_NAMES  # noqa: E402
+
+
+class CountingStore(SqliteSharedStore):
+    """SqliteSharedStore che conta le transazioni BEGIN IMMEDIATE"""
+    def __init__(self, path):
+        super().__init__(path)
+        self.writes = 0
+        self.writes_lock = threading.Lock()
+
+    def update(self, key, fn, ttl=None):
+        with self.writes_lock:
+            self.writes += 1
+        return super().update(key, fn, ttl)
+
+
+class LegacyScheduler(UpstreamScheduler):
+    """Implementazione precedente: waiter e lease nello stesso record, riscritto da ogni waiter a ogni poll"""
+    def _legacy_try_acquire(self, waiter_id, priority, enqueued_at, cost):
+        def apply(raw):
+            now = time.time()
+            state = json.loads(raw) if raw else {}
+            requests_level, tokens_level = self._refill(state, now)
+            waiters = {k: v for k, v in state.get('w', {}).items() if v[2] > now}
+            leases = {k: exp for k, exp in state.get('l', {}).items() if exp > now}
+            waiters[waiter_id] = [priority, enqueued_at, now + self.max_wait + 5]
+            head = min(waiters.items(), key=lambda item: (item[1][0], item[1][1], item[0]))[0]
+            granted = False
+            if head == waiter_id and not (self.max_concurrency > 0 and len(leases) >= self.max_concurrency):
+                granted = True
+                leases[waiter_id] = now + self.lease_ttl
+                del waiters[waiter_id]
+            new_state = {'r': requests_level, 't': tokens_level, 'ts': now, 'w': waiters, 'l': leases}
+            return json.dumps(new_state, separators=(',', ':')), granted
+        return self.store.update(self.STATE_KEY, apply)
+
+    def acquire(self, priority=PRIORITY_DEFAULT, cost_tokens=0, timeout=None):
+        waiter_id = os.urandom(16).hex()
+        enqueued_at = time.time()
+        while not self._legacy_try_acquire(waiter_id, priority, enqueued_at, cost_tokens):
+            with self.cond:
+                self.cond.wait(self.poll_interval)
+        with self.cond:
+            self.granted[PRIORITY_NAMES[priority]] += 1
+        return waiter_id
+
+
+def run(scheduler_cls, waiters, concurrency, hold, poll_interval):
+    store = CountingStore(os.path.join(tempfile.mkdtemp(), 'bench-state.db'))
+    scheduler = scheduler_cls(store, rpm=0, tpm=0, max_concurrency=concurrency,
+                              max_wait=600, poll_interval=poll_interval)
+    waits = []
+    waits_lock = threading.Lock()
+
+    def worker():
+        started = time.perf_counter()
+        lease_id = scheduler.acquire()
+        waited = time.perf_counter() - started
+        time.sleep(hold)
+        scheduler.release(lease_id)
+        with waits_lock:
+            waits.append(waited)
+
+    threads = [threading.Thread(target=worker) for _ in range(waiters)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    waits.sort()
+    return {
+        'total_seconds': round(elapsed, 3),
+        'ideal_seconds': round(waiters / concurrency * hold, 3),
+        'write_transactions': store.writes,
+        'writes_per_grant': round(store.writes / waiters, 1),
+        'wait_p50_ms': round(waits[len(waits) // 2] * 1000, 1),
+        'wait_max_ms': round(waits[-1] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--waiters', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--hold-ms', type=float, default=10)
+    parser.add_argument('--poll-ms', type=float, default=50)
+    args = parser.parse_args()
+
+    results = {'waiters': args.waiters, 'concurrency': args.concurrency, 'hold_ms': args.hold_ms}
+    for name, scheduler_cls in (('current', UpstreamScheduler), ('legacy', LegacyScheduler)):
+        results[name] = run(scheduler_cls, args.waiters, args.concurrency, args.hold_ms / 1000, args.poll_ms / 1000)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
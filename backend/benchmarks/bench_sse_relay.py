@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Costo CPU del relay SSE per 1.000 token inoltrati.
+
+Confronta il vecchio ciclo (iter_lines + json.loads per riga + log INFO per token +
+json.dumps per frame) con StreamRelay (parsing incrementale dei byte, percorso veloce
+sul testo, batching dei delta). I log vanno su un handler verso /dev/null, come in
+produzione con livello INFO.
+
+Uso:
+    python benchmarks/bench_sse_relay.py --tokens 20000
+    python benchmarks/bench_sse_relay.py --tokens-per-event 4 --network-chunk 1024
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+logger = logging.getLogger('bench_sse_relay')
+
+
+def build_stream(tokens, tokens_per_event):
+    """Stream SSE sintetico nel formato di streamGenerateContent?alt=sse"""
+    words = [f'parola{i % 50}' + ('à' if i % 7 == 0 else '') for i in range(tokens)]
+    events = []
+    for start in range(0, tokens, tokens_per_event):
+        candidate = {'content': {'parts': [{'text': ' '.join(words[start:start + tokens_per_event]) + ' '}], 'role': 'model'},
+                     'index': 0}
+        if start + tokens_per_event >= tokens:
+            candidate['finishReason'] = 'STOP'
+        event = {'candidates': [candidate], 'usageMetadata': {'promptTokenCount': 1200, 'totalTokenCount': 1200 + start},
+                 'modelVersion': 'gemini-2.5-pro'}
+        events.append(f'data: {json.dumps(event)}\r\n\r\n')
+    return ''.join(events).encode('utf-8')
+
+
+def network_chunks(raw, size):
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+def legacy_relay(raw, size):
+    """Ciclo precedente di generate_response_stream, con i suoi log INFO"""
+    text = b''.join(network_chunks(raw, size)).decode('utf-8')
+    chunk_count = 0
+    for line in text.splitlines():
+        if line and line.startswith('data: '):
+            chunk_data = json.loads(line[6:])
+            candidates = chunk_data.get('candidates', [])
+            if candidates:
+                candidate = candidates[0]
+                logger.info(f"Candidates trovati: {len(candidates)}, keys: {list(candidate.keys())}")
+                if 'content' in candidate:
+                    parts = candidate.get('content', {}).get('parts', [])
+                    logger.info(f"Parts trovati: {len(parts)}")
+                    if parts and 'text' in parts[0]:
+                        text_chunk = parts[0]['text']
+                        logger.info(f"Text chunk estratto: {repr(text_chunk[:100])}")
+                        if text_chunk:
+                            text_chunk = app_module.fix_encoding_issues(text_chunk)
+                            chunk_count += 1
+                            logger.info(f"✓ Inviato chunk {chunk_count}: {text_chunk[:50]}...")
+                            yield f"data: {json.dumps({'text': text_chunk})}\n\n"
+
+
+def new_relay(raw, size, flush_interval):
+    relay = app_module.StreamRelay(flush_interval=flush_interval)
+    yield from relay.relay(iter(network_chunks(raw, size)))
+
+
+def measure(fn, tokens, repeat):
+    best = None
+    frames = 0
+    for _ in range(repeat):
+        started = time.process_time()
+        frames = sum(1 for _ in fn())
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {'cpu_ms_per_1000_tokens': round(best / tokens * 1000 * 1000, 3), 'frames': frames}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=20000)
+    parser.add_argument('--tokens-per-event', type=int, default=1)
+    parser.add_argument('--network-chunk', type=int, default=512, help='dimensione dei read di rete simulati (byte)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    for name in ('bench_sse_relay', 'app'):
+        target = logging.getLogger(name)
+        target.handlers = [handler]
+        target.propagate = False
+        target.setLevel(logging.INFO)
+
+    raw = build_stream(args.tokens, args.tokens_per_event)
+    report = {
+        'json_codec': app_module.JSON_CODEC,
+        'tokens': args.tokens,
+        'stream_bytes': len(raw),
+        'legacy_iter_lines': measure(lambda: legacy_relay(raw, args.network_chunk), args.tokens, args.repeat),
+        'relay_no_batching': measure(lambda: new_relay(raw, args.network_chunk, 0), args.tokens, args.repeat),
+        # Stream già tutto in memoria: con intervallo > 0 il batching unisce tutto tranne il primo delta;
+        # max_chars limita la dimensione dei frame come farebbe un upstream più veloce del client
+        'relay_batched': measure(lambda: new_relay(raw, args.network_chunk, app_module.STREAM_FLUSH_INTERVAL_MS / 1000),
+                                 args.tokens, args.repeat),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
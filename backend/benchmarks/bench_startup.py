@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Avvio a freddo: tempo di import di app.py (mediana su processi nuovi), moduli più costosi
+(-X importtime), latenza della prima richiesta per worker e avvio di gunicorn con e senza
+--preload (tempo fino a /healthz, RSS e PSS totali di master + worker).
+
+Le richieste vanno al server Gemini finto (fake_gemini.py), nessuna chiamata a Google.
+Il JSON (stdout o --output) riporta il commit git; --compare mostra le variazioni
+rispetto a un'esecuzione precedente.
+
+Uso:
+    python benchmarks/bench_startup.py --runs 7
+    python benchmarks/bench_startup.py --output after.json --compare before.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from load_test import (STORE_NAME, free_port, wait_for, git_revision, process_tree,  # noqa: E402
+                       rss_bytes, stop)
+
+IMPORT_SCRIPT = """
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+getattr(app, 'load_genai', lambda: None)()
+print(imported - started, time.perf_counter() - imported)
+"""
+
+FIRST_REQUEST_SCRIPT = """
+import json, time
+import app
+client = app.app.test_client()
+timings = {}
+for label in ('config_first', 'config_second'):
+    started = time.perf_counter()
+    client.get('/api/config')
+    timings[label] = time.perf_counter() - started
+for label in ('query_first', 'query_second'):
+    started = time.perf_counter()
+    response = client.post('/api/chat/query', json={'query': 'Qual è il budget del progetto?'})
+    assert response.status_code == 200, response.status_code
+    timings[label] = time.perf_counter() - started
+print(json.dumps(timings))
+"""
+
+
+def app_env(fake_url, state_dir, name):
+    env = dict(os.environ)
+    env.update({
+        'GEMINI_API_ROOT': fake_url,
+        'GEMINI_API_KEY': 'bench-key',
+        'FILE_SEARCH_STORE_NAME': STORE_NAME,
+        'SHARED_STATE_PATH': os.path.join(state_dir, f'{name}.sqlite'),
+        'RATE_LIMIT_MAX': '1000000',
+        'LOG_LEVEL': 'WARNING',
+    })
+    return env
+
+
+def run_python(script, env, *flags):
+    result = subprocess.run([sys.executable, *flags, '-c', script], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout, result.stderr
+
+
+def ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+# ==================== IMPORT ====================
+
+def measure_imports(env, runs):
+    interpreter, app_import, sdk_import = [], [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        run_python('pass', env)
+        interpreter.append(time.perf_counter() - started)
+        out, _ = run_python(IMPORT_SCRIPT, env)
+        app_seconds, sdk_seconds = map(float, out.split())
+        app_import.append(app_seconds)
+        sdk_import.append(sdk_seconds)
+    return {
+        'interpreter_ms': ms(statistics.median(interpreter)),
+        'app_import_ms': ms(statistics.median(app_import)),
+        'app_import_min_ms': ms(min(app_import)),
+        'genai_import_ms': ms(statistics.median(sdk_import)),
+    }
+
+
+def top_imports(env, limit):
+    """Moduli di primo livello importati da app.py ordinati per tempo cumulativo"""
+    _, err = run_python('import app', env, '-X', 'importtime')
+    modules = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name[1:]
+        # Due spazi di indentazione per livello: il livello 1 sono gli import diretti di app.py
+        if (len(name) - len(name.lstrip())) // 2 == 1:
+            modules.append((name.strip(), int(cumulative)))
+    modules.sort(key=lambda item: item[1], reverse=True)
+    return {name: round(us / 1000, 1) for name, us in modules[:limit]}
+
+
+def measure_first_request(env, runs):
+    samples = []
+    for _ in range(runs):
+        out, _ = run_python(FIRST_REQUEST_SCRIPT, env)
+        samples.append(json.loads(out))
+    return {label: ms(statistics.median(s[label] for s in samples)) for label in samples[0]}
+
+
+# ==================== GUNICORN ====================
+
+def pss_bytes(root_pid):
+    """PSS totale (pagine condivise divise tra i processi che le usano): misura la condivisione copy-on-write"""
+    total = 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/smaps_rollup') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            return None
+    return total
+
+
+def request(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    started = time.perf_counter()
+    conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status, time.perf_counter() - started
+
+
+def measure_gunicorn(env, preload, workers):
+    port = free_port()
+    env = dict(env, GUNICORN_PRELOAD='true' if preload else 'false')
+    command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(BACKEND_DIR, 'gunicorn.conf.py'),
+               '-w', str(workers), '-b', f'127.0.0.1:{port}', '--chdir', BACKEND_DIR, 'app:app']
+    started = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(port, '/healthz', timeout=60)
+        ready = time.perf_counter() - started
+        # Attende il boot di tutti i worker prima di misurare la memoria
+        deadline = time.monotonic() + 30
+        while len(process_tree(process.pid)) < workers + 1 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        time.sleep(1.0)
+        idle = {'rss_mb': round(rss_bytes(process.pid) / 2 ** 20, 1), 'pss_mb': round((pss_bytes(process.pid) or 0) / 2 ** 20, 1)}
+        # Prime query: con connessioni nuove il master le distribuisce tra i worker
+        latencies = []
+        for _ in range(workers * 2):
+            status, seconds = request(port, 'POST', '/api/chat/query', {'query': 'Qual è il budget del progetto?'})
+            if status == 200:
+                latencies.append(seconds)
+        warm = {'rss_mb': round(rss_bytes(process.pid) / 2 ** 20, 1), 'pss_mb': round((pss_bytes(process.pid) or 0) / 2 ** 20, 1)}
+    finally:
+        stop(process)
+    return {
+        'ready_ms': ms(ready),
+        'query_max_ms': ms(max(latencies)) if latencies else None,
+        'query_median_ms': ms(statistics.median(latencies)) if latencies else None,
+        'idle': idle,
+        'after_queries': warm,
+    }
+
+
+# ==================== REPORT ====================
+
+def flatten(data, prefix=''):
+    items = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            items.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            items[prefix + key] = value
+    return items
+
+
+def compare(previous, current, log):
+    log(f"\nConfronto con {previous.get('meta', {}).get('git_revision')} -> {current['meta']['git_revision']}")
+    old = flatten({k: v for k, v in previous.items() if k not in ('meta', 'top_imports_ms')})
+    new = flatten({k: v for k, v in current.items() if k not in ('meta', 'top_imports_ms')})
+    for key, value in new.items():
+        before = old.get(key)
+        change = f'{(value - before) / before * 100:+7.1f}%' if before else '     n/d'
+        log(f'{key:40} {before!s:>9} -> {value!s:>9}  {change}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='processi nuovi per misura (si riporta la mediana)')
+    parser.add_argument('--top', type=int, default=12, help='moduli riportati da -X importtime')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--skip-gunicorn', action='store_true')
+    parser.add_argument('--output', help='file JSON dei risultati (default: stdout)')
+    parser.add_argument('--compare', help='JSON di un\'esecuzione precedente da confrontare')
+    args = parser.parse_args()
+
+    def log(message):
+        print(message, file=sys.stderr, flush=True)
+
+    fake_port = free_port()
+    fake = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_gemini.py'), '--port', str(fake_port),
+                             '--latency', '0.01'], stdout=subprocess.DEVNULL)
+    report = {'meta': {
+        'git_revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+    }}
+    try:
+        wait_for(fake_port)
+        with tempfile.TemporaryDirectory() as state_dir:
+            env = app_env(f'http://127.0.0.1:{fake_port}', state_dir, 'startup')
+            report['import'] = measure_imports(env, args.runs)
+            log(f"import: {report['import']}")
+            report['top_imports_ms'] = top_imports(env, args.top)
+            report['first_request_ms'] = measure_first_request(env, args.runs)
+            log(f"prima richiesta: {report['first_request_ms']}")
+            if not args.skip_gunicorn:
+                report['gunicorn'] = {}
+                for preload in (False, True):
+                    label = 'preload' if preload else 'no_preload'
+                    report['gunicorn'][label] = measure_gunicorn(
+                        app_env(f'http://127.0.0.1:{fake_port}', state_dir, label), preload, args.workers)
+                    log(f"gunicorn {label}: {report['gunicorn'][label]}")
+    finally:
+        stop(fake)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report, log)
+
+
+if __name__ == '__main__':
+    main()
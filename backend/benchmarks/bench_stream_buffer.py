@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Occupazione della connessione a Gemini negli stream con client lenti: il producer scarica la
+risposta nel buffer a piena velocità, il client la legge al proprio ritmo (pausa per frame).
+
+Per ogni policy del buffer (coalesce, spill, drop) riporta tempo di occupazione della connessione
+upstream (upstream_hold), durata complessiva per il client e ritardo del client sulla fine della
+generazione (client_lag), più frame ricevuti ed esito. Senza buffer (lettura in lockstep) la
+connessione resterebbe occupata per tutta la durata lato client.
+
+Le richieste vanno al server Gemini finto (fake_gemini.py) con velocità dei token configurabile.
+
+Uso:
+    python benchmarks/bench_stream_buffer.py --tokens-per-second 200 --words 300 --client-delay 0.1
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_gemini import STORE_NAME, FakeGeminiServer  # noqa: E402
+
+
+def run_stream(client, app_module, query, client_delay):
+    """Legge uno stream con una pausa dopo ogni frame; restituisce i tempi lato client e l'evento timing"""
+    body = {'query': query, 'relevant_chunks': [{'chunkText': 'Il progetto costa 100 euro', 'chunkRelevanceScore': 0.9}]}
+    started = time.perf_counter()
+    frames, timing, outcome = 0, None, 'incomplete'
+    with client.post('/api/chat/generate-stream', json=body, buffered=False) as response:
+        for frame in response.response:
+            text = frame.decode('utf-8')
+            if text.startswith('event: timing'):
+                timing = json.loads(text.split('data: ', 1)[1])
+            elif '"done"' in text:
+                outcome = 'done'
+            elif '"slow_client"' in text:
+                outcome = 'dropped'
+            elif '"text"' in text:
+                frames += 1
+                time.sleep(client_delay)
+    return {'client_ms': (time.perf_counter() - started) * 1000, 'frames': frames, 'outcome': outcome,
+            'upstream_hold_ms': (timing or {}).get('upstream_hold'), 'client_lag_ms': (timing or {}).get('client_lag')}
+
+
+def median(samples, key):
+    values = [s[key] for s in samples if s[key] is not None]
+    return round(statistics.median(values), 1) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens-per-second', type=float, default=200)
+    parser.add_argument('--words', type=int, default=300, help='parole della risposta del server finto')
+    parser.add_argument('--client-delay', type=float, default=0.1, help='pausa del client dopo ogni frame (s)')
+    parser.add_argument('--max-frames', type=int, default=8, help='STREAM_BUFFER_MAX_FRAMES per la prova')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    with FakeGeminiServer(tokens_per_second=args.tokens_per_second, answer_words=args.words) as server:
+        # Import ritardato: GEMINI_API_ROOT deve puntare al server finto prima di importare app
+        os.environ.update({'GEMINI_API_ROOT': server.url, 'GEMINI_API_KEY': 'fake-key',
+                           'FILE_SEARCH_STORE_NAME': STORE_NAME, 'RESPONSE_CACHE_TTL': '0'})
+        logging.disable(logging.WARNING)
+        import app as app_module
+        app_module.rate_limiter = app_module.RateLimiter(10 ** 6, 60, app_module.MemorySharedStore())
+        client = app_module.app.test_client()
+        original = app_module.StreamBuffer
+
+        report = {'tokens_per_second': args.tokens_per_second, 'words': args.words,
+                  'generation_ms_expected': round(args.words / args.tokens_per_second * 1000, 1),
+                  'client_delay_s': args.client_delay, 'max_frames': args.max_frames, 'policies': {}}
+        for policy in app_module.STREAM_BUFFER_POLICIES:
+            app_module.StreamBuffer = lambda: original(policy, max_frames=args.max_frames)
+            samples = [run_stream(client, app_module, f'Qual è il budget del progetto? {policy} {i}', args.client_delay)
+                       for i in range(args.runs)]
+            report['policies'][policy] = {
+                'upstream_hold_ms': median(samples, 'upstream_hold_ms'),
+                # In lockstep la connessione resterebbe occupata fino alla fine lato client
+                'lockstep_hold_ms_estimate': median(samples, 'client_ms'),
+                'client_ms': median(samples, 'client_ms'),
+                'client_lag_ms': median(samples, 'client_lag_ms'),
+                'frames': median(samples, 'frames'),
+                'outcomes': sorted({s['outcome'] for s in samples}),
+            }
+        app_module.StreamBuffer = original
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Server finto delle API Gemini / File Search per benchmark e test offline.
+
+Emula generateContent, streamGenerateContent?alt=sse, uploadToFileSearchStore,
+lo stato delle operazioni, il dettaglio dello store (sonda di /readyz),
+lista/dettaglio/eliminazione dei documenti e :query
+sui chunk, con latenza configurabile, velocità dei token in streaming e
+iniezione di errori secondo un pattern ciclico (es. "429,503,ok") o con una
+probabilità fissa, contando le chiamate ricevute per path. Si avvia da riga di
+comando o in-process con FakeGeminiServer.
+
+Uso:
+    python benchmarks/fake_gemini.py --port 8765 --errors 429,ok --retry-after 1
+    python benchmarks/fake_gemini.py --latency 0.05 --tokens-per-second 200 --answer-words 300
+    GEMINI_API_ROOT=http://127.0.0.1:8765 gunicorn -w 4 app:app
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+STORE_NAME = 'fileSearchStores/bench-store'
+
+LOREM = ('il sistema recupera i passaggi rilevanti dai documenti caricati e genera una risposta '
+         'contestualizzata citando le fonti utilizzate per ogni affermazione').split(' ')
+
+DOCUMENT_PATH = re.compile(r'^/v1beta/(fileSearchStores/[^/]+/documents/[^/:]+)$')
+QUERY_PATH = re.compile(r'^/v1beta/(fileSearchStores/[^/]+/documents/[^/:]+):query$')
+LIST_PATH = re.compile(r'^/v1beta/(fileSearchStores/[^/]+)/documents$')
+UPLOAD_PATH = re.compile(r'^/upload/v1beta/(fileSearchStores/[^/:]+):uploadToFileSearchStore$')
+STORE_PATH = re.compile(r'^/v1beta/(fileSearchStores/[^/:]+)$')
+OPERATION_PATH = re.compile(r'^/v1beta/(fileSearchStores/[^/]+/(?:upload/)?operations/[^/]+)$')
+
+
+def make_answer(words):
+    """Testo di risposta di `words` parole (ripetendo LOREM)"""
+    return ' '.join(itertools.islice(itertools.cycle(LOREM), words)).capitalize() + '.'
+
+
+class FakeGeminiState:
+    """Configurazione, documenti emulati e contatori condivisi dai thread del server"""
+    def __init__(self, errors='ok', latency=0.0, retry_after=None, answer='Risposta di prova dal server finto.',
+                 tokens_per_second=0.0, error_rate=0.0, error_status=503, latency_jitter=0.0,
+                 answer_words=0, documents=5, chunks=10, operation_seconds=1.0, store=STORE_NAME, seed=None):
+        self.pattern = itertools.cycle([e.strip() for e in errors.split(',') if e.strip()] or ['ok'])
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.retry_after = retry_after
+        self.answer = make_answer(answer_words) if answer_words else answer
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.chunks = chunks
+        self.operation_seconds = operation_seconds
+        self.store = store
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.documents = {}
+        self.operations = {}
+        for i in range(documents):
+            self.add_document(f'documento-{i + 1}.pdf', state='STATE_ACTIVE')
+
+    def next_outcome(self, path):
+        with self.lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+            outcome = next(self.pattern)
+            if outcome == 'ok' and self.error_rate and self.random.random() < self.error_rate:
+                outcome = str(self.error_status)
+            return outcome
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def sleep_latency(self):
+        delay = self.latency
+        if self.latency_jitter:
+            with self.lock:
+                delay += self.random.uniform(0, self.latency_jitter)
+        if delay:
+            time.sleep(delay)
+
+    def add_document(self, display_name, state='STATE_PENDING', metadata=None, size=0):
+        with self.lock:
+            name = f'{self.store}/documents/{uuid.uuid4().hex[:12]}'
+            self.documents[name] = {
+                'name': name,
+                'displayName': display_name,
+                'customMetadata': metadata or [],
+                'state': state,
+                'sizeBytes': str(size),
+                'mimeType': 'application/pdf',
+                'createTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            }
+            return name
+
+    def operation_status(self, name):
+        with self.lock:
+            operation = self.operations.get(name)
+            if operation is None:
+                return None
+            created, document_name = operation
+            done = time.monotonic() - created >= self.operation_seconds
+            if done and document_name in self.documents:
+                self.documents[document_name]['state'] = 'STATE_ACTIVE'
+        result = {'name': name, 'done': done}
+        if done:
+            result['response'] = {'documentName': document_name}
+        return result
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    state: FakeGeminiState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, extra_headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (extra_headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self, path):
+        self._send_json(404, {'error': {'code': 404, 'message': f'path non emulato: {path}', 'status': 'NOT_FOUND'}})
+
+    def _inject_error(self, outcome):
+        """Risponde con l'errore previsto dal pattern; False se la richiesta va servita"""
+        if outcome == 'ok':
+            return False
+        if outcome == 'hang':
+            time.sleep(3600)
+        status = int(outcome)
+        headers = {}
+        if status == 429 and self.state.retry_after is not None:
+            headers['Retry-After'] = str(self.state.retry_after)
+        self._send_json(status, {'error': {'code': status, 'message': 'errore iniettato', 'status': 'INJECTED'}}, headers)
+        return True
+
+    def _begin(self):
+        """Legge il body, applica latenza ed errori; restituisce (path, query, body) o None se già risposto"""
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        parts = urlsplit(self.path)
+        outcome = self.state.next_outcome(parts.path)
+        self.state.sleep_latency()
+        if self._inject_error(outcome):
+            return None
+        return parts.path, parse_qs(parts.query), body
+
+    def do_POST(self):
+        begun = self._begin()
+        if begun is None:
+            return
+        path, _, body = begun
+        if path.endswith(':streamGenerateContent'):
+            return self._stream_answer()
+        if path.endswith(':generateContent'):
+            return self._send_json(200, self._generate_body())
+        match = QUERY_PATH.match(path)
+        if match:
+            return self._query_chunks(match.group(1), body)
+        match = UPLOAD_PATH.match(path)
+        if match:
+            return self._upload(match.group(1), body)
+        self._not_found(path)
+
+    def do_GET(self):
+        begun = self._begin()
+        if begun is None:
+            return
+        path, query, _ = begun
+        match = LIST_PATH.match(path)
+        if match:
+            return self._list_documents(query)
+        match = OPERATION_PATH.match(path)
+        if match:
+            status = self.state.operation_status(match.group(1))
+            return self._send_json(200, status) if status else self._not_found(path)
+        match = STORE_PATH.match(path)
+        if match:
+            if match.group(1) != self.state.store:
+                return self._not_found(path)
+            with self.state.lock:
+                count = len(self.state.documents)
+            return self._send_json(200, {'name': self.state.store, 'displayName': 'bench', 'activeDocumentsCount': str(count)})
+        match = DOCUMENT_PATH.match(path)
+        if match:
+            with self.state.lock:
+                document = self.state.documents.get(match.group(1))
+            return self._send_json(200, document) if document else self._not_found(path)
+        self._not_found(path)
+
+    def do_DELETE(self):
+        begun = self._begin()
+        if begun is None:
+            return
+        path = begun[0]
+        match = DOCUMENT_PATH.match(path)
+        if match:
+            with self.state.lock:
+                removed = self.state.documents.pop(match.group(1), None)
+            return self._send_json(200, {}) if removed else self._not_found(path)
+        self._not_found(path)
+
+    def _generate_body(self):
+        answer = self.state.answer
+        return {
+            'candidates': [{
+                'content': {'parts': [{'text': answer}], 'role': 'model'},
+                'finishReason': 'STOP',
+                'groundingMetadata': {'groundingChunks': [
+                    {'retrievedContext': {'title': 'documento-1.pdf', 'text': make_answer(40)}}
+                ]},
+            }],
+            'usageMetadata': {'promptTokenCount': 500, 'candidatesTokenCount': len(answer.split(' ')),
+                              'totalTokenCount': 500 + len(answer.split(' '))},
+        }
+
+    def _list_documents(self, query):
+        page_size = int(query.get('pageSize', ['20'])[0])
+        offset = int(query.get('pageToken', ['0'])[0] or 0)
+        with self.state.lock:
+            documents = list(self.state.documents.values())
+        page = documents[offset:offset + page_size]
+        body = {'documents': page}
+        if offset + page_size < len(documents):
+            body['nextPageToken'] = str(offset + page_size)
+        self._send_json(200, body)
+
+    def _query_chunks(self, document_name, body):
+        try:
+            results = int(json.loads(body or b'{}').get('resultsCount', self.state.chunks))
+        except ValueError:
+            results = self.state.chunks
+        chunks = [{
+            'chunk': {'name': f'{document_name}/chunks/c{i}', 'data': {'stringValue': make_answer(80 + i)},
+                      'customMetadata': []},
+            'chunkRelevanceScore': round(0.95 - i * 0.05, 3),
+        } for i in range(min(results, self.state.chunks))]
+        self._send_json(200, {'relevantChunks': chunks})
+
+    def _upload(self, store, body):
+        match = re.search(rb'"displayName"\s*:\s*"([^"]*)"', body)
+        display_name = match.group(1).decode('utf-8', 'replace') if match else 'upload'
+        document_name = self.state.add_document(display_name, size=len(body))
+        operation = f'{store}/upload/operations/{uuid.uuid4().hex[:12]}'
+        with self.state.lock:
+            self.state.operations[operation] = (time.monotonic(), document_name)
+        self._send_json(200, {'name': operation})
+
+    def _stream_answer(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        words = self.state.answer.split(' ')
+        delay = 1 / self.state.tokens_per_second if self.state.tokens_per_second else 0
+        for i, word in enumerate(words):
+            candidate = {'content': {'parts': [{'text': word + (' ' if i < len(words) - 1 else '')}], 'role': 'model'}}
+            if i == len(words) - 1:
+                candidate['finishReason'] = 'STOP'
+            self._write_chunk(f"data: {json.dumps({'candidates': [candidate]})}\r\n\r\n".encode('utf-8'))
+            if delay:
+                time.sleep(delay)
+        self._write_chunk(b'')
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):X}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+
+class FakeGeminiServer:
+    """Avvia il server finto in un thread; utilizzabile come context manager"""
+    def __init__(self, host='127.0.0.1', port=0, **state_options):
+        self.state = FakeGeminiState(**state_options)
+        handler = type('Handler', (FakeGeminiHandler,), {'state': self.state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.request_queue_size = 1024
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--errors', default='ok', help='pattern ciclico di esiti: ok, 429, 500, 503, hang')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probabilità di errore sulle risposte "ok"')
+    parser.add_argument('--error-status', type=int, default=503, help='status usato con --error-rate')
+    parser.add_argument('--latency', type=float, default=0.0, help='latenza aggiunta per richiesta (s)')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='latenza casuale aggiuntiva massima (s)')
+    parser.add_argument('--retry-after', type=float, default=None, help='header Retry-After sui 429 (s)')
+    parser.add_argument('--tokens-per-second', type=float, default=0.0, help='velocità dello streaming (0 = immediato)')
+    parser.add_argument('--answer-words', type=int, default=0, help='lunghezza della risposta in parole (0 = frase fissa)')
+    parser.add_argument('--documents', type=int, default=5, help='documenti presenti all\'avvio')
+    parser.add_argument('--chunks', type=int, default=10, help='chunk massimi restituiti da :query')
+    parser.add_argument('--operation-seconds', type=float, default=1.0, help='durata delle operazioni di upload (s)')
+    args = parser.parse_args()
+    server = FakeGeminiServer(args.host, args.port, errors=args.errors, latency=args.latency,
+                              retry_after=args.retry_after, tokens_per_second=args.tokens_per_second,
+                              error_rate=args.error_rate, error_status=args.error_status,
+                              latency_jitter=args.latency_jitter, answer_words=args.answer_words,
+                              documents=args.documents, chunks=args.chunks, operation_seconds=args.operation_seconds)
+    print(f'Server Gemini finto su {server.url} (errori: {args.errors}, store: {server.state.store})', flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+Load test offline: avvia il server Gemini finto e app.py sotto gunicorn (worker sync,
+gthread o gevent) e misura, per ogni combinazione server x workload x concorrenza,
+throughput, latenza p50/p95/p99, time-to-first-token degli stream e RSS del
+processo gunicorn (master + worker).
+
+I risultati sono JSON (stdout o --output) con commit git e parametri, così due
+esecuzioni su commit diversi si confrontano con --compare.
+
+Uso:
+    python benchmarks/load_test.py --servers sync,gthread --workloads stream,generate --concurrency 8,32
+    python benchmarks/load_test.py --duration 20 --latency 0.2 --tokens-per-second 50 --output after.json
+    python benchmarks/load_test.py --workloads mixed --compare before.json --output after.json
+
+Il client di carico è a thread nello stesso interprete: oltre qualche centinaio di
+richieste/s su una sola CPU diventa lui il collo di bottiglia (vedi client_cpu_seconds).
+"""
+import argparse
+import http.client
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+STORE_NAME = 'fileSearchStores/bench-store'
+
+SERVERS = {
+    'sync': ['-k', 'sync', '-w', '4'],
+    'gthread': ['-k', 'gthread', '-w', '2', '--threads', '16'],
+    'gevent': ['-k', 'gevent', '-w', '2', '--worker-connections', '512'],
+}
+# Modulo richiesto dal worker class (scenario saltato se non installato)
+SERVER_REQUIRES = {'gevent': 'gevent'}
+
+# Workload: elenco pesato di tipi di richiesta
+WORKLOADS = {
+    'generate': {'generate': 1},
+    'stream': {'stream': 1},
+    'query': {'query': 1},
+    'chunks': {'chunks': 1},
+    'documents': {'documents': 1},
+    'upload': {'upload': 1},
+    'mixed': {'stream': 6, 'generate': 2, 'chunks': 1, 'documents': 1},
+}
+
+CHUNK_TEXT = ('Il progetto prevede tre fasi di sviluppo con un budget complessivo di 100.000 euro '
+              'e una durata stimata di diciotto mesi. ') * 4
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, path=None, timeout=30.0):
+    """Attende che la porta accetti connessioni (e che path risponda 200, se indicato)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            if path is None:
+                conn.connect()
+                conn.close()
+                return
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            if response.status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f'porta {port} non pronta entro {timeout}s')
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BACKEND_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ==================== RSS ====================
+
+def process_tree(root_pid):
+    """pid del processo e dei suoi discendenti (da /proc, solo Linux)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # Il nome del processo può contenere spazi: i campi seguono l'ultima ')'
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+
+def rss_bytes(root_pid):
+    """RSS totale dell'albero di processi in byte (None fuori da Linux)"""
+    if not os.path.isdir('/proc'):
+        return None
+    total = 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.25):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            value = rss_bytes(self.pid)
+            if value is None:
+                return
+            self.peak = max(self.peak, value)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+# ==================== RICHIESTE ====================
+
+def multipart_body(index, size):
+    boundary = f'bench{index:08d}'
+    payload = (b'%PDF-1.4 bench ' * (size // 15 + 1))[:size]
+    parts = [
+        f'--{boundary}\r\nContent-Disposition: form-data; name="displayName"\r\n\r\nbench-{index}.pdf\r\n'.encode(),
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="bench-{index}.pdf"\r\n'
+        f'Content-Type: application/pdf\r\n\r\n'.encode() + payload + b'\r\n',
+        f'--{boundary}--\r\n'.encode(),
+    ]
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class RequestFactory:
+    """Costruisce (metodo, path, body, headers) per ogni tipo di richiesta"""
+    def __init__(self, documents, chunks, upload_bytes, unique_queries):
+        self.documents = documents or [f'{STORE_NAME}/documents/missing']
+        self.upload_bytes = upload_bytes
+        self.unique_queries = unique_queries
+        self.counter = itertools.count()
+        self.relevant_chunks = [
+            {'chunk': {'data': {'stringValue': f'{CHUNK_TEXT} (parte {i})'}}, 'chunkRelevanceScore': round(0.9 - i * 0.04, 2)}
+            for i in range(chunks)
+        ]
+
+    def query_text(self, index):
+        return f'Quanto costa il progetto? #{index}' if self.unique_queries else 'Quanto costa il progetto?'
+
+    def build(self, kind):
+        index = next(self.counter)
+        json_headers = {'Content-Type': 'application/json'}
+        if kind in ('generate', 'stream'):
+            path = '/api/chat/generate' if kind == 'generate' else '/api/chat/generate-stream'
+            body = {'query': self.query_text(index), 'relevant_chunks': self.relevant_chunks}
+            return 'POST', path, json.dumps(body).encode(), json_headers
+        if kind == 'query':
+            return 'POST', '/api/chat/query', json.dumps({'query': self.query_text(index)}).encode(), json_headers
+        if kind == 'chunks':
+            document = self.documents[index % len(self.documents)]
+            return 'POST', f'/api/documents/{document}/chunks', json.dumps({'query': '*', 'resultsCount': 20}).encode(), json_headers
+        if kind == 'documents':
+            return 'GET', '/api/documents?pageSize=20', None, {}
+        if kind == 'upload':
+            body, content_type = multipart_body(index, self.upload_bytes)
+            return 'POST', '/api/documents/upload', body, {'Content-Type': content_type}
+        raise ValueError(f'tipo di richiesta sconosciuto: {kind}')
+
+
+def send(conn, method, path, body, headers, stream):
+    """Esegue una richiesta; restituisce (status, latenza, ttft) in secondi"""
+    started = time.perf_counter()
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    ttft = None
+    if stream:
+        while True:
+            data = response.read1(65536)
+            if not data:
+                break
+            if ttft is None and b'"text"' in data:
+                ttft = time.perf_counter() - started
+    else:
+        response.read()
+    return response.status, time.perf_counter() - started, ttft
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99),
+            'mean': round(sum(values) / len(values) * 1000, 2), 'max': round(values[-1] * 1000, 2)}
+
+
+def drive(port, factory, mix, concurrency, duration, warmup, timeout, seed):
+    """Genera carico chiuso con `concurrency` client; le richieste del warmup non sono conteggiate"""
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    started = time.perf_counter()
+    measure_from = started + warmup
+    deadline = measure_from + duration
+    lock = threading.Lock()
+    samples = {kind: {'latency': [], 'ttft': [], 'ok': 0, 'errors': {}} for kind in kinds}
+
+    def client(worker_index):
+        rng = random.Random(seed + worker_index)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            kind = rng.choices(kinds, weights)[0]
+            method, path, body, headers = factory.build(kind)
+            try:
+                status, latency, ttft = send(conn, method, path, body, headers, kind == 'stream')
+                error = None if status < 400 else str(status)
+            except (OSError, http.client.HTTPException) as exc:
+                latency, ttft, error = time.perf_counter() - now, None, type(exc).__name__
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+            if now < measure_from:
+                continue
+            with lock:
+                bucket = samples[kind]
+                if error is None:
+                    bucket['ok'] += 1
+                    bucket['latency'].append(latency)
+                    if ttft is not None:
+                        bucket['ttft'].append(ttft)
+                else:
+                    bucket['errors'][error] = bucket['errors'].get(error, 0) + 1
+        conn.close()
+
+    cpu_before = time.process_time()
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Le richieste in corso alla scadenza finiscono comunque: il tempo misurato arriva all'ultima
+    elapsed = max(time.perf_counter(), deadline) - measure_from
+    return samples, elapsed, time.process_time() - cpu_before
+
+
+def summarize(samples, elapsed):
+    ok = sum(bucket['ok'] for bucket in samples.values())
+    errors = {}
+    for bucket in samples.values():
+        for key, count in bucket['errors'].items():
+            errors[key] = errors.get(key, 0) + count
+    latencies = [value for bucket in samples.values() for value in bucket['latency']]
+    ttfts = [value for bucket in samples.values() for value in bucket['ttft']]
+    return {
+        'requests': ok + sum(errors.values()),
+        'ok': ok,
+        'errors': errors,
+        'throughput_rps': round(ok / elapsed, 2) if elapsed > 0 else 0.0,
+        'latency_ms': percentiles(latencies),
+        'ttft_ms': percentiles(ttfts),
+        'by_kind': {kind: {'ok': bucket['ok'], 'errors': bucket['errors'], 'latency_ms': percentiles(bucket['latency'])}
+                    for kind, bucket in samples.items()},
+    }
+
+
+# ==================== PROCESSI ====================
+
+def start_fake(args, port):
+    command = [sys.executable, os.path.join(BENCH_DIR, 'fake_gemini.py'), '--port', str(port),
+               '--errors', args.errors, '--error-rate', str(args.error_rate),
+               '--latency', str(args.latency), '--latency-jitter', str(args.latency_jitter),
+               '--tokens-per-second', str(args.tokens_per_second), '--answer-words', str(args.answer_words),
+               '--documents', str(args.documents), '--chunks', str(args.chunks)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    wait_for(port)
+    return process
+
+
+def start_gunicorn(server, args, port, fake_url, state_dir):
+    env = dict(os.environ)
+    env.update({
+        'GEMINI_API_ROOT': fake_url,
+        'GEMINI_API_KEY': 'bench-key',
+        'FILE_SEARCH_STORE_NAME': STORE_NAME,
+        'SHARED_STATE_PATH': os.path.join(state_dir, f'{server}.sqlite'),
+        'RATE_LIMIT_MAX': '1000000',
+        'GEMINI_RPM_LIMIT': '0',
+        'GEMINI_TPM_LIMIT': '0',
+        'UPSTREAM_MAX_CONCURRENCY': '1024',
+        'RESPONSE_CACHE_TTL': '0',
+        'QUERY_CACHE_TTL': '0',
+        'DOCUMENTS_CACHE_TTL': '0',
+        'LOG_LEVEL': 'WARNING',
+    })
+    env['GUNICORN_PRELOAD'] = 'true' if args.preload else 'false'
+    for override in args.env:
+        key, _, value = override.partition('=')
+        env[key] = value
+    command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(BACKEND_DIR, 'gunicorn.conf.py'),
+               *SERVERS[server], '-b', f'127.0.0.1:{port}',
+               '--timeout', '120', '--chdir', BACKEND_DIR, *args.gunicorn_arg, 'app:app']
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                               stderr=None if args.verbose else subprocess.DEVNULL)
+    try:
+        wait_for(port, '/api/config', timeout=60)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def list_documents(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', '/api/documents?pageSize=20')
+    data = json.loads(conn.getresponse().read() or b'{}')
+    conn.close()
+    return [doc['name'] for doc in data.get('documents', [])]
+
+
+def run_server(server, args, fake_url, state_dir, log):
+    port = free_port()
+    process = start_gunicorn(server, args, port, fake_url, state_dir)
+    results = []
+    try:
+        documents = list_documents(port)
+        idle_rss = rss_bytes(process.pid)
+        for workload, concurrency in itertools.product(args.workloads, args.concurrency):
+            factory = RequestFactory(documents, args.chunks, args.upload_kb * 1024, not args.same_query)
+            sampler = RssSampler(process.pid)
+            sampler.start()
+            samples, elapsed, client_cpu = drive(port, factory, WORKLOADS[workload], concurrency,
+                                                 args.duration, args.warmup, args.request_timeout, args.seed)
+            sampler.stop()
+            result = {'server': server, 'workload': workload, 'concurrency': concurrency,
+                      'elapsed_s': round(elapsed, 3), **summarize(samples, elapsed),
+                      'rss_mb': {'idle': round(idle_rss / 2 ** 20, 1) if idle_rss else None,
+                                 'peak': round(sampler.peak / 2 ** 20, 1) if sampler.peak else None},
+                      'client_cpu_seconds': round(client_cpu, 2)}
+            results.append(result)
+            log(format_row(result))
+    finally:
+        stop(process)
+    return results
+
+
+# ==================== REPORT ====================
+
+def format_row(result):
+    latency = result['latency_ms'] or {}
+    ttft = result['ttft_ms'] or {}
+    errors = sum(result['errors'].values())
+    return (f"{result['server']:8} {result['workload']:9} c={result['concurrency']:<4} "
+            f"{result['throughput_rps']:8.1f} rps  p50 {latency.get('p50', '-'):>8} p95 {latency.get('p95', '-'):>8} "
+            f"p99 {latency.get('p99', '-'):>8} ms  ttft p50 {ttft.get('p50', '-'):>7} ms  "
+            f"rss {result['rss_mb']['peak']} MB  errori {errors}")
+
+
+def compare(previous, current, log):
+    """Variazioni percentuali rispetto a un'esecuzione precedente (stessi scenari)"""
+    index = {(r['server'], r['workload'], r['concurrency']): r for r in previous.get('results', [])}
+    log(f"\nConfronto con {previous.get('meta', {}).get('git_revision')} -> {current['meta']['git_revision']}")
+
+    def delta(old, new):
+        if old in (None, 0) or new is None:
+            return '     n/d'
+        return f'{(new - old) / old * 100:+7.1f}%'
+
+    for result in current['results']:
+        old = index.get((result['server'], result['workload'], result['concurrency']))
+        if old is None:
+            continue
+        fields = [
+            ('rps', old['throughput_rps'], result['throughput_rps']),
+            ('p95', (old['latency_ms'] or {}).get('p95'), (result['latency_ms'] or {}).get('p95')),
+            ('p99', (old['latency_ms'] or {}).get('p99'), (result['latency_ms'] or {}).get('p99')),
+            ('ttft p50', (old['ttft_ms'] or {}).get('p50'), (result['ttft_ms'] or {}).get('p50')),
+            ('rss', old['rss_mb']['peak'], result['rss_mb']['peak']),
+        ]
+        log(f"{result['server']:8} {result['workload']:9} c={result['concurrency']:<4} "
+            + '  '.join(f'{name} {delta(a, b)}' for name, a, b in fields))
+
+
+def csv_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', type=csv_list, default=['sync', 'gthread', 'gevent'],
+                        help=f"worker gunicorn ({', '.join(SERVERS)})")
+    parser.add_argument('--workloads', type=csv_list, default=['stream', 'generate', 'mixed'],
+                        help=f"workload ({', '.join(WORKLOADS)})")
+    parser.add_argument('--concurrency', type=lambda v: [int(x) for x in csv_list(v)], default=[8, 32])
+    parser.add_argument('--duration', type=float, default=10.0, help='secondi misurati per scenario')
+    parser.add_argument('--warmup', type=float, default=2.0, help='secondi di riscaldamento non misurati')
+    parser.add_argument('--request-timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--same-query', action='store_true', help='stessa domanda per tutte le richieste (cache)')
+    parser.add_argument('--upload-kb', type=int, default=64)
+    # Server finto
+    parser.add_argument('--latency', type=float, default=0.05, help='latenza upstream per chiamata (s)')
+    parser.add_argument('--latency-jitter', type=float, default=0.0)
+    parser.add_argument('--tokens-per-second', type=float, default=100.0, help='velocità dello streaming upstream')
+    parser.add_argument('--answer-words', type=int, default=100)
+    parser.add_argument('--errors', default='ok', help='pattern ciclico di errori upstream (es. 429,ok)')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--documents', type=int, default=20)
+    parser.add_argument('--chunks', type=int, default=5, help='chunk per richiesta di generazione e per :query')
+    # App
+    parser.add_argument('--env', action='append', default=[], help='variabile per app.py, es. --env RETRY_MAX_ATTEMPTS=1')
+    parser.add_argument('--gunicorn-arg', action='append', default=[], help='argomento extra per gunicorn')
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='carica l\'app in ogni worker invece che nel master (GUNICORN_PRELOAD=false)')
+    parser.add_argument('--output', help='file JSON dei risultati (default: stdout)')
+    parser.add_argument('--compare', help='JSON di un\'esecuzione precedente da confrontare')
+    parser.add_argument('--verbose', action='store_true', help='mostra lo stderr di gunicorn')
+    args = parser.parse_args()
+
+    for name in args.servers:
+        if name not in SERVERS:
+            parser.error(f'server sconosciuto: {name}')
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f'workload sconosciuto: {name}')
+
+    def log(message):
+        print(message, file=sys.stderr, flush=True)
+
+    report = {
+        'meta': {
+            'git_revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'verbose')},
+        },
+        'results': [],
+        'skipped': {},
+    }
+
+    fake_port = free_port()
+    fake = start_fake(args, fake_port)
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            for server in args.servers:
+                module = SERVER_REQUIRES.get(server)
+                if module and importlib.util.find_spec(module) is None:
+                    report['skipped'][server] = f'{module} non installato'
+                    log(f'{server}: saltato ({module} non installato)')
+                    continue
+                report['results'].extend(run_server(server, args, f'http://127.0.0.1:{fake_port}', state_dir, log))
+    finally:
+        stop(fake)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report, log)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
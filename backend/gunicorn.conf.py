@@ -0,0 +1,47 @@
+"""
+Configurazione gunicorn (letta automaticamente se gunicorn parte dalla cartella backend/).
+
+Con preload l'app, e su richiesta gli SDK pesanti (google-genai), vengono importati una volta
+nel master e condivisi copy-on-write dai worker invece di essere importati da ciascuno.
+gc.freeze() sposta gli oggetti del master nella generazione permanente: il garbage collector
+dei worker non li visita più e non riscrive (duplicandole) le pagine condivise.
+Thread di log, flush delle metriche e sonde di salute ripartono da soli in ogni worker.
+
+Le opzioni da riga di comando hanno la precedenza (es. gunicorn -w 2 app:app).
+"""
+import gc
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+# Thread per worker: gli stream SSE (chat, /api/events) restano aperti a lungo e con worker sync
+# occuperebbero un intero processo ciascuno
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+# Di default 8 thread per le richieste più uno per ogni stream di /api/events ammesso dal worker
+# (EVENTS_MAX_SUBSCRIBERS, oltre il limite 503): gli ascoltatori non tolgono thread alla chat
+threads = int(os.getenv('GUNICORN_THREADS') or 8 + int(os.getenv('EVENTS_MAX_SUBSCRIBERS', '4')))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+# Importa google-genai e numpy nel master (≈0.4s una volta sola) e crea il client in ogni worker all'avvio,
+# invece che alla prima query
+preload_sdks = os.getenv('GUNICORN_PRELOAD_SDKS', 'true').lower() == 'true'
+
+
+def when_ready(server):
+    """Nel master, dopo il caricamento dell'app e prima del fork dei worker"""
+    if not preload_app:
+        return
+    if preload_sdks:
+        import app
+        app.load_genai()
+        app.load_numpy()
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    """Nel worker appena creato: client genai (≈0.1s, pool httpx proprio) prima della prima richiesta"""
+    if not preload_sdks:
+        return
+    import app
+    if app.GENERATION_API_KEY:
+        app.get_genai_client()
@@ -2,13 +2,41 @@
 Test suite per il sistema RAG
 """
 import pytest
+import json
 import sys
 import os
+import threading
+import time
 
 # Aggiungi la directory backend al path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app import app
+import app as app_module
+
+@pytest.fixture(autouse=True)
+def fresh_rate_limiter(monkeypatch):
+    """Ogni test parte con i contatori del rate limit vuoti"""
+    monkeypatch.setattr(app_module.rate_limiter, 'store', app_module.MemorySharedStore())
+    monkeypatch.setattr(app_module.download_rate_limiter, 'store', app_module.MemorySharedStore())
+
+@pytest.fixture(autouse=True)
+def isolated_app_state(monkeypatch, tmp_path):
+    """Singleton globali dell'app nuovi per ogni test (retry disattivati salvo test dedicati)"""
+    monkeypatch.setattr(app_module, 'circuit_breakers', app_module.CircuitBreakerRegistry(app_module.MemorySharedStore()))
+    monkeypatch.setattr(app_module, 'retry_policy', app_module.RetryPolicy(max_attempts=1))
+    monkeypatch.setattr(app_module, 'admission', app_module.AdmissionController())
+    events_store = app_module.MemorySharedStore()
+    monkeypatch.setattr(app_module, 'event_bus', app_module.EventBus(events_store))
+    monkeypatch.setattr(app_module, 'operation_watcher',
+                        app_module.OperationWatcher(events_store, app_module.event_bus, autostart=False))
+    monkeypatch.setattr(app_module, 'event_hub', app_module.EventHub(poll_interval=0.01))
+    monkeypatch.setattr(app_module, 'query_cache', app_module.QueryCache())
+    monkeypatch.setattr(app_module, 'documents_cache', app_module.QueryCache(ttl_seconds=30))
+    monkeypatch.setattr(app_module, 'document_mirror', app_module.DocumentMirror())
+    monkeypatch.setattr(app_module, 'chunk_store', app_module.ChunkStore(app_module.MemorySharedStore()))
+    monkeypatch.setattr(app_module, 'stream_replay', app_module.StreamReplayLog(app_module.MemorySharedStore(), poll_interval=0.01))
+    monkeypatch.setattr(app_module, 'document_storage', app_module.DocumentStorage(str(tmp_path / 'documents_storage')))
 
 @pytest.fixture
 def client():
@@ -120,3 +148,1369 @@ def test_chunks_page(client):
     """Test: chunks page carica"""
     response = client.get('/chunks')
     assert response.status_code == 200
+
+# ==================== Cache risposte ====================
+
+
+class FakeGeminiResponse:
+    """Risposta finta di generateContent / streamGenerateContent"""
+    def __init__(self, text='Risposta di prova', status_code=200, sse_lines=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text_value = text
+        self.sse_lines = sse_lines or []
+        self.content = b'{}'
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.exceptions.HTTPError(response=self)
+
+    def json(self):
+        return {'candidates': [{'content': {'parts': [{'text': self.text_value}]}, 'finishReason': 'STOP'}]}
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(self.sse_lines)
+
+    def iter_content(self, chunk_size=None):
+        # Byte spezzati a metà riga, come arrivano dalla rete
+        raw = ''.join(line + '\r\n' for line in self.sse_lines).encode('utf-8')
+        return (raw[i:i + 7] for i in range(0, len(raw), 7))
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_generate(monkeypatch):
+    """Sostituisce le chiamate HTTP a Gemini e conta le invocazioni"""
+    calls = []
+
+    def fake_post(url, **kwargs):
+        calls.append(url)
+        if 'streamGenerateContent' in url:
+            return FakeGeminiResponse(sse_lines=[
+                'data: {"candidates": [{"content": {"parts": [{"text": "Ciao "}]}}]}',
+                '',
+                'data: {"candidates": [{"content": {"parts": [{"text": "mondo"}]}, "finishReason": "STOP"}]}',
+            ])
+        return FakeGeminiResponse()
+
+    monkeypatch.setattr(app_module.http_session, 'post', fake_post)
+    app_module.response_cache.clear()
+    yield calls
+    app_module.response_cache.clear()
+
+
+GENERATE_BODY = {
+    'query': 'Quanto costa il progetto?',
+    'relevant_chunks': [{'chunk': {'data': {'stringValue': 'Il progetto costa 100 euro'}}, 'chunkRelevanceScore': 0.9}],
+}
+
+
+def test_generate_response_cache_hit(client, fake_generate):
+    """Test: la stessa domanda con gli stessi chunk non richiama il modello"""
+    first = client.post('/api/chat/generate', json=GENERATE_BODY)
+    second = client.post('/api/chat/generate', json=GENERATE_BODY)
+    assert first.status_code == 200 and second.status_code == 200
+    assert len(fake_generate) == 1
+    assert second.get_json()['cached'] is True
+    assert second.get_json()['response'] == first.get_json()['response']
+
+    # Chunk diversi -> chiave diversa
+    other = dict(GENERATE_BODY, relevant_chunks=[{'chunk': {'data': {'stringValue': 'Altro testo'}}, 'chunkRelevanceScore': 0.9}])
+    client.post('/api/chat/generate', json=other)
+    assert len(fake_generate) == 2
+
+
+def test_generate_stream_cache_replay(client, fake_generate, monkeypatch):
+    """Test: una risposta in streaming viene memorizzata e riprodotta come SSE"""
+    monkeypatch.setattr(app_module, 'RESPONSE_CACHE_REPLAY_CHUNK_CHARS', 4)
+    first = client.post('/api/chat/generate-stream', json=GENERATE_BODY)
+    assert b'Ciao ' in first.data
+    second = client.post('/api/chat/generate-stream', json=GENERATE_BODY)
+    assert len(fake_generate) == 1
+    frames = [line for line in second.data.decode().split('\n') if line.startswith('data: ')]
+    texts = [json.loads(f[6:]).get('text', '') for f in frames]
+    assert ''.join(texts) == 'Ciao mondo'
+    assert json.loads(frames[-1][6:]) == {'done': True, 'cached': True}
+
+
+def test_response_cache_stale_while_revalidate(monkeypatch):
+    """Test: oltre il TTL la voce stale viene servita e aggiornata in background"""
+    cache = app_module.ResponseCache(ttl_seconds=10, stale_ttl_seconds=60)
+    cache.set('k', 'vecchia')
+    cache.cache['k'] = ('vecchia', app_module.time.time() - 30)
+    assert cache.lookup('k') == ('vecchia', 'stale')
+    assert cache.begin_refresh('k') is True
+    assert cache.begin_refresh('k') is False
+    cache.end_refresh('k')
+    cache.cache['k'] = ('vecchia', app_module.time.time() - 100)
+    assert cache.lookup('k') == (None, 'miss')
+
+# ==================== Stato condiviso e scheduler upstream ====================
+
+
+def test_sqlite_shared_store_atomic_update(tmp_path):
+    """Test: lo store SQLite supporta TTL e incrementi atomici da più thread"""
+    store = app_module.SqliteSharedStore(str(tmp_path / 'state.db'))
+    store.set('a', 'uno', ttl=60)
+    store.set('scaduta', 'x', ttl=0.01)
+    time.sleep(0.02)
+    assert store.get('a') == 'uno'
+    assert store.get('scaduta') is None
+    assert store.keys('a') == ['a']
+
+    def worker():
+        for _ in range(50):
+            store.incr('contatore')
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert store.get('contatore') == '200'
+
+
+def test_scheduler_token_bucket_waits():
+    """Test: oltre la capacità del bucket RPM le richieste attendono invece di partire"""
+    scheduler = app_module.UpstreamScheduler(app_module.MemorySharedStore(), rpm=600, tpm=0,
+                                             max_concurrency=0, burst_seconds=1, max_wait=5)
+    started = time.monotonic()
+    for _ in range(10):
+        scheduler.release(scheduler.acquire())
+    assert time.monotonic() - started < 0.05
+    scheduler.release(scheduler.acquire())
+    assert time.monotonic() - started >= 0.05
+    assert scheduler.stats()['granted']['default'] == 11
+
+
+def test_scheduler_priority_and_timeout():
+    """Test: con la concorrenza satura la chat passa prima degli upload; il timeout dà UpstreamBusyError"""
+    scheduler = app_module.UpstreamScheduler(app_module.MemorySharedStore(), rpm=0, tpm=0,
+                                             max_concurrency=1, max_wait=5, poll_interval=0.01)
+    holder = scheduler.acquire(app_module.PRIORITY_DEFAULT)
+    order = []
+
+    def waiter(priority, name):
+        with scheduler.slot(priority):
+            order.append(name)
+
+    bulk = threading.Thread(target=waiter, args=(app_module.PRIORITY_BULK, 'bulk'))
+    bulk.start()
+    time.sleep(0.05)
+    chat = threading.Thread(target=waiter, args=(app_module.PRIORITY_INTERACTIVE, 'chat'))
+    chat.start()
+    time.sleep(0.05)
+    assert scheduler.stats()['queue_depth'] == {'interactive': 1, 'default': 0, 'bulk': 1}
+    scheduler.release(holder)
+    bulk.join()
+    chat.join()
+    assert order == ['chat', 'bulk']
+
+    holder = scheduler.acquire()
+    with pytest.raises(app_module.UpstreamBusyError):
+        scheduler.acquire(timeout=0.05)
+    scheduler.release(holder)
+    assert scheduler.stats()['timeouts']['default'] == 1
+    assert scheduler.stats()['queue_depth'] == {'interactive': 0, 'default': 0, 'bulk': 0}
+
+
+def test_scheduler_only_head_waiter_writes(tmp_path):
+    """Test: con lo store SQLite i waiter non in testa non aprono transazioni sullo stato"""
+    store = app_module.SqliteSharedStore(str(tmp_path / 'state.db'))
+    scheduler = app_module.UpstreamScheduler(store, rpm=0, tpm=0, max_concurrency=1,
+                                             max_wait=5, poll_interval=0.01)
+    holder = scheduler.acquire()
+    threads = [threading.Thread(target=lambda: scheduler.release(scheduler.acquire())) for _ in range(10)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    writes = []
+    original_update = store.update
+    store.update = lambda key, fn, ttl=None: writes.append(key) or original_update(key, fn, ttl)
+    time.sleep(0.2)
+    # Solo il waiter in testa riprova: ~20 poll in 0.2s, non 10 waiter x 20 poll
+    assert len(writes) < 40
+    assert scheduler.stats()['queue_depth']['default'] == 10
+    scheduler.release(holder)
+    for t in threads:
+        t.join()
+    assert scheduler.stats()['granted']['default'] == 11
+    assert store.keys(scheduler.WAITER_PREFIX) == []
+
+
+def test_scheduler_stats_endpoint(client):
+    """Test: le metriche dello scheduler sono esposte"""
+    response = client.get('/api/upstream/scheduler')
+    assert response.status_code == 200
+    data = response.get_json()['scheduler']
+    assert 'queue_depth' in data and 'wait_seconds' in data
+
+
+# ==================== Rate limiting ====================
+
+
+def test_rate_limiter_gcra_burst_and_recovery():
+    """Test: GCRA consente il burst, poi blocca e calcola retry_after"""
+    limiter = app_module.RateLimiter(max_requests=3, time_window=0.3)
+    results = [limiter.check('1.2.3.4') for _ in range(4)]
+    assert [r[0] for r in results] == [True, True, True, False]
+    assert [r[1] for r in results[:3]] == [2, 1, 0]
+    assert 0 < results[3][2] <= 0.1
+    assert limiter.check('5.6.7.8')[0] is True  # chiavi indipendenti
+    time.sleep(0.11)
+    assert limiter.is_allowed('1.2.3.4') is True
+
+
+def test_rate_limiter_evicts_idle_keys():
+    """Test: le chiavi inattive scadono e vengono eliminate dallo store"""
+    store = app_module.MemorySharedStore(sweep_interval=3600)
+    limiter = app_module.RateLimiter(max_requests=5, time_window=0.05, store=store)
+    for i in range(100):
+        limiter.check(f'10.0.0.{i}')
+    assert len(store.data) == 100
+    time.sleep(0.06)
+    assert store.sweep() == 100
+    assert store.data == {}
+
+
+def test_rate_limit_headers_and_429(client, monkeypatch):
+    """Test: le route chat applicano il rate limit con header X-RateLimit-*"""
+    monkeypatch.setattr(app_module, 'rate_limiter', app_module.RateLimiter(max_requests=2, time_window=60))
+    first = client.post('/api/chat/generate', json={'relevant_chunks': []})
+    assert first.status_code == 400
+    assert first.headers['X-RateLimit-Limit'] == '2'
+    assert first.headers['X-RateLimit-Remaining'] == '1'
+    client.post('/api/chat/generate', json={'relevant_chunks': []})
+    blocked = client.post('/api/chat/generate', json={'relevant_chunks': []})
+    assert blocked.status_code == 429
+    assert blocked.headers['X-RateLimit-Remaining'] == '0'
+    assert int(blocked.headers['Retry-After']) >= 1
+    # Le route non limitate non sono toccate
+    assert 'X-RateLimit-Limit' not in client.get('/api/config').headers
+
+
+# ==================== Circuit breaker ====================
+
+
+def test_circuit_breaker_single_probe_half_open():
+    """Test: dopo il timeout passa una sola chiamata di prova; il successo richiude il circuito"""
+    breaker = app_module.CircuitBreaker('generate', app_module.MemorySharedStore(), failure_threshold=2, timeout=0.05)
+    breaker.record_failure()
+    assert breaker.call_allowed() is True
+    breaker.record_failure()
+    assert breaker.state == 'OPEN'
+    assert breaker.call_allowed() is False
+    assert breaker.peek()[0] is True
+    time.sleep(0.06)
+    assert breaker.call_allowed() is True   # la prova
+    assert breaker.call_allowed() is False  # le altre falliscono subito
+    breaker.record_success()
+    assert breaker.state == 'CLOSED'
+    assert breaker.call_allowed() is True
+    assert breaker.stats()['transitions'] == {'OPEN': 1, 'HALF_OPEN': 1, 'CLOSED': 1}
+
+
+def test_circuit_breaker_probe_failure_reopens():
+    """Test: una prova fallita riapre il circuito; cancel_probe libera la prova"""
+    breaker = app_module.CircuitBreaker('upload', app_module.MemorySharedStore(), failure_threshold=1, timeout=0.02)
+    breaker.record_failure()
+    time.sleep(0.03)
+    assert breaker.call_allowed() is True
+    breaker.cancel_probe()
+    assert breaker.call_allowed() is True
+    breaker.record_failure()
+    assert breaker.state == 'OPEN'
+    assert breaker.call_allowed() is False
+
+
+def test_circuit_breaker_per_operation_and_failure_classes(client, monkeypatch):
+    """Test: 5xx e timeout aprono solo il breaker dell'operazione; poi si fallisce subito senza rete"""
+    import requests
+    calls = []
+
+    def failing_post(url, **kwargs):
+        calls.append(url)
+        if len(calls) % 2:
+            raise requests.exceptions.ReadTimeout('timeout')
+        return FakeGeminiResponse(status_code=503)
+
+    monkeypatch.setattr(app_module.http_session, 'post', failing_post)
+    app_module.response_cache.clear()
+    for _ in range(app_module.circuit_breakers.failure_threshold):
+        assert client.post('/api/chat/generate', json=GENERATE_BODY).status_code == 500
+    upstream_calls = len(calls)
+
+    started = time.perf_counter()
+    response = client.post('/api/chat/generate', json=GENERATE_BODY)
+    assert time.perf_counter() - started < 0.5
+    assert response.status_code == 503
+    assert response.get_json()['circuit_breaker_status'] == 'OPEN'
+    assert int(response.headers['Retry-After']) >= 1
+    assert len(calls) == upstream_calls
+
+    stats = client.get('/api/upstream/breakers').get_json()['breakers']
+    assert stats['generate']['state'] == 'OPEN'
+    assert stats['list']['state'] == 'CLOSED'
+
+
+def test_retry_policy_decorrelated_jitter_bounds():
+    """Test: le attese restano tra base e cap e crescono al massimo di 3x"""
+    policy = app_module.RetryPolicy(base_delay=0.5, max_delay=8)
+    delay = policy.base_delay
+    for _ in range(50):
+        previous = delay
+        delay = policy.next_delay(previous)
+        assert policy.base_delay <= delay <= min(policy.max_delay, previous * 3)
+
+
+def test_generate_retries_429_honoring_retry_after(client, monkeypatch):
+    """Test: 429 -> 503 -> 200 produce 3 chiamate e le attese rispettano Retry-After"""
+    statuses = [429, 503, 200]
+    calls = []
+    waits = []
+
+    def flaky_post(url, **kwargs):
+        calls.append(url)
+        return FakeGeminiResponse(status_code=statuses[len(calls) - 1], headers={'Retry-After': '2'})
+
+    monkeypatch.setattr(app_module.http_session, 'post', flaky_post)
+    monkeypatch.setattr(app_module, 'upstream_sleep', waits.append)
+    monkeypatch.setattr(app_module, 'retry_policy', app_module.RetryPolicy(max_attempts=3, base_delay=0.1))
+    app_module.response_cache.clear()
+
+    response = client.post('/api/chat/generate', json=GENERATE_BODY)
+    assert response.status_code == 200
+    assert len(calls) == 3
+    assert waits == [2.0, 2.0]
+    assert app_module.retry_policy.stats()['retries'] == {'generate': 2}
+
+
+def test_stream_retry_releases_slot_during_backoff(client, monkeypatch):
+    """Test: dopo un 429 in streaming lo slot dello scheduler è libero per tutto il backoff"""
+    responses = [FakeGeminiResponse(status_code=429, headers={'Retry-After': '2'}), FakeGeminiResponse(sse_lines=[
+        'data: {"candidates": [{"content": {"parts": [{"text": "Ciao"}]}, "finishReason": "STOP"}]}'])]
+    in_flight_during_backoff = []
+    monkeypatch.setattr(app_module.http_session, 'post', lambda url, **kwargs: responses.pop(0))
+    monkeypatch.setattr(app_module, 'upstream_sleep',
+                        lambda seconds: in_flight_during_backoff.append(app_module.upstream_scheduler.stats()['in_flight']))
+    monkeypatch.setattr(app_module, 'retry_policy', app_module.RetryPolicy(max_attempts=2))
+    app_module.response_cache.clear()
+
+    with client.post('/api/chat/generate-stream', json=GENERATE_BODY) as response:
+        assert '"Ciao"' in response.get_data(as_text=True)
+    assert in_flight_during_backoff == [0]
+    assert app_module.upstream_scheduler.stats()['in_flight'] == 0
+
+
+def test_retry_policy_gives_up_when_retry_after_exceeds_deadline(monkeypatch):
+    """Test: un Retry-After oltre il budget restituisce subito l'ultima risposta, senza attendere"""
+    waits = []
+    monkeypatch.setattr(app_module, 'upstream_sleep', waits.append)
+    policy = app_module.RetryPolicy(max_attempts=5, deadline=10)
+    calls = []
+
+    def attempt(remaining):
+        calls.append(remaining)
+        return FakeGeminiResponse(status_code=429, headers={'Retry-After': '60'})
+
+    response = policy.run(attempt, 'generate')
+    assert response.status_code == 429
+    assert len(calls) == 1 and calls[0] <= 10
+    assert waits == []
+    assert policy.stats()['gave_up'] == {'generate': 1}
+
+
+def test_retry_policy_skips_client_errors_and_open_breaker(monkeypatch):
+    """Test: 4xx non si ritentano; un breaker aperto interrompe subito i retry"""
+    monkeypatch.setattr(app_module, 'upstream_sleep', lambda seconds: None)
+    policy = app_module.RetryPolicy(max_attempts=5)
+    calls = []
+
+    def bad_request(remaining):
+        calls.append(remaining)
+        return FakeGeminiResponse(status_code=400)
+
+    assert policy.run(bad_request, 'generate').status_code == 400
+    assert len(calls) == 1
+
+    def open_breaker(remaining):
+        calls.append(remaining)
+        raise app_module.CircuitOpenError('generate', 30)
+
+    with pytest.raises(app_module.CircuitOpenError):
+        policy.run(open_breaker, 'generate')
+    assert len(calls) == 2
+
+
+def test_sse_parser_handles_split_bytes_and_crlf():
+    """Test: eventi spezzati tra chunk di rete, delimitatori CRLF e ultimo evento senza riga vuota"""
+    raw = 'data: {"candidates": [{"content": {"parts": [{"text": "Perché \\"sì\\""}]}}]}\r\n\r\n: commento\r\n' \
+          'data: {"candidates": [{"content": {"parts": [{"text": "fine"}]}, "finishReason": "STOP"}]}'
+    data = raw.encode('utf-8')
+    events = list(app_module.iter_sse_data(data[i:i + 5] for i in range(0, len(data), 5)))
+    assert len(events) == 2
+    assert app_module.parse_stream_event(events[0]) == ('Perché "sì"', None)
+    assert app_module.parse_stream_event(events[1]) == ('fine', 'STOP')
+
+
+def test_stream_relay_batches_deltas_on_flush_interval():
+    """Test: con intervallo lungo i delta vengono uniti; con max_chars si svuota prima"""
+    events = b''.join(
+        b'data: {"candidates": [{"content": {"parts": [{"text": "tok%d "}]}}]}\n\n' % i for i in range(20)
+    )
+    relay = app_module.StreamRelay(flush_interval=60, max_chars=10 ** 6)
+    frames = list(relay.relay([events]))
+    # Il primo delta parte subito, gli altri arrivano entro l'intervallo e finiscono in un frame
+    assert len(frames) == 2
+    assert json.loads(frames[0][6:])['text'] == 'tok0 '
+    assert json.loads(frames[1][6:])['text'] == ''.join(f'tok{i} ' for i in range(1, 20))
+
+    relay = app_module.StreamRelay(flush_interval=60, max_chars=12)
+    frames = list(relay.relay([events]))
+    assert 1 < len(frames) < 20
+    assert ''.join(json.loads(f[6:])['text'] for f in frames) == relay.text
+
+
+
+def test_stream_buffer_policies_when_client_falls_behind():
+    """Buffer tra upstream e client: coalesce unisce i delta, spill passa su disco in ordine, drop chiude il client"""
+    events = [{'text': f'tok{i} '} for i in range(6)]
+    buffer = app_module.StreamBuffer('coalesce', max_frames=2)
+    for event in events + [{'warning': 'Risposta incompleta: MAX_TOKENS'}]:
+        assert buffer.put(dict(event))
+    buffer.finish()
+    drained = list(buffer.drain())
+    assert drained[0] == {'text': 'tok0 '} and drained[1] == {'text': 'tok1 tok2 tok3 tok4 tok5 '}
+    assert drained[2]['warning'] and buffer.overflows == 5
+
+    buffer = app_module.StreamBuffer('spill', max_frames=2)
+    for event in events[:4]:
+        buffer.put(dict(event))
+    reader = buffer.drain()
+    assert next(reader) == events[0] and buffer.spill_pending == 2
+    buffer.put(dict(events[4]))  # la coda ha posto, ma l'ordine impone il disco
+    assert [next(reader) for _ in range(4)] == events[1:5] and buffer.spill_write == 0
+    buffer.put(dict(events[5]))
+    buffer.finish(ValueError('upstream interrotto'))
+    assert next(reader) == events[5]
+    with pytest.raises(ValueError):
+        next(reader)
+    buffer.cancel()
+    assert buffer.put({'text': 'x'}) is False
+
+    buffer = app_module.StreamBuffer('drop', max_frames=2)
+    assert all(buffer.put(dict(event)) for event in events)
+    buffer.finish()
+    assert buffer.dropped and list(buffer.drain()) == []
+
+
+def test_stream_upstream_drained_before_slow_client(client, monkeypatch, fake_generate):
+    """Il producer finisce la generazione (e riempie la cache) mentre il client non legge; poi drop del client lento"""
+    import functools
+    words = ['Ciao ', 'bel ', 'mondo ', 'di ', 'prova']
+    lines = [json.dumps({'candidates': [{'content': {'parts': [{'text': w}]}, **({'finishReason': 'STOP'} if i == len(words) - 1 else {})}]})
+             for i, w in enumerate(words)]
+
+    def fake_post(url, **kwargs):
+        return FakeGeminiResponse(sse_lines=[part for line in lines for part in ('data: ' + line, '')])
+    monkeypatch.setattr(app_module.http_session, 'post', fake_post)
+    monkeypatch.setattr(app_module, 'StreamRelay', functools.partial(app_module.StreamRelay, flush_interval=0))
+    monkeypatch.setattr(app_module, 'StreamBuffer', functools.partial(app_module.StreamBuffer, 'drop', max_frames=1))
+
+    with client.post('/api/chat/generate-stream', json=GENERATE_BODY, buffered=False) as response:
+        frames = iter(response.response)
+        first = next(frames)  # avvia il producer; poi il client resta fermo
+        # La generazione arriva comunque in fondo e la connessione upstream si libera
+        deadline = time.monotonic() + 5
+        while (app_module.response_cache.size() == 0 or app_module.upstream_scheduler.stats()['in_flight']) \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert list(app_module.response_cache.cache.values())[0][0] == 'Ciao bel mondo di prova'
+        assert app_module.upstream_scheduler.stats()['in_flight'] == 0
+        rest = first + b''.join(frames)
+    assert b'slow_client' in rest and b'"done"' not in rest
+
+
+def sse_frames(body: bytes) -> list:
+    """Frame SSE come (id, evento, dati)"""
+    frames = []
+    for raw in body.decode('utf-8').strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in raw.split('\n') if ': ' in line)
+        frames.append((fields.get('id'), fields.get('event'), json.loads(fields['data'])))
+    return frames
+
+
+def test_stream_resume_with_last_event_id_replays_and_attaches(client, monkeypatch, fake_generate):
+    """Last-Event-ID: i frame mancanti arrivano dal registro, anche mentre la generazione è ancora in corso"""
+    import functools
+    monkeypatch.setattr(app_module, 'StreamRelay', functools.partial(app_module.StreamRelay, flush_interval=0))
+    frames = sse_frames(client.post('/api/chat/generate-stream', json=GENERATE_BODY).data)
+    assert frames[0][1] == 'stream' and frames[0][0] == f"{frames[0][2]['stream_id']}:0"
+    assert [f[2] for f in frames if f[1] is None] == [{'text': 'Ciao '}, {'text': 'mondo'}, {'done': True}]
+    resumed = sse_frames(client.post('/api/chat/generate-stream', json=GENERATE_BODY,
+                                     headers={'Last-Event-ID': frames[1][0]}).data)
+    assert resumed == [f for f in frames if f[1] is None][1:] and len(fake_generate) == 1
+
+    # Il client si disconnette a metà: la generazione continua e la ripresa la segue fino alla fine
+    gate = threading.Event()
+
+    class SlowStream(FakeGeminiResponse):
+        def iter_content(self, chunk_size=None):
+            yield b'data: {"candidates": [{"content": {"parts": [{"text": "Prima "}]}}]}\n\n'
+            gate.wait(5)
+            yield b'data: {"candidates": [{"content": {"parts": [{"text": "dopo"}]}, "finishReason": "STOP"}]}\n\n'
+    monkeypatch.setattr(app_module.http_session, 'post', lambda url, **kwargs: SlowStream())
+    with client.post('/api/chat/generate-stream', json={**GENERATE_BODY, 'query': 'Altra domanda'}, buffered=False) as response:
+        chunks = iter(response.response)
+        next(chunks)
+        first = sse_frames(next(chunks))[0]
+    assert first[2] == {'text': 'Prima '}
+    threading.Timer(0.1, gate.set).start()
+    attached = sse_frames(client.post('/api/chat/generate-stream', headers={'Last-Event-ID': first[0]}).data)
+    assert [f[2] for f in attached] == [{'text': 'dopo'}, {'done': True}]
+
+    missing = client.post('/api/chat/generate-stream', json=GENERATE_BODY, headers={'Last-Event-ID': '0123456789abcdef:3'})
+    assert missing.status_code == 404 and missing.get_json()['code'] == 'stream_not_found'
+
+# ==================== Riparazione encoding ====================
+
+ENCODING_GOLDEN = [
+    # (testo originale, uscita attesa: virgolette tipografiche ed ellissi normalizzate)
+    ('Perché la città è più bella? Così: «Né l’uno né l’altro…» – disse', 'Perché la città è più bella? Così: «Né l\'uno né l\'altro...» – disse'),
+    ('È già lì. Ò Ù À Ì — costo 1.200 € (±20°)', 'È già lì. Ò Ù À Ì — costo 1.200 € (±20°)'),
+    ('Größe, Übermaß und Äpfel: „schön“ für Müller', 'Größe, Übermaß und Äpfel: "schön" für Müller'),
+]
+
+
+def mojibake(text, codec):
+    """UTF-8 letto come cp1252 (byte non definiti come Latin-1) o come Latin-1"""
+    raw = text.encode('utf-8')
+    if codec == 'latin-1':
+        return raw.decode('latin-1')
+    return ''.join(bytes([b]).decode('cp1252', errors='ignore') or chr(b) for b in raw)
+
+
+@pytest.mark.parametrize('original,expected', ENCODING_GOLDEN)
+@pytest.mark.parametrize('codec', ['cp1252', 'latin-1'])
+def test_fix_encoding_issues_golden_it_de(original, expected, codec):
+    """Test: testo italiano/tedesco mal decodificato viene riparato in una passata"""
+    broken = mojibake(original, codec)
+    assert broken != original
+    assert app_module.fix_encoding_issues(broken) == expected
+
+
+def test_fix_encoding_issues_leaves_clean_text_untouched():
+    """Test: testo già corretto (ASCII o UTF-8 valido) esce identico, senza copie"""
+    for text in ('Plain ASCII answer', 'Perché la città è più bella', 'Größe „schön“ – 5 €'):
+        assert app_module.fix_encoding_issues(text) is text
+
+
+def test_encoding_repairer_handles_sequences_split_across_chunks():
+    """Test: sequenze spezzate tra chunk SSE vengono riparate come il testo intero"""
+    original, expected = ENCODING_GOLDEN[0]
+    broken = mojibake(original, 'cp1252')
+    for size in (1, 2, 3, 7):
+        repairer = app_module.EncodingRepairer()
+        pieces = [repairer.feed(broken[i:i + size]) for i in range(0, len(broken), size)]
+        assert ''.join(pieces) + repairer.flush() == expected
+
+
+# ==================== Logging strutturato ====================
+
+@pytest.fixture
+def captured_logs():
+    """Log sincroni su un buffer; alla fine ripristina la configurazione di default"""
+    import io
+    buffer = io.StringIO()
+    app_module.configure_logging('INFO', 'json', async_mode=False, stream=buffer)
+    yield lambda: [json.loads(line) for line in buffer.getvalue().splitlines() if line.startswith('{')]
+    app_module.configure_logging()
+
+
+def test_request_id_propagated_through_retries_and_stream(client, monkeypatch, captured_logs):
+    """Test: il request id del client finisce nell'header di risposta e nei log di retry e streaming"""
+    responses = [FakeGeminiResponse(status_code=503), FakeGeminiResponse(sse_lines=[
+        'data: {"candidates": [{"content": {"parts": [{"text": "Ciao"}]}, "finishReason": "STOP"}]}'])]
+    monkeypatch.setattr(app_module.http_session, 'post', lambda url, **kwargs: responses.pop(0))
+    monkeypatch.setattr(app_module, 'upstream_sleep', lambda seconds: None)
+    monkeypatch.setattr(app_module, 'retry_policy', app_module.RetryPolicy(max_attempts=2))
+    app_module.response_cache.clear()
+
+    response = client.post('/api/chat/generate-stream', json=GENERATE_BODY, headers={'X-Request-ID': 'req-42'})
+    body = response.get_data(as_text=True)
+    assert response.headers['X-Request-ID'] == 'req-42'
+    assert '"Ciao"' in body
+
+    entries = captured_logs()
+    retry_logs = [e for e in entries if e['msg'].startswith('Retry stream')]
+    stream_logs = [e for e in entries if e['msg'].startswith('Streaming completato')]
+    assert retry_logs and stream_logs
+    assert all(e['request_id'] == 'req-42' for e in retry_logs + stream_logs)
+    assert stream_logs[0]['route'] == '/api/chat/generate-stream'
+
+
+def test_log_sampling_per_route_keeps_warnings(client, monkeypatch, captured_logs):
+    """Test: con campionamento 0 la route non scrive INFO ma i WARNING restano"""
+    monkeypatch.setitem(app_module.LOG_SAMPLE_RATES, '/api/chat/generate', 0.0)
+    monkeypatch.setattr(app_module.http_session, 'post', lambda url, **kwargs: FakeGeminiResponse(status_code=400))
+    app_module.response_cache.clear()
+
+    response = client.post('/api/chat/generate', json=GENERATE_BODY)
+    assert response.status_code == 500
+    entries = [e for e in captured_logs() if e['route'] == '/api/chat/generate']
+    assert not [e for e in entries if e['level'] == 'INFO']
+    assert [e for e in entries if e['level'] == 'ERROR']
+
+
+def test_queue_handler_never_blocks_and_caps_payloads():
+    """Test: con coda piena i record vengono scartati; i payload lunghi vengono troncati"""
+    import logging
+    import queue as queue_module
+    handler = app_module.NonBlockingQueueHandler(queue_module.Queue(1))
+    record = logging.LogRecord('app', logging.INFO, __file__, 1, 'payload %s', (app_module.LazyJson({'x': 'y' * 5000}, limit=100),), None)
+    started = time.perf_counter()
+    for _ in range(3):
+        handler.handle(record)
+    assert time.perf_counter() - started < 0.1
+    assert handler.dropped == 2
+
+    formatted = app_module.StructuredFormatter('json', max_chars=100).format(handler.queue.get_nowait())
+    message = json.loads(formatted)['msg']
+    assert len(message) < 200 and 'caratteri]' in message
+
+
+# ==================== Metriche ====================
+
+def test_metrics_endpoint_aggregates_workers(client, monkeypatch, fake_generate):
+    """Test: /metrics espone istogrammi per route e upstream, TTFT, breaker e somma i worker"""
+    registry = app_module.MetricsRegistry(app_module.MemorySharedStore(), flush_interval=0)
+    registry.collectors.append(app_module.collect_process_metrics)
+    monkeypatch.setattr(app_module, 'metrics', registry)
+    monkeypatch.setattr(app_module, 'response_cache', app_module.ResponseCache(ttl_seconds=60, stale_ttl_seconds=0, max_entries=10))
+
+    # La durata per route viene registrata alla chiusura della risposta (come fa il server WSGI)
+    with client.post('/api/chat/generate', json=GENERATE_BODY) as first:
+        assert first.status_code == 200
+    with client.post('/api/chat/generate', json=GENERATE_BODY) as second:
+        assert second.get_json()['cached'] is True
+    with client.post('/api/chat/generate-stream', json={**GENERATE_BODY, 'query': 'Altra domanda'}) as stream:
+        stream.get_data()
+
+    # Un secondo worker ha pubblicato la sua istantanea nello store condiviso
+    other = app_module.MetricsRegistry(registry.store, flush_interval=0)
+    other.observe('upstream_request_duration_seconds', 0.2, operation='generate', outcome='2xx')
+    other.gauge_add('streams_in_flight', 2)
+    registry.store.set('metrics:999999', json.dumps(other.snapshot()), ttl=30)
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    lines = dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+
+    assert lines['upstream_request_duration_seconds_count{operation="generate",outcome="2xx"}'] == '2'
+    assert lines['upstream_request_duration_seconds_count{operation="stream",outcome="2xx"}'] == '1'
+    assert lines['http_request_duration_seconds_count{method="POST",route="/api/chat/generate",status="200"}'] == '2'
+    assert lines['stream_time_to_first_token_seconds_count'] == '1'
+    assert lines['streams_in_flight'] == '2'
+    assert lines['response_cache_requests_total{result="hit"}'] == '1'
+    assert lines['circuit_breaker_state{operation="generate"}'] == '0'
+    assert lines['metrics_workers'] == '2'
+    assert 'upstream_request_duration_seconds_bucket{operation="generate",outcome="2xx",le="+Inf"} 2' in text
+    assert '# TYPE scheduler_queue_depth gauge' in text
+
+def test_server_timing_header_and_stream_timing_event(client, monkeypatch, fake_generate):
+    """Test: Server-Timing sulle risposte JSON, evento SSE 'timing' prima di done negli stream"""
+    monkeypatch.setattr(app_module, 'response_cache', app_module.ResponseCache(ttl_seconds=60, stale_ttl_seconds=0, max_entries=10))
+
+    response = client.post('/api/chat/generate', json=GENERATE_BODY)
+    assert response.status_code == 200
+    names = [entry.split(';')[0] for entry in response.headers['Server-Timing'].split(', ')]
+    for name in ('validate', 'prompt', 'cache_lookup', 'scheduler_wait', 'upstream_generate', 'parse', 'total'):
+        assert name in names
+
+    stream = client.post('/api/chat/generate-stream', json={**GENERATE_BODY, 'query': 'Altra domanda'})
+    body = stream.get_data(as_text=True)
+    frames = body.strip().split('\n\n')
+    # Ogni frame ha un id ("<stream>:<n>") per la ripresa con Last-Event-ID
+    assert frames[-1].startswith('id: ') and json.loads(frames[-1].split('data: ', 1)[1]) == {'done': True}
+    assert frames[-2].startswith('event: timing\ndata: ')
+    timing = json.loads(frames[-2].split('data: ', 1)[1])
+    for name in ('upstream_wait', 'upstream_stream', 'relay', 'first_token', 'total'):
+        assert name in timing
+    assert timing['first_token'] <= timing['total']
+
+def test_debug_trace_ring_buffer(client, monkeypatch, fake_generate):
+    """Test: con X-Debug-Trace l'albero degli span finisce nel buffer condiviso, limitato in dimensione"""
+    assert client.get('/api/debug/traces').status_code == 404
+
+    monkeypatch.setattr(app_module, 'DEBUG_TRACE_ENABLED', True)
+    monkeypatch.setattr(app_module, 'DEBUG_TRACE_BUFFER_SIZE', 2)
+    monkeypatch.setattr(app_module, 'shared_store', app_module.MemorySharedStore())
+
+    request_ids = []
+    for i in range(3):
+        with client.post('/api/chat/generate', json={**GENERATE_BODY, 'query': f'Domanda {i}'},
+                         headers={'X-Debug-Trace': '1'}) as response:
+            request_ids.append(response.headers['X-Debug-Trace-Id'])
+    # Senza header niente trace dettagliato
+    with client.post('/api/chat/generate', json=GENERATE_BODY) as response:
+        assert 'X-Debug-Trace-Id' not in response.headers
+
+    listing = client.get('/api/debug/traces').get_json()['traces']
+    assert [t['request_id'] for t in listing] == [request_ids[2], request_ids[1]]
+    assert client.get(f'/api/debug/traces/{request_ids[0]}').status_code == 404
+
+    tree = client.get(f'/api/debug/traces/{request_ids[2]}').get_json()['trace']
+    assert tree['route'] == '/api/chat/generate'
+    top = {node['name']: node for node in tree['spans']}
+    assert 'validate' in top and 'cache_lookup' in top
+    assert {child['name'] for child in top['upstream']['children']} == {'scheduler_wait', 'upstream_generate'}
+
+def test_readyz_serves_cached_probe_shared_across_workers(client, monkeypatch):
+    """Test: /readyz non chiama mai Gemini; la sonda in background è una sola per intervallo sul nodo"""
+    store = app_module.MemorySharedStore()
+    monkeypatch.setattr(app_module, 'shared_store', store)
+    monkeypatch.setattr(app_module, 'GEMINI_API_KEY', 'test-key')
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORE_NAME', 'fileSearchStores/test')
+    probe = app_module.HealthProbe(interval=15, timeout=1, stale_after=60, autostart=False)
+    monkeypatch.setattr(app_module, 'health_probe', probe)
+    statuses = []
+
+    def fake_get(url, **kwargs):
+        assert url.endswith('/fileSearchStores/test')
+        return FakeGeminiResponse(status_code=statuses.pop(0))
+
+    monkeypatch.setattr(app_module.http_session, 'get', fake_get)
+
+    assert client.get('/healthz').status_code == 200
+    pending = client.get('/readyz')
+    assert pending.status_code == 503
+    assert 'probe_pending' in pending.get_json()['reasons']
+
+    statuses.append(200)
+    probe.refresh()
+    for _ in range(5):
+        response = client.get('/readyz')
+        assert response.status_code == 200
+    body = response.get_json()
+    assert body['checks']['upstream']['ok'] is True
+    assert body['checks']['breakers']['generate'] == 'CLOSED'
+    assert statuses == []
+
+    # Un secondo worker riusa il risultato pubblicato nello store condiviso
+    other = app_module.HealthProbe(interval=15, timeout=1, stale_after=60, autostart=False)
+    other.refresh()
+    assert other.state['upstream']['ok'] is True
+
+    # Risultato scaduto: nuova sonda, che fallisce
+    published = json.loads(store.get(probe.RESULT_KEY))
+    published['checked_at'] -= 30
+    store.set(probe.RESULT_KEY, json.dumps(published))
+    store.delete(probe.LEASE_KEY)
+    statuses.append(403)
+    probe.refresh()
+    failed = client.get('/readyz')
+    assert failed.status_code == 503
+    assert failed.get_json()['reasons'] == ['upstream']
+
+    # Quota esaurita (comune a tutti i nodi): Gemini è raggiungibile, il nodo resta in rotazione
+    store.delete(probe.LEASE_KEY)
+    published = json.loads(store.get(probe.RESULT_KEY))
+    published['checked_at'] -= 30
+    store.set(probe.RESULT_KEY, json.dumps(published))
+    statuses.append(429)
+    probe.refresh()
+    throttled = client.get('/readyz')
+    assert throttled.status_code == 200
+    assert throttled.get_json()['reasons'] == []
+    assert throttled.get_json()['degraded'] == ['upstream_throttled']
+    assert throttled.get_json()['checks']['upstream']['status'] == 429
+
+def test_readyz_load_shedding_on_streams_in_flight(client, monkeypatch):
+    """Test: oltre la soglia di stream aperti nel worker /readyz fallisce"""
+    probe = app_module.HealthProbe(interval=0, autostart=False)
+    probe.refresh()
+    monkeypatch.setattr(app_module, 'health_probe', probe)
+    registry = app_module.MetricsRegistry(app_module.MemorySharedStore(), flush_interval=0)
+    monkeypatch.setattr(app_module, 'metrics', registry)
+    monkeypatch.setattr(app_module, 'READY_MAX_STREAMS_IN_FLIGHT', 2)
+
+    registry.gauge_add('streams_in_flight', 2)
+    assert client.get('/readyz').status_code == 200
+    registry.gauge_add('streams_in_flight', 1)
+    response = client.get('/readyz')
+    assert response.status_code == 503
+    assert response.get_json()['reasons'] == ['load_shedding']
+    assert response.get_json()['streams_in_flight'] == 3
+
+def test_admission_codel_detects_standing_queue():
+    """Test: sovraccarico solo se anche l'attesa minima di un intervallo supera il target"""
+    now = [0.0]
+    controller = app_module.AdmissionController(target=0.05, interval=1.0, slo=5.0, overload_timeout=0.1,
+                                                clock=lambda: now[0])
+    # Burst: attese lunghe ma una breve nello stesso intervallo -> nessun sovraccarico
+    for sojourn in (0.5, 0.01, 0.8):
+        controller.observe(sojourn, app_module.PRIORITY_INTERACTIVE)
+    now[0] = 1.0
+    assert controller.shedding() is False
+    assert controller.queue_timeout(app_module.PRIORITY_INTERACTIVE) == 5.0
+
+    # Coda stabile: la minima resta sopra il target per tutto l'intervallo
+    for sojourn in (0.3, 0.2, 0.4):
+        controller.observe(sojourn, app_module.PRIORITY_INTERACTIVE)
+    now[0] = 2.0
+    assert controller.shedding() is True
+    assert controller.queue_timeout(app_module.PRIORITY_INTERACTIVE) == 0.1
+    assert controller.queue_timeout(app_module.PRIORITY_BULK) == 0.1
+
+    # La chat entra ancora, il bulk no
+    controller.admit(app_module.PRIORITY_INTERACTIVE)
+    with pytest.raises(app_module.AdmissionRejectedError) as rejected:
+        controller.admit(app_module.PRIORITY_BULK)
+    assert rejected.value.reason == 'overload'
+    controller.release(app_module.PRIORITY_INTERACTIVE)
+
+    # Un intervallo senza code riporta al carico normale
+    controller.observe(0.001, app_module.PRIORITY_INTERACTIVE)
+    now[0] = 3.0
+    assert controller.shedding() is False
+
+def test_admission_fast_503_and_chat_priority(client, monkeypatch, fake_generate):
+    """Test: oltre il tetto di richieste in corso 503 immediato con Retry-After; gli export cedono prima della chat"""
+    registry = app_module.MetricsRegistry(app_module.MemorySharedStore(), flush_interval=0)
+    monkeypatch.setattr(app_module, 'metrics', registry)
+    controller = app_module.AdmissionController(max_in_flight=4, bulk_share=0.25)
+    monkeypatch.setattr(app_module, 'admission', controller)
+
+    # Un export già in corso esaurisce la quota bulk (1 su 4) ma non blocca la chat
+    controller.admit(app_module.PRIORITY_BULK)
+    export = client.post('/api/documents/fileSearchStores/s/documents/d/chunks', json={'query': '*'})
+    assert export.status_code == 503
+    assert export.headers['Retry-After'] == '1'
+    assert export.get_json()['reason'] == 'in_flight'
+    with client.post('/api/chat/generate', json=GENERATE_BODY) as chat:
+        assert chat.status_code == 200
+    assert controller.stats()['in_flight']['interactive'] == 0
+
+    # Worker pieno: anche la chat riceve un 503 senza toccare Gemini
+    for _ in range(3):
+        controller.admit(app_module.PRIORITY_INTERACTIVE)
+    calls_before = len(fake_generate)
+    started = time.perf_counter()
+    rejected = client.post('/api/chat/generate-stream', json=GENERATE_BODY)
+    assert rejected.status_code == 503
+    assert time.perf_counter() - started < 0.5
+    assert len(fake_generate) == calls_before
+
+    counters = registry.snapshot()['counters']
+    assert counters['admission_decisions_total{decision="in_flight",priority="bulk"}'] == 1
+    assert counters['admission_decisions_total{decision="in_flight",priority="interactive"}'] == 1
+    assert counters['admission_decisions_total{decision="admitted",priority="interactive"}'] == 4
+
+def test_import_leaves_sdks_lazy_and_client_per_process(monkeypatch):
+    """Test: importare app.py non carica google-genai/openai; il client genai è uno per processo"""
+    import subprocess
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    loaded = subprocess.run(
+        [sys.executable, '-c', "import sys, app; print('google.genai' in sys.modules, 'openai' in sys.modules)"],
+        cwd=backend_dir, capture_output=True, text=True, check=True).stdout.split()
+    assert loaded == ['False', 'False']
+
+    monkeypatch.setattr(app_module, 'sdk_clients', {})
+    monkeypatch.setattr(app_module, 'GENERATION_API_KEY', 'test-key')
+    client = app_module.get_genai_client()
+    assert app_module.get_genai_client() is client
+    # Dopo un fork (pid diverso) il figlio crea il proprio client invece di riusare il pool httpx del padre
+    monkeypatch.setattr(app_module.os, 'getpid', lambda: -1)
+    assert app_module.get_genai_client() is not client
+
+class FakeJsonResponse(FakeGeminiResponse):
+    """Risposta finta con corpo JSON arbitrario (documenti, :query)"""
+    def __init__(self, body, status_code=200):
+        super().__init__(status_code=status_code)
+        self.body = body
+
+    def json(self):
+        return self.body
+
+def test_compression_and_etag_revalidation(client, monkeypatch):
+    """Test: gzip oltre la soglia secondo Accept-Encoding, SSE compresso per frame, ETag -> 304 sulle GET"""
+    import gzip
+    import zlib
+    monkeypatch.setattr(app_module, 'RESPONSE_ENCODERS', {'gzip': app_module.GzipEncoder})
+    chunks = [{'chunk': {'data': {'stringValue': f'Chunk {i}: il budget del progetto è di 100.000 euro. ' * 5}},
+               'chunkRelevanceScore': 0.8} for i in range(40)]
+    upstream_calls = []
+
+    def fake_upstream(operation, method, url, *args, **kwargs):
+        upstream_calls.append(url)
+        if url.endswith(':query'):
+            return FakeJsonResponse({'relevantChunks': chunks})
+        return FakeJsonResponse({'name': 'fileSearchStores/s/documents/d', 'displayName': 'Budget.pdf'})
+    monkeypatch.setattr(app_module, 'upstream_request', fake_upstream)
+
+    url = '/api/documents/fileSearchStores/s/documents/d/chunks?query=budget&resultsCount=40'
+    plain = client.get(url)
+    assert plain.status_code == 200 and 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.headers['Vary']
+    compressed = client.get(url, headers={'Accept-Encoding': 'br;q=0, gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert len(compressed.data) < len(plain.data) / 5
+    assert gzip.decompress(compressed.data) == plain.data
+    # Stesso ETag (debole) per le due codifiche; If-None-Match -> 304 senza corpo
+    assert compressed.headers['ETag'] == plain.headers['ETag'] and plain.headers['ETag'].startswith('W/')
+    revalidated = client.get(url, headers={'If-None-Match': plain.headers['ETag'], 'Accept-Encoding': 'gzip'})
+    assert revalidated.status_code == 304 and revalidated.data == b''
+    # Il POST resta compatibile (stesso corpo) ma non diventa mai 304
+    posted = client.post('/api/documents/fileSearchStores/s/documents/d/chunks',
+                         json={'query': 'budget', 'resultsCount': 40}, headers={'If-None-Match': plain.headers['ETag']})
+    assert posted.status_code == 200 and posted.data == plain.data
+
+    config = client.get('/api/config')
+    assert 'Content-Encoding' not in config.headers  # sotto la soglia
+    assert client.get('/api/config', headers={'If-None-Match': config.headers['ETag']}).status_code == 304
+
+    # Stream: ogni frame viene compresso e svuotato subito, il client decodifica frame per frame
+    def frames():
+        for i in range(3):
+            yield app_module.sse_frame({'text': f'token {i} '})
+    stream = app_module.compress_stream(frames(), app_module.GzipEncoder())
+    decoder = zlib.decompressobj(31)
+    received = [decoder.decompress(next(stream)).decode() for _ in range(3)]
+    assert received == [app_module.sse_frame({'text': f'token {i} '}) for i in range(3)]
+
+def test_operation_watcher_coalesces_polls_and_pushes_events(client, monkeypatch):
+    """Test: un solo poll upstream per operazione con backoff, stato dallo store, eventi SSE e cache invalidate"""
+    clock = [1000.0]
+    store = app_module.MemorySharedStore()
+    bus = app_module.EventBus(store)
+    watcher = app_module.OperationWatcher(store, bus, initial_interval=1, max_interval=4, backoff=2,
+                                          autostart=False, clock=lambda: clock[0])
+    monkeypatch.setattr(app_module, 'event_bus', bus)
+    monkeypatch.setattr(app_module, 'operation_watcher', watcher)
+    operation = 'fileSearchStores/s/upload/operations/op1'
+    document = 'fileSearchStores/s/documents/d1'
+    polls, done = [], [False]
+
+    def fake_upstream(name, method, url, *args, **kwargs):
+        polls.append(url)
+        body = {'name': operation, 'done': done[0]}
+        if done[0]:
+            body['response'] = {'documentName': document}
+        return FakeJsonResponse(body)
+    monkeypatch.setattr(app_module, 'upstream_request', fake_upstream)
+
+    # Primo GET: una chiamata a Gemini, poi l'operazione passa al watcher; i client successivi leggono lo store
+    assert client.get(f'/api/operations/{operation}').get_json()['done'] is False
+    assert watcher.watching(operation)
+    for _ in range(10):
+        assert client.get(f'/api/operations/{operation}').get_json()['done'] is False
+    assert len(polls) == 1
+
+    # Backoff adattivo: nessun poll prima della scadenza, poi intervalli 1 -> 2 -> 4 (massimo)
+    watcher.tick()
+    assert len(polls) == 1
+    intervals = []
+    for _ in range(3):
+        clock[0] = json.loads(store.get(watcher.WATCH_KEY))[operation]['next_poll']
+        watcher.tick()
+        intervals.append(json.loads(store.get(watcher.WATCH_KEY))[operation]['interval'])
+    assert intervals == [2, 4, 4] and len(polls) == 4
+
+    app_module.sync_document_caches()
+    app_module.documents_cache.set('20:', {'documents': []})
+    app_module.query_cache.set('q', {'relevant_chunks': []})
+    cursor = bus.last_id()
+    done[0] = True
+    clock[0] = json.loads(store.get(watcher.WATCH_KEY))[operation]['next_poll']
+    watcher.tick()
+    assert not watcher.watching(operation)
+    assert client.get(f'/api/operations/{operation}').get_json()['document'] == {'documentName': document}
+    assert len(polls) == 5
+
+    # Fine upload: evento operation + document_added; le cache di ogni worker vedono la nuova generation
+    events, _, gap = bus.read_since(cursor)
+    assert [e['event'] for e in events] == ['operation', 'document_added'] and not gap
+    assert events[1]['data']['name'] == document
+    app_module.sync_document_caches()
+    assert app_module.documents_cache.get('20:') is None and app_module.query_cache.get('q') is None
+
+    # Client SSE che si riconnette con Last-Event-ID: riceve gli eventi persi con il loro id
+    monkeypatch.setattr(app_module, 'EVENTS_STREAM_MAX_SECONDS', 0.05)
+    monkeypatch.setattr(app_module, 'EVENTS_POLL_INTERVAL', 0.01)
+    with client.get('/api/events', headers={'Last-Event-ID': str(cursor)}) as response:
+        body = response.get_data(as_text=True)
+    assert f'id: {cursor + 1}\nevent: operation\n' in body
+    assert f'id: {cursor + 2}\nevent: document_added\n' in body
+    # Cursore oltre l'ultimo evento (store azzerato): il client deve ricaricare tutto
+    with client.get('/api/events', headers={'Last-Event-ID': '999'}) as response:
+        assert 'event: resync' in response.get_data(as_text=True)
+
+    # Registrazioni concorrenti dello stesso stato finale: un solo document_added
+    cursor = bus.last_id()
+    other = 'fileSearchStores/s/upload/operations/op2'
+    barrier = threading.Barrier(8)
+
+    def record_done():
+        barrier.wait()
+        watcher.record(other, {'name': other, 'done': True, 'response': {'documentName': document}})
+    threads = [threading.Thread(target=record_done) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    events, _, _ = bus.read_since(cursor)
+    assert [e['event'] for e in events] == ['operation', 'document_added']
+
+def test_event_hub_fans_out_and_caps_subscribers(client, monkeypatch):
+    """Test: un solo lettore per worker inoltra gli eventi ai subscriber; oltre il limite 503 con Retry-After"""
+    hub = app_module.EventHub(max_subscribers=2, poll_interval=0.01)
+    monkeypatch.setattr(app_module, 'event_hub', hub)
+    time.sleep(0.05)  # lettori dei test precedenti senza subscriber: terminano da soli
+    inboxes = [hub.subscribe(-1)[0] for _ in range(2)]
+    assert [t.name for t in threading.enumerate()].count('event-hub') == 1
+    app_module.event_bus.document_changed('document_deleted', {'name': 'fileSearchStores/s/documents/d1'})
+    for inbox in inboxes:
+        assert 'event: document_deleted' in inbox.get(timeout=2)
+
+    rejected = client.get('/api/events')
+    assert rejected.status_code == 503 and rejected.headers['Retry-After'] == str(app_module.EVENTS_RETRY_AFTER)
+    hub.unsubscribe(inboxes.pop())
+    # Il posto si libera alla chiusura della risposta, anche se lo stream non è mai stato letto
+    client.get('/api/events', buffered=False).close()
+    monkeypatch.setattr(app_module, 'EVENTS_STREAM_MAX_SECONDS', 0.05)
+    with client.get('/api/events', headers={'Last-Event-ID': '0'}) as response:
+        assert 'event: document_deleted' in response.get_data(as_text=True)
+    hub.unsubscribe(inboxes.pop())
+    time.sleep(0.05)
+    assert not hub.subscribers and hub.reader_pid is None
+
+def test_federated_query_merges_stores_with_deadline(client, monkeypatch):
+    """Query su più store: fan-out parallelo, merge per score normalizzato, store lento escluso e risultato parziale"""
+    stores = ['fileSearchStores/a', 'fileSearchStores/b', 'fileSearchStores/slow']
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORES', stores)
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORE_NAME', stores[0])
+    monkeypatch.setattr(app_module, 'FEDERATED_STORE_TIMEOUT', 0.2)
+    release = threading.Event()
+    scores = {'fileSearchStores/a': [0.9, 0.4], 'fileSearchStores/b': [0.7, 0.95, 0.1]}
+
+    def fake_retrieve(store, query_text, document_name=None, metadata_filter=None):
+        assert app_module.request_trace.get() is None
+        if store.endswith('slow'):
+            release.wait(5)
+        return {'answer': f'risposta {store}', 'chunks': [
+            {'chunkText': f'{store}-{i}', 'chunkRelevanceScore': score, 'sourceDocument': f'{store}/documents/d', 'sourceStore': store}
+            for i, score in enumerate(scores.get(store, [1.0]))]}
+    monkeypatch.setattr(app_module, 'retrieve_from_store', fake_retrieve)
+
+    started = time.perf_counter()
+    data = client.post('/api/chat/query', json={'query': 'budget', 'resultsCount': 3}).get_json()
+    release.set()
+    assert time.perf_counter() - started < 2
+    assert [c['chunkText'] for c in data['relevant_chunks']] == ['fileSearchStores/b-1', 'fileSearchStores/a-0', 'fileSearchStores/b-0']
+    assert data['answer'] == 'risposta fileSearchStores/b' and data['partial'] is True
+    assert {s['store']: s['status'] for s in data['stores']} == {'fileSearchStores/a': 'ok', 'fileSearchStores/b': 'ok', 'fileSearchStores/slow': 'timeout'}
+    assert all(s['latency_ms'] >= 0 for s in data['stores'])
+    assert app_module.query_cache.get(json.dumps(['budget', None, 3, stores], ensure_ascii=False)) is None
+
+    # Selezione per richiesta (anche solo per id) e normalizzazione sul migliore di ciascuno store
+    monkeypatch.setattr(app_module, 'FEDERATED_SCORE_NORMALIZATION', 'max')
+    data = client.post('/api/chat/query', json={'query': 'budget', 'stores': ['a', 'fileSearchStores/b']}).get_json()
+    assert 'partial' not in data and [s['store'] for s in data['stores']] == stores[:2]
+    assert [c['normalizedScore'] for c in data['relevant_chunks'][:2]] == [1.0, 1.0]
+    assert client.post('/api/chat/query', json={'query': 'budget', 'stores': ['ignoto']}).status_code == 400
+    assert client.get('/api/documents?store=ignoto').status_code == 400
+
+def test_multi_document_query_fans_out_and_merges(client, monkeypatch):
+    """documentNames: un :query per documento con limite di concorrenza, merge top-k senza duplicati"""
+    store = 'fileSearchStores/s'
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORES', [store])
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORE_NAME', store)
+    monkeypatch.setattr(app_module, 'MULTI_DOCUMENT_CONCURRENCY', 2)
+    monkeypatch.setattr(app_module, 'MULTI_DOCUMENT_TIMEOUT', 0.5)
+    documents = [f'{store}/documents/d{i}' for i in range(4)]
+    active, peak, lock = [0], [0], threading.Lock()
+
+    def fake_upstream(operation, method, url, *args, **kwargs):
+        document = url.rsplit('/', 1)[-1].split(':')[0]
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05 if document != 'd3' else 2)
+        with lock:
+            active[0] -= 1
+        score = int(document[1:]) / 10
+        return FakeJsonResponse({'relevantChunks': [
+            {'chunk': {'name': f'{url[:-6]}/chunks/c0', 'data': {'stringValue': f'testo {document}'}}, 'chunkRelevanceScore': 0.5 + score},
+            # Stesso testo in ogni documento (es. intestazione ripetuta): resta una volta sola
+            {'chunk': {'data': {'stringValue': 'Intestazione  comune'}}, 'chunkRelevanceScore': 0.25 + score},
+        ]})
+    monkeypatch.setattr(app_module, 'upstream_request', fake_upstream)
+
+    data = client.post('/api/chat/query', json={'query': 'budget', 'documentNames': documents, 'resultsCount': 4}).get_json()
+    assert peak[0] == 2
+    assert [c['chunkText'] for c in data['relevant_chunks']] == ['testo d2', 'testo d1', 'testo d0', 'Intestazione  comune']
+    assert data['relevant_chunks'][3]['sourceDocument'] == documents[2]
+    assert data['documents_searched'] == '4' and data['partial'] is True
+    assert {d['document']: d['status'] for d in data['documents']}[documents[3]] == 'timeout'
+
+    assert client.post('/api/chat/query', json={'query': 'budget', 'documentNames': ['fileSearchStores/altro/documents/x']}).status_code == 400
+    assert client.post('/api/chat/query', json={'query': 'budget', 'documentNames': 'd1'}).status_code == 400
+
+def test_metadata_filters_and_facet_index(client, monkeypatch):
+    """filters: compilati per il File Search, risolti dall'indice delle faccette; conteggi nella lista documenti"""
+    store = 'fileSearchStores/s'
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORES', [store])
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORE_NAME', store)
+    metadata = [('hr', '2024'), ('legale', '2024'), ('hr', '2023'), ('tecnico', '2025'), ('hr', '2025')]
+    documents = [{'name': f'{store}/documents/d{i}', 'customMetadata': [
+        {'key': 'reparto', 'stringValue': reparto}, {'key': 'anno', 'stringValue': anno}, {'key': 'pagine', 'numericValue': 10 * i}]}
+        for i, (reparto, anno) in enumerate(metadata)]
+    list_calls = []
+
+    def fake_upstream(operation, method, url, *args, params=None, **kwargs):
+        list_calls.append(params)
+        offset = int(params.get('pageToken') or 0)
+        body = {'documents': documents[offset:offset + 3]}
+        if offset + 3 < len(documents):
+            body['nextPageToken'] = str(offset + 3)
+        return FakeJsonResponse(body)
+    monkeypatch.setattr(app_module, 'upstream_request', fake_upstream)
+    retrievals = []
+
+    def fake_retrieve(store, query_text, document_name=None, metadata_filter=None):
+        retrievals.append(metadata_filter)
+        return {'answer': 'ok', 'chunks': [{'chunkText': 't', 'chunkRelevanceScore': 0.9, 'sourceStore': store}]}
+    monkeypatch.setattr(app_module, 'retrieve_from_store', fake_retrieve)
+
+    filters = app_module.parse_metadata_filters({'reparto': ['hr', 'legale'], 'pagine': {'gte': 20}})
+    assert app_module.compile_metadata_filter(filters) == '(reparto = "hr" OR reparto = "legale") AND pagine >= 20'
+    index = app_module.FacetIndex(documents)
+    assert [d['name'] for d in index.select(index.match(filters))] == [f'{store}/documents/d2', f'{store}/documents/d4']
+    assert index.counts()['reparto'] == {'hr': 3, 'legale': 1, 'tecnico': 1}
+    for invalid in ({'reparto': {'eq': 'hr'}}, {'anno': {'gte': '2024'}}, {'a b': 'x'}, ['reparto']):
+        with pytest.raises(app_module.MetadataFilterError):
+            app_module.parse_metadata_filters(invalid)
+
+    # Filtro spinto nel File Search; il mirror (2 pagine) viene letto una volta sola
+    data = client.post('/api/chat/query', json={'query': 'ferie', 'filters': {'reparto': 'hr'}}).get_json()
+    assert retrievals == ['reparto = "hr"'] and data['documents_matched'] == 3 and data['filter'] == 'reparto = "hr"'
+    assert len(list_calls) == 2
+    # Nessun documento corrispondente: risposta vuota senza chiamare Gemini
+    data = client.post('/api/chat/query', json={'query': 'ferie', 'filters': {'reparto': 'marketing'}}).get_json()
+    assert data['relevant_chunks'] == [] and data['documents_matched'] == 0 and len(retrievals) == 1
+    assert client.post('/api/chat/query', json={'query': 'ferie', 'filters': {'reparto': {'gte': 'x'}}}).status_code == 400
+
+    # Faccette nella lista documenti; con filters la lista viene dal mirror
+    data = client.get('/api/documents?facets=true&filters=' + json.dumps({'anno': ['2024', '2025']})).get_json()
+    assert [d['name'] for d in data['documents']] == [documents[i]['name'] for i in (0, 1, 3, 4)]
+    assert data['facets']['reparto'] == {'hr': 2, 'legale': 1, 'tecnico': 1} and data['totalCount'] == 4
+    assert len(list_calls) == 2
+    for token in ('abc', '-3'):
+        assert client.get('/api/documents?pageToken=' + token + '&filters=' + json.dumps({'anno': '2024'})).status_code == 400
+    # Un documento aggiunto o eliminato (evento) ricostruisce il mirror in background:
+    # intanto le richieste usano subito l'indice precedente
+    gate = threading.Event()
+    monkeypatch.setattr(app_module.document_mirror, 'fetch', lambda store: gate.wait(5) and documents[1:])
+    app_module.event_bus.document_changed('document_deleted', {'name': documents[0]['name']})
+    started = time.monotonic()
+    data = client.get('/api/documents?filters=' + json.dumps({'reparto': 'hr'})).get_json()
+    assert data['totalCount'] == 3 and time.monotonic() - started < 1
+    gate.set()
+    for _ in range(100):
+        if not app_module.document_mirror.refreshing:
+            break
+        time.sleep(0.01)
+    assert client.get('/api/documents?filters=' + json.dumps({'reparto': 'hr'})).get_json()['totalCount'] == 2
+
+
+def test_rerank_drops_duplicates_and_cuts_at_knee(client, monkeypatch, fake_generate):
+    """Reranking locale: copie scartate, coda sotto il ginocchio esclusa, ripiego sulla soglia senza numpy"""
+    pytest.importorskip('numpy')
+    monkeypatch.setattr(app_module, 'term_vectors', app_module.TermVectorCache())
+    budget = 'Il budget previsto per la manutenzione del sistema è di 120000 euro in tre anni'
+    chunks = [{'chunkText': budget, 'chunkRelevanceScore': 0.9},
+              {'chunkText': budget, 'chunkRelevanceScore': 0.88},
+              {'chunkText': 'La manutenzione del sistema prevede due interventi annuali', 'chunkRelevanceScore': 0.8}]
+    chunks += [{'chunkText': f'Allegato {i}: elenco fornitori abilitati numero {i}', 'chunkRelevanceScore': 0.35}
+               for i in range(12)]
+    selected, candidates, duplicates = app_module.rerank_chunks('budget manutenzione sistema', chunks, 10)
+    assert [c['chunkRelevanceScore'] for c in selected] == [0.9, 0.8] and duplicates == 1
+    assert len(candidates) == 3
+
+    _, _, report = app_module.select_chunks_for_generation(chunks, 'budget manutenzione sistema')
+    assert report['selection'] == 'rerank' and report['chunks_used'] == 2
+    assert report['context_tokens_saved'] == report['context_tokens_threshold'] - report['context_tokens'] > 0
+
+    # I chunk di /api/chat/query (chunkText) arrivano nel prompt
+    prompts = []
+
+    def fake_post(url, **kwargs):
+        prompts.append(json.dumps(kwargs.get('json')))
+        return FakeGeminiResponse()
+    monkeypatch.setattr(app_module.http_session, 'post', fake_post)
+    data = client.post('/api/chat/generate', json={'query': 'Qual è il budget di manutenzione?',
+                                                   'relevant_chunks': chunks}).get_json()
+    assert data['context_selection']['selection'] == 'rerank' and '120000 euro' in prompts[0]
+    assert 'Allegato' not in prompts[0]
+
+    monkeypatch.setattr(app_module, 'load_numpy', lambda: None)
+    chunks_to_use, _, report = app_module.select_chunks_for_generation(chunks, 'budget')
+    assert report['selection'] == 'threshold' and len(chunks_to_use) == len(chunks)
+
+
+def test_chunk_references_resolved_across_workers(client, monkeypatch, fake_generate):
+    """/api/chat/query con includeText false: id e anteprime; la generazione risolve gli id, 409 se evicted"""
+    store = 'fileSearchStores/s'
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORES', [store])
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORE_NAME', store)
+    texts = ['Il budget del progetto è di 120000 euro ' * 20, 'La consegna è prevista in tre fasi']
+
+    def fake_retrieve(store, query_text, document_name=None, metadata_filter=None):
+        return {'answer': 'ok', 'chunks': [{'chunkText': t, 'chunkRelevanceScore': 0.9, 'sourceStore': store}
+                                           for t in texts]}
+    monkeypatch.setattr(app_module, 'retrieve_from_store', fake_retrieve)
+    prompts = []
+
+    def fake_post(url, **kwargs):
+        prompts.append(json.dumps(kwargs.get('json')))
+        return FakeGeminiResponse()
+    monkeypatch.setattr(app_module.http_session, 'post', fake_post)
+
+    chunks = client.post('/api/chat/query', json={'query': 'budget', 'includeText': False}).get_json()['relevant_chunks']
+    assert [c['chunkId'] for c in chunks] == [app_module.ChunkStore.make_id(t) for t in texts]
+    assert 'chunkText' not in chunks[0] and len(chunks[0]['chunkPreview']) == app_module.CHUNK_PREVIEW_CHARS
+    # Dalla cache del retrieval il testo completo resta disponibile
+    cached = client.post('/api/chat/query', json={'query': 'budget'}).get_json()
+    assert cached['cached'] and cached['relevant_chunks'][1]['chunkText'] == texts[1]
+
+    # Un altro worker (LRU vuota) risolve gli id dallo stato condiviso
+    monkeypatch.setattr(app_module, 'chunk_store', app_module.ChunkStore(app_module.chunk_store.store))
+    data = client.post('/api/chat/generate', json={'query': 'Qual è il budget?', 'relevant_chunks': chunks}).get_json()
+    assert data['success'] and '120000 euro' in prompts[-1] and 'tre fasi' in prompts[-1]
+    assert all('chunkText' not in c for c in data['chunks_filtered'])
+
+    # Id scaduti ovunque: 409 con gli id mancanti; con il testo completo la generazione riparte
+    monkeypatch.setattr(app_module, 'chunk_store', app_module.ChunkStore(app_module.MemorySharedStore()))
+    response = client.post('/api/chat/generate-stream', json={'query': 'Qual è il budget?', 'relevant_chunks': chunks})
+    assert response.status_code == 409 and response.get_json()['missing_chunk_ids'] == [c['chunkId'] for c in chunks]
+    full = [dict(c, chunkText=t) for c, t in zip(chunks, texts)]
+    assert client.post('/api/chat/generate', json={'query': 'Qual è il budget?', 'relevant_chunks': full}).status_code == 200
+    assert app_module.chunk_store.get_many([chunks[1]['chunkId']]) == {chunks[1]['chunkId']: texts[1]}
+    bad = client.post('/api/chat/generate', json={'query': 'Qual è il budget?', 'relevant_chunks': [{'chunkId': '../x'}]})
+    assert bad.status_code == 400
+
+def test_document_download_with_range_and_etag(client, monkeypatch):
+    """Test: originale archiviato all'upload, scaricabile a fine operazione con Range/If-Range/ETag, rimosso con il documento"""
+    import io
+    import werkzeug.wsgi
+    operation = 'fileSearchStores/s/upload/operations/op1'
+    document = 'fileSearchStores/s/documents/d1'
+    content = b'0123456789' * 100
+    monkeypatch.setattr(app_module, 'upstream_request', lambda name, method, url, *args, **kwargs: FakeJsonResponse({'name': operation}))
+    response = client.post('/api/documents/upload', data={'file': (io.BytesIO(content), 'Contratto finale.txt')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert client.get(f'/api/documents/{document}/download').status_code == 404
+
+    app_module.operation_watcher.record(operation, {'name': operation, 'done': True, 'response': {'documentName': document}})
+    full = client.get(f'/api/documents/{document}/download')
+    assert full.status_code == 200 and full.data == content
+    assert 'filename="Contratto finale.txt"' in full.headers['Content-Disposition'] and full.headers['Accept-Ranges'] == 'bytes'
+    etag = full.headers['ETag']
+    assert not etag.startswith('W/') and 'private' in full.headers['Cache-Control']
+
+    # Download ripreso: solo i byte mancanti finché il file è lo stesso, altrimenti tutto da capo
+    partial = client.get(f'/api/documents/{document}/download', headers={'Range': 'bytes=995-', 'If-Range': etag})
+    assert partial.status_code == 206 and partial.data == content[995:]
+    assert partial.headers['Content-Range'] == f'bytes 995-999/{len(content)}'
+    changed = client.get(f'/api/documents/{document}/download', headers={'Range': 'bytes=995-', 'If-Range': '"altro"'})
+    assert changed.status_code == 200 and len(changed.data) == len(content)
+    assert client.get(f'/api/documents/{document}/download', headers={'If-None-Match': etag}).status_code == 304
+
+    # Con gunicorn l'intervallo torna al file_wrapper del server, posizionato all'inizio del Range
+    served = client.get(f'/api/documents/{document}/download', headers={'Range': 'bytes=10-19'},
+                        environ_overrides={'SERVER_SOFTWARE': 'gunicorn/23', 'wsgi.file_wrapper': werkzeug.wsgi.FileWrapper})
+    assert served.status_code == 206 and served.headers['Content-Length'] == '10' and served.data.startswith(content[10:20])
+
+    client.delete(f'/api/documents/{document}')
+    assert client.get(f'/api/documents/{document}/download').get_json()['code'] == 'original_not_available'
+
+def test_bulk_delete_streams_progress_and_invalidates_once(client, monkeypatch):
+    """Test: eliminazione in blocco per nomi o filtro, avanzamento NDJSON, stop con breaker aperto, un solo evento"""
+    store = 'fileSearchStores/s'
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORES', [store])
+    monkeypatch.setattr(app_module, 'FILE_SEARCH_STORE_NAME', store)
+    monkeypatch.setattr(app_module, 'BULK_DELETE_CONCURRENCY', 1)
+    documents = [{'name': f'{store}/documents/d{i}', 'customMetadata': [{'key': 'reparto', 'stringValue': reparto}]}
+                 for i, reparto in enumerate(['hr', 'hr', 'legale', 'hr', 'hr', 'hr'])]
+    statuses = {'d0': 200, 'd1': 404, 'd3': 500}
+    deletes, threads = [], set()
+
+    def fake_upstream(operation, method, url, *args, params=None, **kwargs):
+        if method == 'GET':
+            return FakeJsonResponse({'documents': documents})
+        deletes.append(url.rsplit('/', 1)[-1])
+        threads.add(threading.current_thread().name.split('_')[0])
+        if url.endswith('d4'):
+            raise app_module.CircuitOpenError('delete', retry_after=30)
+        return FakeJsonResponse({}, status_code=statuses.get(url.rsplit('/', 1)[-1], 200))
+    monkeypatch.setattr(app_module, 'upstream_request', fake_upstream)
+
+    assert client.post('/api/documents/bulk-delete', json={'names': ['fileSearchStores/altro/documents/x']}).status_code == 400
+    assert client.post('/api/documents/bulk-delete', json={}).status_code == 400
+    for body in ([1, 2], 'names', 3):
+        response = client.post('/api/documents/bulk-delete', json=body)
+        assert response.status_code == 400 and response.get_json()['success'] is False
+    dry = client.post('/api/documents/bulk-delete', json={'filters': {'reparto': 'hr'}, 'dryRun': True}).get_json()
+    assert dry['total'] == 5 and not deletes
+
+    generation = app_module.event_bus.generation()
+    cursor = app_module.event_bus.last_id()
+    inbox, _ = app_module.event_hub.subscribe(-1)
+    response = client.post('/api/documents/bulk-delete', json={'filters': {'reparto': 'hr'}})
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines[0] == {'type': 'start', 'total': 5, 'concurrency': 1}
+    assert [(line['name'].rsplit('/', 1)[-1], line['status']) for line in lines[1:-1]] == [
+        ('d0', 'deleted'), ('d1', 'missing'), ('d3', 'failed'), ('d4', 'failed'), ('d5', 'skipped')]
+    assert lines[-2]['retry_after'] == 30 and deletes == ['d0', 'd1', 'd3', 'd4']
+    assert {k: lines[-1][k] for k in ('deleted', 'missing', 'failed', 'skipped')} == {'deleted': 1, 'missing': 1, 'failed': 2, 'skipped': 1}
+
+    # Cache invalidate una volta sola per l'intera eliminazione
+    events, _, _ = app_module.event_bus.read_since(cursor)
+    assert [e['event'] for e in events] == ['document_deleted'] and events[0]['data']['names'] == [f'{store}/documents/d0']
+    assert app_module.event_bus.generation() == generation + 1
+    # Eliminazioni nel pool di manutenzione, non in quello del fan-out interattivo
+    assert threads == {'maintenance'}
+
+    # Gli ascoltatori di /api/events ricevono un solo document_deleted con l'elenco dei nomi
+    frame = inbox.get(timeout=2)
+    assert frame.count('event: document_deleted') == 1
+    data = json.loads(frame.split('data: ', 1)[1])
+    assert data['name'] is None and data['names'] == [f'{store}/documents/d0'] and data['count'] == 1
+    app_module.event_hub.unsubscribe(inbox)
+
+def test_download_rate_limit_separate_from_chat(client, monkeypatch):
+    """Test: le richieste Range dei download hanno un limite proprio e non esauriscono quello della chat"""
+    store = app_module.MemorySharedStore()
+    monkeypatch.setattr(app_module, 'rate_limiter', app_module.RateLimiter(max_requests=2, time_window=60, store=store))
+    monkeypatch.setattr(app_module, 'download_rate_limiter',
+                        app_module.RateLimiter(max_requests=5, time_window=60, store=store, prefix='rl:download'))
+    document = 'fileSearchStores/s/documents/d1'
+    source = os.path.join(app_module.document_storage.root, 'upload.pdf')
+    os.makedirs(app_module.document_storage.root, exist_ok=True)
+    with open(source, 'wb') as f:
+        f.write(b'%PDF' + b'0' * 4096)
+    app_module.document_storage.stage('op1', source, 'manuale.pdf', 'application/pdf', 'Manuale')
+    app_module.document_storage.attach('op1', document)
+
+    statuses = [client.get(f'/api/documents/{document}/download', headers={'Range': f'bytes={i * 512}-{i * 512 + 511}'}).status_code
+                for i in range(6)]
+    assert statuses == [206] * 5 + [429]
+    chat = client.post('/api/chat/generate', json={'relevant_chunks': []})
+    assert chat.status_code == 400 and chat.headers['X-RateLimit-Remaining'] == '1'
@@ -3,12 +3,18 @@
 # Google File Search Application - Windows
 # ========================================
 
+# Codici di uscita: 0 = pronto, 1 = attivo ma non pronto (degradato), 2 = servizio DOWN
+# /healthz = liveness (il processo risponde), /readyz = readiness (Gemini, store, breaker, carico)
+
 param(
-    [string]$Url = "http://localhost:5000/api/config",
+    [string]$Url = "http://localhost:5000",
     [int]$TimeoutSec = 10,
     [switch]$AutoRestart
 )
 
+$LiveUrl = "$Url/healthz"
+$ReadyUrl = "$Url/readyz"
+
 Write-Host ""
 Write-Host "====================================" -ForegroundColor Cyan
 Write-Host " HEALTH CHECK" -ForegroundColor Cyan
@@ -19,30 +25,8 @@ $timestamp = Get-Date -Format "yyyy-MM-dd HH:mm:ss"
 Write-Host "[$timestamp] Verifica stato servizio..." -ForegroundColor Gray
 
 try {
-    # Test connessione HTTP
-    $response = Invoke-WebRequest -Uri $Url -TimeoutSec $TimeoutSec -UseBasicParsing -ErrorAction Stop
-    
-    if ($response.StatusCode -eq 200) {
-        Write-Host "✓ Servizio OK" -ForegroundColor Green
-        Write-Host "  Status Code: $($response.StatusCode)" -ForegroundColor Gray
-        Write-Host "  Response Time: $($response.Headers['Date'])" -ForegroundColor Gray
-        
-        # Parse JSON response se disponibile
-        try {
-            $config = $response.Content | ConvertFrom-Json
-            Write-Host "  Model: $($config.default_model)" -ForegroundColor Gray
-            Write-Host "  Results Count: $($config.results_count)" -ForegroundColor Gray
-        } catch {
-            # Ignore JSON parse errors
-        }
-        
-        exit 0
-    } else {
-        Write-Host "✗ Servizio DEGRADED" -ForegroundColor Yellow
-        Write-Host "  Status Code: $($response.StatusCode)" -ForegroundColor Gray
-        exit 1
-    }
-    
+    # Liveness: solo se il processo non risponde ha senso riavviarlo
+    $null = Invoke-WebRequest -Uri $LiveUrl -TimeoutSec $TimeoutSec -UseBasicParsing -ErrorAction Stop
 } catch {
     Write-Host "✗ Servizio DOWN" -ForegroundColor Red
     Write-Host "  Errore: $($_.Exception.Message)" -ForegroundColor Gray
@@ -68,7 +52,7 @@ try {
             Start-Sleep -Seconds 5
             
             # Re-test
-            $retest = Invoke-WebRequest -Uri $Url -TimeoutSec $TimeoutSec -UseBasicParsing -ErrorAction SilentlyContinue
+            $retest = Invoke-WebRequest -Uri $LiveUrl -TimeoutSec $TimeoutSec -UseBasicParsing -ErrorAction SilentlyContinue
             if ($retest.StatusCode -eq 200) {
                 Write-Host "✓ Servizio ripristinato con successo" -ForegroundColor Green
                 exit 0
@@ -82,3 +66,46 @@ try {
     
     exit 2
 }
+
+# Readiness: 503 con i motivi (upstream, store, load_shedding, ...) se il worker va tolto dalla rotazione
+$statusCode = 0
+$content = $null
+try {
+    $response = Invoke-WebRequest -Uri $ReadyUrl -TimeoutSec $TimeoutSec -UseBasicParsing -ErrorAction Stop
+    $statusCode = $response.StatusCode
+    $content = $response.Content
+} catch {
+    if ($_.Exception.Response) {
+        $statusCode = [int]$_.Exception.Response.StatusCode
+        try {
+            $reader = New-Object System.IO.StreamReader($_.Exception.Response.GetResponseStream())
+            $content = $reader.ReadToEnd()
+        } catch {
+            # Corpo non leggibile
+        }
+    }
+}
+
+if ($statusCode -eq 200) {
+    Write-Host "✓ Servizio OK" -ForegroundColor Green
+} else {
+    Write-Host "⚠ Servizio DEGRADED (readyz: $statusCode)" -ForegroundColor Yellow
+}
+
+# Parse JSON response se disponibile
+try {
+    $ready = $content | ConvertFrom-Json
+    Write-Host "  Motivi: $($ready.reasons -join ', ')" -ForegroundColor Gray
+    if ($ready.checks.upstream) {
+        Write-Host "  Gemini: ok=$($ready.checks.upstream.ok) $($ready.checks.upstream.latency_ms) ms" -ForegroundColor Gray
+    }
+    if ($ready.checks.store) {
+        Write-Host "  Store: $($ready.checks.store.backend) ok=$($ready.checks.store.ok)" -ForegroundColor Gray
+    }
+    Write-Host "  Stream in corso (worker): $($ready.streams_in_flight)" -ForegroundColor Gray
+} catch {
+    # Ignore JSON parse errors
+}
+
+if ($statusCode -eq 200) { exit 0 }
+exit 1
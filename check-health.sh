@@ -5,11 +5,16 @@
 # ========================================
 
 # Configurazione
-HEALTH_URL="${HEALTH_URL:-http://localhost:5000/api/config}"
+# /healthz = liveness (il processo risponde), /readyz = readiness (Gemini, store, breaker, carico)
+BASE_URL="${BASE_URL:-http://localhost:5000}"
+LIVE_URL="${LIVE_URL:-$BASE_URL/healthz}"
+READY_URL="${READY_URL:-$BASE_URL/readyz}"
 TIMEOUT="${TIMEOUT:-10}"
 AUTO_RESTART="${AUTO_RESTART:-false}"
 SERVICE_NAME="google-filesearch"
 
+# Codici di uscita: 0 = pronto, 1 = attivo ma non pronto (degradato), 2 = servizio DOWN
+
 echo ""
 echo "===================================="
 echo " HEALTH CHECK"
@@ -19,18 +24,8 @@ echo ""
 timestamp=$(date '+%Y-%m-%d %H:%M:%S')
 echo "[$timestamp] Verifica stato servizio..."
 
-# Test connessione HTTP
-if response=$(curl -sf --max-time "$TIMEOUT" "$HEALTH_URL" 2>&1); then
-    echo "✓ Servizio OK"
-    
-    # Parse JSON response se jq disponibile
-    if command -v jq &> /dev/null; then
-        echo "  Model: $(echo "$response" | jq -r '.default_model')"
-        echo "  Results Count: $(echo "$response" | jq -r '.results_count')"
-    fi
-    
-    exit 0
-else
+# Liveness: solo se il processo non risponde ha senso riavviarlo
+if ! response=$(curl -sf --max-time "$TIMEOUT" "$LIVE_URL" 2>&1); then
     echo "✗ Servizio DOWN"
     echo "  Errore: $response"
     
@@ -46,7 +41,7 @@ else
             sleep 5
             
             # Re-test
-            if curl -sf --max-time "$TIMEOUT" "$HEALTH_URL" > /dev/null 2>&1; then
+            if curl -sf --max-time "$TIMEOUT" "$LIVE_URL" > /dev/null 2>&1; then
                 echo "✓ Servizio ripristinato con successo"
                 exit 0
             else
@@ -59,5 +54,27 @@ else
         fi
     fi
     
-    exit 1
+    exit 2
+fi
+
+# Readiness: 503 con i motivi (upstream, store, load_shedding, ...) se il worker va tolto dalla rotazione
+ready_response=$(curl -s --max-time "$TIMEOUT" -w '\n%{http_code}' "$READY_URL" 2>&1)
+ready_status=$(echo "$ready_response" | tail -n 1)
+ready_body=$(echo "$ready_response" | sed '$d')
+
+if [ "$ready_status" = "200" ]; then
+    echo "✓ Servizio OK"
+else
+    echo "⚠ Servizio DEGRADED (readyz: $ready_status)"
 fi
+
+# Parse JSON response se jq disponibile
+if command -v jq &> /dev/null && [ -n "$ready_body" ]; then
+    echo "  Motivi: $(echo "$ready_body" | jq -r '.reasons | join(", ")')"
+    echo "  Gemini: $(echo "$ready_body" | jq -r '.checks.upstream | if . == null then "in attesa" else "ok=\(.ok) \(.latency_ms // "-") ms" end')"
+    echo "  Store: $(echo "$ready_body" | jq -r '.checks.store | if . == null then "in attesa" else "\(.backend) ok=\(.ok)" end')"
+    echo "  Stream in corso (worker): $(echo "$ready_body" | jq -r '.streams_in_flight')"
+fi
+
+[ "$ready_status" = "200" ] && exit 0
+exit 1
@@ -11,6 +11,7 @@ import Chip from '@mui/material/Chip';
 import Tooltip from '@mui/material/Tooltip';
 import DeleteIcon from '@mui/icons-material/Delete';
 import OpenInNewIcon from '@mui/icons-material/OpenInNew';
+import DownloadIcon from '@mui/icons-material/Download';
 import InfoIcon from '@mui/icons-material/Info';
 import Dialog from '@mui/material/Dialog';
 import DialogTitle from '@mui/material/DialogTitle';
@@ -19,6 +20,7 @@ import DialogActions from '@mui/material/DialogActions';
 import Button from '@mui/material/Button';
 import Typography from '@mui/material/Typography';
 import Box from '@mui/material/Box';
+import { apiService } from '../../services/api';
 import type { Document } from '../../types';
 
 interface DocumentsListProps {
@@ -152,6 +154,18 @@ export default function DocumentsList({ documents, onDelete, isDeleting }: Docum
                         </IconButton>
                       </Tooltip>
                     )}
+                    {/* Plain link: the browser streams the file and resumes interrupted downloads with Range */}
+                    <Tooltip title="Scarica originale">
+                      <IconButton
+                        size="small"
+                        color="primary"
+                        component="a"
+                        href={apiService.getDocumentDownloadUrl(doc.name)}
+                        download
+                      >
+                        <DownloadIcon fontSize="small" />
+                      </IconButton>
+                    </Tooltip>
                     <Tooltip title="Visualizza metadati">
                       <IconButton
                         size="small"
@@ -7,6 +7,7 @@ import LinearProgress from '@mui/material/LinearProgress';
 import Chip from '@mui/material/Chip';
 import Alert from '@mui/material/Alert';
 import { apiService } from '../../services/api';
+import { useServerEvents } from '../../hooks';
 
 interface Operation {
   operationName: string;
@@ -23,15 +24,19 @@ interface OperationsMonitorProps {
 // Componente separato per ogni operazione per rispettare le regole degli Hooks
 function OperationItem({ 
   operation, 
-  onComplete 
+  onComplete,
+  eventsConnected,
 }: { 
   operation: Operation; 
   onComplete: (operationName: string, success: boolean) => void;
+  eventsConnected: boolean;
 }) {
+  // One fetch at mount (the operation may finish before the event channel connects), then status
+  // arrives via /api/events; slow polling only while the channel is down
   const { data } = useQuery({
     queryKey: ['operation', operation.operationName],
     queryFn: () => apiService.getOperationStatus(operation.operationName),
-    refetchInterval: 3000, // Poll every 3 seconds
+    refetchInterval: eventsConnected ? false : 15000,
     enabled: Boolean(operation.operationName) && operation.status !== 'done' && operation.status !== 'error',
   });
 
@@ -64,6 +69,20 @@ function OperationItem({
 
 export default function OperationsMonitor({ operations, onOperationComplete }: OperationsMonitorProps) {
   const activeOperations = operations.filter(op => op.status !== 'done' && op.status !== 'error');
+  const activeNames = new Set(activeOperations.map(op => op.operationName));
+
+  const eventsConnected = useServerEvents({
+    onOperation: (event) => {
+      if (!activeNames.has(event.name)) {
+        return;
+      }
+      if (event.done || event.expired) {
+        onOperationComplete(event.name, !event.error && !event.expired);
+      } else if (event.error) {
+        onOperationComplete(event.name, false);
+      }
+    },
+  });
 
   if (activeOperations.length === 0) {
     return null;
@@ -80,6 +99,7 @@ export default function OperationsMonitor({ operations, onOperationComplete }: O
           key={operation.operationName}
           operation={operation}
           onComplete={onOperationComplete}
+          eventsConnected={eventsConnected}
         />
       ))}
 
@@ -2,3 +2,4 @@
 export * from './useDocumentsQueries';
 export * from './useChunksQueries';
 export * from './useChatQueries';
+export * from './useServerEvents';
@@ -11,13 +11,20 @@ export function useChatQueryChunks() {
     mutationFn: async ({
       query,
       results_count,
+      documentNames,
+      includeText = false,
     }: {
       query: string;
       results_count?: number;
+      documentNames?: string[];
+      // By default only chunk ids + previews: generation resolves the text on the server
+      includeText?: boolean;
     }) => {
       const response = await apiService.queryChatChunks({
         query,
         results_count,
+        documentNames: documentNames?.length ? documentNames : undefined,
+        includeText,
       });
       return response;
     },
@@ -94,7 +101,11 @@ export function useChatStream() {
           setCurrentStreamingMessage('');
           throw error;
         },
-        signal
+        signal,
+        // onReset: the server no longer holds the stream, a fresh generation starts over
+        () => {
+          setCurrentStreamingMessage('');
+        }
       );
     } catch (error) {
       setIsStreaming(false);
@@ -1,7 +1,7 @@
 import { useQuery, useMutation, useQueryClient } from '@tanstack/react-query';
 import { apiService } from '../services/api';
 import { useDocumentsStore } from '../stores';
-import type { UploadRequest, PaginationParams } from '../types';
+import type { UploadRequest, PaginationParams, BulkDeleteProgress } from '../types';
 
 // Query Keys
 export const documentKeys = {
@@ -113,13 +113,15 @@ export function useBatchDeleteDocuments() {
   const clearSelection = useDocumentsStore((state) => state.clearSelection);
 
   return useMutation({
-    mutationFn: async (documentNames: string[]) => {
-      // Delete all documents in parallel
-      const deletePromises = documentNames.map((name) =>
-        apiService.deleteDocument(name, true)
-      );
-      return Promise.all(deletePromises);
-    },
+    mutationFn: async ({
+      documentNames,
+      onProgress,
+    }: {
+      documentNames: string[];
+      onProgress?: (progress: BulkDeleteProgress) => void;
+    }) =>
+      // One request: bounded concurrency, retries and a single cache invalidation on the server
+      apiService.bulkDeleteDocuments({ names: documentNames }, onProgress),
     onSuccess: () => {
       // Clear selection
       clearSelection();
@@ -0,0 +1,54 @@
+import { useEffect, useRef, useState } from 'react';
+import { useQueryClient } from '@tanstack/react-query';
+import { apiService } from '../services/api';
+import { documentKeys } from './useDocumentsQueries';
+import { useDocumentsStore } from '../stores';
+import type { DocumentEvent, OperationEvent } from '../types';
+
+interface ServerEventsOptions {
+  onOperation?: (event: OperationEvent) => void;
+}
+
+// Documents named by an event: `name` for single changes, `names` (with name: null) for bulk deletes
+export const documentEventNames = (event: DocumentEvent): string[] =>
+  event.names ?? (event.name ? [event.name] : []);
+
+/**
+ * Hook subscribing to /api/events (operation status and document changes).
+ * Document events and resyncs invalidate the documents list; returns whether the channel is connected,
+ * so callers can fall back to polling while it is down.
+ */
+export function useServerEvents({ onOperation }: ServerEventsOptions = {}) {
+  const queryClient = useQueryClient();
+  const [connected, setConnected] = useState(false);
+  const onOperationRef = useRef(onOperation);
+
+  useEffect(() => {
+    onOperationRef.current = onOperation;
+  });
+
+  useEffect(() => {
+    const invalidateDocuments = () => queryClient.invalidateQueries({ queryKey: documentKeys.lists() });
+
+    return apiService.subscribeEvents(
+      {
+        operation: (event) => onOperationRef.current?.(event),
+        document_added: invalidateDocuments,
+        document_deleted: (event) => {
+          // Drop deleted documents from the local list and selection right away, then refetch
+          const { removeDocument } = useDocumentsStore.getState();
+          documentEventNames(event).forEach(removeDocument);
+          invalidateDocuments();
+        },
+        resync: () => {
+          // Events were missed: reload everything the events would have updated
+          invalidateDocuments();
+          queryClient.invalidateQueries({ queryKey: ['operation'] });
+        },
+      },
+      setConnected
+    );
+  }, [queryClient]);
+
+  return connected;
+}
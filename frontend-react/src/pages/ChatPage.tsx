@@ -17,7 +17,9 @@ import ChatInput from '../components/Chat/ChatInput';
 import ChatSettings from '../components/Chat/ChatSettings';
 import TypingIndicator from '../components/Chat/TypingIndicator';
 import { useChatQueryChunks, useChatGenerate, useChatStream, useDocuments } from '../hooks';
-import { useChatStore } from '../stores';
+import { useChatStore, useDocumentsStore } from '../stores';
+import { ChunksEvictedError } from '../services/api';
+import type { Chunk } from '../types';
 
 export default function ChatPage() {
   const [abortController, setAbortController] = useState<AbortController | null>(null);
@@ -39,6 +41,7 @@ export default function ChatPage() {
   const clearMessages = useChatStore((state) => state.clearMessages);
   const isStreaming = useChatStore((state) => state.isStreaming);
   const currentStreamingMessage = useChatStore((state) => state.currentStreamingMessage);
+  const selectedDocuments = useDocumentsStore((state) => state.selectedDocuments);
 
   // Use React Query hooks
   const { data: documentsData } = useDocuments();
@@ -72,11 +75,15 @@ export default function ChatPage() {
     });
 
     try {
-      // Phase 1: Query for relevant chunks
-      const queryResult = await queryChunksMutation.mutateAsync({
-        query: text,
-        results_count: settings.topK,
-      });
+      // Phase 1: Query for relevant chunks (ids + previews, the text stays on the server)
+      const retrieve = (includeText: boolean) =>
+        queryChunksMutation.mutateAsync({
+          query: text,
+          results_count: settings.topK,
+          documentNames: selectedDocuments,
+          includeText,
+        });
+      const queryResult = await retrieve(false);
 
       if (!queryResult.success || queryResult.relevant_chunks.length === 0) {
         throw new Error('Nessun chunk rilevante trovato');
@@ -89,28 +96,39 @@ export default function ChatPage() {
       }));
 
       // Phase 2: Generate response
-      if (settings.streamResponse) {
-        // Streaming generation
-        const controller = new AbortController();
-        setAbortController(controller);
+      const generate = async (chunks: Chunk[]) => {
+        if (settings.streamResponse) {
+          // Streaming generation
+          const controller = new AbortController();
+          setAbortController(controller);
 
-        await streamResponse(
-          {
+          await streamResponse(
+            {
+              query: text,
+              relevant_chunks: chunks,
+              model: settings.model,
+              chat_history: chatHistory,
+            },
+            controller.signal
+          );
+        } else {
+          // Non-streaming generation
+          await generateMutation.mutateAsync({
             query: text,
-            relevant_chunks: queryResult.relevant_chunks,
+            relevant_chunks: chunks,
             model: settings.model,
             chat_history: chatHistory,
-          },
-          controller.signal
-        );
-      } else {
-        // Non-streaming generation
-        await generateMutation.mutateAsync({
-          query: text,
-          relevant_chunks: queryResult.relevant_chunks,
-          model: settings.model,
-          chat_history: chatHistory,
-        });
+          });
+        }
+      };
+
+      try {
+        await generate(queryResult.relevant_chunks);
+      } catch (error) {
+        if (!(error instanceof ChunksEvictedError)) throw error;
+        // The server evicted the referenced chunks: retrieve again with the full text
+        const fullResult = await retrieve(true);
+        await generate(fullResult.relevant_chunks);
       }
     } catch (error: any) {
       if (error.name !== 'AbortError') {
@@ -11,10 +11,62 @@ import type {
   ChatQueryResponse,
   ChatGenerateRequest,
   ChatGenerateResponse,
+  ChunksEvictedResponse,
   ConfigResponse,
   PaginationParams,
+  ServerEventHandlers,
+  BulkDeleteRequest,
+  BulkDeleteProgress,
+  BulkDeleteSummary,
+  StreamMessage,
+  StreamTiming,
 } from '../types';
 
+// Generation referenced chunks the server no longer holds: retry with the full text
+export class ChunksEvictedError extends Error {
+  missingChunkIds: string[];
+
+  constructor(body: ChunksEvictedResponse) {
+    super(body.error);
+    this.name = 'ChunksEvictedError';
+    this.missingChunkIds = body.missing_chunk_ids;
+  }
+}
+
+const isChunksEvicted = (status: number | undefined, body: unknown): body is ChunksEvictedResponse =>
+  status === 409 && (body as ChunksEvictedResponse | undefined)?.code === 'chunks_evicted';
+
+// Interrupted generate streams are resumed from the last received event id
+const STREAM_MAX_RESUMES = 3;
+const STREAM_RESUME_BACKOFF_MS = 500;
+
+// Network failure or stream cut short: resumable with Last-Event-ID
+class StreamInterruptedError extends Error {
+  constructor(message: string) {
+    super(message);
+    this.name = 'StreamInterruptedError';
+  }
+}
+
+// One SSE message (lines up to a blank line): event / id / data fields
+const parseStreamMessage = (raw: string): StreamMessage => {
+  const message: StreamMessage = {};
+  for (const line of raw.split('\n')) {
+    const separator = line.indexOf(':');
+    if (separator <= 0) continue;
+    const field = line.slice(0, separator);
+    const value = line.slice(separator + 1).replace(/^ /, '');
+    if (field === 'event' || field === 'id') message[field] = value;
+    else if (field === 'data') message.data = message.data === undefined ? value : `${message.data}\n${value}`;
+  }
+  return message;
+};
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// Reconnect delay when the server refuses the events channel (matches EVENTS_RETRY_AFTER)
+const EVENTS_RECONNECT_MS = 30000;
+
 // Create axios instance
 const api: AxiosInstance = axios.create({
   baseURL: '/api',
@@ -123,14 +175,59 @@ export const apiService = {
     return response.data;
   },
 
+  // Bulk delete: the server runs the deletes concurrently and streams one NDJSON line per document
+  bulkDeleteDocuments: async (
+    data: BulkDeleteRequest,
+    onProgress?: (progress: BulkDeleteProgress) => void
+  ): Promise<BulkDeleteSummary> => {
+    const response = await fetch('/api/documents/bulk-delete', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(data),
+    });
+    if (!response.ok) {
+      const body = await response.json().catch(() => undefined);
+      throw new Error(body?.error ?? `HTTP error! status: ${response.status}`);
+    }
+    const reader = response.body?.getReader();
+    if (!reader) {
+      throw new Error('Response body is not readable');
+    }
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let summary: BulkDeleteSummary | undefined;
+    while (true) {
+      const { done, value } = await reader.read();
+      buffer += decoder.decode(value, { stream: !done });
+      const lines = buffer.split('\n');
+      buffer = done ? '' : lines.pop() ?? '';
+      for (const line of lines) {
+        if (!line.trim()) continue;
+        const progress = JSON.parse(line) as BulkDeleteProgress;
+        if (progress.type === 'done') summary = progress;
+        onProgress?.(progress);
+      }
+      if (done) break;
+    }
+    if (!summary) {
+      throw new Error('Eliminazione interrotta prima della fine');
+    }
+    return summary;
+  },
+
+  // Original file kept by the backend at upload (404 for documents uploaded elsewhere)
+  getDocumentDownloadUrl: (documentName: string): string => {
+    return `/api/documents/${documentName}/download`;
+  },
+
   queryDocumentChunks: async (
     documentName: string,
     data: ChunkQueryRequest
   ): Promise<ChunkQueryResponse> => {
-    const response = await api.post<ChunkQueryResponse>(
-      `/documents/${documentName}/chunks`,
-      data
-    );
+    // GET: the browser revalidates with If-None-Match and reuses its copy on 304
+    const response = await api.get<ChunkQueryResponse>(`/documents/${documentName}/chunks`, {
+      params: { query: data.query, resultsCount: data.results_count },
+    });
     return response.data;
   },
 
@@ -141,8 +238,48 @@ export const apiService = {
   },
 
   generateChatResponse: async (data: ChatGenerateRequest): Promise<ChatGenerateResponse> => {
-    const response = await api.post<ChatGenerateResponse>('/chat/generate', data);
-    return response.data;
+    try {
+      const response = await api.post<ChatGenerateResponse>('/chat/generate', data);
+      return response.data;
+    } catch (error) {
+      const response = (error as AxiosError).response;
+      if (isChunksEvicted(response?.status, response?.data)) {
+        throw new ChunksEvictedError(response.data as ChunksEvictedResponse);
+      }
+      throw error;
+    }
+  },
+
+  // Server events: one EventSource per page; the browser reconnects by itself with Last-Event-ID.
+  // A refused connection (503: too many subscribers on the server worker) closes the EventSource
+  // for good: retry later, callers poll meanwhile
+  subscribeEvents: (
+    handlers: ServerEventHandlers,
+    onConnectionChange?: (connected: boolean) => void
+  ): (() => void) => {
+    let source: EventSource | undefined;
+    let retryTimer: ReturnType<typeof setTimeout> | undefined;
+    const connect = () => {
+      source = new EventSource('/api/events');
+      for (const [event, handler] of Object.entries(handlers)) {
+        if (!handler) continue;
+        source.addEventListener(event, (message) => {
+          (handler as (data: unknown) => void)(JSON.parse((message as MessageEvent).data));
+        });
+      }
+      source.onopen = () => onConnectionChange?.(true);
+      source.onerror = () => {
+        onConnectionChange?.(false);
+        if (source?.readyState === EventSource.CLOSED) {
+          retryTimer = setTimeout(connect, EVENTS_RECONNECT_MS);
+        }
+      };
+    };
+    connect();
+    return () => {
+      clearTimeout(retryTimer);
+      source?.close();
+    };
   },
 
   // Streaming endpoint URL
@@ -150,88 +287,123 @@ export const apiService = {
     return '/api/chat/generate-stream';
   },
 
-  // Helper for streaming with fetch
+  // Helper for streaming with fetch: buffers partial lines across reads and, when the connection
+  // drops (or the server cuts a slow client), resumes from the last event id instead of regenerating
   streamChatResponse: async (
     data: ChatGenerateRequest,
     onChunk: (text: string) => void,
     onDone: () => void,
     onError: (error: Error) => void,
-    signal?: AbortSignal
+    signal?: AbortSignal,
+    onReset?: () => void,
+    onTiming?: (timing: StreamTiming) => void
   ): Promise<void> => {
-    try {
-      console.log('Fetch a /api/chat/generate-stream con:', {
-        chunks: data.relevant_chunks.length,
-        model: data.model,
-        query_length: data.query.length
-      });
-      
+    let lastEventId: string | undefined;
+    let resumes = 0;
+
+    // One connection; returns true once `done` arrives
+    const readStream = async (): Promise<boolean> => {
       const response = await fetch('/api/chat/generate-stream', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          ...(lastEventId ? { 'Last-Event-ID': lastEventId } : {}),
         },
         body: JSON.stringify(data),
         signal,
+      }).catch((error: unknown) => {
+        if (error instanceof TypeError) throw new StreamInterruptedError(error.message);
+        throw error;
       });
 
-      console.log('Risposta fetch:', response.status, response.statusText);
-      
       if (!response.ok) {
+        const body = await response.json().catch(() => undefined);
+        if (isChunksEvicted(response.status, body)) {
+          throw new ChunksEvictedError(body);
+        }
+        if (response.status === 404 && body?.code === 'stream_not_found' && lastEventId) {
+          // Stream expired on the server: start over with a fresh generation
+          console.warn('Stream non più disponibile, nuova generazione');
+          lastEventId = undefined;
+          onReset?.();
+          throw new StreamInterruptedError(body.error);
+        }
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
       const reader = response.body?.getReader();
-      const decoder = new TextDecoder();
-
       if (!reader) {
         throw new Error('Response body is not readable');
       }
+      const decoder = new TextDecoder();
+      let buffer = '';
 
-      console.log('Inizio lettura dello stream...');
-      let totalChunks = 0;
-      
-      while (true) {
-        const { done, value } = await reader.read();
-        
-        console.log('Reader read:', { done, valueLength: value?.length });
-        
-        if (done) {
-          console.log('Stream completato, totale chunks ricevuti:', totalChunks);
-          break;
-        }
+      try {
+        while (true) {
+          const { done, value } = await reader.read().catch((error: unknown) => {
+            if (error instanceof TypeError) throw new StreamInterruptedError(error.message);
+            throw error;
+          });
+          if (done) {
+            throw new StreamInterruptedError('Stream terminato senza segnale done');
+          }
 
-        const chunk = decoder.decode(value);
-        console.log('Chunk decodificato:', chunk.substring(0, 100));
-        const lines = chunk.split('\n');
+          buffer += decoder.decode(value, { stream: true });
+          let boundary: number;
+          while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const message = parseStreamMessage(buffer.slice(0, boundary));
+            buffer = buffer.slice(boundary + 2);
+            if (message.id) lastEventId = message.id;
+            if (message.data === undefined) continue;
 
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
-            const data = line.slice(6);
-            console.log('Parsing data:', data.substring(0, 50));
+            let parsed;
             try {
-              const parsed = JSON.parse(data);
-              if (parsed.done) {
-                console.log('Ricevuto segnale done');
-                onDone();
-              } else if (parsed.text) {
-                console.log('Ricevuto testo:', parsed.text.substring(0, 30));
-                totalChunks++;
-                onChunk(parsed.text);
-              } else if (parsed.error) {
-                console.error('Ricevuto errore:', parsed.error);
-                throw new Error(parsed.error);
-              }
+              parsed = JSON.parse(message.data);
             } catch (e) {
-              console.warn('Errore parsing JSON:', e, 'Data:', data.substring(0, 50));
-              // Skip invalid JSON
+              console.warn('Errore parsing JSON:', e, 'Data:', message.data.substring(0, 50));
+              continue;
+            }
+            if (message.event === 'timing') {
+              console.debug('Tempi dello stream (ms):', parsed);
+              onTiming?.(parsed);
+            } else if (message.event === 'stream') {
+              console.debug('Stream avviato:', parsed.stream_id);
+            } else if (parsed.done) {
+              onDone();
+              return true;
+            } else if (parsed.text) {
+              onChunk(parsed.text);
+            } else if (parsed.error) {
+              if (parsed.code === 'slow_client' && lastEventId) {
+                throw new StreamInterruptedError(parsed.error);
+              }
+              throw new Error(parsed.error);
             }
           }
         }
+      } finally {
+        reader.cancel().catch(() => undefined);
+      }
+    };
+
+    try {
+      console.log('Fetch a /api/chat/generate-stream con:', {
+        chunks: data.relevant_chunks.length,
+        model: data.model,
+        query_length: data.query.length
+      });
+      while (true) {
+        try {
+          if (await readStream()) return;
+        } catch (error) {
+          if (!(error instanceof StreamInterruptedError) || signal?.aborted || resumes >= STREAM_MAX_RESUMES) {
+            throw error;
+          }
+          resumes++;
+          console.warn(`Stream interrotto (${error.message}), ripresa da ${lastEventId ?? 'inizio'} (tentativo ${resumes})`);
+          await sleep(STREAM_RESUME_BACKOFF_MS * 2 ** (resumes - 1));
+        }
       }
-      
-      // Se arriviamo qui senza aver ricevuto done, chiamalo comunque
-      console.log('Fine loop, chiamata onDone');
-      onDone();
     } catch (error) {
       console.error('Errore in streamChatResponse:', error);
       onError(error as Error);
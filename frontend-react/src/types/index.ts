@@ -18,10 +18,23 @@ export interface Document {
   metadata?: Record<string, string>;
 }
 
+// Metadata filters: value, alternatives (OR) or numeric range; different keys are ANDed
+export type MetadataFilters = Record<
+  string,
+  string | number | Array<string | number> | { gt?: number; gte?: number; lt?: number; lte?: number }
+>;
+
+// Facet counts per metadata key/value
+export type DocumentFacets = Record<string, Record<string, number>>;
+
 export interface DocumentsResponse {
   success: boolean;
   documents: Document[];
   nextPageToken?: string;
+  store?: string;
+  facets?: DocumentFacets;
+  totalCount?: number;
+  filter?: string;
 }
 
 // Upload Types
@@ -67,6 +80,61 @@ export interface OperationResponse {
   };
 }
 
+// Server Events (/api/events)
+export interface OperationEvent {
+  name: string;
+  done: boolean;
+  displayName?: string | null;
+  document?: string;
+  expired?: boolean;
+  error?: {
+    code: number;
+    message: string;
+  };
+}
+
+export interface DocumentEvent {
+  name: string | null;
+  displayName?: string | null;
+  // Bulk delete: one event for all deleted documents
+  names?: string[];
+  count?: number;
+  generation: number;
+}
+
+// POST /api/documents/bulk-delete: explicit names or a metadata filter
+export interface BulkDeleteRequest {
+  names?: string[];
+  filters?: Record<string, unknown>;
+  stores?: string[];
+}
+
+export type BulkDeleteStatus = 'deleted' | 'missing' | 'failed' | 'skipped';
+
+// NDJSON progress lines
+export type BulkDeleteProgress =
+  | { type: 'start'; total: number; concurrency: number }
+  | {
+      type: 'item';
+      name: string;
+      status: BulkDeleteStatus;
+      latency_ms: number;
+      completed: number;
+      total: number;
+      error?: string;
+      retry_after?: number;
+    }
+  | ({ type: 'done'; total: number; duration_ms: number } & Record<BulkDeleteStatus, number>);
+
+export type BulkDeleteSummary = Extract<BulkDeleteProgress, { type: 'done' }>;
+
+export interface ServerEventHandlers {
+  operation?: (event: OperationEvent) => void;
+  document_added?: (event: DocumentEvent) => void;
+  document_deleted?: (event: DocumentEvent) => void;
+  resync?: () => void;
+}
+
 // Chunk Types
 export interface Chunk {
   chunk?: {
@@ -80,6 +148,12 @@ export interface Chunk {
   };
   chunkRelevanceScore?: number;
   source_document?: string;
+  // /api/chat/query format: full text, or only id + preview with includeText: false
+  chunkText?: string;
+  chunkId?: string;
+  chunkPreview?: string;
+  sourceDocument?: string;
+  sourceStore?: string;
   document?: {
     name?: string;
     displayName?: string;
@@ -113,16 +187,36 @@ export interface ChatQueryRequest {
   query: string;
   document_name?: string;
   results_count?: number;
+  stores?: string[];
+  // Restricts retrieval to these documents (one :query per document on the server)
+  documentNames?: string[];
+  filters?: MetadataFilters;
+  // false: chunks come back as chunkId + chunkPreview, the text stays in the server chunk store
+  includeText?: boolean;
+}
+
+export interface StoreSearchResult {
+  store: string;
+  status: 'ok' | 'timeout' | 'error';
+  latency_ms: number;
+  chunks: number;
+  error?: string;
 }
 
 export interface ChatQueryResponse {
   success: boolean;
   relevant_chunks: Chunk[];
   query: string;
+  stores?: StoreSearchResult[];
+  documents?: Array<Omit<StoreSearchResult, 'store'> & { document: string }>;
+  partial?: boolean;
+  filter?: string;
+  documents_matched?: number;
 }
 
 export interface ChatGenerateRequest {
   query: string;
+  // Chunks with text or references (chunkId) to the server chunk store
   relevant_chunks: Chunk[];
   model?: string;
   chat_history?: Array<{ role: string; text: string }>;
@@ -133,6 +227,37 @@ export interface ChatGenerateResponse {
   response: string;
   chunks_used: number;
   chunks_filtered: Chunk[];
+  context_selection?: ContextSelection;
+}
+
+// 409 from generate(-stream) when referenced chunks were evicted from the server chunk store
+export interface ChunksEvictedResponse {
+  success: false;
+  error: string;
+  code: 'chunks_evicted';
+  missing_chunk_ids: string[];
+}
+
+// Frame SSE di /api/chat/generate-stream: id "<stream>:<seq>" per riprendere con Last-Event-ID
+export interface StreamMessage {
+  event?: string;
+  id?: string;
+  data?: string;
+}
+
+// Evento `timing` alla fine dello stream (millisecondi)
+export type StreamTiming = Record<string, number | null>;
+
+// Selezione dei chunk per la generazione (reranking locale o soglia fissa)
+export interface ContextSelection {
+  selection: 'rerank' | 'threshold';
+  chunks_received: number;
+  chunks_used: number;
+  duplicates_dropped: number;
+  context_tokens: number;
+  context_tokens_threshold: number;
+  context_tokens_saved: number;
+  ms: number;
 }
 
 // Config Types
@@ -165,4 +290,7 @@ export interface Notification {
 export interface PaginationParams {
   pageSize?: number;
   pageToken?: string;
+  facets?: boolean;
+  // JSON-encoded MetadataFilters: the list is then served from the server-side mirror
+  filters?: string;
 }